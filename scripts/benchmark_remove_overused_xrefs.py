@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Benchmark babel_utils.remove_overused_xrefs() and remove_overused_xrefs_from_table() against the dictionary-based
+implementation they replaced.
+
+This generates random UNII -> PUBCHEM.COMPOUND xref pairs, with enough collisions that some objects and subjects are
+overused, and times all three implementations on them, checking that they return the same pairs. The builders now read
+their concords with concords.read_concord_pair_table() and call remove_overused_xrefs_from_table(), so the pairs are
+also given to it as a PyArrow table (building the table isn't included in its time).
+
+For example:
+    python scripts/benchmark_remove_overused_xrefs.py --pairs 1000000 5000000
+
+On one development machine, this gave:
+    pairs       bothways   dictionaries   remove_overused_xrefs()   remove_overused_xrefs_from_table()   pairs kept
+    1,000,000   no         6.18s          1.71s                     1.65s                                607,612
+    1,000,000   yes        6.52s          2.56s                     3.03s                                368,194
+    5,000,000   no         36.40s         21.83s                    9.90s                                3,031,338
+    5,000,000   yes        56.57s         34.64s                    15.50s                               1,837,499
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+import pyarrow as pa
+
+# Allow this script to be run from anywhere.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.babel_utils import remove_overused_xrefs, remove_overused_xrefs_from_table  # noqa: E402
+
+
+def remove_overused_xrefs_with_dicts(pairlist, bothways=False):
+    """The original dictionary-based implementation of remove_overused_xrefs()."""
+    xref_counts_v = defaultdict(int)
+    xref_counts_k = defaultdict(int)
+    for k, v in pairlist:
+        xref_counts_v[v] += 1
+        xref_counts_k[k] += 1
+    return [(k, v) for k, v in pairlist if xref_counts_v[v] < 2 and (not bothways or xref_counts_k[k] < 2)]
+
+
+def make_pairs(count, seed):
+    """
+    Generate `count` random xref pairs. Identifiers are drawn from a range twice as large as the number of pairs, so
+    about 40% of the pairs share their object with another pair.
+    """
+    rng = random.Random(seed)
+    return [[f"UNII:{rng.randrange(2 * count):010d}", f"PUBCHEM.COMPOUND:{rng.randrange(2 * count)}"]
+            for _ in range(count)]
+
+
+def time_function(function, pairs, bothways):
+    gc.collect()
+    start = time.perf_counter()
+    result = function(pairs, bothways=bothways)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, nargs='+', default=[1_000_000, 5_000_000],
+                        help='The numbers of pairs to benchmark')
+    parser.add_argument('--seed', type=int, default=1234, help='The random seed to generate pairs with')
+    args = parser.parse_args()
+
+    for count in args.pairs:
+        pairs = make_pairs(count, args.seed)
+        table = pa.table({'subject': [subject for subject, _ in pairs], 'object': [obj for _, obj in pairs]})
+        for bothways in [False, True]:
+            expected, dict_seconds = time_function(remove_overused_xrefs_with_dicts, pairs, bothways)
+            result, seconds = time_function(remove_overused_xrefs, pairs, bothways)
+            if result != expected:
+                raise RuntimeError(f"remove_overused_xrefs() returned different pairs for {count:,} pairs "
+                                   f"(bothways={bothways})")
+            del result
+            table_result, table_seconds = time_function(remove_overused_xrefs_from_table, table, bothways)
+            if list(zip(table_result.column('subject').to_pylist(), table_result.column('object').to_pylist())) != expected:
+                raise RuntimeError(f"remove_overused_xrefs_from_table() returned different pairs for {count:,} pairs "
+                                   f"(bothways={bothways})")
+            print(f"{count:,} pairs, bothways={bothways}: dictionaries {dict_seconds:.2f}s, "
+                  f"remove_overused_xrefs() {seconds:.2f}s, remove_overused_xrefs_from_table() {table_seconds:.2f}s, "
+                  f"kept {len(expected):,} pairs")
+        del pairs, table
+
+
+if __name__ == '__main__':
+    main()
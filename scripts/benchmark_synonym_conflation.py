@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Benchmark synonym conflation on a single large conflation group.
+
+DrugChemical conflation can put tens of thousands of RXCUI cliques into a single conflated clique, which is the worst
+case for src/synonyms/synonymconflation.py. This script generates a compendium, a conflation file and a synonym file
+for one conflation group of N cliques (each with its own synonyms) in a temporary directory, and times
+conflate_synonyms() on them for every N.
+
+It only uses conflate_synonyms(), so it can be used to compare revisions, e.g.:
+    python scripts/benchmark_synonym_conflation.py --sizes 2500 5000 10000
+    git checkout <older revision> -- src/synonyms/synonymconflation.py
+    python scripts/benchmark_synonym_conflation.py --sizes 2500 5000 10000
+
+For example, on one development machine (running both revisions one after the other), incremental per-group
+conflation (ConflatedSynonymGroup) took:
+    N        before   after
+    2,500    7.45s    0.30s
+    5,000    24.89s   0.45s
+    10,000   88.52s   1.05s
+    20,000   -        1.89s
+    40,000   -        3.88s
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+# Allow this script to be run from anywhere.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.synonyms.synonymconflation import conflate_synonyms  # noqa: E402
+
+
+def write_inputs(directory, size):
+    """
+    Write the input files for a single conflation group of `size` RXCUI cliques.
+
+    :return: A tuple of (synonyms filename, compendium filename, conflation filename).
+    """
+    compendium = os.path.join(directory, 'Drug.txt')
+    with open(compendium, 'w') as outf:
+        for i in range(size):
+            outf.write(json.dumps({'type': 'biolink:Drug', 'identifiers': [{'i': f'RXCUI:{i}'}]}) + '\n')
+
+    conflation = os.path.join(directory, 'DrugChemical.txt')
+    with open(conflation, 'w') as outf:
+        outf.write(json.dumps([f'RXCUI:{i}' for i in range(size)]) + '\n')
+
+    synonyms = os.path.join(directory, 'Drug.txt.gz')
+    with gzip.open(synonyms, 'wt') as outf:
+        for i in range(size):
+            names = [f'drug {i}', f'drug {i} 10 mg', 'drug']
+            outf.write(json.dumps({
+                'curie': f'RXCUI:{i}',
+                'names': names,
+                'types': ['Drug', 'OntologyClass'],
+                'preferred_name': names[0],
+                'shortest_name_length': 4,
+                'clique_identifier_count': 1,
+                'taxa': [],
+            }) + '\n')
+    return synonyms, compendium, conflation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2500, 5000, 10000, 20000, 40000],
+                        help='The number of cliques in the conflation group to benchmark')
+    parser.add_argument('--log-file', default=os.devnull,
+                        help='Where to write the log messages from conflate_synonyms() (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Log messages are still formatted and written (as they would be in a build), just not to the terminal.
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.FileHandler(args.log_file))
+    root_logger.setLevel(logging.INFO)
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            synonyms, compendium, conflation = write_inputs(directory, size)
+            output = os.path.join(directory, 'output.txt.gz')
+            start = time.perf_counter()
+            conflate_synonyms([synonyms], [compendium], [conflation], output)
+            elapsed = time.perf_counter() - start
+        print(f"N={size:,}: {elapsed:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
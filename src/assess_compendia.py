@@ -1,8 +1,7 @@
 import os
 from os import path
 import jsonlines
-from collections import defaultdict
-from src.util import Text
+from src.reports.compendium_scanner import scan_compendium, ClusterReportAccumulator
 
 #TODO: Assess whether we are bringing in any new identifiers (we shouldn't, unless we just don't have id's for a thing)
 def assess_completeness(input_dir,compendia,reportfile):
@@ -29,24 +28,17 @@ def assess_completeness(input_dir,compendia,reportfile):
         for missing_id in l:
             outf.write(f'{missing_id}\n')
 
-def makecountset(j):
-    eids = [Text.get_curie(x['i']) for x in j['identifiers']]
-    pcounts = defaultdict(int)
-    for p in eids:
-        pcounts[p] += 1
-    return frozenset( [(k,v)  for k,v in pcounts.items()] )
+def assess(compendium,reportfile,workers=1):
+    """Write a report of the number of clusters in a compendium, their sizes and their cluster types (the number of
+    identifiers with each prefix)."""
+    clusters, = scan_compendium(compendium, [ClusterReportAccumulator], workers=workers)
+    write_cluster_report(clusters, reportfile)
 
-
-def assess(compendium,reportfile):
-    nclusters =  0
-    clustersizes = defaultdict(int)
-    clustertypes = defaultdict(int)
-    with jsonlines.open(compendium,'r') as inf:
-        for j in inf:
-            nclusters += 1
-            clustersizes[ len(j['identifiers']) ] += 1
-            countset = makecountset(j)
-            clustertypes[countset] += 1
+def write_cluster_report(clusters, reportfile):
+    """Write out the report for a ClusterReportAccumulator."""
+    nclusters = clusters.nclusters
+    clustersizes = clusters.clustersizes
+    clustertypes = clusters.clustertypes
     with open(reportfile,'w') as outf:
         outf.write(f'{nclusters} clusters\n')
         sizes = list(clustersizes.keys())
@@ -59,4 +51,4 @@ def assess(compendium,reportfile):
         ct.sort()
         outf.write('\nCluster Type Distribution\n')
         for v,k in ct:
-            outf.write(f'{k}\t{v}\n')
\ No newline at end of file
+            outf.write(f'{k}\t{v}\n')
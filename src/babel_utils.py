@@ -1,5 +1,9 @@
+import itertools
+import multiprocessing
+import shutil
 import subprocess
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from ftplib import FTP
 from io import BytesIO
@@ -9,22 +13,37 @@ from datetime import timedelta
 import time
 import requests
 import os
-import urllib
-import jsonlines
+import urllib.parse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import yaml
 from humanfriendly import format_timespan
 
+from src.downloads import DOWNLOAD_BLOCK_SIZE, get_download_manager, list_ftp_directory
 from src.metadata.provenance import write_combined_metadata
 from src.node import NodeFactory, SynonymFactory, DescriptionFactory, InformationContentFactory, TaxonFactory
 from src.properties import PropertyList, HAS_ALTERNATIVE_ID
 from src.util import Text, get_config, get_memory_usage_summary, get_logger
 from src.LabeledID import LabeledID
+from src.json_codec import JSONLWriter, dumps_line, loads
+from src.incremental_glom import IncrementalGlom
+from src.unionfind import UnionFind
 from collections import defaultdict
+from operator import itemgetter
 import sqlite3
 from typing import List, Tuple
 
 # Configuration items
 WRITE_COMPENDIUM_LOG_EVERY_X_CLIQUES = 1_000_000
+# When writing a compendium in parallel, how many shards should we give each worker? Using more than one shard per
+# worker evens out the load when some parts of the clique list are slower to process than others.
+WRITE_COMPENDIUM_SHARDS_PER_WORKER = 4
+# Don't bother with parallel processing unless every worker will have at least this many cliques to process.
+WRITE_COMPENDIUM_MIN_CLIQUES_PER_SHARD = 10_000
+# How many cliques should write_compendium() prefetch taxa for at a time?
+WRITE_COMPENDIUM_TAXA_PREFETCH_CLIQUES = 10_000
 
 # Set up a logger.
 logger = get_logger(__name__)
@@ -68,13 +87,13 @@ def pull_via_ftp(ftpsite, ftpdir, ftpfile, decompress_data=False, outfilename=No
     """Retrieve data via ftp.
     Setting decompress=True will ungzip the data
     If outfilename is None (default) then the data will be returned.
-    Otherwise it will be written to the downloads directory."""
-    ftp = FTP(ftpsite)
-    ftp.login()
-    ftp.cwd(ftpdir)
-    print('   getting data')
+    Otherwise it will be written to the downloads directory, using the download manager (see src/downloads.py)."""
     config = get_config()
     if outfilename is None:
+        ftp = FTP(ftpsite)
+        ftp.login()
+        ftp.cwd(ftpdir)
+        print('   getting data')
         with BytesIO() as data:
             ftp.retrbinary(f'RETR {ftpfile}', data.write)
             ftp.quit()
@@ -84,22 +103,19 @@ def pull_via_ftp(ftpsite, ftpdir, ftpfile, decompress_data=False, outfilename=No
             else:
                 return binary.decode()
     ofilename = os.path.join(config['download_directory'],outfilename)
-    odir = os.path.abspath(os.path.dirname(ofilename))
-    if not os.path.exists(odir):
-        os.makedirs(odir)
-    print(f'  writing data to {ofilename}')
-    print(f'{ftpsite}/{ftpdir}/{ftpfile}')
+    url = f"ftp://{ftpsite}/{ftpdir.strip('/')}/{ftpfile}"
+    print(f'  writing data from {url} to {ofilename}')
     if not decompress_data:
-        with open(ofilename,'wb') as ofile:
-            ftp.retrbinary(f'RETR {ftpfile}', ofile.write)
-            ftp.quit()
+        get_download_manager().download(url, ofilename)
     else:
-        with BytesIO() as data:
-            ftp.retrbinary(f'RETR {ftpfile}', data.write)
-            ftp.quit()
-            value = gzip.decompress(data.getvalue()).decode()
-        with open(ofilename,'w') as ofile:
-            ofile.write(value)
+        compressed_filename = get_download_manager().download(url, ofilename + '.gz')
+        with gzip.open(compressed_filename, 'rb') as compressed_file, open(ofilename, 'wb') as ofile:
+            shutil.copyfileobj(compressed_file, ofile, DOWNLOAD_BLOCK_SIZE)
+        # Don't keep a compressed copy next to the decompressed file (along with its download manifest): it would only
+        # save us a download next time, at the cost of twice the disk space.
+        os.remove(compressed_filename)
+        if os.path.exists(compressed_filename + '.download.json'):
+            os.remove(compressed_filename + '.download.json')
     return ofilename
 
 def dump_dict(outdict,outfname):
@@ -159,7 +175,8 @@ class ThrottledRequester:
 
 def pull_via_urllib(url: str, in_file_name: str, decompress = True, subpath=None):
     """
-    Retrieve files via urllib, optionally decompresses it, and writes it locally into downloads
+    Retrieve files via the download manager (see src/downloads.py), optionally decompresses it, and writes it locally
+    into downloads
     url: str - the url with the correct version attached
     in_file_name: str - the name of the target file to work
     returns: str - the output file name
@@ -174,37 +191,15 @@ def pull_via_urllib(url: str, in_file_name: str, decompress = True, subpath=None
     else:
         dl_file_name = os.path.join(download_dir,subpath,in_file_name)
 
-    # Add support for redirects
-    opener = urllib.request.build_opener(urllib.request.HTTPRedirectHandler())
-
-    # get a handle to the ftp file
     print(url+in_file_name)
-    handle = opener.open(url + in_file_name)
-
-    # create the compressed file
-    with open(dl_file_name, 'wb') as compressed_file:
-        # while there is data
-        while True:
-            # read a block of data
-            data = handle.read(1024)
-
-            # fif nothing read about
-            if len(data) == 0:
-                break
-
-            # write out the data to the output file
-            compressed_file.write(data)
+    get_download_manager().download(url + in_file_name, dl_file_name)
 
     if decompress:
         out_file_name = dl_file_name[:-3]
 
-        # create the output text file
-        with open(out_file_name, 'w') as output_file:
-            # open the compressed file
-            with gzip.open(dl_file_name, 'rt') as compressed_file:
-                for line in compressed_file:
-                    # write the data to the output file
-                    output_file.write(line)
+        # decompress the file into the output file
+        with gzip.open(dl_file_name, 'rb') as compressed_file, open(out_file_name, 'wb') as output_file:
+            shutil.copyfileobj(compressed_file, output_file, DOWNLOAD_BLOCK_SIZE)
 
         #remove the compressed file
         os.remove(dl_file_name)
@@ -234,8 +229,9 @@ def pull_via_wget(
         recurse:WgetRecursionOptions = WgetRecursionOptions.NO_RECURSION,
         retries:int=10):
     """
-    Download a file using wget. We call wget from the command line, and use command line options to
-    request continuing incomplete downloads.
+    Download a file (or a directory) the way wget would. Single files and FTP directories are downloaded by the download
+    manager (see src/downloads.py); for HTTP directories, we call wget from the command line, and use command line
+    options to request continuing incomplete downloads.
 
     :param url_prefix: The URL prefix to download.
     :param in_file_name: The filename to download -- this will be concatenated to the URL prefix. This should include
@@ -261,38 +257,56 @@ def pull_via_wget(
     else:
         dl_file_name = os.path.join(download_dir, in_file_name)
 
-    # Prepare wget options.
-    wget_command_line = [
-        'wget',
-        '--progress=bar:force:noscroll',
-    ]
-    if continue_incomplete:
-        wget_command_line.append('--continue')
-    if timestamping:
-        wget_command_line.append('--timestamping')
-    if retries > 0:
-        wget_command_line.append(f'--tries={retries}')
-
-    # Add URL and output file.
-    wget_command_line.append(url)
-
-    # Handle recursion options
-    match recurse:
-        case WgetRecursionOptions.NO_RECURSION:
-            # Write to a single file, dl_file_name
-            wget_command_line.extend(['-O', dl_file_name])
-        case WgetRecursionOptions.RECURSE_SUBFOLDERS:
-            # dl_file_name should be a directory name.
-            wget_command_line.extend(['--recursive', '--no-parent', '--no-directories', '--directory-prefix=' + dl_file_name])
-        case WgetRecursionOptions.RECURSE_DIRECTORY_ONLY:
-            # dl_file_name should be a directory name.
-            wget_command_line.extend(['--recursive', '--no-parent', '--no-directories', '--level=1', '--directory-prefix=' + dl_file_name])
-
-    # Execute wget.
-    logger.info(f"Downloading {dl_file_name} using wget: {wget_command_line}")
-    process = subprocess.run(wget_command_line)
-    if process.returncode != 0:
-        raise RuntimeError(f"Could not execute wget {wget_command_line}: {process.stderr}")
+    # Single files and FTP directories are downloaded by the download manager (see src/downloads.py), which downloads
+    # them in parallel and can resume interrupted downloads. We still use wget to mirror HTTP directories.
+    if recurse == WgetRecursionOptions.NO_RECURSION or url.startswith('ftp://'):
+        if recurse == WgetRecursionOptions.NO_RECURSION:
+            downloads = [(url, dl_file_name)]
+        else:
+            # Like wget's --no-directories, we download every file into dl_file_name.
+            file_urls = list_ftp_directory(url, recursive=(recurse == WgetRecursionOptions.RECURSE_SUBFOLDERS))
+            os.makedirs(dl_file_name, exist_ok=True)
+            downloads = [(file_url, os.path.join(dl_file_name, os.path.basename(urllib.parse.urlparse(file_url).path)))
+                         for file_url in file_urls]
+        if not continue_incomplete:
+            for _, filename in downloads:
+                if os.path.exists(filename + '.part'):
+                    os.remove(filename + '.part')
+        logger.info(f"Downloading {len(downloads)} files from {url} to {dl_file_name} using the download manager.")
+        get_download_manager().download_all(downloads, force=not timestamping, retries=retries)
+    else:
+        # Prepare wget options.
+        wget_command_line = [
+            'wget',
+            '--progress=bar:force:noscroll',
+        ]
+        if continue_incomplete:
+            wget_command_line.append('--continue')
+        if timestamping:
+            wget_command_line.append('--timestamping')
+        if retries > 0:
+            wget_command_line.append(f'--tries={retries}')
+
+        # Add URL and output file.
+        wget_command_line.append(url)
+
+        # Handle recursion options
+        match recurse:
+            case WgetRecursionOptions.NO_RECURSION:
+                # Write to a single file, dl_file_name
+                wget_command_line.extend(['-O', dl_file_name])
+            case WgetRecursionOptions.RECURSE_SUBFOLDERS:
+                # dl_file_name should be a directory name.
+                wget_command_line.extend(['--recursive', '--no-parent', '--no-directories', '--directory-prefix=' + dl_file_name])
+            case WgetRecursionOptions.RECURSE_DIRECTORY_ONLY:
+                # dl_file_name should be a directory name.
+                wget_command_line.extend(['--recursive', '--no-parent', '--no-directories', '--level=1', '--directory-prefix=' + dl_file_name])
+
+        # Execute wget.
+        logger.info(f"Downloading {dl_file_name} using wget: {wget_command_line}")
+        process = subprocess.run(wget_command_line)
+        if process.returncode != 0:
+            raise RuntimeError(f"Could not execute wget {wget_command_line}: {process.stderr}")
 
     # Decompress the downloaded file if needed.
     uncompressed_filename = None
@@ -359,7 +373,7 @@ def get_numerical_curie_suffix(curie):
     return None
 
 
-def write_compendium(metadata_yamls, synonym_list, ofname, node_type, labels=None, extra_prefixes=None, icrdf_filename=None, properties_jsonl_gz_files=None):
+def write_compendium(metadata_yamls, synonym_list, ofname, node_type, labels=None, extra_prefixes=None, icrdf_filename=None, properties_jsonl_gz_files=None, workers=1):
     """
     :param metadata_yaml: The YAML files containing the metadata for this compendium.
     :param synonym_list:
@@ -375,6 +389,9 @@ def write_compendium(metadata_yamls, synonym_list, ofname, node_type, labels=Non
         properly specified as a prerequisite in a Snakemake file, so that write_compendium() is not run until after
         icRDF.tsv has been generated.
     :param properties_files: (OPTIONAL) A list of SQLite3 files containing properties to be added to the output.
+    :param workers: (OPTIONAL) The number of worker processes to write the compendium with. Snakemake rules that want
+        this to be more than one should reserve that many threads (e.g. `threads: config['write_compendium_workers']`)
+        and pass `workers=threads` down, so that Snakemake knows how many cores the rule uses.
     :return:
     """
     logger.info(f"Starting write_compendium({metadata_yamls}, {len(synonym_list)} slists, {ofname}, {node_type}, {len(labels)} labels, {extra_prefixes}, {icrdf_filename}, {properties_jsonl_gz_files}): {get_memory_usage_summary()}")
@@ -385,36 +402,15 @@ def write_compendium(metadata_yamls, synonym_list, ofname, node_type, labels=Non
         labels = {}
     config = get_config()
     cdir = config['output_directory']
-    biolink_version = config['biolink_version']
-
-    node_factory = NodeFactory(make_local_name(''),biolink_version)
-    logger.info(f"NodeFactory ready: {node_factory} with {get_memory_usage_summary()}")
-    synonym_factory = SynonymFactory(make_local_name(''))
-    logger.info(f"SynonymFactory ready: {synonym_factory} with {get_memory_usage_summary()}")
-
-    # Load the preferred_name_boost_prefixes -- this tells us which prefixes to boost when
-    # coming up with a preferred label for a particular Biolink class.
-    preferred_name_boost_prefixes = config['preferred_name_boost_prefixes']
 
-    # Create an InformationContentFactory based on the specified icRDF.tsv file. Default to the one in the download
-    # directory.
     if not icrdf_filename:
         raise RuntimeError("No icrdf_filename parameter provided to write_compendium() -- this is required!")
-    ic_factory = InformationContentFactory(icrdf_filename)
-    logger.info(f"InformationContentFactory ready: {ic_factory} with {get_memory_usage_summary()}")
-
-    description_factory = DescriptionFactory(make_local_name(''))
-    logger.info(f"DescriptionFactory ready: {description_factory} with {get_memory_usage_summary()}")
-
-    taxon_factory = TaxonFactory(make_local_name(''))
-    logger.info(f"TaxonFactory ready: {taxon_factory} with {get_memory_usage_summary()}")
-
-    node_test = node_factory.create_node(input_identifiers=[],node_type=node_type,labels={},extra_prefixes = extra_prefixes)
-    logger.info(f"NodeFactory test complete: {node_test} with {get_memory_usage_summary()}")
 
     # Create compendia and synonyms directories, just in case they haven't been created yet.
     os.makedirs(os.path.join(cdir, 'compendia'), exist_ok=True)
     os.makedirs(os.path.join(cdir, 'synonyms'), exist_ok=True)
+    compendium_filename = os.path.join(cdir, 'compendia', ofname)
+    synonyms_filename = os.path.join(cdir, 'synonyms', ofname)
 
     # Load all the properties.
     property_list = PropertyList()
@@ -427,6 +423,101 @@ def write_compendium(metadata_yamls, synonym_list, ofname, node_type, labels=Non
     else:
         logger.info("No property files provided or loaded.")
 
+    workers = int(workers or 1)
+    if workers > 1 and len(synonym_list) >= workers * WRITE_COMPENDIUM_MIN_CLIQUES_PER_SHARD:
+        counts = write_compendium_in_parallel(workers, synonym_list, ofname, compendium_filename, synonyms_filename,
+                                              node_type, labels, extra_prefixes, icrdf_filename, property_list)
+    else:
+        counts = write_compendium_cliques(synonym_list, ofname, compendium_filename, synonyms_filename,
+                                          node_type, labels, extra_prefixes, icrdf_filename, property_list)
+
+    # Write out the metadata.yaml file combining information from all the metadata.yaml files.
+    write_combined_metadata(
+        os.path.join(cdir, 'metadata', ofname + '.yaml'),
+        typ='compendium',
+        name=ofname,
+        counts={
+            'cliques': counts['cliques'],
+            'eq_ids': counts['eq_ids'],
+            'synonyms': counts['synonyms'],
+            'property_sources': counts['property_sources'],
+        },
+        combined_from_filenames=metadata_yamls,
+    )
+
+
+def make_compendium_factories(icrdf_filename):
+    """
+    Set up the factories that write_compendium_cliques() uses to look up node information, synonyms, information
+    content, descriptions and taxa. These load data lazily (by prefix) and keep it, so they should be reused for as
+    many cliques as possible: write_compendium_in_parallel() sets them up once in each worker process.
+
+    :param icrdf_filename: The icRDF.tsv file to read information content values from.
+    :return: A dictionary of factories: node, synonym, ic, description and taxon.
+    """
+    biolink_version = get_config()['biolink_version']
+
+    node_factory = NodeFactory(make_local_name(''),biolink_version)
+    logger.info(f"NodeFactory ready: {node_factory} with {get_memory_usage_summary()}")
+    synonym_factory = SynonymFactory(make_local_name(''))
+    logger.info(f"SynonymFactory ready: {synonym_factory} with {get_memory_usage_summary()}")
+
+    # Create an InformationContentFactory based on the specified icRDF.tsv file.
+    ic_factory = InformationContentFactory(icrdf_filename)
+    logger.info(f"InformationContentFactory ready: {ic_factory} with {get_memory_usage_summary()}")
+
+    description_factory = DescriptionFactory(make_local_name(''))
+    logger.info(f"DescriptionFactory ready: {description_factory} with {get_memory_usage_summary()}")
+
+    taxon_factory = TaxonFactory(make_local_name(''))
+    logger.info(f"TaxonFactory ready: {taxon_factory} with {get_memory_usage_summary()}")
+
+    return {
+        'node': node_factory,
+        'synonym': synonym_factory,
+        'ic': ic_factory,
+        'description': description_factory,
+        'taxon': taxon_factory,
+    }
+
+
+def write_compendium_cliques(synonym_list, ofname, compendium_filename, synonyms_filename, node_type, labels, extra_prefixes, icrdf_filename, property_list, shard_description='', factories=None):
+    """
+    Write the compendium and synonym lines for a list of cliques. This is the inner loop of write_compendium(), and is
+    run either directly (for a single process) or once for every shard (when running in parallel).
+
+    :param synonym_list: The cliques to write.
+    :param ofname: The name of the compendium being written (used for logging).
+    :param compendium_filename: The file to write compendium lines to.
+    :param synonyms_filename: The file to write synonym lines to.
+    :param node_type: The Biolink type of these cliques.
+    :param labels: A map of identifiers to labels.
+    :param extra_prefixes: Additional prefixes to allow for this node_type.
+    :param icrdf_filename: The icRDF.tsv file to read information content values from.
+    :param property_list: A PropertyList of properties to add to the output.
+    :param shard_description: A description of the shard being written (used for logging).
+    :param factories: The factories from make_compendium_factories() to use. If None, we set up our own factories, and
+        close them once all the cliques have been written.
+    :return: A dictionary of counts: cliques, eq_ids, synonyms and property_sources.
+    """
+    config = get_config()
+
+    # Load the preferred_name_boost_prefixes -- this tells us which prefixes to boost when
+    # coming up with a preferred label for a particular Biolink class.
+    preferred_name_boost_prefixes = config['preferred_name_boost_prefixes']
+
+    close_factories = factories is None
+    if factories is None:
+        factories = make_compendium_factories(icrdf_filename)
+    node_factory = factories['node']
+    synonym_factory = factories['synonym']
+    ic_factory = factories['ic']
+    description_factory = factories['description']
+    taxon_factory = factories['taxon']
+
+    node_test = node_factory.create_node(input_identifiers=[],node_type=node_type,labels={},extra_prefixes = extra_prefixes)
+    logger.info(f"NodeFactory test complete: {node_test} with {get_memory_usage_summary()}")
+
     property_source_count = defaultdict(int)
 
     # Counts.
@@ -435,13 +526,13 @@ def write_compendium(metadata_yamls, synonym_list, ofname, node_type, labels=Non
     count_synonyms = 0
 
     # Write compendium and synonym files.
-    with jsonlines.open(os.path.join(cdir,'compendia',ofname),'w') as outf, jsonlines.open(os.path.join(cdir,'synonyms',ofname),'w') as sfile:
+    with JSONLWriter(compendium_filename) as outf, JSONLWriter(synonyms_filename) as sfile:
         # Calculate an estimated time to completion.
         start_time = time.time_ns()
         count_slist = 0
         total_slist = len(synonym_list)
 
-        for slist in synonym_list:
+        for slist in prefetch_taxa_for_cliques(synonym_list, taxon_factory):
             # Before we get started, let's estimate where we're at.
             count_slist += 1
             if (count_slist == 1) or (count_slist % WRITE_COMPENDIUM_LOG_EVERY_X_CLIQUES == 0):
@@ -452,7 +543,7 @@ def write_compendium(metadata_yamls, synonym_list, ofname, node_type, labels=Non
                 remaining_slist = total_slist - count_slist
                 # count_slist --> time_elapsed_seconds
                 # remaining_slist --> remaining_slist/count_slit*time_elapsed_seconds
-                logger.info(f"Generating compendia and synonyms for {ofname} currently at {count_slist:,} out of {total_slist:,} ({count_slist/total_slist*100:.2f}%) in {format_timespan(time_elapsed_seconds)}: {get_memory_usage_summary()}")
+                logger.info(f"Generating compendia and synonyms for {ofname}{shard_description} currently at {count_slist:,} out of {total_slist:,} ({count_slist/total_slist*100:.2f}%) in {format_timespan(time_elapsed_seconds)}: {get_memory_usage_summary()}")
                 logger.info(f" - Current rate: {count_slist/time_elapsed_seconds:.2f} cliques/second or {time_elapsed_seconds/count_slist:.6f} seconds/clique.")
 
                 time_remaining_seconds = (time_elapsed_seconds / count_slist * remaining_slist)
@@ -674,22 +765,147 @@ def write_compendium(metadata_yamls, synonym_list, ofname, node_type, labels=Non
                     traceback.print_exc()
                     raise ex
 
-    # Write out the metadata.yaml file combining information from all the metadata.yaml files.
-    write_combined_metadata(
-        os.path.join(cdir, 'metadata', ofname + '.yaml'),
-        typ='compendium',
-        name=ofname,
-        counts={
-            'cliques': count_cliques,
-            'eq_ids': count_eq_ids,
-            'synonyms': count_synonyms,
-            'property_sources': property_source_count,
-        },
-        combined_from_filenames=metadata_yamls,
+    # Close all the factories.
+    if close_factories:
+        taxon_factory.close()
+
+    return {
+        'cliques': count_cliques,
+        'eq_ids': count_eq_ids,
+        'synonyms': count_synonyms,
+        'property_sources': property_source_count,
+    }
+
+
+def prefetch_taxa_for_cliques(synonym_list, taxon_factory, batch_size=None):
+    """
+    Iterate over a list of cliques, asking the TaxonFactory to prefetch the taxa for every batch of cliques before we
+    get to them. This replaces a query per CURIE with a few batched queries per batch of cliques.
+
+    :param synonym_list: The cliques to iterate over.
+    :param taxon_factory: The TaxonFactory to prefetch taxa into.
+    :param batch_size: The number of cliques to prefetch taxa for at a time (defaults to
+        WRITE_COMPENDIUM_TAXA_PREFETCH_CLIQUES).
+    """
+    if batch_size is None:
+        batch_size = WRITE_COMPENDIUM_TAXA_PREFETCH_CLIQUES
+    cliques = iter(synonym_list)
+    while True:
+        batch = list(itertools.islice(cliques, batch_size))
+        if not batch:
+            return
+        taxon_factory.prefetch_taxa(itertools.chain.from_iterable(batch))
+        yield from batch
+
+
+# Arguments for write_compendium_shard(), set by write_compendium_in_parallel() before the worker processes are forked.
+# This allows the workers to share the (potentially very large) clique list and labels with the parent process
+# instead of having them pickled and sent over to each worker.
+_write_compendium_job = None
+
+# The factories used by write_compendium_shard() in a worker process, set up once per worker by
+# init_write_compendium_worker() so that every shard the worker writes can reuse the data they have already loaded.
+_write_compendium_worker_factories = None
+
+
+def init_write_compendium_worker():
+    """
+    Set up the factories for a write_compendium_in_parallel() worker process. This runs once in every worker process.
+    """
+    global _write_compendium_worker_factories
+    _write_compendium_worker_factories = make_compendium_factories(_write_compendium_job['icrdf_filename'])
+
+
+def write_compendium_shard(shard_index, start, end):
+    """
+    Write a single shard of the cliques set up by write_compendium_in_parallel(). This runs in a worker process.
+
+    :return: The counts returned by write_compendium_cliques().
+    """
+    job = _write_compendium_job
+    return write_compendium_cliques(
+        job['synonym_list'][start:end],
+        job['ofname'],
+        get_shard_filename(job['compendium_filename'], shard_index),
+        get_shard_filename(job['synonyms_filename'], shard_index),
+        job['node_type'],
+        job['labels'],
+        job['extra_prefixes'],
+        job['icrdf_filename'],
+        job['property_list'],
+        shard_description=f" (shard {shard_index + 1:,} of {job['shard_count']:,}, cliques {start:,} to {end:,})",
+        factories=_write_compendium_worker_factories,
     )
 
-    # Close all the factories.
-    taxon_factory.close()
+
+def get_shard_filename(filename, shard_index):
+    """
+    Return the filename to use for a particular shard of an output file.
+    """
+    return f"{filename}.shard-{shard_index:05d}"
+
+
+def write_compendium_in_parallel(workers, synonym_list, ofname, compendium_filename, synonyms_filename, node_type, labels, extra_prefixes, icrdf_filename, property_list):
+    """
+    Write a compendium using several worker processes.
+
+    The cliques are split into contiguous shards. Each worker process sets up its own factories once (in
+    init_write_compendium_worker()) and writes each shard it is given into separate shard files, which are then concatenated in order. Since every clique is written in
+    exactly the same way as in write_compendium_cliques(), the final compendium and synonym files are byte-identical to
+    the ones written by a single process.
+
+    :param workers: The number of worker processes to use.
+    :return: A dictionary of counts, summed across all shards.
+    """
+    global _write_compendium_job
+
+    # Sets can't be sliced, so we turn everything into a list. Iterating over a set again in the same process returns
+    # the same order, so this doesn't change the order in which cliques are written.
+    synonym_list = list(synonym_list)
+    shard_count = workers * WRITE_COMPENDIUM_SHARDS_PER_WORKER
+    shard_size = -(-len(synonym_list) // shard_count)
+    shards = []
+    for shard_index, start in enumerate(range(0, len(synonym_list), shard_size)):
+        shards.append((shard_index, start, min(start + shard_size, len(synonym_list))))
+    logger.info(f"Writing {len(synonym_list):,} cliques for {ofname} in {len(shards):,} shards with {workers} worker processes: {get_memory_usage_summary()}")
+
+    _write_compendium_job = {
+        'synonym_list': synonym_list,
+        'ofname': ofname,
+        'compendium_filename': compendium_filename,
+        'synonyms_filename': synonyms_filename,
+        'node_type': node_type,
+        'labels': labels,
+        'extra_prefixes': extra_prefixes,
+        'icrdf_filename': icrdf_filename,
+        'property_list': property_list,
+        'shard_count': len(shards),
+    }
+    try:
+        # We need to fork so that the worker processes inherit _write_compendium_job.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=init_write_compendium_worker) as executor:
+            shard_counts = list(executor.map(write_compendium_shard, *zip(*shards)))
+    finally:
+        _write_compendium_job = None
+
+    # Concatenate all the shards in order.
+    for filename in [compendium_filename, synonyms_filename]:
+        with open(filename, 'wb') as outf:
+            for shard_index, _, _ in shards:
+                shard_filename = get_shard_filename(filename, shard_index)
+                with open(shard_filename, 'rb') as shardf:
+                    shutil.copyfileobj(shardf, outf)
+                os.remove(shard_filename)
+
+    counts = {'cliques': 0, 'eq_ids': 0, 'synonyms': 0, 'property_sources': defaultdict(int)}
+    for shard_count in shard_counts:
+        for key in ['cliques', 'eq_ids', 'synonyms']:
+            counts[key] += shard_count[key]
+        for source, count in shard_count['property_sources'].items():
+            counts['property_sources'][source] += count
+    logger.info(f"Finished writing {ofname} from {len(shards):,} shards: {get_memory_usage_summary()}")
+    return counts
 
 
 def glom(conc_set, newgroups, unique_prefixes=['INCHIKEY'],pref='HP',close={}):
@@ -698,7 +914,13 @@ def glom(conc_set, newgroups, unique_prefixes=['INCHIKEY'],pref='HP',close={}):
     the keys are all of the elements in the set.   For each element in a set, there is a key
     in the dictionary that points to the set.
     newgroups is an iterable that of new equivalence groups (expressed as sets,tuples,or lists)
-    with which we want to update conc_set."""
+    with which we want to update conc_set.
+    conc_set may also be a UnionFind, in which case the merging is done by the disjoint-set backend
+    (with the same semantics) instead of by rebuilding sets, or an IncrementalGlom, which records the groups
+    to be glommed later (see src/incremental_glom.py)."""
+    if isinstance(conc_set, (UnionFind, IncrementalGlom)):
+        conc_set.glom(newgroups, unique_prefixes=unique_prefixes, pref=pref, close=close)
+        return
     n = 0
     bad = 0
     shit_prefixes=set(['KEGG','PUBCHEM'])
@@ -913,24 +1135,105 @@ def read_identifier_file(infile):
     return identifiers,types
 
 
+def format_clique(clique):
+    """Format a clique (an iterable of identifiers) as a single line of a clique list file.
+
+    Clique list files (such as untyped compendia and conflation files) contain one clique per line, as a JSON list of
+    identifiers, e.g. `["RXCUI:1092396", "RXCUI:849078", "PUBCHEM.COMPOUND:446284"]`. Unlike the Python set
+    representations we used to write, these can be parsed with a JSON parser instead of ast.literal_eval(), which is
+    much faster and uses much less memory.
+
+    :param clique: An iterable of identifiers. These are written out in the order they are provided.
+    :return: The clique as a line of text, including the trailing newline.
+    """
+    return dumps_line(list(clique))
+
+def parse_clique(line):
+    """Parse a single line of a clique list file (see format_clique()).
+
+    :return: The list of identifiers in this clique.
+    """
+    return loads(line)
+
+def read_clique_list(filename):
+    """Read a clique list file (see format_clique()).
+
+    :param filename: The clique list file to read.
+    :return: An iterator of lists of identifiers, one for each clique in the file.
+    """
+    with open(filename, 'r') as inf:
+        for line in inf:
+            if line.strip():
+                yield parse_clique(line)
+
+def write_clique_list(filename, cliques):
+    """Write a clique list file (see format_clique()).
+
+    :param filename: The clique list file to write.
+    :param cliques: An iterable of cliques, each of which is an iterable of identifiers.
+    :return: The number of cliques written.
+    """
+    count = 0
+    with open(filename, 'w') as outf:
+        for clique in cliques:
+            outf.write(format_clique(clique))
+            count += 1
+    return count
+
+
+def get_unused_xref_mask(subject_codes, object_codes, bothways: bool = False):
+    """Given integer-encoded subjects and objects of a list of xrefs (e.g. as returned by pandas.factorize()), return a
+    boolean mask of the xrefs that remove_overused_xrefs() would keep: those whose object only appears once (and, if
+    bothways is set, whose subject only appears once as well).
+
+    :param subject_codes: A NumPy array of non-negative integer codes for the subjects.
+    :param object_codes: A NumPy array of non-negative integer codes for the objects.
+    :param bothways: If True, also remove xrefs whose subject appears more than once.
+    :return: A NumPy boolean array, True for every xref that should be kept.
+    """
+    mask = np.bincount(object_codes)[object_codes] < 2
+    if bothways:
+        mask &= np.bincount(subject_codes)[subject_codes] < 2
+    return mask
+
+def factorize_arrow_column(column):
+    """Integer-encode a PyArrow array or chunked array, like pandas.factorize() but without converting its values into
+    Python objects.
+
+    :return: A NumPy array of the code for every value in the column.
+    """
+    return pc.index_in(column, value_set=pc.unique(column)).to_numpy()
+
+def remove_overused_xrefs_from_table(pairs, bothways: bool = False):
+    """Like remove_overused_xrefs(), but for a PyArrow Table with subject and object columns (such as the ones returned
+    by concords.read_concord_pair_table()). The columns are integer-encoded with PyArrow, so the pairs don't need to be
+    turned into Python strings until they have been filtered.
+
+    :return: A PyArrow Table containing the pairs to keep, in their original order.
+    """
+    if pairs.num_rows == 0:
+        return pairs
+    object_codes = factorize_arrow_column(pairs.column('object'))
+    subject_codes = None
+    if bothways:
+        subject_codes = factorize_arrow_column(pairs.column('subject'))
+    return pairs.filter(pa.array(get_unused_xref_mask(subject_codes, object_codes, bothways=bothways)))
+
 def remove_overused_xrefs(pairlist: List[Tuple], bothways:bool = False):
     """Given a list of tuples (id1, id2) meaning id1-[xref]->id2, remove any id2 that are associated with more
     than one id1.  The idea is that if e.g. id1 is made up of UBERONS and 2 of those have an xref to say a UMLS
-    then it doesn't mean that all of those should be identified.  We don't really know what it means, so remove it."""
-    xref_counts_v = defaultdict(int)
-    xref_counts_k = defaultdict(int)
-    for k, v in pairlist:
-        xref_counts_v[v] += 1
-        xref_counts_k[k] += 1
-    improved_pairs = []
-    for k,v in pairlist:
-        if xref_counts_v[v] < 2:
-            if bothways:
-                if xref_counts_k[k] < 2:
-                    improved_pairs.append( (k,v) )
-            else:
-                improved_pairs.append((k, v))
-    return improved_pairs
+    then it doesn't mean that all of those should be identified.  We don't really know what it means, so remove it.
+
+    Rather than counting the identifiers in dictionaries, we integer-encode the two columns with pandas.factorize()
+    and count them with NumPy, which is much faster for the hundreds of millions of pairs in some of our concords."""
+    if len(pairlist) == 0:
+        return []
+    object_codes, _ = pd.factorize(np.fromiter(map(itemgetter(1), pairlist), dtype=object, count=len(pairlist)))
+    subject_codes = None
+    if bothways:
+        subject_codes, _ = pd.factorize(np.fromiter(map(itemgetter(0), pairlist), dtype=object, count=len(pairlist)))
+    mask = get_unused_xref_mask(subject_codes, object_codes, bothways=bothways)
+    return list(itertools.compress(map(tuple, pairlist), mask.tolist()))
 
 def norm(x,op):
     #Get curie returns the uppercase
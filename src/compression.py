@@ -0,0 +1,184 @@
+"""
+compression.py - write large compressed files using several cores.
+
+Our largest outputs (the synonym files, the KGX exports, the SAPBERT training data) used to be written through
+gzip.open(), which compresses on a single core and can take hours. open_compressed() returns a file object that
+compresses in parallel instead:
+
+- For gzip, it works like pigz: the data is split into blocks of PARALLEL_GZIP_BLOCK_SIZE bytes, which are
+  raw-deflated by a pool of threads (zlib releases the GIL while it compresses). Each block is primed with the last
+  32 KiB of the previous block as its dictionary, so compression is nearly as good as compressing the whole file at
+  once, and ends with a sync flush, so that the compressed blocks can be concatenated into a single deflate stream. We
+  write them out in order inside a single, standard gzip member, with a CRC-32 and length that we calculate as we go.
+- For zstd (filenames ending in `.zst`), it uses the multithreaded compressor in the optional `zstandard` package.
+
+The number of threads and the gzip compression level come from `compression_workers` and `gzip_compression_level` in
+the config.
+"""
+import io
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from src.util import get_config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# How many bytes of uncompressed data to compress in each block.
+PARALLEL_GZIP_BLOCK_SIZE = 1024 * 1024
+
+# How many bytes of the previous block to use as the dictionary for the next one (the size of the deflate window).
+PARALLEL_GZIP_DICTIONARY_SIZE = 32 * 1024
+
+# The zstd compression level to use.
+ZSTD_COMPRESSION_LEVEL = 3
+
+
+def get_compression_settings(workers=None, level=None):
+    """
+    Fill in the number of compression threads and the gzip compression level from the config, if they aren't given.
+    """
+    config = get_config()
+    if workers is None:
+        workers = config.get('compression_workers', 1)
+    if level is None:
+        level = config.get('gzip_compression_level', 6)
+    return max(1, workers), level
+
+
+def compress_block(block, dictionary, level, last):
+    """
+    Raw-deflate a block of data, so that it can be appended to the deflate stream of the blocks before it.
+
+    :param block: The uncompressed data.
+    :param dictionary: The end of the previous block's data (or b'' for the first block).
+    :param level: The zlib compression level.
+    :param last: Whether this is the last block in the stream.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    """
+    A binary file object that writes a single gzip member, compressing blocks of data in parallel.
+    """
+
+    def __init__(self, fileobj, workers=None, level=None, block_size=None):
+        """
+        :param fileobj: A binary file object to write the compressed data to. It will be closed when this is closed.
+        :param workers: The number of threads to compress with (defaults to `compression_workers` in the config).
+        :param level: The gzip compression level (defaults to `gzip_compression_level` in the config).
+        :param block_size: The number of bytes to compress in each block (defaults to PARALLEL_GZIP_BLOCK_SIZE).
+        """
+        super().__init__()
+        self.fileobj = fileobj
+        self.workers, self.level = get_compression_settings(workers, level)
+        self.block_size = block_size or PARALLEL_GZIP_BLOCK_SIZE
+        self.executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        # Compressed blocks that we're waiting for, in the order we need to write them.
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+
+        # A gzip header (RFC 1952) with no file name, the current time, and an unknown OS, like Python's gzip module.
+        self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff')
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = memoryview(data).cast('B')
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.submit_block(block, last=False)
+        return len(data)
+
+    def submit_block(self, block, last):
+        """
+        Compress a block (in a worker thread, if we have any), and write out any blocks that have been compressed.
+        """
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        dictionary = self.dictionary
+        self.dictionary = (dictionary + block)[-PARALLEL_GZIP_DICTIONARY_SIZE:]
+        if self.executor is None:
+            self.fileobj.write(compress_block(block, dictionary, self.level, last))
+            return
+        self.pending.append(self.executor.submit(compress_block, block, dictionary, self.level, last))
+        # Don't let more than two blocks per worker pile up in memory.
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.workers):
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.submit_block(bytes(self.buffer), last=True)
+            self.buffer.clear()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.fileobj.close()
+            super().close()
+
+
+def open_compressed(filename, mode='wt', encoding='utf-8', workers=None, level=None):
+    """
+    Open a file for writing, compressed with several threads: with zstd if the filename ends in `.zst`, and with gzip
+    otherwise.
+
+    :param filename: The file to write.
+    :param mode: 'wt' (the default) or 'wb', and similarly for appending ('at' or 'ab'), which adds a new gzip member
+        or zstd frame to the end of the file.
+    :param encoding: The text encoding to use in text mode.
+    :param workers: The number of threads to compress with (defaults to `compression_workers` in the config).
+    :param level: The gzip compression level (defaults to `gzip_compression_level` in the config).
+    :return: A binary or text file object.
+    """
+    if mode.replace('t', '') not in {'w', 'wb', 'a', 'ab'}:
+        raise ValueError(f"open_compressed() can only open files for writing, not with mode '{mode}'")
+    binary_mode = 'ab' if mode.startswith('a') else 'wb'
+
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"Cannot write {filename}: zstd compression requires the zstandard package.")
+        workers, _ = get_compression_settings(workers, level)
+        compressor = zstandard.ZstdCompressor(level=ZSTD_COMPRESSION_LEVEL, threads=workers if workers > 1 else 0)
+        binary_file = compressor.stream_writer(open(filename, binary_mode), closefd=True)
+    else:
+        binary_file = ParallelGzipWriter(open(filename, binary_mode), workers=workers, level=level)
+
+    if 'b' in mode:
+        return binary_file
+    return io.TextIOWrapper(binary_file, encoding=encoding)
+
+
+def compress_file(input_filename, output_filename, workers=None, level=None):
+    """
+    Compress a file with open_compressed().
+    """
+    with open(input_filename, 'rb') as inf, open_compressed(output_filename, 'wb', workers=workers, level=level) as outf:
+        while True:
+            block = inf.read(PARALLEL_GZIP_BLOCK_SIZE)
+            if not block:
+                break
+            outf.write(block)
@@ -0,0 +1,311 @@
+"""
+concords.py - read concord files, using a columnar (Parquet) copy where possible.
+
+Concord files (`intermediate/*/concords/*`) are TSV files of the form `subject<TAB>predicate<TAB>object`. Several
+builders read the same concord files, and parsing them line-by-line in Python is a significant part of their runtime.
+
+The first time a concord file is read, we use DuckDB to write a columnar copy next to it (`<concord>.parquet`). In
+this copy, every CURIE is split into a prefix column (which Parquet dictionary-encodes, since there are only a handful
+of prefixes in any concord file) and a local ID column. The Parquet file records the size and modification time of the
+concord file it was built from, and is rebuilt if the concord file changes. Every row also records the line number it
+came from, so reads can ask for the rows in file order explicitly (`ORDER BY line_number`) instead of relying on the
+order in which DuckDB happened to write them.
+
+Converting a concord file costs one extra pass over it, which is paid by the first reader; every later reader (and there
+are usually several) scans the Parquet file instead. Readers can get the rows as:
+- read_concord_arrow_batches(): PyArrow RecordBatches of the columnar copy (prefix, local ID and predicate columns),
+  without building any Python strings. This is the fastest way to read a concord file.
+- read_concord_numpy_batches(): the same batches, as dictionaries of NumPy arrays.
+- read_concord_pair_table(): a PyArrow Table of the subject and object CURIEs (and their prefixes), for code that wants
+  to filter the pairs (e.g. with babel_utils.remove_overused_xrefs_from_table()) before turning them into Python strings.
+- read_concord_batches() / read_concord_pairs(): (subject, predicate, object) or (subject, object) tuples of CURIEs,
+  for code that works with Python strings.
+
+If a concord file can't be converted (for example, because some lines don't have exactly three columns), we fall back
+to reading it as text, which gives the same results (and the same errors) as reading it directly.
+"""
+import os
+
+import duckdb
+import pyarrow as pa
+
+from src.util import get_logger, get_memory_usage_summary
+
+logger = get_logger(__name__)
+
+# Change this if the layout of the columnar concord files changes, so that old files are rebuilt.
+COLUMNAR_CONCORD_FORMAT_VERSION = '2'
+
+# How many rows to return in each batch.
+CONCORD_BATCH_SIZE = 1_000_000
+
+# The columns of the columnar concord files that readers get back, in order.
+COLUMNAR_CONCORD_COLUMNS = ['subject_prefix', 'subject_local_id', 'predicate', 'object_prefix', 'object_local_id']
+
+# The columns of the tables returned by read_concord_pair_table(), in order.
+CONCORD_PAIR_COLUMNS = ['subject_prefix', 'subject', 'object_prefix', 'object']
+
+
+def get_columnar_concord_filename(concord_filename):
+    return concord_filename + '.parquet'
+
+
+def get_source_metadata(concord_filename):
+    """
+    Describe the concord file that a columnar concord file should be built from. These values are stored in the
+    Parquet file's key-value metadata.
+    """
+    stat = os.stat(concord_filename)
+    return {
+        'babel_concord_version': COLUMNAR_CONCORD_FORMAT_VERSION,
+        'babel_concord_source_size': str(stat.st_size),
+        'babel_concord_source_mtime_ns': str(stat.st_mtime_ns),
+    }
+
+
+def is_columnar_concord_current(concord_filename, columnar_filename):
+    """
+    Check whether the columnar concord file exists and was built from the current version of the concord file.
+    """
+    if not os.path.exists(columnar_filename):
+        return False
+    with duckdb.connect() as db:
+        try:
+            rows = db.execute("SELECT decode(key), decode(value) FROM parquet_kv_metadata(?)", [columnar_filename]).fetchall()
+        except duckdb.Error as e:
+            logger.warning(f"Could not read metadata from columnar concord {columnar_filename}, rebuilding: {e}")
+            return False
+    metadata = dict(rows)
+    return all(metadata.get(key) == value for key, value in get_source_metadata(concord_filename).items())
+
+
+def split_curie_sql(column):
+    """
+    Return SQL expressions for the prefix and local ID of a CURIE column. CURIEs without a colon have a NULL local ID.
+    """
+    prefix = f"CASE WHEN strpos({column}, ':') > 0 THEN substr({column}, 1, strpos({column}, ':') - 1) ELSE {column} END"
+    local_id = f"CASE WHEN strpos({column}, ':') > 0 THEN substr({column}, strpos({column}, ':') + 1) ELSE NULL END"
+    return prefix, local_id
+
+
+def join_curie_sql(prefix_column, local_id_column):
+    """
+    Return a SQL expression that turns a prefix and local ID column back into a CURIE.
+    """
+    return f"CASE WHEN {local_id_column} IS NULL THEN {prefix_column} ELSE {prefix_column} || ':' || {local_id_column} END"
+
+
+def write_columnar_concord(concord_filename):
+    """
+    Write a columnar copy of a concord file next to it.
+
+    :param concord_filename: The concord file to convert.
+    :return: The columnar concord filename, or None if the concord file couldn't be converted.
+    """
+    columnar_filename = get_columnar_concord_filename(concord_filename)
+    tmp_filename = f"{columnar_filename}.tmp-{os.getpid()}"
+    logger.info(f"Writing columnar concord {columnar_filename}: {get_memory_usage_summary()}")
+
+    # Match `line.strip().split('\t')`: empty columns are empty strings (not NULLs), and we strip whitespace from the
+    # start of the subject and the end of the object.
+    subject_prefix, subject_local_id = split_curie_sql("regexp_replace(coalesce(subject, ''), '^\\s+', '')")
+    object_prefix, object_local_id = split_curie_sql("regexp_replace(coalesce(object, ''), '\\s+$', '')")
+    kv_metadata = ', '.join(f"{key}: '{value}'" for key, value in get_source_metadata(concord_filename).items())
+    with duckdb.connect() as db:
+        try:
+            # Reading the file on a single thread (parallel=false) numbers the rows in the order of the lines in the
+            # file.
+            db.execute(f"""COPY (
+                SELECT
+                    row_number() OVER () AS line_number,
+                    {subject_prefix} AS subject_prefix,
+                    {subject_local_id} AS subject_local_id,
+                    coalesce(predicate, '') AS predicate,
+                    {object_prefix} AS object_prefix,
+                    {object_local_id} AS object_local_id
+                FROM read_csv(?, delim='\\t', header=false, quote='', escape='', auto_detect=false, strict_mode=true,
+                    null_padding=false, all_varchar=true, new_line='\\n', parallel=false,
+                    columns={{'subject': 'VARCHAR', 'predicate': 'VARCHAR', 'object': 'VARCHAR'}})
+            ) TO '{tmp_filename}' (FORMAT PARQUET, KV_METADATA {{{kv_metadata}}})""", [concord_filename])
+        except duckdb.Error as e:
+            logger.warning(f"Could not write columnar concord for {concord_filename}, will read it as text: {e}")
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return None
+
+    os.replace(tmp_filename, columnar_filename)
+    logger.info(f"Wrote columnar concord {columnar_filename}: {get_memory_usage_summary()}")
+    return columnar_filename
+
+
+def get_columnar_concord(concord_filename):
+    """
+    Return the columnar concord file for a concord file, building it if it doesn't exist or is out of date.
+
+    :return: The columnar concord filename, or None if the concord file couldn't be converted.
+    """
+    columnar_filename = get_columnar_concord_filename(concord_filename)
+    if is_columnar_concord_current(concord_filename, columnar_filename):
+        return columnar_filename
+    return write_columnar_concord(concord_filename)
+
+
+def read_columnar_concord(db, columnar_filename, columns, batch_size):
+    """
+    Read some of the columns of a columnar concord file, in the order of the lines in the concord file.
+
+    :param db: The DuckDB connection to use.
+    :param columnar_filename: The columnar concord file to read.
+    :param columns: SQL expressions for the columns to read.
+    :param batch_size: The maximum number of rows in each batch.
+    :return: A pyarrow.RecordBatchReader.
+    """
+    return db.execute(f"""SELECT {', '.join(columns)} FROM read_parquet(?) ORDER BY line_number""",
+                      [columnar_filename]).fetch_record_batch(batch_size)
+
+
+def read_text_concord_batches(concord_filename, batch_size, strict):
+    """
+    Read a concord file as text, in batches of (subject, predicate, object) tuples.
+    """
+    batch = []
+    with open(concord_filename, 'r') as inf:
+        for line in inf:
+            x = line.strip().split('\t')
+            if strict and len(x) != 3:
+                raise RuntimeError(f'Line "{line.strip()}" in {concord_filename} is not a valid concord: {x}')
+            batch.append((x[0], x[1], x[2]))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def split_curie(curie):
+    """
+    Split a CURIE into its prefix and local ID, in the same way as the columnar concord files.
+    """
+    prefix, colon, local_id = curie.partition(':')
+    return (prefix, local_id) if colon else (curie, None)
+
+
+def read_concord_arrow_batches(concord_filename, batch_size=CONCORD_BATCH_SIZE, strict=False):
+    """
+    Read a concord file in batches of PyArrow RecordBatches with the columns in COLUMNAR_CONCORD_COLUMNS, i.e.
+    subject_prefix, subject_local_id, predicate, object_prefix and object_local_id. The local ID of a CURIE without a
+    colon is null.
+
+    :param concord_filename: The concord file to read.
+    :param batch_size: The maximum number of rows in each batch.
+    :param strict: If True, raise a RuntimeError if any line doesn't have exactly three columns.
+    :return: An iterator of pyarrow.RecordBatch, in the order the rows appear in the concord file.
+    """
+    columnar_filename = get_columnar_concord(concord_filename)
+    if columnar_filename is not None:
+        with duckdb.connect() as db:
+            yield from read_columnar_concord(db, columnar_filename, COLUMNAR_CONCORD_COLUMNS, batch_size)
+        return
+
+    for batch in read_text_concord_batches(concord_filename, batch_size, strict):
+        subject_prefixes, subject_local_ids = zip(*[split_curie(subject) for subject, _, _ in batch])
+        object_prefixes, object_local_ids = zip(*[split_curie(obj) for _, _, obj in batch])
+        yield pa.record_batch([
+            pa.array(subject_prefixes, pa.string()),
+            pa.array(subject_local_ids, pa.string()),
+            pa.array([predicate for _, predicate, _ in batch], pa.string()),
+            pa.array(object_prefixes, pa.string()),
+            pa.array(object_local_ids, pa.string()),
+        ], names=COLUMNAR_CONCORD_COLUMNS)
+
+
+def read_concord_numpy_batches(concord_filename, batch_size=CONCORD_BATCH_SIZE, strict=False):
+    """
+    Read a concord file in batches of NumPy arrays. This is read_concord_arrow_batches() with every batch converted into
+    a dictionary of column name to NumPy array (of Python strings, with None for null local IDs).
+
+    :return: An iterator of dictionaries, in the order the rows appear in the concord file.
+    """
+    for batch in read_concord_arrow_batches(concord_filename, batch_size=batch_size, strict=strict):
+        yield {name: column.to_numpy(zero_copy_only=False) for name, column in zip(batch.schema.names, batch.columns)}
+
+
+def read_concord_batches(concord_filename, batch_size=CONCORD_BATCH_SIZE, strict=False):
+    """
+    Read a concord file in batches.
+
+    :param concord_filename: The concord file to read.
+    :param batch_size: The maximum number of rows in each batch.
+    :param strict: If True, raise a RuntimeError if any line doesn't have exactly three columns.
+    :return: An iterator of lists of (subject, predicate, object) tuples, in the order they appear in the concord file.
+    """
+    columnar_filename = get_columnar_concord(concord_filename)
+    if columnar_filename is None:
+        yield from read_text_concord_batches(concord_filename, batch_size, strict)
+        return
+
+    columns = [join_curie_sql('subject_prefix', 'subject_local_id'), 'predicate',
+               join_curie_sql('object_prefix', 'object_local_id')]
+    with duckdb.connect() as db:
+        for batch in read_columnar_concord(db, columnar_filename, columns, batch_size):
+            yield list(zip(*(column.to_pylist() for column in batch.columns)))
+
+
+def read_concord_pairs(concord_filename, strict=False):
+    """
+    Read all the (subject, object) pairs from a concord file.
+
+    :param concord_filename: The concord file to read.
+    :param strict: If True, raise a RuntimeError if any line doesn't have exactly three columns.
+    :return: An iterator of (subject, object) tuples, in the order they appear in the concord file.
+    """
+    columnar_filename = get_columnar_concord(concord_filename)
+    if columnar_filename is None:
+        for batch in read_text_concord_batches(concord_filename, CONCORD_BATCH_SIZE, strict):
+            for subject, _, obj in batch:
+                yield subject, obj
+        return
+
+    # There's no need to fetch the predicates.
+    columns = [join_curie_sql('subject_prefix', 'subject_local_id'), join_curie_sql('object_prefix', 'object_local_id')]
+    with duckdb.connect() as db:
+        for batch in read_columnar_concord(db, columnar_filename, columns, CONCORD_BATCH_SIZE):
+            yield from zip(batch.column(0).to_pylist(), batch.column(1).to_pylist())
+
+
+def read_concord_pair_table(concord_filename, strict=False):
+    """
+    Read all the (subject, object) pairs from a concord file into a PyArrow Table with the columns in
+    CONCORD_PAIR_COLUMNS, i.e. the prefix and CURIE of the subject and of the object. Unlike read_concord_pairs(), this
+    doesn't create any Python objects for the pairs, so they can be filtered with PyArrow or NumPy first.
+
+    :param concord_filename: The concord file to read.
+    :param strict: If True, raise a RuntimeError if any line doesn't have exactly three columns.
+    :return: A pyarrow.Table, with the rows in the order they appear in the concord file.
+    """
+    columnar_filename = get_columnar_concord(concord_filename)
+    if columnar_filename is None:
+        subjects = []
+        objects = []
+        for batch in read_text_concord_batches(concord_filename, CONCORD_BATCH_SIZE, strict):
+            for subject, _, obj in batch:
+                subjects.append(subject)
+                objects.append(obj)
+        return pa.table([
+            pa.array([split_curie(subject)[0] for subject in subjects], pa.string()),
+            pa.array(subjects, pa.string()),
+            pa.array([split_curie(obj)[0] for obj in objects], pa.string()),
+            pa.array(objects, pa.string()),
+        ], names=CONCORD_PAIR_COLUMNS)
+
+    columns = ['subject_prefix', f"{join_curie_sql('subject_prefix', 'subject_local_id')} AS subject",
+               'object_prefix', f"{join_curie_sql('object_prefix', 'object_local_id')} AS object"]
+    with duckdb.connect() as db:
+        return read_columnar_concord(db, columnar_filename, columns, CONCORD_BATCH_SIZE).read_all()
+
+
+def get_concord_table_pairs(table):
+    """
+    Return the (subject, object) pairs in a table from read_concord_pair_table() as a list of tuples of CURIEs.
+    """
+    return list(zip(table.column('subject').to_pylist(), table.column('object').to_pylist()))
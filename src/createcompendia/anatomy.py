@@ -1,5 +1,8 @@
 from collections import defaultdict
 import requests
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 
 import src.datahandlers.obo as obo
 from src.metadata.provenance import write_concord_metadata
@@ -8,7 +11,8 @@ from src.util import Text
 from src.prefixes import MESH, NCIT, CL, GO, UBERON, SNOMEDCT, WIKIDATA, UMLS, FMA
 from src.categories import ANATOMICAL_ENTITY, GROSS_ANATOMICAL_STRUCTURE, CELL, CELLULAR_COMPONENT
 from src.ubergraph import build_sets
-from src.babel_utils import write_compendium, glom, get_prefixes, read_identifier_file, remove_overused_xrefs
+from src.babel_utils import write_compendium, glom, get_prefixes, read_identifier_file, remove_overused_xrefs_from_table
+from src.concords import read_concord_pair_table, get_concord_table_pairs
 import src.datahandlers.umls as umls
 import src.datahandlers.mesh as mesh
 
@@ -186,26 +190,27 @@ def build_compendia(concordances, metadata_yamls, identifiers, icrdf_filename):
     for infile in concordances:
         print(infile)
         print('loading',infile)
-        pairs = []
+        pairs = read_concord_pair_table(infile)
         # We have a concordance problem with UMLS - it is including GO terms that are obsolete and we don't want
         # them added. So we want to limit concordances to terms that are already in the dicts. But that's ONLY for the
         # UMLS concord.  We trust the others to retrieve decent identifiers.
         bs = frozenset( [UMLS, GO])
-        with open(infile,'r') as inf:
-            for line in inf:
-                x = line.strip().split('\t')
-                prefixes = frozenset( [xi.split(':')[0] for xi in x[0:3:2]]) #leave out the predicate
-                if prefixes == bs:
-                    use = True
-                    for xi in (x[0], x[2]):
-                        if xi not in dicts:
-                            print(f"Skipping pair {x} from {infile}: terms with prefixes {bs} are skipped unless they are already in the concords.")
-                            use = False
-                    if not use:
-                        continue
-                pairs.append( ([x[0], x[2]]) )
-        newpairs = remove_overused_xrefs(pairs)
-        setpairs = [ set(x) for x in newpairs]
+        subject_prefixes = pairs.column('subject_prefix')
+        object_prefixes = pairs.column('object_prefix')
+        bs_rows = np.flatnonzero(pc.or_(
+            pc.and_(pc.equal(subject_prefixes, UMLS), pc.equal(object_prefixes, GO)),
+            pc.and_(pc.equal(subject_prefixes, GO), pc.equal(object_prefixes, UMLS)),
+        ).to_numpy())
+        if len(bs_rows) > 0:
+            use = np.ones(pairs.num_rows, dtype=bool)
+            for row, pair in zip(bs_rows, get_concord_table_pairs(pairs.take(bs_rows))):
+                for xi in pair:
+                    if xi not in dicts:
+                        print(f"Skipping pair {list(pair)} from {infile}: terms with prefixes {bs} are skipped unless they are already in the concords.")
+                        use[row] = False
+            pairs = pairs.filter(pa.array(use))
+        newpairs = remove_overused_xrefs_from_table(pairs)
+        setpairs = [ set(x) for x in get_concord_table_pairs(newpairs)]
         glom(dicts, setpairs, unique_prefixes=[UBERON, GO])
     typed_sets = create_typed_sets(set([frozenset(x) for x in dicts.values()]),types)
     for biotype,sets in typed_sets.items():
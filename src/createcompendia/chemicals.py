@@ -1,12 +1,13 @@
 import logging
 import os
+import shutil
+import tempfile
 from collections import defaultdict
 from os.path import dirname
 
-import jsonlines
 import requests
-import ast
 import gzip
+import pyarrow.compute as pc
 
 from src.properties import Property, HAS_ALTERNATIVE_ID
 from src.metadata.provenance import write_concord_metadata, write_combined_metadata
@@ -16,7 +17,12 @@ from src.categories import MOLECULAR_MIXTURE, SMALL_MOLECULE, CHEMICAL_ENTITY, P
 from src.sdfreader import read_sdf
 
 from src.datahandlers.unichem import data_sources as unichem_data_sources
-from src.babel_utils import write_compendium, glom, get_prefixes, read_identifier_file, remove_overused_xrefs
+from src.babel_utils import write_compendium, glom, get_prefixes, read_identifier_file, remove_overused_xrefs_from_table, \
+    format_clique, read_clique_list, write_clique_list
+from src.incremental_glom import start_glom, finish_glom
+from src.unionfind import UnionFind
+from src.concords import read_concord_pair_table, get_concord_table_pairs
+from src.compression import open_compressed
 
 import src.datahandlers.mesh as mesh
 import src.datahandlers.umls as umls
@@ -157,10 +163,10 @@ def write_chebi_ids(outfile):
     mixture_id = f'{CHEBI}:60004'
     peptide_id = f'{CHEBI}:16670'
     uber = UberGraph()
-    uberres_chems = uber.get_subclasses_and_smiles(chemical_entity_id)
-    uberres_racimates = set([x['descendent'] for x in uber.get_subclasses_of(racimate_id)]) #no smiles for this one
-    uberres_mixtures = set([x['descendent'] for x in uber.get_subclasses_of(mixture_id)]) #no smiles for this one
-    uberres_peptides = set([x['descendent'] for x in uber.get_subclasses_of(peptide_id)]) #no smiles for this one
+    uberres_chems = uber.stream_subclasses_and_smiles(chemical_entity_id)
+    uberres_racimates = set([x['descendent'] for x in uber.stream_subclasses_of(racimate_id)]) #no smiles for this one
+    uberres_mixtures = set([x['descendent'] for x in uber.stream_subclasses_of(mixture_id)]) #no smiles for this one
+    uberres_peptides = set([x['descendent'] for x in uber.stream_subclasses_of(peptide_id)]) #no smiles for this one
     with open(outfile, 'w') as idfile:
         for k in uberres_chems:
             desc = k["descendent"]
@@ -329,23 +335,18 @@ def read_inchikeys(struct_file):
 def combine_unichem(concordances,output):
     PREFIXES_TO_REMOVE_OVERUSED_XREFS = [UNII, KEGGCOMPOUND, DRUGCENTRAL]
 
-    dicts = {}
+    dicts = UnionFind()
     for infile in concordances:
         print(infile)
         print('loading',infile)
-        pairs = []
+        # We keep the pairs in a PyArrow table until we've removed the overused xrefs, so that we only need to make
+        # Python strings for the pairs that we glom.
+        pairs = read_concord_pair_table(infile)
 
         # We will want to only remove overused xrefs for specific prefixes.
         # UniChem files should only have a single prefix in the first column,
         # but out of paranoia we'll double-check that.
-        prefixes_in_file = set()
-
-        with open(infile,'r') as inf:
-            for line in inf:
-                x = line.strip().split('\t')
-                pairs.append( ([x[0], x[2]]) )
-                # Get the prefix from the first row to determine if we need to remove overused xrefs
-                prefixes_in_file.add(Text.get_prefix(x[0]))
+        prefixes_in_file = set(pc.unique(pairs.column('subject_prefix')).to_pylist())
 
         # Was there more than one prefix in the first column?
         if len(prefixes_in_file) != 1:
@@ -355,22 +356,12 @@ def combine_unichem(concordances,output):
         # Only remove overused xrefs for specific prefixes
         newpairs = pairs
         if prefix_to_check in PREFIXES_TO_REMOVE_OVERUSED_XREFS:
-            newpairs = remove_overused_xrefs(pairs)
-        setpairs = [ set(x) for x in newpairs ]
+            newpairs = remove_overused_xrefs_from_table(pairs)
+        del pairs
+        setpairs = [ set(x) for x in get_concord_table_pairs(newpairs) ]
         glom(dicts, setpairs, unique_prefixes=[INCHIKEY])
     chem_sets = set([frozenset(x) for x in dicts.values()])
-    with jsonlines.open(output, mode='w') as writer:
-        for chemset in chem_sets:
-            writer.write(list(chemset))
-
-def read_partial_unichem(unichem_partial):
-    chem_sets = {}
-    with jsonlines.open(unichem_partial) as reader:
-        for chemlist in reader:
-            chemset = set(chemlist)
-            for element in chemset:
-                chem_sets[element] = chemset
-    return chem_sets
+    write_clique_list(output, chem_sets)
 
 def is_cas(thing):
     #The last digit in a CAS is a checksum. We could use, but are not atm.
@@ -511,7 +502,7 @@ def make_chebi_relations(sdf,dbx,outfile,propfile_gz,metadata_yaml):
     # What if we don't have a propfile directory?
     os.makedirs(dirname(propfile_gz), exist_ok=True)
 
-    with open(outfile,'w') as outf, gzip.open(propfile_gz, 'wt') as propf:
+    with open(outfile,'w') as outf, open_compressed(propfile_gz, 'wt') as propf:
         #Write SDF structured things
         for cid,props in chebi_sdf_dat.items():
             if secondary_chebi_id in props:
@@ -637,10 +628,17 @@ def get_wikipedia_relationships(outfile, metadata_yaml):
         concord_filename=outfile,
     )
 
+def print_pairs_with(pairs, curie):
+    """Print the pairs in a table from read_concord_pair_table() that contain a particular CURIE (for debugging)."""
+    matches = pairs.filter(pc.or_(pc.equal(pairs.column('subject'), curie), pc.equal(pairs.column('object'), curie)))
+    for pair in get_concord_table_pairs(matches):
+        print(list(pair))
+
 def build_untyped_compendia(concordances, identifiers, unichem_partial, untyped_concord, type_file, metadata_yaml, input_metadata_yamls):
     """:concordances: a list of files from which to read relationships
        :identifiers: a list of files from which to read identifiers and optional categories"""
-    dicts = read_partial_unichem(unichem_partial)
+    dicts = start_glom('chemicals')
+    dicts.add_cliques(read_clique_list(unichem_partial))
     types = {}
     for ifile in identifiers:
         print(ifile)
@@ -650,38 +648,32 @@ def build_untyped_compendia(concordances, identifiers, unichem_partial, untyped_
     for infile in concordances:
         print(infile)
         print('loading',infile)
-        pairs = []
-        with open(infile,'r') as inf:
-            for line in inf:
-                x = line.strip().split('\t')
-                pairs.append( ([x[0], x[2]]) )
+        pairs = read_concord_pair_table(infile)
         p = False
-        if DRUGCENTRAL in [ n.split(':')[0] for n in pairs[0] ]:
+        if DRUGCENTRAL in [ pairs.column('subject_prefix')[0].as_py(), pairs.column('object_prefix')[0].as_py() ]:
             p = True
             i = 'DrugCentral:4970'
         if p:
             print('before filtering:')
-            for pair in pairs:
-                if i in pair:
-                    print(pair)
-        newpairs = remove_overused_xrefs(pairs)
-        setpairs = [ set(x) for x in newpairs ]
+            print_pairs_with(pairs, i)
+        newpairs = remove_overused_xrefs_from_table(pairs)
+        del pairs
         if p:
             print('after filtering:')
-            for pair in newpairs:
-                if i in pair:
-                    print(pair)
+            print_pairs_with(newpairs, i)
+        setpairs = [ set(x) for x in get_concord_table_pairs(newpairs) ]
         glom(dicts, setpairs, unique_prefixes=[INCHIKEY])
-        if p:
+        # An IncrementalGlom doesn't glom anything until finish_glom() is called.
+        if p and isinstance(dicts, UnionFind):
             print('after glomming:')
             print(dicts[i])
+    dicts = finish_glom(dicts)
     with open(type_file,'w') as outf:
         for x,y in types.items():
             outf.write(f'{x}\t{y}\n')
-    untyped_sets = set([frozenset(x) for x in dicts.values()])
-    with open(untyped_concord, 'w') as outf:
-        for s in untyped_sets:
-            outf.write(f'{set(s)}\n')
+    # Write out the untyped compendium as a clique list, with one list of identifiers per line. dicts is a UnionFind,
+    # so every clique is only returned once.
+    write_clique_list(untyped_concord, (sorted(clique) for clique in dicts.values()))
 
     # Build the metadata file by combining the input metadata_yamls.
     write_combined_metadata(
@@ -694,30 +686,54 @@ def build_untyped_compendia(concordances, identifiers, unichem_partial, untyped_
         combined_from_filenames=input_metadata_yamls,
     )
 
-def build_compendia(type_file, untyped_compendia_file, properties_jsonl_gz_files, metadata_yamls, icrdf_filename):
+def build_compendia(type_file, untyped_compendia_file, properties_jsonl_gz_files, metadata_yamls, icrdf_filename, workers=1):
     types = {}
+    # There are only a handful of distinct types, so we make sure every identifier refers to the same type string
+    # instead of storing a separate copy for each identifier.
+    distinct_types = {}
     with open(type_file,'r') as inf:
         for line in inf:
             x = line.strip().split('\t')
-            types[x[0]] = x[1]
+            types[x[0]] = distinct_types.setdefault(x[1], x[1])
     logger.info(f'Loaded {len(types)} types from {type_file}: {get_memory_usage_summary()}')
 
-    untyped_sets = set()
-    with open(untyped_compendia_file,'r') as inf:
-        for line in inf:
-            s = ast.literal_eval(line.strip())
-            untyped_sets.add(frozenset(s))
-    logger.info(f'Loaded {len(untyped_sets)} untyped sets from {untyped_compendia_file}: {get_memory_usage_summary()}')
-
-    typed_sets = create_typed_sets(untyped_sets, types)
-    logger.info(f'Created {len(typed_sets)} typed sets from {len(untyped_sets)} untyped sets: {get_memory_usage_summary()}')
-
-    for biotype, sets in typed_sets.items():
-        baretype = biotype.split(':')[-1]
-        if biotype == DRUG:
-            write_compendium(metadata_yamls, sets, f'{baretype}.txt', biotype, {}, extra_prefixes=[MESH,UNII], icrdf_filename=icrdf_filename, properties_jsonl_gz_files=properties_jsonl_gz_files)
-        else:
-            write_compendium(metadata_yamls, sets, f'{baretype}.txt', biotype, {}, extra_prefixes=[RXCUI], icrdf_filename=icrdf_filename, properties_jsonl_gz_files=properties_jsonl_gz_files)
+    # Type the untyped cliques one at a time, routing each one into a spill file for its type. That way, we only need
+    # to hold the cliques for a single type in memory at a time. The spill files are only needed while this function is
+    # running, so we write them into a temporary directory next to the untyped compendium and remove it when we're done.
+    spill_dir = tempfile.mkdtemp(prefix='typed-compendia-', dir=os.path.dirname(os.path.abspath(untyped_compendia_file)))
+    try:
+        spill_files = {}
+        count_untyped = 0
+        count_typed = defaultdict(int)
+        try:
+            for clique in read_clique_list(untyped_compendia_file):
+                count_untyped += 1
+                for biotype, typed_clique in type_clique(frozenset(clique), types):
+                    if biotype not in spill_files:
+                        spill_filename = os.path.join(spill_dir, biotype.split(':')[-1] + '.jsonl')
+                        spill_files[biotype] = (spill_filename, open(spill_filename, 'w'))
+                    spill_files[biotype][1].write(format_clique(sorted(typed_clique)))
+                    count_typed[biotype] += 1
+        finally:
+            for _, spill_file in spill_files.values():
+                spill_file.close()
+        logger.info(f'Created {sum(count_typed.values())} typed sets from {count_untyped} untyped sets: {dict(count_typed)}, {get_memory_usage_summary()}')
+
+        # We no longer need the types.
+        del types
+
+        for biotype, (spill_filename, _) in spill_files.items():
+            sets = [set(clique) for clique in read_clique_list(spill_filename)]
+            logger.info(f'Loaded {len(sets)} {biotype} sets from {spill_filename}: {get_memory_usage_summary()}')
+            baretype = biotype.split(':')[-1]
+            if biotype == DRUG:
+                write_compendium(metadata_yamls, sets, f'{baretype}.txt', biotype, {}, extra_prefixes=[MESH,UNII], icrdf_filename=icrdf_filename, properties_jsonl_gz_files=properties_jsonl_gz_files, workers=workers)
+            else:
+                write_compendium(metadata_yamls, sets, f'{baretype}.txt', biotype, {}, extra_prefixes=[RXCUI], icrdf_filename=icrdf_filename, properties_jsonl_gz_files=properties_jsonl_gz_files, workers=workers)
+            del sets
+            os.remove(spill_filename)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
 
 def create_typed_sets(eqsets, types):
     """
@@ -727,78 +743,90 @@ def create_typed_sets(eqsets, types):
     :param eqsets: A list of lists of identifiers (should NOT be a list of LabeledIDs, but a list of strings).
     :param types: A dictionary of known types for each identifier. (Some identifiers don't have known types.)
     """
-    order = [DRUG, MOLECULAR_MIXTURE, SMALL_MOLECULE, POLYPEPTIDE, COMPLEX_MOLECULAR_MIXTURE, CHEMICAL_MIXTURE, CHEMICAL_ENTITY]
     typed_sets = defaultdict(set)
-    # logging.warning(f"create_typed_sets: eqsets={eqsets}, types=...")
     for equivalent_ids in eqsets:
-        # logging.warning(f"Processing equivalent_ids={equivalent_ids}.")
-        # prefixes = set([ Text.get_curie(x) for x in equivalent_ids])
-        prefixes = get_prefixes(equivalent_ids)
-        found = False
-        for prefix in [PUBCHEMCOMPOUND]:
-            if prefix in prefixes and not found:
-                #I only want to accept the type if all pubchems agree on it.
-                pctypes = set()
-                for x in prefixes[prefix]:
-                    if x in types:
-                        pctypes.add(types[x])
-                    else:
-                        # logging.warning(f"No type found for {x}, skipping.")
-                        pass
-
-                if len(pctypes) == 1:
-                    typed_sets[list(pctypes)[0]].add(equivalent_ids)
-                    found = True
-                elif pctypes == {'biolink:SmallMolecule', 'biolink:MolecularMixture'}:
-                    # This is a common case (8,178 cases in 2022oct13) which occurs in cases where the InChI for
-                    # e.g. water (SMILES: O) and hydron;hydroxide ([H+].[OH-]) are identical, causing them to be
-                    # merged. (They may also be merged if we combine two identifiers into a single clique that is
-                    # linked to two PubChem entries.)
-                    #
-                    # The comprehensive solution would be to use SMILES or molecular formula or per-database
-                    # type information to split these cliques. Instead, as a temporary solution, we will split
-                    # everything we're _sure_ is a biolink:MolecularMixture into a separate clique, and leave all
-                    # the other identifiers as a biolink:SmallMolecule.
-                    #
-                    # First reported in https://github.com/TranslatorSRI/Babel/issues/83
-                    molecular_mixture_ids = set()
-                    all_other_ids = set()
-                    for eq_id in equivalent_ids:
-                        if eq_id in types and types[eq_id] == 'biolink:MolecularMixture':
-                            molecular_mixture_ids.add(eq_id)
-                        else:
-                            all_other_ids.add(eq_id)
-
-                    logging.info(
-                        f"Found a clique that that contains PUBCHEM types " +
-                        "({'biolink:SmallMolecule', 'biolink:MolecularMixture'}). This clique will be split " +
-                        f"into a biolink:MolecularMixture ({molecular_mixture_ids}) and " +
-                        f"a biolink:SmallMolecule ({all_other_ids})"
-                    )
-                    typed_sets['biolink:MolecularMixture'].add(frozenset(molecular_mixture_ids))
-                    typed_sets['biolink:SmallMolecule'].add(frozenset(all_other_ids))
-                    found = True
+        for biotype, typed_ids in type_clique(equivalent_ids, types):
+            typed_sets[biotype].add(typed_ids)
+    return typed_sets
+
+def type_clique(equivalent_ids, types):
+    """
+    Type a single set of equivalent identifiers into being a subclass of ChemicalEntity. Usually this returns a single
+    clique, but cliques that mix biolink:SmallMolecule and biolink:MolecularMixture PubChem identifiers are split.
+
+    :param equivalent_ids: A frozenset of identifiers (should NOT be LabeledIDs, but strings).
+    :param types: A dictionary of known types for each identifier. (Some identifiers don't have known types.)
+    :return: A list of (type, frozenset of identifiers) tuples.
+    """
+    order = [DRUG, MOLECULAR_MIXTURE, SMALL_MOLECULE, POLYPEPTIDE, COMPLEX_MOLECULAR_MIXTURE, CHEMICAL_MIXTURE, CHEMICAL_ENTITY]
+    typed_sets = []
+    # prefixes = set([ Text.get_curie(x) for x in equivalent_ids])
+    prefixes = get_prefixes(equivalent_ids)
+    found = False
+    for prefix in [PUBCHEMCOMPOUND]:
+        if prefix in prefixes and not found:
+            #I only want to accept the type if all pubchems agree on it.
+            pctypes = set()
+            for x in prefixes[prefix]:
+                if x in types:
+                    pctypes.add(types[x])
                 else:
-                    logging.warning(f"An unexpected number of PUBCHEM types found for {equivalent_ids} ({len(pctypes)}): {pctypes}")
-        if not found:
-            typecounts = defaultdict(int)
-            for eid in equivalent_ids:
-                if eid in types:
-                    typecounts[types[eid]] += 1
-            if len(typecounts) == 0:
-                #print('how did we not get any types?')
-                #print(equivalent_ids)
-                #One thing that happens is that we can have PUBCHEMs that have been deleted, but are still in UNICHEM
-                # then the pubchem doesn't get assigned a type, but still ends up in the compendium
-                typed_sets[CHEMICAL_ENTITY].add(equivalent_ids)
-            elif len(typecounts) == 1:
-                t = list(typecounts.keys())[0]
-                typed_sets[t].add(equivalent_ids)
+                    # logging.warning(f"No type found for {x}, skipping.")
+                    pass
+
+            if len(pctypes) == 1:
+                typed_sets.append((list(pctypes)[0], equivalent_ids))
+                found = True
+            elif pctypes == {'biolink:SmallMolecule', 'biolink:MolecularMixture'}:
+                # This is a common case (8,178 cases in 2022oct13) which occurs in cases where the InChI for
+                # e.g. water (SMILES: O) and hydron;hydroxide ([H+].[OH-]) are identical, causing them to be
+                # merged. (They may also be merged if we combine two identifiers into a single clique that is
+                # linked to two PubChem entries.)
+                #
+                # The comprehensive solution would be to use SMILES or molecular formula or per-database
+                # type information to split these cliques. Instead, as a temporary solution, we will split
+                # everything we're _sure_ is a biolink:MolecularMixture into a separate clique, and leave all
+                # the other identifiers as a biolink:SmallMolecule.
+                #
+                # First reported in https://github.com/TranslatorSRI/Babel/issues/83
+                molecular_mixture_ids = set()
+                all_other_ids = set()
+                for eq_id in equivalent_ids:
+                    if eq_id in types and types[eq_id] == 'biolink:MolecularMixture':
+                        molecular_mixture_ids.add(eq_id)
+                    else:
+                        all_other_ids.add(eq_id)
+
+                logging.info(
+                    f"Found a clique that that contains PUBCHEM types " +
+                    "({'biolink:SmallMolecule', 'biolink:MolecularMixture'}). This clique will be split " +
+                    f"into a biolink:MolecularMixture ({molecular_mixture_ids}) and " +
+                    f"a biolink:SmallMolecule ({all_other_ids})"
+                )
+                typed_sets.append(('biolink:MolecularMixture', frozenset(molecular_mixture_ids)))
+                typed_sets.append(('biolink:SmallMolecule', frozenset(all_other_ids)))
+                found = True
             else:
-                # First attempt is majority vote, and after that by most specific
-                otypes = [(-c, order.index(t), t) for t, c in typecounts.items()]
-                otypes.sort()
-                t = otypes[0][2]
-                typed_sets[t].add(equivalent_ids)
+                logging.warning(f"An unexpected number of PUBCHEM types found for {equivalent_ids} ({len(pctypes)}): {pctypes}")
+    if not found:
+        typecounts = defaultdict(int)
+        for eid in equivalent_ids:
+            if eid in types:
+                typecounts[types[eid]] += 1
+        if len(typecounts) == 0:
+            #print('how did we not get any types?')
+            #print(equivalent_ids)
+            #One thing that happens is that we can have PUBCHEMs that have been deleted, but are still in UNICHEM
+            # then the pubchem doesn't get assigned a type, but still ends up in the compendium
+            typed_sets.append((CHEMICAL_ENTITY, equivalent_ids))
+        elif len(typecounts) == 1:
+            t = list(typecounts.keys())[0]
+            typed_sets.append((t, equivalent_ids))
+        else:
+            # First attempt is majority vote, and after that by most specific
+            otypes = [(-c, order.index(t), t) for t, c in typecounts.items()]
+            otypes.sort()
+            t = otypes[0][2]
+            typed_sets.append((t, equivalent_ids))
     return typed_sets
 
@@ -1,6 +1,9 @@
 from os import path
 from collections import defaultdict
 
+import pyarrow as pa
+import pyarrow.compute as pc
+
 import src.datahandlers.obo as obo
 from src.metadata.provenance import write_concord_metadata
 
@@ -12,7 +15,9 @@ import src.datahandlers.doid as doid
 import src.datahandlers.mesh as mesh
 import src.datahandlers.efo as efo
 
-from src.babel_utils import read_identifier_file, glom, remove_overused_xrefs, get_prefixes, write_compendium
+from src.babel_utils import read_identifier_file, glom, remove_overused_xrefs_from_table, get_prefixes, write_compendium
+from src.incremental_glom import start_glom, finish_glom
+from src.concords import read_concord_pair_table, get_concord_table_pairs
 
 def write_obo_ids(irisandtypes,outfile,exclude=[]):
     order = [DISEASE, PHENOTYPIC_FEATURE]
@@ -187,7 +192,7 @@ def build_disease_doid_relationships(idfile,outfile, metadata_yaml):
 def build_compendium(concordances, metadata_yamls, identifiers, mondoclose, badxrefs, icrdf_filename):
     """:concordances: a list of files from which to read relationships
        :identifiers: a list of files from which to read identifiers and optional categories"""
-    dicts = {}
+    dicts = start_glom('diseasephenotype')
     types = {}
     for ifile in identifiers:
         print(ifile)
@@ -203,7 +208,6 @@ def build_compendium(concordances, metadata_yamls, identifiers, mondoclose, badx
     #Load and glom concords
     for infile in concordances:
         print(infile)
-        pairs = []
         pref = path.basename(infile)
         if pref in badxrefs:
             print('reading bad xrefs',pref)
@@ -211,23 +215,25 @@ def build_compendium(concordances, metadata_yamls, identifiers, mondoclose, badx
         else:
             print('no bad pairs', pref)
             bad_pairs = set()
-        with open(infile,'r') as inf:
-            for line in inf:
-                stuff = line.strip().split('\t')
-                if len(stuff) != 3:
-                    raise RuntimeError('Line "', line.strip(), '" is not a valid concord: ', stuff)
-                x = tuple([stuff[0].strip(), stuff[2].strip()])
-                if x not in bad_pairs:
-                    pairs.append( x )
+        pairs = read_concord_pair_table(infile, strict=True)
+        subjects = pc.utf8_trim_whitespace(pairs.column('subject'))
+        objects = pc.utf8_trim_whitespace(pairs.column('object'))
+        pairs = pairs.set_column(1, 'subject', subjects).set_column(3, 'object', objects)
+        if bad_pairs:
+            # CURIEs can't contain tabs, so we can match both CURIEs of a pair at once.
+            bad_keys = pa.array([f"{subject}\t{obj}" for subject, obj in bad_pairs], pa.string())
+            is_bad = pc.is_in(pc.binary_join_element_wise(subjects, objects, '\t'), value_set=bad_keys)
+            pairs = pairs.filter(pc.invert(is_bad))
         if pref in ['MONDO','HP','EFO']:
-            newpairs = remove_overused_xrefs(pairs)
+            newpairs = remove_overused_xrefs_from_table(pairs)
         else:
             newpairs = pairs
-        glom(dicts, newpairs, unique_prefixes=[MONDO, HP], close={MONDO:close_mondos})
+        glom(dicts, get_concord_table_pairs(newpairs), unique_prefixes=[MONDO, HP], close={MONDO:close_mondos})
         try:
             print(dicts['OMIM:607644'])
         except:
             print('notyet')
+    dicts = finish_glom(dicts)
     typed_sets = create_typed_sets(set([frozenset(x) for x in dicts.values()]),types)
     for biotype,sets in typed_sets.items():
         baretype = biotype.split(':')[-1]
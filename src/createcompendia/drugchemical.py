@@ -6,7 +6,13 @@ from src.prefixes import RXCUI, PUBCHEMCOMPOUND, UMLS
 from src.categories import (CHEMICAL_ENTITY, DRUG, MOLECULAR_MIXTURE, FOOD, COMPLEX_MOLECULAR_MIXTURE,
                             SMALL_MOLECULE, NUCLEIC_ACID_ENTITY, MOLECULAR_ENTITY, FOOD_ADDITIVE,
                             ENVIRONMENTAL_FOOD_CONTAMINANT, PROCESSED_MATERIAL, CHEMICAL_MIXTURE, POLYPEPTIDE)
-from src.babel_utils import glom, get_numerical_curie_suffix
+from src.babel_utils import glom, get_numerical_curie_suffix, format_clique
+from src import json_codec
+from src.curie_index import CurieIndex, get_compendium_name
+from src.curie_interner import CurieInterner, CurieMap
+from src.unionfind import UnionFind
+from src.concords import read_concord_pairs
+from array import array
 from collections import defaultdict
 import os,json
 
@@ -248,19 +254,6 @@ def build_rxnorm_relationships(conso, relfile, outfile, metadata_yaml):
     )
 
 
-def load_cliques(compendium):
-    rx_to_clique = {}
-    with open(compendium,"r") as infile:
-        for line in infile:
-            if RXCUI not in line:
-                continue
-            j = json.loads(line)
-            clique = j["identifiers"][0]["i"]
-            for terms in j["identifiers"]:
-               if terms["i"].startswith(RXCUI):
-                   rx_to_clique[terms["i"]] = clique
-    return rx_to_clique
-
 def build_pubchem_relationships(infile,outfile, metadata_yaml):
     with open(infile,"r") as inf:
         document = json.load(inf)
@@ -284,13 +277,13 @@ def build_pubchem_relationships(infile,outfile, metadata_yaml):
         concord_filename=outfile,
     )
 
-def build_conflation(manual_concord_filename, rxn_concord, umls_concord, pubchem_rxn_concord, drug_compendium, chemical_compendia, icrdf_filename, outfilename, input_metadata_yamls, output_metadata_yaml):
+def build_conflation(manual_concord_filename, rxn_concord, umls_concord, pubchem_rxn_concord, drug_compendium, chemical_compendia, chemical_curie_indexes, icrdf_filename, outfilename, input_metadata_yamls, output_metadata_yaml):
     """RXN_concord contains relationshps between rxcuis that can be used to conflate
     Now we don't want all of them.  We want the ones that are between drugs and chemicals,
     and the ones between drugs and drugs.
     To determine which those are, we're going to have to dig around in all the compendia.
     We also want to get all the clique leaders as well.  For those, we only need to worry if there are RXCUIs
-    in the clique."""
+    in the clique, which we can look up in the CURIE indexes of the chemical compendia (see src/curie_index.py)."""
 
     print("Loading information content values...")
     ic_factory = InformationContentFactory(icrdf_filename)
@@ -319,86 +312,81 @@ def build_conflation(manual_concord_filename, rxn_concord, umls_concord, pubchem
     print(f"{len(manual_concords)} manual concords loaded.")
 
     print("load all chemical conflations so we can normalize identifiers")
-    preferred_curie_for_curie = {}
+    # The chemical compendia contain hundreds of millions of CURIEs, so we intern them all in a single CurieInterner and
+    # store everything else we need as handles into it.
+    curie_interner = CurieInterner()
+    preferred_curie_for_curie = CurieMap(curie_interner)
     type_for_preferred_curie = {}
     clique_for_preferred_curie = {}
     for chemical_compendium in chemical_compendia:
         with open(chemical_compendium, 'r') as compendiumf:
             logger.info(f"Loading {chemical_compendium}")
             for line in compendiumf:
-                clique = json.loads(line)
+                clique = json_codec.loads(line)
                 preferred_id = clique['identifiers'][0]['i']
-                clique_for_preferred_curie[preferred_id] = list(map(lambda ident: ident['i'], clique['identifiers']))
-                type_for_preferred_curie[preferred_id] = clique['type']
+                preferred_handle = curie_interner.intern(preferred_id)
+                clique_for_preferred_curie[preferred_handle] = array('q', [curie_interner.intern(ident['i']) for ident in clique['identifiers']])
+                type_for_preferred_curie[preferred_handle] = clique['type']
                 for ident in clique['identifiers']:
                     id = ident['i']
                     preferred_curie_for_curie[id] = preferred_id
 
     print(f"Loaded preferred CURIEs for {len(preferred_curie_for_curie)} CURIEs from the chemical compendia.")
 
-    print("load drugs")
-    drug_rxcui_to_clique = load_cliques(drug_compendium)
+    print("load RXCUIs from the chemical CURIE indexes")
+    drug_compendium_name = get_compendium_name(drug_compendium)
+    drug_rxcui_to_clique = {}
     chemical_rxcui_to_clique = {}
-    for chemical_compendium in chemical_compendia:
-        if chemical_compendium == drug_compendium:
-            continue
-        print(f"load {chemical_compendium}")
-        chemical_rxcui_to_clique.update(load_cliques(chemical_compendium))
+    for entry in CurieIndex(chemical_curie_indexes).iter_prefix(RXCUI + ':'):
+        if entry.compendium == drug_compendium_name:
+            drug_rxcui_to_clique[entry.curie] = entry.clique_leader
+        else:
+            chemical_rxcui_to_clique[entry.curie] = entry.clique_leader
 
     pairs = []
     for concfile in [rxn_concord,umls_concord]:
-        with open(concfile,"r") as infile:
-            for line in infile:
-                x = line.strip().split('\t')
-                subject = x[0]
-                object = x[2]
-
-                # While we do this, we will also normalize all chemicals to their preferred clique IDs.
-                if subject in drug_rxcui_to_clique and object in chemical_rxcui_to_clique:
-                    subject = drug_rxcui_to_clique[subject]
-                    object = chemical_rxcui_to_clique[object]
-                    pairs.append( (subject,object) )
-                elif subject in chemical_rxcui_to_clique and object in drug_rxcui_to_clique:
-                    subject = chemical_rxcui_to_clique[subject]
-                    object = drug_rxcui_to_clique[object]
-                    pairs.append( (subject,object) )
-                # OK, this is possible, and it's OK, as long as we get real clique leaders
-                elif subject in drug_rxcui_to_clique and object in drug_rxcui_to_clique:
-                    subject = drug_rxcui_to_clique[subject]
-                    object = drug_rxcui_to_clique[object]
-                    pairs.append( (subject,object) )
-                elif subject in chemical_rxcui_to_clique and object in chemical_rxcui_to_clique:
-                    subject = chemical_rxcui_to_clique[subject]
-                    object = chemical_rxcui_to_clique[object]
-                    pairs.append( (subject,object) )
-    with open(pubchem_rxn_concord,"r") as infile:
-        for line in infile:
-            x = line.strip().split('\t')
-            subject = x[0]
-            object = x[2]
-
-            if subject in drug_rxcui_to_clique:
+        for subject, object in read_concord_pairs(concfile):
+            # While we do this, we will also normalize all chemicals to their preferred clique IDs.
+            if subject in drug_rxcui_to_clique and object in chemical_rxcui_to_clique:
                 subject = drug_rxcui_to_clique[subject]
-            elif subject in chemical_rxcui_to_clique:
+                object = chemical_rxcui_to_clique[object]
+                pairs.append( (subject,object) )
+            elif subject in chemical_rxcui_to_clique and object in drug_rxcui_to_clique:
                 subject = chemical_rxcui_to_clique[subject]
-            else:
-                logger.warning(
-                    f"Subject in subject-object pair ({subject}, {object}) isn't mapped to a RxCUI, skipping."
-                )
-                continue
-                # raise RuntimeError(f"Unknown identifier in drugchemical conflation as subject: {subject}")
-
-            if object in drug_rxcui_to_clique:
                 object = drug_rxcui_to_clique[object]
-            elif object in chemical_rxcui_to_clique:
+                pairs.append( (subject,object) )
+            # OK, this is possible, and it's OK, as long as we get real clique leaders
+            elif subject in drug_rxcui_to_clique and object in drug_rxcui_to_clique:
+                subject = drug_rxcui_to_clique[subject]
+                object = drug_rxcui_to_clique[object]
+                pairs.append( (subject,object) )
+            elif subject in chemical_rxcui_to_clique and object in chemical_rxcui_to_clique:
+                subject = chemical_rxcui_to_clique[subject]
                 object = chemical_rxcui_to_clique[object]
-            else:
-                logger.warning(
-                    f"Object in subject-object pair ({subject}, {object}) isn't mapped to a RxCUI"
-                )
-                # raise RuntimeError(f"Unknown identifier in drugchemical conflation as object: {object}")
+                pairs.append( (subject,object) )
+    for subject, object in read_concord_pairs(pubchem_rxn_concord):
+        if subject in drug_rxcui_to_clique:
+            subject = drug_rxcui_to_clique[subject]
+        elif subject in chemical_rxcui_to_clique:
+            subject = chemical_rxcui_to_clique[subject]
+        else:
+            logger.warning(
+                f"Subject in subject-object pair ({subject}, {object}) isn't mapped to a RxCUI, skipping."
+            )
+            continue
+            # raise RuntimeError(f"Unknown identifier in drugchemical conflation as subject: {subject}")
+
+        if object in drug_rxcui_to_clique:
+            object = drug_rxcui_to_clique[object]
+        elif object in chemical_rxcui_to_clique:
+            object = chemical_rxcui_to_clique[object]
+        else:
+            logger.warning(
+                f"Object in subject-object pair ({subject}, {object}) isn't mapped to a RxCUI"
+            )
+            # raise RuntimeError(f"Unknown identifier in drugchemical conflation as object: {object}")
 
-            pairs.append((subject, object))
+        pairs.append((subject, object))
 
     # Normalize the pairs to be glommed. We need to do this here because it may be that multiple conflations will be
     # merged together because they share a normalized identifier. We can do this by adding pairs to indicate that every
@@ -431,7 +419,7 @@ def build_conflation(manual_concord_filename, rxn_concord, umls_concord, pubchem
 
     # Glommin' time
     print("glom")
-    gloms = {}
+    gloms = UnionFind(curie_interner)
     glom(gloms, pairs_to_be_glommed)
 
     # Set up a NodeFactory.
@@ -455,7 +443,7 @@ def build_conflation(manual_concord_filename, rxn_concord, umls_concord, pubchem
             # To do this is a two-step process:
             # 1. Figure out all the possible types (of the remaining IDs).
             conflation_possible_types = map(
-                lambda id: type_for_preferred_curie[preferred_curie_for_curie[id]],
+                lambda id: type_for_preferred_curie[preferred_curie_for_curie.get_handle(id)],
                 conflation_id_list
             )
             # 2. Sort possible types in our preferred order of types.
@@ -565,7 +553,7 @@ def build_conflation(manual_concord_filename, rxn_concord, umls_concord, pubchem
             conflation_clique_leader = final_conflation_id_list[0]
             conflation_clique_leader_prefix = conflation_clique_leader.split(':')[0]
             conflation_clique_leader_ic = ic_factory.get_ic({
-                'identifiers': list(map(lambda curie: {'identifier': curie}, clique_for_preferred_curie[conflation_clique_leader]))
+                'identifiers': list(map(lambda curie: {'identifier': curie}, curie_interner.curies(clique_for_preferred_curie[curie_interner.get(conflation_clique_leader)])))
             })
             if conflation_clique_leader_ic is None:
                 conflation_clique_leader_ic = float(100.0)
@@ -579,14 +567,14 @@ def build_conflation(manual_concord_filename, rxn_concord, umls_concord, pubchem
                     continue
 
                 # Note that this works because curie is always a clique leader here.
-                curie_type = type_for_preferred_curie[curie]
+                curie_type = type_for_preferred_curie[curie_interner.get(curie)]
                 if curie_type != conflation_type:
                     # Only consider clique leaders that are of the calculated type.
                     continue
 
                 # Is this a lower information content value? If so, prefer this CURIE.
                 curie_ic = ic_factory.get_ic({
-                    'identifiers': list(map(lambda curie: {'identifier': curie}, clique_for_preferred_curie[curie]))
+                    'identifiers': list(map(lambda curie: {'identifier': curie}, curie_interner.curies(clique_for_preferred_curie[curie_interner.get(curie)])))
                 })
                 if curie_ic is not None and float(curie_ic) < float(conflation_clique_leader_ic):
                     logging.info(f"Found better IC with CURIE {curie} (IC {curie_ic}) than previous conflation clique "
@@ -609,7 +597,7 @@ def build_conflation(manual_concord_filename, rxn_concord, umls_concord, pubchem
                 # Write out all the identifiers.
             logger.info(f"Ordered DrugChemical conflation {final_conflation_id_list}")
 
-            outfile.write(f"{json.dumps(final_conflation_id_list)}\n")
+            outfile.write(format_clique(final_conflation_id_list))
             written.add(fs)
 
     # Write out metadata.yaml
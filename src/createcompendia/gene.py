@@ -8,6 +8,7 @@ from src.categories import GENE
 import src.datahandlers.umls as umls
 
 from src.babel_utils import read_identifier_file,glom,write_compendium
+from src.concords import read_concord_pairs
 
 import os
 import json
@@ -316,11 +317,7 @@ def build_gene_compendia(concordances, metadata_yamls, identifiers, icrdf_filena
     for infile in concordances:
         print(infile)
         print('loading', infile)
-        pairs = []
-        with open(infile, 'r') as inf:
-            for line in inf:
-                x = line.strip().split('\t')
-                pairs.append(set([x[0], x[2]]))
+        pairs = [set([subject, obj]) for subject, obj in read_concord_pairs(infile)]
         glom(dicts, pairs, unique_prefixes=uniques)
     gene_sets = set([frozenset(x) for x in dicts.values()])
     baretype = GENE.split(':')[-1]
@@ -1,6 +1,10 @@
 from src.metadata.provenance import write_concord_metadata
 from src.prefixes import UNIPROTKB, NCBIGENE
-from src.babel_utils import glom
+from src.babel_utils import glom, write_clique_list
+from src.curie_index import CurieIndex
+from src.curie_interner import CurieInterner, CurieMap
+from src.unionfind import UnionFind
+from array import array
 from collections import defaultdict
 
 import jsonlines
@@ -61,35 +65,28 @@ def gpkey(curie):
     pref = curie.split(':')[0]
     return (kl[pref], curie)
 
-def collect_valid_ids(compendium_file, idset):
-    with jsonlines.open(compendium_file,'r') as inf:
-        for line in inf:
-            ids = [x['i'] for x in line['identifiers']]
-            idset.update(ids)
-
-def build_conflation(geneprotein_concord, gene_compendium, protein_compendium, outfile):
+def build_conflation(geneprotein_concord, gene_curie_index, protein_curie_index, outfile):
     """
     Fortunately our concord is in terms of the two preferred ids.
     All we should have to do is load that in, glom it up, and write out the groups
     But, there are some things in the concord that don't exist in at least the gene (maybe in the protein as well)
+    so we check every pair against the CURIE indexes of the Gene and Protein compendia (see src/curie_index.py).
     """
-    all_ids = set()
-    collect_valid_ids(gene_compendium,all_ids)
-    collect_valid_ids(protein_compendium,all_ids)
-    conf = {}
-    pairs= []
+    curie_index = CurieIndex([gene_curie_index, protein_curie_index])
+    conf = UnionFind()
+    # Keep the pairs as handles in the UnionFind's interner rather than as millions of tuples of strings.
+    interner = conf.interner
+    subjects = array('q')
+    objects = array('q')
     with open(geneprotein_concord, 'r') as inf:
         for line in inf:
             x = line.strip().split('\t')
-            if (x[0] in all_ids) and (x[2] in all_ids):
-                pairs.append( (x[0], x[2]) )
-    glom(conf,pairs)
+            if (x[0] in curie_index) and (x[2] in curie_index):
+                subjects.append(interner.intern(x[0]))
+                objects.append(interner.intern(x[2]))
+    glom(conf, ((interner.curie(subject), interner.curie(obj)) for subject, obj in zip(subjects, objects)))
     conf_sets = set([frozenset(x) for x in conf.values()])
-    with jsonlines.open(outfile,'w') as outf:
-        for cs in conf_sets:
-            lc = list(cs)
-            lc.sort(key=gpkey)
-            outf.write(lc)
+    write_clique_list(outfile, (sorted(cs, key=gpkey) for cs in conf_sets))
 
 def build_compendium(gene_compendium, protein_compendium, geneprotein_concord, outfile):
     """Gene and Protein are both pretty big, and we want this to happen somewhat easily.
@@ -103,20 +100,35 @@ def build_compendium(gene_compendium, protein_compendium, geneprotein_concord, o
     There is one complication- the gene/protein links are not 1:1.  There are multiple UniProts associated with
     the same gene.  So we need to read until we have all of the proteins for a gene before we merge/write.
     """
-    uniprot2ncbi={}
-    ncbi2uniprot = defaultdict(list)
+    # The concord is stored as handles into a CurieInterner: uniprot2ncbi maps every UniProtKB ID to its NCBIGene ID,
+    # and protein_counts counts the UniProtKB IDs for every NCBIGene handle.
+    interner = CurieInterner()
+    uniprot2ncbi = CurieMap(interner)
+    protein_counts = array('q')
     with open(geneprotein_concord, 'r') as inf:
         for line in inf:
             x = line.strip().split('\t')
             uniprot2ncbi[x[0]] = x[2]
-            ncbi2uniprot[x[2]].append(x[0])
-    mappable_gene_ids = set(uniprot2ncbi.values())
+            gene_handle = interner.intern(x[2])
+            if gene_handle >= len(protein_counts):
+                protein_counts.extend([0] * (len(interner) - len(protein_counts)))
+            protein_counts[gene_handle] += 1
+    # Flag the NCBIGene IDs that some UniProtKB ID is (still) mapped to.
+    mappable_gene_handles = bytearray(len(interner))
+    for gene_handle in uniprot2ncbi.values_by_handle:
+        if gene_handle >= 0:
+            mappable_gene_handles[gene_handle] = 1
+
+    def is_mappable_gene(gene_id):
+        gene_handle = interner.get(gene_id)
+        return gene_handle is not None and mappable_gene_handles[gene_handle] == 1
+
     mappable_genes = defaultdict(list)
     with jsonlines.open(outfile,'w') as outf:
         with jsonlines.open(gene_compendium,'r') as infile:
             for gene in infile:
                 best_id = gene['id']['identifier']
-                if best_id not in mappable_gene_ids:
+                if not is_mappable_gene(best_id):
                     outf.write(gene)
                 else:
                     mappable_genes[best_id].append( gene )
@@ -130,7 +142,7 @@ def build_compendium(gene_compendium, protein_compendium, geneprotein_concord, o
                     try:
                         ncbi_id = uniprot2ncbi[uniprot_id]
                         mappable_genes[ncbi_id].append(protein)
-                        if len(mappable_genes[ncbi_id]) == len(ncbi2uniprot[ncbi_id]) + 1:
+                        if len(mappable_genes[ncbi_id]) == protein_counts[interner.get(ncbi_id)] + 1:
                             newnode = merge(mappable_genes[ncbi_id])
                             outf.write(newnode)
                             #Remove once we've written so we can make sure to clean up at the end
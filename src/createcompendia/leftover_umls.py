@@ -1,9 +1,9 @@
-import json
 import logging
 
-import jsonlines
 from pathlib import Path
 
+from src import json_codec
+from src.curie_index import CurieIndex
 from src.node import NodeFactory
 from src.util import get_biolink_model_toolkit
 from src.datahandlers import umls
@@ -11,14 +11,15 @@ from src.prefixes import UMLS
 from src.categories import ACTIVITY, AGENT, DEVICE, DRUG, FOOD, SMALL_MOLECULE, PHYSICAL_ENTITY, PUBLICATION, PROCEDURE
 
 
-def write_leftover_umls(compendia, umls_labels_filename, mrconso, mrsty, synonyms, umls_compendium, umls_synonyms, report, biolink_version):
+def write_leftover_umls(curie_indexes, umls_labels_filename, mrconso, mrsty, synonyms, umls_compendium, umls_synonyms, report, biolink_version):
     """
     Search for "leftover" UMLS concepts, i.e. those that are defined and valid in MRCONSO but are not
     mapped to a concept in Babel.
 
     As described in https://github.com/TranslatorSRI/NodeNormalization/issues/119#issuecomment-1154751451
 
-    :param compendia: A list of compendia to collect.
+    :param curie_indexes: A list of CURIE index shards (see src/curie_index.py) for the compendia whose UMLS IDs should
+        not be included in the leftover UMLS compendium.
     :param umls_labels_filename: The filename of the UMLS labels file to use for this compendium (e.g. 'babel_downloads/UMLS/labels').
     :param mrconso: MRCONSO.RRF file path
     :param mrsty: MRSTY.RRF file path
@@ -30,7 +31,7 @@ def write_leftover_umls(compendia, umls_labels_filename, mrconso, mrsty, synonym
     :return: Nothing.
     """
 
-    logging.info(f"write_leftover_umls({compendia}, {umls_labels_filename}, {mrconso}, {mrsty}, {synonyms}, {umls_compendium}, {umls_synonyms}, {report}, {biolink_version})")
+    logging.info(f"write_leftover_umls({curie_indexes}, {umls_labels_filename}, {mrconso}, {mrsty}, {synonyms}, {umls_compendium}, {umls_synonyms}, {report}, {biolink_version})")
 
     # For now, we have many more UMLS entities in MRCONSO than in the compendia, so
     # we'll make an in-memory list of those first. Once that flips, this should be
@@ -50,19 +51,11 @@ def write_leftover_umls(compendia, umls_labels_filename, mrconso, mrsty, synonym
         # This defaults to the version of the Biolink model that is included with this BMT.
         biolink_toolkit = get_biolink_model_toolkit(biolink_version)
 
-        for compendium in compendia:
-            logging.info(f"Starting compendium: {compendium}")
-            umls_ids = set()
-
-            with open(compendium, 'r') as f:
-                for row in f:
-                    cluster = json.loads(row)
-                    for id in cluster['identifiers']:
-                        if id['i'].startswith(UMLS + ':'):
-                            umls_ids.add(id['i'])
-
-            logging.info(f"Completed compendium {compendium} with {len(umls_ids)} UMLS IDs")
-            umls_ids_in_other_compendia.update(umls_ids)
+        # The CURIE indexes are sorted by CURIE, so we only need to read the UMLS part of each one.
+        curie_index = CurieIndex(curie_indexes)
+        logging.info(f"Collecting UMLS IDs from {curie_index}")
+        for entry in curie_index.iter_prefix(UMLS + ':'):
+            umls_ids_in_other_compendia.add(entry.curie)
 
         logging.info(f"Completed all compendia with {len(umls_ids_in_other_compendia)} UMLS IDs.")
         reportf.write(f"Completed all compendia with {len(umls_ids_in_other_compendia)} UMLS IDs.\n")
@@ -178,7 +171,7 @@ def write_leftover_umls(compendia, umls_labels_filename, mrconso, mrsty, synonym
                         'l': label,
                     }]
                 }
-                compendiumf.write(json.dumps(cluster) + "\n")
+                compendiumf.write(json_codec.dumps_line(cluster))
                 umls_ids_in_this_compendium.add(umls_id)
                 logging.debug(f"Writing {cluster} to {compendiumf}")
 
@@ -208,7 +201,7 @@ def write_leftover_umls(compendia, umls_labels_filename, mrconso, mrsty, synonym
         # Write out synonyms to synonym file.
         node_factory = NodeFactory(umls_labels_filename, biolink_version)
         count_synonym_objs = 0
-        with jsonlines.open(umls_synonyms, 'w') as umls_synonymsf:
+        with json_codec.JSONLWriter(umls_synonyms) as umls_synonymsf:
             for id in synonyms_by_id:
                 synonyms_list = list(sorted(list(synonyms_by_id[id]), key=lambda syn:len(syn)))
 
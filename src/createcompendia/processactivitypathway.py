@@ -1,6 +1,8 @@
 from os import path
 from collections import defaultdict
 
+import pyarrow as pa
+
 import src.datahandlers.obo as obo
 import src.datahandlers.reactome as reactome
 import src.datahandlers.rhea as rhea
@@ -12,7 +14,8 @@ from src.prefixes import GO, REACT, WIKIPATHWAYS, RHEA, SMPDB, EC, PANTHERPATHWA
 from src.categories import BIOLOGICAL_PROCESS, MOLECULAR_ACTIVITY, PATHWAY
 from src.ubergraph import build_sets
 
-from src.babel_utils import read_identifier_file, glom, remove_overused_xrefs, get_prefixes, write_compendium
+from src.babel_utils import read_identifier_file, glom, remove_overused_xrefs_from_table, get_prefixes, write_compendium
+from src.concords import read_concord_pair_table, get_concord_table_pairs
 
 def write_obo_ids(irisandtypes,outfile,exclude=[]):
     order = [PATHWAY, BIOLOGICAL_PROCESS, MOLECULAR_ACTIVITY]
@@ -92,28 +95,26 @@ def build_compendia(concordances, metadata_yamls, identifiers, icrdf_filename):
         # We have a concordance problem with UMLS - it is including GO terms that are obsolete and we don't want
         # them added. So we want to limit concordances to terms that are already in the dicts. But that's ONLY for the
         # UMLS concord.  We trust the others to retrieve decent identifiers.
-        pairs = []
-        with open(infile,'r') as inf:
-            for line in inf:
-                x = line.strip().split('\t')
-                if infile.endswith("UMLS"):
-                    use = True
-                    for xi in (x[0], x[2]):
-                        if xi not in dicts:
-                            print(f"Skipping pair {x} from {infile} because {xi} is not in dicts")
-                            use = False
-                    if not use:
-                        continue
-                pair = ([x[0], x[2]])
-                fspair = frozenset(pair)
-                if fspair not in bad_concords:
-                    pairs.append( pair )
+        pairs = read_concord_pair_table(infile)
+        # These checks need Python lookups, so we make a mask of the pairs to keep and filter the table with it.
+        use = []
+        for pair in get_concord_table_pairs(pairs):
+            use_pair = True
+            if infile.endswith("UMLS"):
+                for xi in pair:
+                    if xi not in dicts:
+                        print(f"Skipping pair {list(pair)} from {infile} because {xi} is not in dicts")
+                        use_pair = False
+            if frozenset(pair) in bad_concords:
+                use_pair = False
+            use.append(use_pair)
+        pairs = pairs.filter(pa.array(use, pa.bool_()))
         #one kind of error is that GO->Reactome xrefs are freqently more like subclass relations. So
         # GO:0004674 (protein serine/threonine kinase) has over 400 Reactome xrefs
         # remove_overused_xrefs assumes that we want to remove pairs where the second pair is overused
         # but this case it's the first, so we use the bothways optoin
-        newpairs = remove_overused_xrefs(pairs,bothways=True)
-        setpairs = [ set(x) for x in newpairs]
+        newpairs = remove_overused_xrefs_from_table(pairs,bothways=True)
+        setpairs = [ set(x) for x in get_concord_table_pairs(newpairs)]
         glom(dicts, setpairs, unique_prefixes=[GO])
     typed_sets = create_typed_sets(set([frozenset(x) for x in dicts.values()]),types)
     for biotype,sets in typed_sets.items():
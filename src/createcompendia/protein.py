@@ -159,9 +159,10 @@ def build_umls_relationships(mrconso, idfile, outfile, metadata_yaml):
     # than proteins, which could result in duplicates (if the same ID is picked up in both chemicals and proteins).
     umls.build_sets(mrconso, idfile, outfile, {'MSH': MESH, 'DRUGBANK': DRUGBANK}, provenance_metadata_yaml=metadata_yaml)
 
-def build_protein_compendia(concordances, metadata_yamls, identifiers, icrdf_filename):
+def build_protein_compendia(concordances, metadata_yamls, identifiers, icrdf_filename, workers=1):
     """:concordances: a list of files from which to read relationships
-       :identifiers: a list of files from which to read identifiers and optional categories"""
+       :identifiers: a list of files from which to read identifiers and optional categories
+       :workers: the number of worker processes to write the compendium with"""
     dicts = {}
     types = {}
     uniques = [UNIPROTKB,PR]
@@ -198,5 +199,5 @@ def build_protein_compendia(concordances, metadata_yamls, identifiers, icrdf_fil
 
     baretype = PROTEIN.split(':')[-1]
     logger.info(f"Writing compendium for {baretype}, memory usage: {get_memory_usage_summary()}")
-    write_compendium(metadata_yamls, gene_sets, f'{baretype}.txt', PROTEIN, {}, extra_prefixes=[DRUGBANK], icrdf_filename=icrdf_filename)
+    write_compendium(metadata_yamls, gene_sets, f'{baretype}.txt', PROTEIN, {}, extra_prefixes=[DRUGBANK], icrdf_filename=icrdf_filename, workers=workers)
     logger.info(f"Wrote compendium for {baretype}, memory usage: {get_memory_usage_summary()}")
@@ -10,7 +10,9 @@ from pathlib import Path
 import xml.etree.ElementTree as ET
 
 from src.babel_utils import pull_via_wget, WgetRecursionOptions, glom, read_identifier_file, write_compendium
+from src.unionfind import UnionFind
 from src.categories import JOURNAL_ARTICLE, PUBLICATION
+from src.compression import open_compressed
 from src.metadata.provenance import write_concord_metadata
 from src.prefixes import PMID, DOI, PMC
 
@@ -166,6 +168,9 @@ def parse_pubmed_into_tsvs(baseline_dir, updatefiles_dir, titles_file, status_fi
             map(lambda fn: os.path.join(updatefiles_dir, fn), sorted(os.listdir(updatefiles_dir))))
 
         for pubmed_filename in (baseline_filenames + updatefiles_filenames):
+            if pubmed_filename.endswith(".download.json"):
+                # Download manifests written by the download manager (see src/downloads.py).
+                continue
             if not pubmed_filename.endswith(".xml.gz"):
                 logging.warning(f"Skipping non-gzipped-XML file {pubmed_filename} in PubMed files.")
                 continue
@@ -243,7 +248,7 @@ def parse_pubmed_into_tsvs(baseline_dir, updatefiles_dir, titles_file, status_fi
                     f"{count_titles} titles with the following PubStatuses: {sorted(file_pubstatuses)}.")
 
     # Write the statuses into a gzipped JSONL file.
-    with gzip.open(status_file, 'wt') as statusf:
+    with open_compressed(status_file, 'wt') as statusf:
         # This will be more readable as a JSONL file, so let's write it out that way.
         for pmid, statuses in pmid_status.items():
             statusf.write(json.dumps({'id': pmid, 'statuses': sorted(statuses)}, sort_keys=True) + '\n')
@@ -277,7 +282,7 @@ def generate_compendium(concordances, metadata_yamls, identifiers, titles, publi
     :param icrdf_filename: The ICRDF file.
     """
 
-    dicts = {}
+    dicts = UnionFind()
     types = {}
     uniques = [PMID]
 
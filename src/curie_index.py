@@ -0,0 +1,133 @@
+"""
+curie_index.py - a build-once index of which clique every CURIE belongs to, across compendia.
+
+Several stages need to know "which clique does CURIE X belong to?" for CURIEs in other compendia: the GeneProtein
+conflation needs to know which CURIEs are in the Gene and Protein compendia, and the leftover UMLS compendium needs to
+know which UMLS IDs are already in any other compendium. Each of these used to read and parse every line of the
+compendia they needed, and hold all of their CURIEs in memory.
+
+Instead, we build a CURIE index shard for every compendium once (`babel_outputs/indexes/curies/<compendium>.tsv`). Each
+shard is a TSV file of `curie<TAB>clique_leader<TAB>biolink_type` lines, which we turn into a memory-mapped sorted
+string table (see src/sstable.py) as soon as it is written. A CurieIndex opens a list of shards and looks CURIEs up in
+each of them, so a stage can use exactly the compendia it depends on -- which matters for leftover UMLS, since the
+UMLS compendium is itself built from the index of every other compendium.
+"""
+import os
+from typing import NamedTuple
+
+from src import json_codec
+from src.sstable import open_tsv_table
+from src.util import get_logger, get_memory_usage_summary
+
+logger = get_logger(__name__)
+
+
+class CurieIndexEntry(NamedTuple):
+    """The clique that a CURIE belongs to in one compendium."""
+    curie: str
+    compendium: str
+    clique_leader: str
+    biolink_type: str
+
+
+def get_compendium_name(filename):
+    """
+    Return the name of the compendium that a compendium or CURIE index shard filename refers to (e.g. 'Gene' for
+    `compendia/Gene.txt` or `indexes/curies/Gene.tsv`).
+    """
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def write_curie_index_shard(compendium_filename, index_filename):
+    """
+    Write the CURIE index shard for a compendium, and build its sorted string table.
+
+    :param compendium_filename: The compendium file to index.
+    :param index_filename: The TSV file to write.
+    """
+    logger.info(f"Writing CURIE index shard {index_filename} for {compendium_filename}: {get_memory_usage_summary()}")
+    os.makedirs(os.path.dirname(index_filename), exist_ok=True)
+    tmp_filename = f"{index_filename}.tmp-{os.getpid()}"
+    count_curies = 0
+    with open(tmp_filename, 'w', encoding='utf-8') as outf:
+        for clique in json_codec.read_compendium(compendium_filename):
+            identifiers = clique['identifiers']
+            if not identifiers:
+                continue
+            clique_leader = identifiers[0]['i']
+            biolink_type = clique.get('type', '')
+            for identifier in identifiers:
+                outf.write(f"{identifier['i']}\t{clique_leader}\t{biolink_type}\n")
+                count_curies += 1
+    os.replace(tmp_filename, index_filename)
+    logger.info(f"Wrote {count_curies:,} CURIEs to CURIE index shard {index_filename}: {get_memory_usage_summary()}")
+
+    # Build the sorted string table now, so that stages that use this shard don't have to.
+    open_tsv_table(index_filename)
+
+
+class CurieIndex:
+    """
+    Look up which clique CURIEs belong to in a list of CURIE index shards.
+    """
+
+    def __init__(self, index_filenames):
+        """
+        :param index_filenames: The CURIE index shards to use. If a CURIE appears in several shards, lookups return the
+            entries in the order the shards are listed here.
+        """
+        self.shards = []
+        for index_filename in index_filenames:
+            table = open_tsv_table(index_filename)
+            if table is None:
+                raise RuntimeError(f"CURIE index shard {index_filename} does not exist.")
+            self.shards.append((get_compendium_name(index_filename), table))
+
+    def __str__(self):
+        return f"CurieIndex of {len(self.shards)} compendia: {', '.join(name for name, _ in self.shards)}"
+
+    def __contains__(self, curie):
+        return any(table.get(curie) for _, table in self.shards)
+
+    def lookup(self, curie):
+        """
+        Look up every clique that a CURIE belongs to.
+
+        :return: A list of CurieIndexEntry, which will be empty if the CURIE isn't in any of our compendia.
+        """
+        entries = []
+        for compendium, table in self.shards:
+            for line in table.get(curie):
+                entries.append(CurieIndexEntry(curie, compendium, *line.split('\t')[1:3]))
+        return entries
+
+    def get(self, curie):
+        """
+        Look up the first clique that a CURIE belongs to.
+
+        :return: A CurieIndexEntry, or None if the CURIE isn't in any of our compendia.
+        """
+        for compendium, table in self.shards:
+            lines = table.get(curie)
+            if lines:
+                return CurieIndexEntry(curie, compendium, *lines[0].split('\t')[1:3])
+        return None
+
+    def get_clique_leader(self, curie):
+        """
+        Return the clique leader of the first clique that a CURIE belongs to, or None if it isn't in any compendium.
+        """
+        entry = self.get(curie)
+        return entry.clique_leader if entry is not None else None
+
+    def iter_prefix(self, prefix):
+        """
+        Iterate over the entries for every CURIE that starts with a prefix (e.g. 'UMLS:'), one shard at a time. Only
+        the part of each shard that contains these CURIEs is read.
+
+        :return: An iterator of CurieIndexEntry.
+        """
+        for compendium, table in self.shards:
+            for line in table.iter_prefix(prefix):
+                curie, clique_leader, biolink_type = line.split('\t')[0:3]
+                yield CurieIndexEntry(curie, compendium, clique_leader, biolink_type)
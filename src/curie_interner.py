@@ -0,0 +1,241 @@
+"""
+curie_interner.py - a compact, shared table of CURIEs.
+
+Most of our builders hold hundreds of millions of CURIEs as separate Python strings in dictionaries, sets and lists,
+and a single Python string costs around fifty bytes of overhead before we even get to its characters. Since most of
+these CURIEs share a small number of prefixes and have numerical local IDs, we can do a lot better:
+
+- CurieInterner splits every CURIE into a prefix and a local ID (suffix). Prefixes are stored once and referred to by a
+  small integer code. Numerical suffixes (e.g. the `962` in `PUBCHEM.COMPOUND:962`) are stored as 64-bit integers in an
+  array; other suffixes are stored as strings. Every CURIE is then represented by an integer handle, which can be used
+  to index into other arrays.
+- CurieMap is a dictionary-like mapping from CURIEs to CURIEs (e.g. from every CURIE to its preferred CURIE) that is
+  stored as an array of handles.
+
+Handles are assigned sequentially starting from zero, so code that builds parallel arrays can simply append to them
+whenever a new handle is handed out.
+
+This is used for the large in-memory indexes that a builder holds for the whole of a build:
+- UnionFind (src/unionfind.py), and therefore every glom() into a UnionFind or IncrementalGlom.
+- drugchemical.build_conflation(): the preferred CURIE, clique and type lookups for every chemical.
+- geneprotein.build_conflation() and geneprotein.build_compendium(): the gene/protein pairs and the concord lookups.
+- synonymconflation: the conflation index.
+- InformationContentFactory (src/node.py): the information content value of every CURIE in icRDF.tsv.
+
+The other factories in src/node.py are deliberately not converted. Their per-prefix labels, synonyms and descriptions
+are memory-mapped sorted string tables (src/sstable.py) and their taxa are SQLite databases, so they aren't held as
+Python objects at all; the common labels and descriptions that they do keep in memory are dominated by the text of the
+labels and descriptions rather than by their CURIEs. Compendium records are also still read and written as strings,
+since each one is only held in memory while it is being processed.
+"""
+from array import array
+
+
+def is_numerical_suffix(suffix):
+    """
+    Check whether a CURIE suffix can be stored as an integer and turned back into exactly the same string.
+
+    :param suffix: A CURIE suffix.
+    :return: True if this suffix can be round-tripped through an integer.
+    """
+    return (
+        0 < len(suffix) <= 18
+        and suffix.isascii()
+        and suffix.isdigit()
+        and (suffix[0] != '0' or suffix == '0')
+    )
+
+
+class CurieInterner:
+    """
+    An append-only table of CURIEs, each of which is identified by an integer handle.
+    """
+
+    def __init__(self, curies=None):
+        # Prefix code -> prefix, and prefix -> prefix code.
+        self.prefixes = []
+        self.prefix_codes = {}
+
+        # For each handle: the prefix code, and either the numerical suffix (if >= 0) or -1 - (an index into
+        # self.suffix_strings).
+        self.handle_prefix = array('l')
+        self.handle_suffix = array('q')
+        self.suffix_strings = []
+
+        # For each prefix code, a dictionary of suffix (an int for numerical suffixes, a str otherwise) -> handle.
+        self.handles_by_prefix = []
+
+        if curies is not None:
+            self.update(curies)
+
+    def __str__(self):
+        return f"CurieInterner containing {len(self):,} CURIEs with {len(self.prefixes):,} prefixes"
+
+    def __len__(self):
+        return len(self.handle_prefix)
+
+    def __contains__(self, curie):
+        return self.get(curie) is not None
+
+    def __iter__(self):
+        for handle in range(len(self)):
+            yield self.curie(handle)
+
+    @staticmethod
+    def split(curie):
+        """
+        Split a CURIE into a prefix and a suffix key. The suffix key is an int for numerical suffixes and a str otherwise.
+        CURIEs without a colon are treated as having an empty suffix.
+        """
+        prefix, colon, suffix = curie.partition(':')
+        if not colon:
+            # Not really a CURIE, but we need to be able to round-trip it anyway.
+            return curie, None
+        if is_numerical_suffix(suffix):
+            return prefix, int(suffix)
+        return prefix, suffix
+
+    def get(self, curie, default=None):
+        """
+        Look up the handle for a CURIE without adding it.
+
+        :return: The handle for this CURIE, or default if it hasn't been interned.
+        """
+        prefix, key = self.split(curie)
+        code = self.prefix_codes.get(prefix)
+        if code is None:
+            return default
+        return self.handles_by_prefix[code].get(key, default)
+
+    def intern(self, curie):
+        """
+        Return the handle for a CURIE, adding it to this table if necessary.
+        """
+        prefix, key = self.split(curie)
+        code = self.prefix_codes.get(prefix)
+        if code is None:
+            code = len(self.prefixes)
+            self.prefixes.append(prefix)
+            self.prefix_codes[prefix] = code
+            self.handles_by_prefix.append({})
+        handles = self.handles_by_prefix[code]
+        handle = handles.get(key)
+        if handle is not None:
+            return handle
+
+        handle = len(self.handle_prefix)
+        handles[key] = handle
+        self.handle_prefix.append(code)
+        if isinstance(key, int):
+            self.handle_suffix.append(key)
+        else:
+            self.handle_suffix.append(-1 - len(self.suffix_strings))
+            self.suffix_strings.append(key)
+        return handle
+
+    def add(self, curie):
+        """
+        Add a CURIE to this table (so that it can be used like a set).
+        """
+        self.intern(curie)
+
+    def update(self, curies):
+        """
+        Add an iterable of CURIEs to this table (so that it can be used like a set).
+        """
+        for curie in curies:
+            self.intern(curie)
+
+    def prefix(self, handle):
+        """
+        Return the prefix of the CURIE with this handle.
+        """
+        return self.prefixes[self.handle_prefix[handle]]
+
+    def curie(self, handle):
+        """
+        Return the CURIE with this handle as a string.
+        """
+        prefix = self.prefixes[self.handle_prefix[handle]]
+        suffix = self.handle_suffix[handle]
+        if suffix >= 0:
+            return f"{prefix}:{suffix}"
+        suffix = self.suffix_strings[-1 - suffix]
+        if suffix is None:
+            return prefix
+        return f"{prefix}:{suffix}"
+
+    def curies(self, handles):
+        """
+        Return a list of CURIEs for an iterable of handles.
+        """
+        return [self.curie(handle) for handle in handles]
+
+
+class CurieMap:
+    """
+    A dictionary-like mapping from CURIEs to CURIEs, stored as an array of handles into a CurieInterner. This supports
+    the parts of the dict interface that our builders use (`in`, `[]`, `get()` and `len()`).
+    """
+
+    def __init__(self, interner=None):
+        self.interner = interner if interner is not None else CurieInterner()
+        # Handle -> value handle, or -1 if this handle isn't a key in this map.
+        self.values_by_handle = array('q')
+        self.count = 0
+
+    def __str__(self):
+        return f"CurieMap containing {self.count:,} CURIEs"
+
+    def __len__(self):
+        return self.count
+
+    def get_handle(self, curie):
+        """
+        Return the handle of the value for this CURIE, or None if it isn't in this map.
+        """
+        handle = self.interner.get(curie)
+        if handle is None or handle >= len(self.values_by_handle):
+            return None
+        value = self.values_by_handle[handle]
+        if value < 0:
+            return None
+        return value
+
+    def __contains__(self, curie):
+        return self.get_handle(curie) is not None
+
+    def __getitem__(self, curie):
+        value = self.get_handle(curie)
+        if value is None:
+            raise KeyError(curie)
+        return self.interner.curie(value)
+
+    def get(self, curie, default=None):
+        value = self.get_handle(curie)
+        if value is None:
+            return default
+        return self.interner.curie(value)
+
+    def __setitem__(self, curie, value):
+        handle = self.interner.intern(curie)
+        value_handle = self.interner.intern(value)
+        values = self.values_by_handle
+        if handle >= len(values):
+            values.extend([-1] * (len(self.interner) - len(values)))
+        if values[handle] < 0:
+            self.count += 1
+        values[handle] = value_handle
+
+    def keys(self):
+        for handle, value in enumerate(self.values_by_handle):
+            if value >= 0:
+                yield self.interner.curie(handle)
+
+    def __iter__(self):
+        return self.keys()
+
+    def items(self):
+        for handle, value in enumerate(self.values_by_handle):
+            if value >= 0:
+                yield self.interner.curie(handle), self.interner.curie(value)
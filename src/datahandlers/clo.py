@@ -1,6 +1,7 @@
 import logging
 import re
 
+from src.metadata.content_cache import content_cached
 from src.metadata.provenance import write_download_metadata
 from src.prefixes import CLO
 from src.categories import CELL_LINE
@@ -12,10 +13,11 @@ import pyoxigraph
 logger = LoggingUtil.init_logging(__name__, level=logging.WARNING)
 
 def pull_clo(metadata_file):
-    _=pull_via_urllib('http://purl.obolibrary.org/obo/','clo.owl', subpath='CLO', decompress=False)
+    clo_filename = pull_via_urllib('http://purl.obolibrary.org/obo/','clo.owl', subpath='CLO', decompress=False)
     write_download_metadata(metadata_file,
                             name='Cell Line Ontology',
                             url='http://purl.obolibrary.org/obo/clo.owl',
+                            downloaded_files=[clo_filename],
                             )
 
 class CLOgraph:
@@ -154,6 +156,7 @@ class CLOgraph:
                 )
 
 
+@content_cached(inputs=['infile'], outputs=['labelfile', 'synfile'])
 def make_labels(infile,labelfile,synfile):
     m = CLOgraph(infile)
     m.pull_CLO_labels_and_synonyms(labelfile,synfile)
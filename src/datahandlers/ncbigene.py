@@ -1,10 +1,13 @@
 from src.babel_utils import make_local_name, pull_via_urllib
+from src.downloads import get_download_manager
 import gzip
 
+from src.metadata.content_cache import content_cached
+
 
 def pull_ncbigene(filenames):
-    for fn in filenames:
-        pull_via_urllib('https://ftp.ncbi.nlm.nih.gov/gene/DATA/', fn, decompress=False, subpath='NCBIGene')
+    url_prefix = 'https://ftp.ncbi.nlm.nih.gov/gene/DATA/'
+    get_download_manager().download_all([(url_prefix + fn, make_local_name(fn, subpath='NCBIGene')) for fn in filenames])
 
 def get_ncbigene_field(row, header, field_name):
     """
@@ -21,6 +24,8 @@ def get_ncbigene_field(row, header, field_name):
         return ''
     return value
 
+@content_cached(inputs=['gene_info_filename'],
+                outputs=['labels_filename', 'synonyms_filename', 'taxa_filename', 'descriptions_filename'])
 def pull_ncbigene_labels_synonyms_and_taxa(gene_info_filename, labels_filename, synonyms_filename, taxa_filename, descriptions_filename):
     """
     Extract labels, synonyms, and taxonomic data for genes from the NCBIGene "gene_info.gz" file
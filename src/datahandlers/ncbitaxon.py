@@ -1,14 +1,16 @@
-import gzip
 import logging
 from collections import defaultdict
 
 from src.babel_utils import pull_via_ftp
 from src.prefixes import NCBITAXON
+from src.metadata.content_cache import content_cached
+from src.compression import open_compressed
 import tarfile
 
 def pull_ncbitaxon():
     pull_via_ftp('ftp.ncbi.nlm.nih.gov','/pub/taxonomy','taxdump.tar.gz',decompress_data=True,outfilename=f'{NCBITAXON}/taxdump.tar')
 
+@content_cached(inputs=['infile'], outputs=['labelfile', 'synfile', 'propfilegz'])
 def make_labels_and_synonyms(infile,labelfile,synfile,propfilegz):
     """
     Generate labels and synonyms for NCBITaxon IDs.
@@ -32,7 +34,7 @@ def make_labels_and_synonyms(infile,labelfile,synfile,propfilegz):
     # we put that into a dictionary and write them out separately later.
     names_by_txid = {}
 
-    with open(labelfile,'w') as labelf, open(synfile,'w') as outsyn, gzip.open(propfilegz,'wt') as propf:
+    with open(labelfile,'w') as labelf, open(synfile,'w') as outsyn, open_compressed(propfilegz,'wt') as propf:
         for line in l:
             sline = line.decode('utf-8').strip().split('|')
             parts = [x.strip() for x in sline]
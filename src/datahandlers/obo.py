@@ -5,6 +5,7 @@ from pathlib import Path
 from src.ubergraph import UberGraph
 from src.babel_utils import make_local_name, pull_via_ftp
 from collections import defaultdict
+from itertools import groupby
 import os, gzip
 from json import loads,dumps
 
@@ -40,47 +41,46 @@ def pull_uber_labels(outputfile, prefix_labels_files_to_generate):
     :return: None
     """
 
-    # Load all the labels from UberGraph.
+    # Stream all the labels from UberGraph (sorted by IRI) into the common output file, and into the label files for
+    # the prefixes that need them.
     uber = UberGraph()
-    labels = uber.get_all_labels()
-    ldict = defaultdict(set)
-    for unit in labels:
-        iri = unit['iri']
-        p = iri.split(':')[0]
-        ldict[p].add( ( unit['iri'], unit['label'] ) )
-
-    # Write out the common output file.
-    with open(outputfile, 'w') as outf:
-        for p in ldict:
-            if p not in ['http','ro'] and not p.startswith('t') and '#' not in p:
-                for unit in ldict[p]:
-                    outf.write(f'{unit[0]}\t{unit[1]}\n')
-
-    # Create prefix directories and label files for some prefixes.
-    for prefix_labels_file in prefix_labels_files_to_generate:
-        prefix_dir = Path(prefix_labels_file).parent
-        prefix = prefix_dir.name
-        os.makedirs(prefix_dir, exist_ok=True)
-        if prefix not in ldict:
+    prefix_files = {}
+    prefixes_seen = set()
+    try:
+        for prefix_labels_file in prefix_labels_files_to_generate:
+            prefix_dir = Path(prefix_labels_file).parent
+            os.makedirs(prefix_dir, exist_ok=True)
+            prefix_files[prefix_dir.name] = open(prefix_labels_file, 'w')
+
+        with open(outputfile, 'w') as outf:
+            for unit in uber.get_all_labels():
+                iri = unit['iri']
+                p = iri.split(':')[0]
+                line = f'{unit["iri"]}\t{unit["label"]}\n'
+                prefixes_seen.add(p)
+                if p not in ['http','ro'] and not p.startswith('t') and '#' not in p:
+                    outf.write(line)
+                if p in prefix_files:
+                    prefix_files[p].write(line)
+    finally:
+        for prefix_file in prefix_files.values():
+            prefix_file.close()
+
+    for prefix in prefix_files:
+        if prefix not in prefixes_seen:
             raise ValueError(f'Prefix {prefix} not found in UberGraph labels download.')
-        with open(prefix_labels_file, 'w') as outf:
-            for unit in ldict[prefix]:
-                outf.write(f'{unit[0]}\t{unit[1]}\n')
 
 
 def pull_uber_descriptions(jsonloutputfile):
     uber = UberGraph()
-    descriptions = uber.get_all_descriptions()
-    descriptions_by_curie = defaultdict(list)
-    for unit in descriptions:
-        descriptions_by_curie[unit['iri']].append(unit['description'])
-
+    # Descriptions are downloaded sorted by IRI, so all the descriptions for a CURIE are next to each other.
     with open(jsonloutputfile, 'w') as outf:
-        for curie in descriptions_by_curie.keys():
+        for curie, units in groupby(uber.get_all_descriptions(), key=lambda unit: unit['iri']):
+            descriptions = [unit['description'] for unit in units]
             try:
                 prefix = Text.get_prefix(curie)
                 if prefix not in ['http','ro'] and not prefix.startswith('t') and '#' not in prefix:
-                    outf.write(json.dumps({ 'curie': curie, 'descriptions': descriptions_by_curie[curie] }) + '\n')
+                    outf.write(json.dumps({ 'curie': curie, 'descriptions': descriptions }) + '\n')
             except ValueError:
                 # Couldn't extract a prefix for this CURIE, so let's ignore it.
                 continue
@@ -97,42 +97,33 @@ def pull_uber_synonyms(jsonloutputfile, prefix_synonyms_files_to_generate):
     :type prefix_synonyms_files_to_generate: list[str]
     :return: None
     """
-    # Load all the synonyms from UberGraph.
+    # Stream all the synonyms from UberGraph. They are sorted by IRI, so all the synonyms for a CURIE are next to each
+    # other, and we only need to group the synonyms for one CURIE by predicate at a time.
     uber = UberGraph()
-    synonyms = uber.get_all_synonyms()
-    ldict = defaultdict(dict)
-    for unit in synonyms:
-        curie = unit[0]
-        predicate = unit[1]
-        synonym = unit[2]
-        if predicate not in ldict[curie]:
-            ldict[curie][predicate] = []
-        ldict[curie][predicate].append(synonym)
-
-    # Write all the synonyms into a common synonym file.
     with open(jsonloutputfile, 'w') as outf:
-        for curie in ldict.keys():
+        for curie, units in groupby(uber.get_all_synonyms(), key=lambda unit: unit[0]):
             try:
                 prefix = Text.get_prefix(curie)
             except ValueError:
                 continue
 
             if prefix not in ['http','ro'] and not prefix.startswith('t') and '#' not in prefix:
-                for predicate in ldict[curie].keys():
-                    for synonym in ldict[curie][predicate]:
+                synonyms_by_predicate = defaultdict(list)
+                for _, predicate, synonym in units:
+                    synonyms_by_predicate[predicate].append(synonym)
+                for predicate, synonyms in synonyms_by_predicate.items():
+                    for synonym in synonyms:
                         outf.write(json.dumps({'curie': curie, 'predicate': predicate, 'synonym': synonym}) + '\n')
 
-    # Create directories and synonyms files for some synonyms.
+    # Create directories and synonyms files for some synonyms. The synonyms were only ever grouped by CURIE, not by
+    # prefix, so these files are placeholders that are only needed to keep Snakemake happy.
     for prefix_synonyms_file in prefix_synonyms_files_to_generate:
         prefix_dir = Path(prefix_synonyms_file).parent
         prefix = prefix_dir.name
         os.makedirs(prefix_dir, exist_ok=True)
         with open(prefix_synonyms_file, 'w') as outf:
-            if prefix not in ldict:
-                logging.warning(f'Prefix {prefix} not found in UberGraph synonyms download.')
-                outf.write('')
-            for unit in ldict[prefix]:
-                outf.write(f'{unit[0]}\t{unit[1]}\n')
+            logging.warning(f'Prefix {prefix} not found in UberGraph synonyms download.')
+            outf.write('')
 
 def pull_uber(expected_ontologies, icrdf_filename):
     pull_uber_icRDF(icrdf_filename)
@@ -145,12 +136,12 @@ def write_obo_ids(irisandtypes,outfile,order,exclude=[]):
     uber = UberGraph()
     iris_to_types=defaultdict(set)
     for iri,ntype in irisandtypes:
-        uberres = uber.get_subclasses_of(iri)
+        uberres = uber.stream_subclasses_of(iri)
         for k in uberres:
             iris_to_types[k['descendent']].add(ntype)
     excludes = []
     for excluded_iri in exclude:
-        excludes += uber.get_subclasses_of(excluded_iri)
+        excludes += uber.stream_subclasses_of(excluded_iri)
     excluded_iris = set( [k['descendent'] for k in excludes ])
     prefix = Text.get_curie(iri)
     with open(outfile, 'w') as idfile:
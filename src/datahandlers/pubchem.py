@@ -1,5 +1,7 @@
 from src.prefixes import PUBCHEMCOMPOUND
-from src.babel_utils import pull_via_wget
+from src.babel_utils import make_local_name
+from src.downloads import get_download_manager
+from src.metadata.content_cache import content_cached
 import gzip
 import requests
 import json
@@ -13,8 +15,8 @@ def pull_pubchem_structures():
     pull(files)
 
 def pull(files):
-    for f in files:
-        pull_via_wget('https://ftp.ncbi.nlm.nih.gov/pubchem/Compound/Extras/', f, decompress=False, subpath=PUBCHEMCOMPOUND)
+    url_prefix = 'https://ftp.ncbi.nlm.nih.gov/pubchem/Compound/Extras/'
+    get_download_manager().download_all([(url_prefix + f, make_local_name(f, subpath=PUBCHEMCOMPOUND)) for f in files])
 
 def pull_rxnorm_annotations(outname):
     pagenum = 1
@@ -30,6 +32,7 @@ def pull_rxnorm_annotations(outname):
     with open(outname,"w") as outf:
         outf.write(json.dumps(base_response,indent=4))
 
+@content_cached(inputs=['infile'], outputs=['outfile'])
 def make_labels_or_synonyms(infile,outfile):
     with gzip.open(infile, 'r') as inf, open(outfile,'w') as outf:
         for l in inf:
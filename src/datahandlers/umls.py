@@ -1,3 +1,4 @@
+from src.metadata.content_cache import content_cached
 from src.metadata.provenance import write_concord_metadata
 from src.prefixes import UMLS, RXCUI
 from src.babel_utils import make_local_name
@@ -272,8 +273,11 @@ def build_sets(mrconso, umls_input, umls_output , other_prefixes, bad_mappings=d
            concord_filename=umls_output,
        )
 
+# The precedence of UMLS sources and term types, used to pick the label for each UMLS concept.
+UMLS_PRECEDENCE_FILENAME = os.path.join('input_data', 'umls_precedence.txt')
+
 def read_umls_priority():
-    mrp = os.path.join('input_data', 'umls_precedence.txt')
+    mrp = UMLS_PRECEDENCE_FILENAME
     pris = []
     with open(mrp,'r') as inf:
         h =inf.readline()
@@ -383,12 +387,12 @@ def download_rxnorm(rxnorm_version, download_dir):
 
 
 
-def pull_umls(mrconso):
+@content_cached(inputs=['mrconso'], outputs=['lname', 'sname', 'snomed_label_name', 'snomed_syn_name'],
+                extra_inputs=[UMLS_PRECEDENCE_FILENAME])
+def pull_umls(mrconso, lname, sname, snomed_label_name, snomed_syn_name):
     """Run through MRCONSO.RRF creating label and synonym files for UMLS and SNOMEDCT"""
     rows = defaultdict(list)
     priority = read_umls_priority()
-    snomed_label_name = make_local_name('labels', subpath='SNOMEDCT')
-    snomed_syn_name = make_local_name('synonyms', subpath='SNOMEDCT')
     with open(mrconso, 'r') as inf, open(snomed_label_name,'w') as snolabels, open(snomed_syn_name,'w') as snosyns:
         for line in inf:
             if not check_mrconso_line(line):
@@ -417,8 +421,6 @@ def pull_umls(mrconso):
                 #print(pkey)
                 pri = 1000000
             rows[cui].append( (pri,term,line) )
-    lname = make_local_name('labels', subpath='UMLS')
-    sname = make_local_name('synonyms', subpath='UMLS')
     re_numerical = re.compile(r"^\s*[+-]*[\d\.]+\s*$")
     with open(lname,'w') as labels, open(sname,'w') as synonyms:
         for cui,crows in rows.items():
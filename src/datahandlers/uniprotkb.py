@@ -6,10 +6,12 @@ import requests
 from requests import request
 
 from src.babel_utils import pull_via_urllib, make_local_name, pull_via_wget
+from src.metadata.content_cache import content_cached
 
 
-def readlabels(which):
-    swissname = make_local_name(f'UniProtKB/uniprot_{which}.fasta')
+def readlabels(which, swissname=None):
+    if swissname is None:
+        swissname = make_local_name(f'UniProtKB/uniprot_{which}.fasta')
     swissprot_labels = {}
     with open(swissname,'r') as inf:
         for line in inf:
@@ -22,9 +24,10 @@ def readlabels(which):
                 swissprot_labels[uniprotid] = f'{name} ({which})'
     return swissprot_labels
 
+@content_cached(inputs=['sprotfile', 'tremblfile'], outputs=['fname'])
 def pull_uniprot_labels(sprotfile,tremblfile,fname):
-    slabels = readlabels('sprot')
-    tlabels = readlabels('trembl')
+    slabels = readlabels('sprot', sprotfile)
+    tlabels = readlabels('trembl', tremblfile)
     with open(fname,'w') as labelfile:
         for k,v in slabels.items():
             labelfile.write(f'{k}\t{v}\n')
@@ -0,0 +1,488 @@
+"""
+downloads.py - a download manager that fetches files over HTTP(S) and FTP in parallel, and can resume them.
+
+pull_via_urllib(), pull_via_ftp() and pull_via_wget() used to download one file at a time, so sources made up of many
+files (e.g. the PubMed baseline or the PubChem extras) were fetched one after another. They now delegate to a
+DownloadManager, which:
+- Runs up to `download_workers` transfers at a time, but no more than `download_workers_per_host` to any one host, so
+  that we don't get throttled (or banned) by a single server.
+- Reads DOWNLOAD_BLOCK_SIZE bytes at a time.
+- Splits large HTTP downloads from servers that accept byte ranges into segments of DOWNLOAD_SEGMENT_SIZE bytes, which
+  are downloaded in parallel. FTP downloads are a single stream per file, but can be restarted from any offset.
+- Downloads into `<filename>.part`, and keeps a manifest in `<filename>.download.json` that records the size and
+  modification time of the remote file and the byte ranges that have been completed. If a download is interrupted, the
+  next attempt only fetches the missing ranges (as long as the remote file hasn't changed).
+- Records the SHA-256 hash of every completed file in its manifest (and checks it against an expected hash if one is
+  given), and skips downloads whose manifests show that the local file is identical to the remote file -- the same as
+  wget's `--timestamping`.
+"""
+import ftplib
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple
+from urllib.parse import urlparse
+
+from src.metadata.content_cache import hash_file
+from src.util import get_config, get_logger, get_memory_usage_summary
+
+logger = get_logger(__name__)
+
+# Change this if the format of the download manifests changes, so that old manifests are ignored.
+DOWNLOAD_MANIFEST_FORMAT_VERSION = 1
+
+# How many bytes to read from the network at a time.
+DOWNLOAD_BLOCK_SIZE = 8 * 1024 * 1024
+
+# How large should the segments of a ranged HTTP download be?
+DOWNLOAD_SEGMENT_SIZE = 256 * 1024 * 1024
+
+# How often (in bytes) should we record the progress of a segment in the manifest?
+DOWNLOAD_MANIFEST_EVERY = 64 * 1024 * 1024
+
+# How long to wait (in seconds) before retrying a failed transfer, and how long to wait for a server to respond.
+DOWNLOAD_RETRY_DELAY = 5
+DOWNLOAD_TIMEOUT = 300
+
+# HTTP status codes in the 4xx range that are worth retrying (Request Timeout and Too Many Requests). Any other 4xx
+# error (such as 403 Forbidden or 404 Not Found) won't go away if we try again.
+RETRYABLE_HTTP_CLIENT_ERRORS = {408, 429}
+
+
+class DownloadError(RuntimeError):
+    """A file could not be downloaded."""
+
+
+def is_permanent_error(err):
+    """
+    Is this an error that retrying a transfer won't fix, such as an HTTP 404 or an FTP 550 (file not found)?
+    """
+    if isinstance(err, urllib.error.HTTPError):
+        return 400 <= err.code < 500 and err.code not in RETRYABLE_HTTP_CLIENT_ERRORS
+    return isinstance(err, ftplib.error_perm)
+
+
+class RemoteFileInfo(NamedTuple):
+    """What we know about a remote file before downloading it."""
+    size: int | None
+    last_modified: str | None
+    etag: str | None
+    # Can we download several parts of this file at the same time (HTTP servers that accept ranges)?
+    accepts_ranges: bool
+    # Can we restart a download of this file from any offset (HTTP servers that accept ranges, and FTP servers)?
+    resumable: bool
+
+
+def get_ftp_path(parsed_url):
+    return urllib.request.url2pathname(parsed_url.path)
+
+
+def open_ftp(parsed_url):
+    """
+    Connect and log in to the FTP server of a URL, in binary mode.
+    """
+    ftp = ftplib.FTP(timeout=DOWNLOAD_TIMEOUT)
+    ftp.connect(parsed_url.hostname, parsed_url.port or 21)
+    ftp.login(parsed_url.username or 'anonymous', parsed_url.password or '')
+    ftp.voidcmd('TYPE I')
+    return ftp
+
+
+def get_remote_file_info(url):
+    """
+    Find out the size and modification time of a remote file, and whether we can download parts of it.
+    """
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == 'ftp':
+        ftp = open_ftp(parsed_url)
+        try:
+            path = get_ftp_path(parsed_url)
+            size = ftp.size(path)
+            try:
+                last_modified = ftp.sendcmd(f'MDTM {path}').split()[-1]
+            except ftplib.error_perm:
+                last_modified = None
+        finally:
+            ftp.close()
+        return RemoteFileInfo(size=size, last_modified=last_modified, etag=None, accepts_ranges=False, resumable=True)
+
+    # Ask for the first byte: a server that supports ranges will tell us the full size in the Content-Range header.
+    request = urllib.request.Request(url, headers={'Range': 'bytes=0-0'})
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as err:
+        # A server that supports ranges can't return the first byte of an empty file, so it tells us that the range
+        # is unsatisfiable instead (along with the size of the file, which should be zero).
+        match = re.match(r'bytes \*/(\d+)', err.headers.get('Content-Range', '') if err.headers else '')
+        if err.code != 416 or not match:
+            raise
+        err.close()
+        return RemoteFileInfo(size=int(match.group(1)), last_modified=None, etag=err.headers.get('ETag'),
+                              accepts_ranges=False, resumable=False)
+    with response:
+        headers = response.headers
+        accepts_ranges = response.status == 206
+        size = None
+        if accepts_ranges:
+            match = re.match(r'bytes \d+-\d+/(\d+)', headers.get('Content-Range', ''))
+            if match:
+                size = int(match.group(1))
+            else:
+                accepts_ranges = False
+        elif headers.get('Content-Length') is not None:
+            size = int(headers['Content-Length'])
+        last_modified = headers.get('Last-Modified')
+        if last_modified is not None:
+            last_modified = parsedate_to_datetime(last_modified).isoformat()
+        return RemoteFileInfo(size=size, last_modified=last_modified, etag=headers.get('ETag'), accepts_ranges=accepts_ranges,
+                              resumable=accepts_ranges)
+
+
+def list_ftp_directory(url, recursive=False):
+    """
+    List the files in an FTP directory.
+
+    :param url: The URL of the directory (e.g. 'ftp://ftp.ncbi.nlm.nih.gov/pubmed/baseline/').
+    :param recursive: Whether to list the files in its subdirectories as well.
+    :return: A list of file URLs.
+    """
+    parsed_url = urlparse(url)
+    ftp = open_ftp(parsed_url)
+    try:
+        file_urls = []
+        directories = [get_ftp_path(parsed_url).rstrip('/') + '/']
+        while directories:
+            directory = directories.pop(0)
+            try:
+                entries = [(name, facts.get('type')) for name, facts in ftp.mlsd(directory, facts=['type'])]
+            except ftplib.error_perm:
+                # This server doesn't support MLSD, so we can't tell files and directories apart.
+                entries = [(os.path.basename(name), 'file') for name in ftp.nlst(directory)]
+            for name, entry_type in sorted(entries):
+                if entry_type == 'file':
+                    file_urls.append(parsed_url._replace(path=urllib.request.pathname2url(directory + name)).geturl())
+                elif entry_type == 'dir' and recursive:
+                    directories.append(directory + name + '/')
+        return file_urls
+    finally:
+        ftp.close()
+
+
+class FileDownload:
+    """
+    The state of a single file download, which is kept in its manifest.
+    """
+
+    def __init__(self, url, filename, sha256=None):
+        self.url = url
+        self.filename = filename
+        self.expected_sha256 = sha256
+        self.part_filename = f"{filename}.part"
+        self.manifest_filename = f"{filename}.download.json"
+        self.host = urlparse(url).hostname
+        self.lock = threading.Lock()
+        self.remote = None
+        self.completed = []
+
+    def __str__(self):
+        return f"FileDownload({self.url} -> {self.filename})"
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_filename):
+            return None
+        with open(self.manifest_filename, 'r') as inf:
+            manifest = json.load(inf)
+        if manifest.get('version') != DOWNLOAD_MANIFEST_FORMAT_VERSION or manifest.get('url') != self.url:
+            return None
+        return manifest
+
+    def save_manifest(self, **extra):
+        manifest = {
+            'version': DOWNLOAD_MANIFEST_FORMAT_VERSION,
+            'url': self.url,
+            'remote': self.remote._asdict(),
+            'completed': self.completed,
+            **extra,
+        }
+        tmp_filename = f"{self.manifest_filename}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_filename, 'w') as outf:
+            json.dump(manifest, outf, indent=2)
+        os.replace(tmp_filename, self.manifest_filename)
+
+    def prepare(self, force=False):
+        """
+        Compare the remote file with the manifest, and work out which byte ranges still need to be downloaded.
+
+        :param force: Download the file from scratch, even if we already have it or part of it.
+        :return: None if the local file is already up to date. Otherwise, a list of (start, end) ranges to download, in
+            which end may be None if the size of the file is unknown. An empty list means that there is nothing left to
+            download (e.g. the remote file is empty, or an earlier attempt downloaded every range but was interrupted
+            before it was finished), but the part file still needs to be finished.
+        """
+        self.remote = get_remote_file_info(self.url)
+        manifest = None if force else self.load_manifest()
+        same_remote = manifest is not None and manifest['remote'] == self.remote._asdict()
+
+        if same_remote and manifest.get('sha256') and os.path.exists(self.filename) and \
+                (self.remote.last_modified is not None or self.remote.etag is not None) and \
+                os.path.getsize(self.filename) == self.remote.size and \
+                (self.expected_sha256 is None or manifest['sha256'] == self.expected_sha256):
+            logger.info(f"{self.filename} is already up to date with {self.url}, skipping download.")
+            return None
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        if same_remote and os.path.exists(self.part_filename) and self.remote.size is not None and self.remote.resumable:
+            self.completed = [list(completed_range) for completed_range in manifest['completed']]
+            logger.info(f"Resuming {self}, {self.get_completed_bytes():,} of {self.remote.size:,} bytes already downloaded.")
+        else:
+            self.completed = []
+            with open(self.part_filename, 'wb'):
+                pass
+        self.save_manifest()
+
+        if self.remote.size is None:
+            return [(0, None)]
+        missing = self.get_missing_ranges()
+        if not self.remote.accepts_ranges:
+            # We can only download a single stream per file, starting from the first missing byte.
+            return [(missing[0][0], self.remote.size)] if missing else []
+        segments = []
+        for start, end in missing:
+            for segment_start in range(start, end, DOWNLOAD_SEGMENT_SIZE):
+                segments.append((segment_start, min(end, segment_start + DOWNLOAD_SEGMENT_SIZE)))
+        return segments
+
+    def get_completed_bytes(self):
+        return sum(end - start for start, end in self.completed)
+
+    def get_missing_ranges(self):
+        """
+        Return the (start, end) ranges of the file that haven't been completed yet.
+        """
+        missing = []
+        position = 0
+        for start, end in self.completed:
+            if start > position:
+                missing.append((position, start))
+            position = max(position, end)
+        if position < self.remote.size:
+            missing.append((position, self.remote.size))
+        return missing
+
+    def mark_completed(self, start, end):
+        """
+        Record that a byte range has been written to the part file, merging it with the other completed ranges.
+        """
+        if end <= start:
+            return
+        with self.lock:
+            merged = []
+            for completed_start, completed_end in sorted(self.completed + [[start, end]]):
+                if merged and completed_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], completed_end)
+                else:
+                    merged.append([completed_start, completed_end])
+            self.completed = merged
+            self.save_manifest()
+
+    def download_range(self, start, end):
+        """
+        Download the bytes from start to end (or to the end of the file, if end is None) into the part file, recording
+        our progress in the manifest as we go.
+        """
+        # If an earlier attempt at this segment got part of the way through, carry on from there.
+        if self.remote.resumable:
+            for completed_start, completed_end in self.completed:
+                if completed_start <= start < completed_end:
+                    start = completed_end
+        if end is not None and start >= end:
+            return
+
+        parsed_url = urlparse(self.url)
+        with open(self.part_filename, 'r+b') as outf:
+            outf.seek(start)
+            position = start
+            recorded = start
+
+            def write(block):
+                nonlocal position, recorded
+                outf.write(block)
+                position += len(block)
+                if position - recorded >= DOWNLOAD_MANIFEST_EVERY:
+                    outf.flush()
+                    self.mark_completed(recorded, position)
+                    recorded = position
+
+            if parsed_url.scheme == 'ftp':
+                ftp = open_ftp(parsed_url)
+                try:
+                    with ftp.transfercmd(f'RETR {get_ftp_path(parsed_url)}', rest=start or None) as conn:
+                        while True:
+                            block = conn.recv(DOWNLOAD_BLOCK_SIZE)
+                            if not block:
+                                break
+                            write(block)
+                    ftp.voidresp()
+                finally:
+                    ftp.close()
+            else:
+                headers = {}
+                if end is not None and self.remote.accepts_ranges:
+                    headers['Range'] = f'bytes={start}-{end - 1}'
+                elif start > 0:
+                    raise DownloadError(f"Cannot resume {self} at byte {start}: the server doesn't accept ranges.")
+                request = urllib.request.Request(self.url, headers=headers)
+                with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+                    if 'Range' in headers and response.status != 206:
+                        raise DownloadError(f"Server ignored the range request {headers['Range']} for {self}.")
+                    while True:
+                        block = response.read(DOWNLOAD_BLOCK_SIZE)
+                        if not block:
+                            break
+                        write(block)
+
+            if self.remote.size is None:
+                # We didn't know how large this file was, so drop anything left over from an earlier attempt.
+                outf.truncate()
+            outf.flush()
+            if end is not None and position != end:
+                self.mark_completed(recorded, position)
+                raise DownloadError(f"Transfer of bytes {start}-{end} of {self} ended early at byte {position}.")
+            self.mark_completed(recorded, position)
+
+    def finish(self):
+        """
+        Check the completed part file, record its hash in the manifest and move it into place.
+        """
+        size = os.path.getsize(self.part_filename)
+        if self.remote.size is not None and size != self.remote.size:
+            raise DownloadError(f"Downloaded {size:,} bytes for {self}, but expected {self.remote.size:,} bytes.")
+        # We hash the file once it's in place, so that the content cache can reuse the hash.
+        os.replace(self.part_filename, self.filename)
+        sha256 = hash_file(self.filename)
+        if self.expected_sha256 is not None and sha256 != self.expected_sha256:
+            os.remove(self.filename)
+            os.remove(self.manifest_filename)
+            raise DownloadError(f"Downloaded file for {self} has SHA-256 hash {sha256}, but expected {self.expected_sha256}.")
+        self.completed = [[0, size]]
+        self.save_manifest(sha256=sha256)
+        logger.info(f"Downloaded {self.filename} from {self.url} ({size:,} bytes, SHA-256 {sha256}).")
+
+
+class DownloadManager:
+    """
+    Download files over HTTP(S) and FTP in parallel, with a limit on the number of concurrent transfers per host.
+    """
+
+    def __init__(self, max_workers=None, max_workers_per_host=None, retries=None):
+        """
+        :param max_workers: The maximum number of concurrent transfers (defaults to `download_workers` in the config).
+        :param max_workers_per_host: The maximum number of concurrent transfers to a single host (defaults to
+            `download_workers_per_host` in the config).
+        :param retries: How many times to retry a failed transfer (defaults to `download_retries` in the config).
+        """
+        config = get_config()
+        self.max_workers = max_workers or config.get('download_workers', 8)
+        self.max_workers_per_host = max_workers_per_host or config.get('download_workers_per_host', 4)
+        self.retries = retries if retries is not None else config.get('download_retries', 10)
+        self.host_semaphores = defaultdict(lambda: threading.BoundedSemaphore(self.max_workers_per_host))
+        self.host_semaphores_lock = threading.Lock()
+
+    def get_host_semaphore(self, host):
+        with self.host_semaphores_lock:
+            return self.host_semaphores[host]
+
+    def download(self, url, filename, sha256=None, force=False, retries=None):
+        """
+        Download a single file.
+
+        :param url: The URL to download.
+        :param filename: The local filename to write it to.
+        :param sha256: The expected SHA-256 hash of the file, if known.
+        :param force: Download the file again, even if the local file is already up to date.
+        :param retries: How many times to retry a failed transfer (defaults to the retries of this download manager).
+        :return: The local filename.
+        """
+        return self.download_all([(url, filename, sha256)], force=force, retries=retries)[0]
+
+    def download_all(self, downloads, force=False, retries=None):
+        """
+        Download several files in parallel.
+
+        :param downloads: A list of (url, filename) or (url, filename, sha256) tuples.
+        :param force: Download the files again, even if the local files are already up to date.
+        :param retries: How many times to retry a failed transfer (defaults to the retries of this download manager).
+        :return: The list of local filenames, in the same order as downloads.
+        """
+        if retries is None:
+            retries = self.retries
+        file_downloads = [FileDownload(*download) for download in downloads]
+        logger.info(f"Downloading {len(file_downloads):,} files with {self.max_workers} workers "
+                    f"({self.max_workers_per_host} per host): {get_memory_usage_summary()}")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Step 1. Work out what needs to be downloaded for each file.
+            segments_by_download = {}
+            futures = {executor.submit(self.with_retries, retries, file_download, file_download.prepare, force): file_download
+                       for file_download in file_downloads}
+            for future in as_completed(futures):
+                segments_by_download[futures[future]] = future.result()
+
+            # Step 2. Download all the segments of all the files, and finish each file once all its segments are done.
+            # Files that are already up to date have no segments (None), while files that have nothing left to download
+            # (an empty list) can be finished straight away.
+            remaining_segments = {file_download: len(segments) for file_download, segments in segments_by_download.items()
+                                  if segments is not None}
+            futures = {}
+            for file_download in file_downloads:
+                if segments_by_download[file_download] == []:
+                    file_download.finish()
+                for start, end in segments_by_download[file_download] or []:
+                    future = executor.submit(self.with_retries, retries, file_download, file_download.download_range, start, end)
+                    futures[future] = file_download
+            for future in as_completed(futures):
+                future.result()
+                file_download = futures[future]
+                remaining_segments[file_download] -= 1
+                if remaining_segments[file_download] == 0:
+                    file_download.finish()
+
+        return [file_download.filename for file_download in file_downloads]
+
+    def with_retries(self, retries, file_download, function, *args):
+        """
+        Call a function that talks to the host of a download, holding its host semaphore and retrying it if it fails.
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.get_host_semaphore(file_download.host):
+                    return function(*args)
+            except (OSError, ftplib.Error, DownloadError) as err:
+                if is_permanent_error(err):
+                    raise DownloadError(f"Could not download {file_download}: {err}") from err
+                if attempt >= retries:
+                    raise DownloadError(f"Could not download {file_download} after {attempt + 1} attempts: {err}") from err
+                logger.warning(f"Attempt {attempt + 1} to download {file_download} failed, retrying in "
+                               f"{DOWNLOAD_RETRY_DELAY} seconds: {err}")
+                time.sleep(DOWNLOAD_RETRY_DELAY)
+
+
+# The download manager shared by the pull_* helpers in babel_utils.
+_download_manager = None
+
+
+def get_download_manager():
+    """
+    Return the download manager shared by this process, creating it if necessary.
+    """
+    global _download_manager
+    if _download_manager is None:
+        _download_manager = DownloadManager()
+    return _download_manager
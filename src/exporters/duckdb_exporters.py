@@ -1,9 +1,11 @@
 # The DuckDB exporter can be used to export particular intermediate files into the
 # in-process database engine DuckDB (https://duckdb.org) for future querying.
+# Compendia are exported directly to Parquet by src/exporters/parquet.py.
 import os.path
 
 import duckdb
 
+from src.exporters.parquet import get_parquet_settings, write_sorted_parquet
 from src.util import get_config
 
 
@@ -21,84 +23,15 @@ def setup_duckdb(duckdb_filename):
     return db
 
 
-def export_compendia_to_parquet(compendium_filename, clique_parquet_filename, duckdb_filename):
-    """
-    Export a compendium to a Parquet file via a DuckDB.
-
-    :param compendium_filename: The compendium filename to read.
-    :param clique_parquet_filename: The filename for the Clique.parquet file.
-    :param duckdb_filename: The DuckDB filename to write. We will write the Parquet files into the directory that
-        this file is located in.
-    """
-
-    # Make sure that duckdb_filename doesn't exist.
-    if os.path.exists(duckdb_filename):
-        raise RuntimeError(f"Will not overwrite existing file {duckdb_filename}")
-
-    duckdb_dir = os.path.dirname(duckdb_filename)
-    os.makedirs(duckdb_dir, exist_ok=True)
-
-    # We'll create these two files as well, but we don't report them back to Snakemake for now.
-    parquet_dir = os.path.dirname(clique_parquet_filename)
-    os.makedirs(parquet_dir, exist_ok=True)
-    edge_parquet_filename = os.path.join(parquet_dir, 'Edge.parquet')
-    node_parquet_filename = os.path.join(parquet_dir, 'Node.parquet')
-
-    with setup_duckdb(duckdb_filename) as db:
-        # Step 1. Load the entire synonyms file.
-        compendium_jsonl = db.read_json(compendium_filename, format='newline_delimited')
-
-        # TODO: add props
-
-        # Step 2. Create a Cliques table with all the cliques from this file.
-        db.sql("""CREATE TABLE Clique
-                (clique_leader STRING, preferred_name STRING, clique_identifier_count INT, biolink_type STRING,
-                information_content FLOAT)""")
-        db.sql("""INSERT INTO Clique SELECT
-                        json_extract_string(identifiers, '$[0].i') AS clique_leader,
-                        preferred_name,
-                        len(identifiers) AS clique_identifier_count,
-                        type AS biolink_type,
-                        ic AS information_content
-                    FROM compendium_jsonl""")
-
-        # Step 3. Create an Edge table with all the clique/CURIE relationships from this file.
-        db.sql("CREATE TABLE Edge (clique_leader STRING, curie STRING, conflation STRING)")
-        db.sql("""INSERT INTO Edge SELECT
-                json_extract_string(identifiers, '$[0].i') AS clique_leader,
-                UNNEST(json_extract_string(identifiers, '$[*].i')) AS curie,
-                'None' AS conflation
-            FROM compendium_jsonl""")
-
-        # Step 4. Create a Nodes table with all the nodes from this file.
-        db.sql("""CREATE TABLE Node (curie STRING, label STRING, label_lc STRING, description STRING[])""")
-        db.sql("""INSERT INTO Node
-            SELECT
-                json_extract_string(identifier, '$.identifiers.i') AS curie,
-                json_extract_string(identifier, '$.identifiers.l') AS label,
-                LOWER(label) AS label_lc,
-                json_extract_string(identifier, '$.identifiers.d') AS description
-            FROM compendium_jsonl, UNNEST(identifiers) AS identifier""")
-
-        # Step 5. Export as Parquet files.
-        db.sql("SELECT * FROM Clique").write_parquet(
-            clique_parquet_filename
-        )
-        db.sql("SELECT * FROM Edge").write_parquet(
-            edge_parquet_filename
-        )
-        db.sql("SELECT * FROM Node").write_parquet(
-            node_parquet_filename
-        )
-
-
-def export_synonyms_to_parquet(synonyms_filename_gz, duckdb_filename, synonyms_parquet_filename):
+def export_synonyms_to_parquet(synonyms_filename_gz, duckdb_filename, synonyms_parquet_filename, sorted_layout=None):
     """
     Export a synonyms file to a DuckDB directory.
 
     :param synonyms_filename: The synonym file (in JSONL) to export to Parquet.
     :param duckdb_filename: A DuckDB file to temporarily store data in.
     :param synonyms_parquet_filename: The Parquet file to store the synoynms in.
+    :param sorted_layout: If True, sort the synonyms by label_lc and write Bloom filters for lookups (defaults to the
+        `parquet_sorted_layout` config setting).
     """
 
     # Make sure that duckdb_filename doesn't exist.
@@ -137,6 +70,12 @@ def export_synonyms_to_parquet(synonyms_filename_gz, duckdb_filename, synonyms_p
                 FROM synonyms_jsonl""")
 
         # Step 3. Export as Parquet files.
-        db.sql("SELECT clique_leader, preferred_name, preferred_name_lc, biolink_type, label, label_lc FROM Synonym").write_parquet(
-            synonyms_parquet_filename
-        )
+        synonyms_query = "SELECT clique_leader, preferred_name, preferred_name_lc, biolink_type, label, label_lc FROM Synonym"
+        row_group_size, compression, sorted_layout = get_parquet_settings(sorted_layout=sorted_layout)
+        if sorted_layout:
+            write_sorted_parquet(db, synonyms_query, synonyms_parquet_filename, ['label_lc', 'clique_leader'],
+                                 ['label_lc', 'clique_leader'], row_group_size, compression)
+        else:
+            db.sql(synonyms_query).write_parquet(
+                synonyms_parquet_filename
+            )
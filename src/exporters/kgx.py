@@ -2,163 +2,224 @@
 # Knowledge Graph Exchange (KGX, https://github.com/biolink/kgx) format.
 # This file provides code for doing that, based on the code from
 # https://github.com/TranslatorSRI/NodeNormalization/blob/68096b2f16e6c2eedb699178ace71cea98dc794f/node_normalizer/loader.py#L70-L208
-import gzip
-import hashlib
-import json
+import itertools
+import multiprocessing
 import os
-from itertools import combinations
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import logging
+from src.reports.compendium_scanner import get_byte_ranges
+from src.compression import open_compressed
 from src.util import LoggingUtil, get_memory_usage_summary
+from src import json_codec
 
 # Default logger for this file.
 logger = LoggingUtil.init_logging(__name__, level=logging.INFO)
 
+# The edge topologies we can write for each clique: an edge between every pair of identifiers (n*(n-1)/2 edges), or an
+# edge from the clique leader to every other identifier (n-1 edges).
+EDGE_TOPOLOGY_PAIRWISE = 'pairwise'
+EDGE_TOPOLOGY_STAR = 'star'
+EDGE_TOPOLOGIES = {EDGE_TOPOLOGY_PAIRWISE, EDGE_TOPOLOGY_STAR}
 
-def convert_compendium_to_kgx(compendium_filename, kgx_nodes_filename, kgx_edges_filename):
+# How many characters of nodes or edges to buffer before writing them to the gzip file.
+KGX_WRITE_BUFFER_CHARS = 4 * 1024 * 1024
+
+# How often to log our progress.
+KGX_LOG_EVERY_X_LINES = 1_000_000
+
+# Don't bother converting a compendium in parallel unless every shard will have at least this many bytes to convert.
+KGX_MIN_BYTES_PER_SHARD = 64 * 1024 * 1024
+
+
+def get_edge_id(compendium_name, subject, object):
     """
-    Convert a compendium file to KGX (https://github.com/biolink/kgx) format.
+    Return a deterministic ID for a same_as edge. We used to use the MD5 hash of the subject, the object and the
+    compendium filename, but hashing every edge is expensive for large cliques, and made the IDs depend on the directory
+    that the compendia were in. The subject and object of our edges are CURIEs, which can't contain whitespace, so
+    joining them with spaces gives a unique ID without any hashing.
+    """
+    return f"{compendium_name} {subject} {object}"
 
-    Based on the code in https://github.com/TranslatorSRI/NodeNormalization/blob/68096b2f16e6c2eedb699178ace71cea98dc794f/node_normalizer/loader.py#L70-L208
 
-    :param compendium_filename: The compendium file to convert.
-    :param kgx_nodes_gz_filename: The KGX nodes gzipped file to write out.
-    :param kgx_edges_gz_filename: The KGX edges gzipped file to write out.
+def generate_edges(curies, edge_topology):
+    """
+    Generate the (subject, object) pairs of the same_as edges for the CURIEs in a clique, with the clique leader first.
     """
+    if edge_topology == EDGE_TOPOLOGY_STAR:
+        leader = curies[0]
+        for curie in curies[1:]:
+            yield leader, curie
+    else:
+        yield from itertools.combinations(curies, 2)
+
+
+class BufferedWriter:
+    """
+    Collect lines in memory and write them to a file in large chunks, so that we don't call into gzip for every line.
+    """
+
+    def __init__(self, outf):
+        self.outf = outf
+        self.lines = []
+        self.size = 0
+        self.count = 0
 
-    logger.info(f"convert_compendium_to_kgx({compendium_filename}, {kgx_nodes_filename}, {kgx_edges_filename})")
+    def write(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        self.count += 1
+        if self.size >= KGX_WRITE_BUFFER_CHARS:
+            self.flush()
 
-    # Set up data structures.
-    nodes: list = []
-    edges: list = []
-    pass_nodes: list = []
+    def flush(self):
+        if self.lines:
+            self.outf.write(''.join(self.lines))
+            self.lines.clear()
+            self.size = 0
 
+
+def convert_byte_range_to_kgx(compendium_filename, start, end, kgx_nodes_filename, kgx_edges_filename, edge_topology,
+                              compression_workers=None):
+    """
+    Convert the cliques in a byte range of a compendium file to KGX, writing the nodes and edges to new gzipped files.
+    Nodes and edges are written as they are generated, so memory use doesn't depend on the size of the cliques.
+
+    :param compendium_filename: The compendium file to convert.
+    :param start: The offset of the first byte to convert (which must be at the start of a line).
+    :param end: The offset after the last byte to convert (which must be at the end of a line).
+    :param kgx_nodes_filename: The gzipped KGX nodes file to write.
+    :param kgx_edges_filename: The gzipped KGX edges file to write.
+    :param edge_topology: EDGE_TOPOLOGY_PAIRWISE or EDGE_TOPOLOGY_STAR.
+    :param compression_workers: The number of threads to compress the output files with (see src/compression.py).
+    :return: A tuple of (count_lines, count_nodes, count_edges).
+    """
+    compendium_name = os.path.splitext(os.path.basename(compendium_filename))[0]
+    predicate = json_codec.dumps("biolink:same_as")
     count_lines = 0
-    count_nodes = 0
-    count_edges = 0
 
-    # Used to count batches of 100000 lines to process together.
-    batch_size = 100000
-    line_counter = 0
+    with open(compendium_filename, "rb") as compendium, \
+        open_compressed(kgx_nodes_filename, "wt", encoding="utf-8", workers=compression_workers) as node_file, \
+        open_compressed(kgx_edges_filename, "wt", encoding="utf-8", workers=compression_workers) as edge_file:
+        nodes = BufferedWriter(node_file)
+        edges = BufferedWriter(edge_file)
+
+        compendium.seek(start)
+        position = start
+        while position < end:
+            line = compendium.readline()
+            if not line:
+                break
+            position += len(line)
+            if not line.strip():
+                continue
+            count_lines += 1
+            if count_lines % KGX_LOG_EVERY_X_LINES == 0:
+                logger.info(f"Converted {count_lines:,} lines from {compendium_filename} (bytes {start:,} to {end:,}) to KGX: "
+                            f"{get_memory_usage_summary()}")
+
+            instance: dict = json_codec.loads(line)
+            identifiers = instance["identifiers"]
+            if len(identifiers) == 0:
+                continue
+
+            # Every node in a clique shares the same category and equivalent identifiers, so we only encode them once
+            # per clique and splice them into each node.
+            curies = [identifier["i"] for identifier in identifiers]
+            encoded_curies = [json_codec.dumps(curie) for curie in curies]
+            shared_fields = (f',"category":{json_codec.dumps(instance["type"])}'
+                             f',"equivalent_identifiers":[{",".join(encoded_curies)}]}}\n')
+            for identifier, encoded_curie in zip(identifiers, encoded_curies):
+                nodes.write(f'{{"id":{encoded_curie},"name":{json_codec.dumps(identifier.get("l", ""))}{shared_fields}')
+
+            encoded = dict(zip(curies, encoded_curies))
+            for subject, object in generate_edges(curies, edge_topology):
+                edges.write(f'{{"id":{json_codec.dumps(get_edge_id(compendium_name, subject, object))}'
+                            f',"subject":{encoded[subject]},"predicate":{predicate},"object":{encoded[object]}}}\n')
+
+        nodes.flush()
+        edges.flush()
+
+    return count_lines, nodes.count, edges.count
+
+
+def convert_compendium_to_kgx(compendium_filename, kgx_nodes_filename, kgx_edges_filename, edge_topology=EDGE_TOPOLOGY_PAIRWISE,
+                              workers=1):
+    """
+    Convert a compendium file to KGX (https://github.com/biolink/kgx) format.
+
+    Based on the code in https://github.com/TranslatorSRI/NodeNormalization/blob/68096b2f16e6c2eedb699178ace71cea98dc794f/node_normalizer/loader.py#L70-L208
+
+    Large compendia can be converted in parallel: we split the compendium into byte ranges, and each worker converts
+    (and compresses) one of them into its own gzipped shard. A file made of several gzip members is itself a valid
+    gzip file, so we then concatenate the shards in order, which gives the same content as converting the compendium
+    in a single process.
+
+    :param compendium_filename: The compendium file to convert.
+    :param kgx_nodes_filename: The KGX nodes gzipped file to write out.
+    :param kgx_edges_filename: The KGX edges gzipped file to write out.
+    :param edge_topology: EDGE_TOPOLOGY_PAIRWISE to write a same_as edge between every pair of identifiers in a clique,
+        or EDGE_TOPOLOGY_STAR to only write edges from the clique leader to the other identifiers.
+    :param workers: The number of worker processes to use. The compendium is only converted in parallel if every
+        worker would have at least KGX_MIN_BYTES_PER_SHARD bytes to convert.
+    """
+
+    logger.info(f"convert_compendium_to_kgx({compendium_filename}, {kgx_nodes_filename}, {kgx_edges_filename}, "
+                f"edge_topology={edge_topology}, workers={workers})")
+    if edge_topology not in EDGE_TOPOLOGIES:
+        raise ValueError(f"Unknown KGX edge topology '{edge_topology}', should be one of: {sorted(EDGE_TOPOLOGIES)}")
 
     # Make the output directories if they don't exist.
     os.makedirs(os.path.dirname(kgx_nodes_filename), exist_ok=True)
     os.makedirs(os.path.dirname(kgx_edges_filename), exist_ok=True)
 
-    # Open the compendium file for reading.
-    with open(compendium_filename, "r", encoding="utf-8") as compendium:
-        # Open the nodes and edges files for writing.
-        with \
-            gzip.open(kgx_nodes_filename, "wt", encoding="utf-8") as node_file, \
-            gzip.open(kgx_edges_filename, "wt", encoding="utf-8") as edge_file:
-
-            # set the flag for suppressing the first ",\n" in the written data
-            first = True
-
-            # At this point we should validate the compendium file, but the report
-            # has already run, so hopefully it's already validated?
-
-            # for each line in the file
-            for line in compendium:
-                # increment the record counter
-                line_counter += 1
-
-                # clear storage for this pass
-                pass_nodes.clear()
-
-                # load the line into memory
-                instance: dict = json.loads(line)
-
-                # all ids (even the root one) are in the equivalent identifiers
-                if len(instance["identifiers"]) > 0:
-                    # loop through each identifier and create a node
-                    for equiv_id in instance["identifiers"]:
-                        # check to see if there is a label. if there is use it
-                        if "l" in equiv_id:
-                            name = equiv_id["l"]
-                        else:
-                            name = ""
-
-                        # add the node to the ones in this pass
-                        pass_nodes.append(
-                            {
-                                "id": equiv_id["i"],
-                                "name": name,
-                                "category": instance["type"],
-                                "equivalent_identifiers": list(x["i"] for x in instance["identifiers"]),
-                            }
-                        )
-
-                    # get the combinations of the nodes in this pass
-                    combos = combinations(pass_nodes, 2)
-
-                    # for all the node combinations create an edge between them
-                    for c in combos:
-                        # create a unique id
-                        record_id: str = c[0]["id"] + c[1]["id"] + f"{compendium_filename}"
-
-                        # save the edge
-                        edges.append(
-                            {
-                                "id": f'{hashlib.md5(record_id.encode("utf-8")).hexdigest()}',
-                                "subject": c[0]["id"],
-                                "predicate": "biolink:same_as",
-                                "object": c[1]["id"],
-                            }
-                        )
-
-                # save the nodes in this pass to the big list
-                nodes.extend(pass_nodes)
-
-                # did we reach the write threshold
-                if line_counter == batch_size:
-                    # first time in doesn't get a leading comma
-                    if first:
-                        prefix = ""
-                    else:
-                        prefix = "\n"
-
-                    # reset the first record flag
-                    first = False
-
-                    # get all the nodes in a string and write them out
-                    nodes_to_write = prefix + "\n".join([json.dumps(node) for node in nodes])
-                    node_file.write(nodes_to_write)
-                    count_nodes += len(nodes)
-
-                    # are there any edges to output
-                    if len(edges) > 0:
-                        # get all the edges in a string and write them out
-                        edges_to_write = prefix + "\n".join([json.dumps(edge) for edge in edges])
-                        edge_file.write(edges_to_write)
-                        count_edges += len(edges)
-
-                    # reset for the next group
-                    nodes.clear()
-                    edges.clear()
-
-                    # Count total lines
-                    count_lines += line_counter
-                    logger.debug(f"Processed {count_lines:,} lines from {compendium_filename}: {get_memory_usage_summary()}")
-
-                    # reset the line counter for the next group
-                    line_counter = 0
-
-            # pick up any remainders in the file
-            if len(nodes) > 0:
-                nodes_to_write = "\n" + "\n".join([json.dumps(node) for node in nodes])
-                node_file.write(nodes_to_write)
-                count_nodes += len(nodes)
-
-            if len(edges) > 0:
-                edges_to_write = "\n" + "\n".join([json.dumps(edge) for edge in edges])
-                edge_file.write(edges_to_write)
-                count_edges += len(edges)
-
-            # Count total lines
-            count_lines += line_counter
-            logger.info(f"Processed a total of {count_lines} lines from {compendium_filename}: {get_memory_usage_summary()}")
-
-    logger.info(f"Converted {compendium_filename} to KGX: " +
-                f"wrote {count_nodes} nodes to {kgx_nodes_filename} and " +
-                f"wrote {count_edges} edges to {kgx_edges_filename}.")
+    size = os.path.getsize(compendium_filename)
+    workers = max(1, min(workers, size // KGX_MIN_BYTES_PER_SHARD))
+    byte_ranges = get_byte_ranges(compendium_filename, workers) if workers > 1 else [(0, size)]
+
+    tmpdir = tempfile.mkdtemp(prefix='kgx-', dir=os.path.dirname(os.path.abspath(kgx_edges_filename)))
+    try:
+        shard_filenames = [
+            (os.path.join(tmpdir, f"nodes-{index:05d}.jsonl.gz"), os.path.join(tmpdir, f"edges-{index:05d}.jsonl.gz"))
+            for index in range(len(byte_ranges))
+        ]
+        arguments = (
+            itertools.repeat(compendium_filename),
+            [start for start, _ in byte_ranges],
+            [end for _, end in byte_ranges],
+            [nodes_shard for nodes_shard, _ in shard_filenames],
+            [edges_shard for _, edges_shard in shard_filenames],
+            itertools.repeat(edge_topology),
+            # If we're converting shards in parallel processes, each of them compresses its shards in a single thread.
+            itertools.repeat(None if len(byte_ranges) == 1 else 1),
+        )
+        if len(byte_ranges) == 1:
+            results = list(map(convert_byte_range_to_kgx, *arguments))
+        else:
+            logger.info(f"Converting {compendium_filename} to KGX in {len(byte_ranges)} shards with {workers} workers.")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                results = list(executor.map(convert_byte_range_to_kgx, *arguments))
+
+        # Concatenate the shards in order, and move the results into place.
+        for output_filename, shards in [(kgx_nodes_filename, [nodes_shard for nodes_shard, _ in shard_filenames]),
+                                        (kgx_edges_filename, [edges_shard for _, edges_shard in shard_filenames])]:
+            if len(shards) == 1:
+                os.replace(shards[0], output_filename)
+                continue
+            tmp_filename = os.path.join(tmpdir, os.path.basename(output_filename))
+            with open(tmp_filename, 'wb') as outf:
+                for shard in shards:
+                    with open(shard, 'rb') as inf:
+                        shutil.copyfileobj(inf, outf)
+            os.replace(tmp_filename, output_filename)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    count_lines = sum(result[0] for result in results)
+    count_nodes = sum(result[1] for result in results)
+    count_edges = sum(result[2] for result in results)
+    logger.info(f"Converted {count_lines:,} lines from {compendium_filename} to KGX: " +
+                f"wrote {count_nodes:,} nodes to {kgx_nodes_filename} and " +
+                f"wrote {count_edges:,} edges to {kgx_edges_filename}: {get_memory_usage_summary()}")
@@ -0,0 +1,291 @@
+"""
+parquet.py - export compendia directly to Parquet files.
+
+Every compendium file is exported into three Parquet files in the same directory:
+- Clique.parquet: one row per clique (clique_leader, preferred_name, clique_identifier_count, biolink_type,
+  information_content).
+- Edge.parquet: one row per identifier in each clique (clique_leader, curie, conflation).
+- Node.parquet: one row per identifier (curie, label, label_lc, description).
+
+These are the same tables that we used to build in a DuckDB database before writing them out as Parquet. Instead, we
+stream the compendium file through PyArrow's JSON reader in blocks, compute all three tables from each block with Arrow
+compute functions, and write them out through Parquet writers, so we only read the compendium once and never need to hold
+a whole compendium (or a temporary DuckDB database) in memory or on disk.
+
+If the `parquet_sorted_layout` config setting is turned on, we then sort the Edge and Node tables by CURIE (and
+duckdb_exporters.export_synonyms_to_parquet() sorts the Synonym table by label_lc). Sorted tables are written with min/max
+statistics, a page index and Bloom filters for their lookup columns, so that point lookups and joins on those columns
+(e.g. in src/reports/duckdb_reports.py) can skip most row groups without reading them.
+"""
+import os
+
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pj
+import pyarrow.parquet as pq
+
+from src.util import get_config, get_logger, get_memory_usage_summary
+
+logger = get_logger(__name__)
+
+# The default number of rows in each Parquet row group, if not set in the config (`parquet_row_group_size`).
+DEFAULT_PARQUET_ROW_GROUP_SIZE = 1_000_000
+
+# The default Parquet compression codec, if not set in the config (`parquet_compression`).
+DEFAULT_PARQUET_COMPRESSION = 'zstd'
+
+# The number of bytes of JSON to read in each block. Every line in a compendium file must be shorter than this.
+PARQUET_JSON_BLOCK_SIZE = 64 * 1024 * 1024
+
+# The parts of a compendium record (see json_codec.CompendiumRecord) that we export. Any other fields are ignored.
+COMPENDIUM_SCHEMA = pa.schema([
+    ('type', pa.string()),
+    ('ic', pa.float64()),
+    ('preferred_name', pa.string()),
+    ('identifiers', pa.list_(pa.struct([
+        ('i', pa.string()),
+        ('l', pa.string()),
+        ('d', pa.list_(pa.string())),
+    ]))),
+])
+
+# The default false positive probability of the Bloom filters in sorted Parquet files, if not set in the config
+# (`parquet_bloom_filter_fpp`).
+DEFAULT_PARQUET_BLOOM_FILTER_FPP = 0.01
+
+# The schemas of the tables we write for each compendium.
+CLIQUE_SCHEMA = pa.schema([
+    ('clique_leader', pa.string()),
+    ('preferred_name', pa.string()),
+    ('clique_identifier_count', pa.int32()),
+    ('biolink_type', pa.string()),
+    ('information_content', pa.float32()),
+])
+EDGE_SCHEMA = pa.schema([
+    ('clique_leader', pa.string()),
+    ('curie', pa.string()),
+    ('conflation', pa.string()),
+])
+NODE_SCHEMA = pa.schema([
+    ('curie', pa.string()),
+    ('label', pa.string()),
+    ('label_lc', pa.string()),
+    ('description', pa.list_(pa.string())),
+])
+
+
+class ParquetTableWriter:
+    """
+    Write Arrow tables to a Parquet file. Tables are buffered until we have at least a full row group, so that every
+    row group except the last one has exactly row_group_size rows, however many rows are in each table we're given.
+
+    The file is written to a temporary file and only moved into place when close() is called, so an interrupted export
+    doesn't leave a partial Parquet file behind. This can be used as a context manager.
+    """
+
+    def __init__(self, filename, schema, row_group_size, compression, **writer_options):
+        """
+        :param writer_options: Any other options to pass to pyarrow.parquet.ParquetWriter.
+        """
+        self.filename = filename
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.tmp_filename = f"{filename}.tmp-{os.getpid()}"
+        self.writer = pq.ParquetWriter(self.tmp_filename, schema, compression=compression, **writer_options)
+        self.buffered_tables = []
+        self.buffered_row_count = 0
+        self.row_count = 0
+
+    def write(self, table):
+        self.buffered_tables.append(table)
+        self.buffered_row_count += table.num_rows
+        if self.buffered_row_count >= self.row_group_size:
+            self.flush(full_row_groups_only=True)
+
+    def flush(self, full_row_groups_only=False):
+        """
+        Write out the buffered rows.
+
+        :param full_row_groups_only: If True, only write out complete row groups and keep any remaining rows buffered.
+        """
+        row_count = self.buffered_row_count
+        if full_row_groups_only:
+            row_count -= row_count % self.row_group_size
+        if row_count == 0:
+            return
+        table = pa.concat_tables(self.buffered_tables)
+        self.writer.write_table(table.slice(0, row_count), row_group_size=self.row_group_size)
+        self.row_count += row_count
+        remainder = table.slice(row_count)
+        self.buffered_tables = [remainder] if remainder.num_rows > 0 else []
+        self.buffered_row_count = remainder.num_rows
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.tmp_filename, self.filename)
+
+    def abort(self):
+        self.writer.close()
+        os.remove(self.tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def get_parquet_settings(row_group_size=None, compression=None, sorted_layout=None):
+    """
+    Fill in any Parquet settings that weren't provided from the config.
+
+    :return: A (row_group_size, compression, sorted_layout) tuple.
+    """
+    config = get_config()
+    if row_group_size is None:
+        row_group_size = int(config.get('parquet_row_group_size', DEFAULT_PARQUET_ROW_GROUP_SIZE))
+    if compression is None:
+        compression = config.get('parquet_compression', DEFAULT_PARQUET_COMPRESSION)
+    if sorted_layout is None:
+        sorted_layout = bool(config.get('parquet_sorted_layout', False))
+    return row_group_size, compression, sorted_layout
+
+
+def write_sorted_parquet(db, query, parquet_filename, sort_columns, bloom_filter_columns, row_group_size, compression,
+                         parameters=None):
+    """
+    Write the results of a DuckDB query to a Parquet file, sorted by some columns, with min/max statistics and a page
+    index for every column and Bloom filters for some of them.
+
+    DuckDB does the sorting (spilling to disk if it needs to), and we stream the sorted rows into the Parquet file.
+
+    :param db: The DuckDB connection to use.
+    :param query: The SQL query whose results should be written.
+    :param parquet_filename: The Parquet file to write. This may be one of the files read by the query, as we only
+        replace it once all the results have been written.
+    :param sort_columns: The columns to sort by, starting with the column that lookups will be made on.
+    :param bloom_filter_columns: The columns to write Bloom filters for.
+    :param row_group_size: The number of rows in each row group.
+    :param compression: The Parquet compression codec to use.
+    :param parameters: Any parameters for the query.
+    """
+    fpp = float(get_config().get('parquet_bloom_filter_fpp', DEFAULT_PARQUET_BLOOM_FILTER_FPP))
+    logger.info(f"Writing {parquet_filename} sorted by {sort_columns}: {get_memory_usage_summary()}")
+    order_by = ', '.join(sort_columns)
+    reader = db.execute(f"SELECT * FROM ({query}) ORDER BY {order_by}", parameters or []).to_arrow_reader(row_group_size)
+    schema = reader.schema
+    writer_options = {
+        # A row group has at most row_group_size distinct values in each column.
+        'bloom_filter_options': {column: {'ndv': row_group_size, 'fpp': fpp} for column in bloom_filter_columns},
+        'sorting_columns': [pq.SortingColumn(schema.get_field_index(column)) for column in sort_columns],
+        'write_page_index': True,
+    }
+    with ParquetTableWriter(parquet_filename, schema, row_group_size, compression, **writer_options) as writer:
+        for batch in reader:
+            writer.write(pa.Table.from_batches([batch], schema=schema))
+    logger.info(f"Wrote {writer.row_count:,} rows to {parquet_filename}: {get_memory_usage_summary()}")
+
+
+def sort_parquet_file(parquet_filename, sort_columns, bloom_filter_columns, row_group_size, compression):
+    """
+    Rewrite a Parquet file in place, sorted by some columns (see write_sorted_parquet()).
+    """
+    with duckdb.connect(config=get_config().get('duckdb_config', {})) as db:
+        write_sorted_parquet(db, "SELECT * FROM read_parquet(?)", parquet_filename, sort_columns, bloom_filter_columns,
+                             row_group_size, compression, parameters=[parquet_filename])
+
+
+def get_compendium_tables(batch):
+    """
+    Compute the Clique, Edge and Node tables for a batch of compendium records.
+
+    :param batch: An Arrow record batch with the COMPENDIUM_SCHEMA.
+    :return: A (cliques, edges, nodes) tuple of Arrow tables.
+    """
+    identifiers = batch.column('identifiers')
+    identifier_counts = pc.fill_null(pc.list_value_length(identifiers), 0)
+
+    # Every flattened identifier, together with the index of the record it came from.
+    flat_identifiers = pc.list_flatten(identifiers)
+    parent_indices = pc.list_parent_indices(identifiers)
+    curies = pc.struct_field(flat_identifiers, 'i')
+    labels = pc.struct_field(flat_identifiers, 'l')
+
+    # The clique leader is the first identifier in each record (or null if it doesn't have any identifiers).
+    first_identifier_indices = pc.subtract(identifiers.offsets[:-1], identifiers.offsets[0])
+    clique_leaders = pc.take(curies, pc.if_else(pc.greater(identifier_counts, 0), first_identifier_indices, None))
+
+    cliques = pa.Table.from_arrays([
+        clique_leaders,
+        batch.column('preferred_name'),
+        pc.cast(identifier_counts, pa.int32()),
+        batch.column('type'),
+        pc.cast(batch.column('ic'), pa.float32()),
+    ], schema=CLIQUE_SCHEMA)
+    edges = pa.Table.from_arrays([
+        pc.take(clique_leaders, parent_indices),
+        curies,
+        pa.array(['None'] * len(curies), type=pa.string()),
+    ], schema=EDGE_SCHEMA)
+    nodes = pa.Table.from_arrays([
+        curies,
+        labels,
+        pc.utf8_lower(labels),
+        pc.struct_field(flat_identifiers, 'd'),
+    ], schema=NODE_SCHEMA)
+    return cliques, edges, nodes
+
+
+def export_compendium_to_parquet(compendium_filename, clique_parquet_filename, row_group_size=None, compression=None,
+                                 sorted_layout=None):
+    """
+    Export a compendium to Clique, Edge and Node Parquet files.
+
+    :param compendium_filename: The compendium filename to read.
+    :param clique_parquet_filename: The filename for the Clique.parquet file. We will write the Edge.parquet and
+        Node.parquet files into the same directory.
+    :param row_group_size: The maximum number of rows in each Parquet row group (defaults to the
+        `parquet_row_group_size` config setting).
+    :param compression: The Parquet compression codec to use (defaults to the `parquet_compression` config setting).
+    :param sorted_layout: If True, sort the Edge and Node tables by CURIE (defaults to the `parquet_sorted_layout`
+        config setting).
+    """
+    row_group_size, compression, sorted_layout = get_parquet_settings(row_group_size, compression, sorted_layout)
+
+    parquet_dir = os.path.dirname(clique_parquet_filename)
+    os.makedirs(parquet_dir, exist_ok=True)
+    edge_parquet_filename = os.path.join(parquet_dir, 'Edge.parquet')
+    node_parquet_filename = os.path.join(parquet_dir, 'Node.parquet')
+
+    logger.info(f"Exporting {compendium_filename} to Parquet files in {parquet_dir} (row groups of {row_group_size:,} rows, "
+                f"{compression} compression): {get_memory_usage_summary()}")
+    with ParquetTableWriter(clique_parquet_filename, CLIQUE_SCHEMA, row_group_size, compression) as cliques, \
+            ParquetTableWriter(edge_parquet_filename, EDGE_SCHEMA, row_group_size, compression) as edges, \
+            ParquetTableWriter(node_parquet_filename, NODE_SCHEMA, row_group_size, compression) as nodes:
+        # PyArrow refuses to read an empty JSON file, but an empty compendium should give us empty tables.
+        if os.path.getsize(compendium_filename) > 0:
+            reader = pj.open_json(
+                compendium_filename,
+                read_options=pj.ReadOptions(block_size=PARQUET_JSON_BLOCK_SIZE),
+                parse_options=pj.ParseOptions(explicit_schema=COMPENDIUM_SCHEMA, unexpected_field_behavior='ignore'),
+            )
+        else:
+            reader = []
+        for batch in reader:
+            clique_table, edge_table, node_table = get_compendium_tables(batch)
+            cliques.write(clique_table)
+            edges.write(edge_table)
+            nodes.write(node_table)
+
+    logger.info(f"Exported {cliques.row_count:,} cliques, {edges.row_count:,} edges and {nodes.row_count:,} nodes from "
+                f"{compendium_filename} to Parquet: {get_memory_usage_summary()}")
+
+    if sorted_layout:
+        sort_parquet_file(edge_parquet_filename, ['curie', 'clique_leader'], ['curie', 'clique_leader'], row_group_size,
+                          compression)
+        sort_parquet_file(node_parquet_filename, ['curie', 'label'], ['curie'], row_group_size, compression)
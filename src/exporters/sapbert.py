@@ -8,16 +8,17 @@
 # This file provides code for doing that, based on the code from
 # https://github.com/TranslatorSRI/babel-validation/blob/f21b1b308e54ec0af616f2c24f7e2738ac4c261c/src/main/scala/org/renci/babel/utils/converter/Converter.scala#L107-L207
 import gzip
-import hashlib
-import itertools
-import json
+import multiprocessing
 import os
 import random
 import re
-from itertools import combinations
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import logging
 
+from src import json_codec
+from src.compression import open_compressed
 from src.util import LoggingUtil, get_config
 
 # Default logger for this file.
@@ -32,9 +33,139 @@ DRUG_CHEMICAL_SMALLER_MAX_LABEL_LENGTH = 40
 MAX_SYNONYM_PAIRS = 50
 # Should we lowercase all the names?
 LOWERCASE_ALL_NAMES = True
+# The seed for sampling synonym pairs. Every CURIE gets its own random number generator, seeded with this and the CURIE,
+# so the pairs we pick for a CURIE don't depend on the order (or the process) in which the entries are converted.
+SAPBERT_SAMPLING_SEED = 'babel-sapbert-1'
+# How many synonym entries each worker should convert at a time when converting in parallel.
+SAPBERT_CHUNK_LINES = 10_000
 
 
-def convert_synonyms_to_sapbert(synonym_filename_gz, sapbert_filename_gzipped):
+def get_pair_offset(i, n):
+    """
+    Return the index of the pair (i, i + 1) in the lexicographic list of all the pairs (i, j) with i < j < n.
+    """
+    return i * (2 * n - i - 1) // 2
+
+
+def unrank_pair(index, n):
+    """
+    Return the pair (i, j) at an index in the lexicographic list of all the pairs (i, j) with i < j < n, i.e. the
+    index'th element of itertools.combinations(range(n), 2), without generating the other pairs.
+    """
+    low, high = 0, n - 2
+    while low < high:
+        middle = (low + high + 1) // 2
+        if get_pair_offset(middle, n) <= index:
+            low = middle
+        else:
+            high = middle - 1
+    return low, index - get_pair_offset(low, n) + low + 1
+
+
+def sample_name_pairs(curie, names, max_pairs=MAX_SYNONYM_PAIRS):
+    """
+    Pick up to max_pairs pairs of distinct names. If there are no more than max_pairs pairs, we return all of them;
+    otherwise we sample pair indexes (random.sample() doesn't need to materialize a range), so we never generate every
+    combination of thousands of names. The sample is seeded by the CURIE, so it is the same on every run.
+
+    :param curie: The CURIE these names belong to.
+    :param names: The names to pair up. Duplicates are ignored.
+    :param max_pairs: The maximum number of pairs to return.
+    :return: A list of (name1, name2) pairs, in the same order as itertools.combinations() would generate them.
+    """
+    unique_names = list(dict.fromkeys(names))
+    count_names = len(unique_names)
+    count_pairs = count_names * (count_names - 1) // 2
+    if count_pairs <= max_pairs:
+        indexes = range(count_pairs)
+    else:
+        rng = random.Random(f"{SAPBERT_SAMPLING_SEED}:{curie}")
+        indexes = sorted(rng.sample(range(count_pairs), max_pairs))
+    return [tuple(unique_names[i] for i in unrank_pair(index, count_names)) for index in indexes]
+
+
+def convert_synonym_lines(input_lines, generate_smaller):
+    """
+    Convert a list of lines from a synonyms file into SAPBERT training rows.
+
+    :param input_lines: The lines to convert.
+    :param generate_smaller: Whether to also generate rows for the smaller training file.
+    :return: A tuple of (training_rows, count_training_rows, smaller_rows, count_smaller_rows, count_entries):
+        the training rows (joined into a single string) and how many there are, the rows for the smaller training file
+        (also joined into a single string, and empty unless generate_smaller is set) and how many there are, and the
+        number of synonym entries that were read.
+    """
+    training_rows = []
+    smaller_rows = []
+    for input_line in input_lines:
+        entry = json_codec.loads(input_line)
+
+        # Read fields from the synonym.
+        curie = entry['curie']
+        preferred_name = entry.get('preferred_name', '').strip()
+        if not preferred_name:
+            logging.warning(f"Unable to convert synonym entry for curie {curie}, skipping: {entry}")
+            continue
+
+        # Is the preferred name small enough that we should ignore it from generate_smaller_file?
+        is_preferred_name_short = (len(preferred_name) <= DRUG_CHEMICAL_SMALLER_MAX_LABEL_LENGTH)
+        #if not is_preferred_name_short:
+        #    logging.warning(f"CURIE {curie} (preferred name: {preferred_name}) will be excluded from the Smaller training file.")
+
+        # Collect and process the list of names.
+        names = entry['names']
+        if LOWERCASE_ALL_NAMES:
+            names = [name.lower() for name in names]
+
+        # We use '||' as a delimiter, so any occurrences of more than one pipe character
+        # should be changed to a single pipe character in the SAPBERT output, so we don't
+        # confuse it up with our delimiter.
+        names = [re.sub(r'\|\|+', '|', name) for name in names]
+
+        # Figure out the Biolink type to report.
+        types = entry['types']
+        if len(types) == 0:
+            biolink_type = 'NamedThing'
+        else:
+            biolink_type = types[0]
+
+        # How many names do we have?
+        if len(names) == 0:
+            # This shouldn't happen, but let's anticipate this anyway.
+            name_pairs = [(preferred_name.lower(), preferred_name.lower())]
+        elif len(names) == 1:
+            # If we have less than two names, we don't have anything to randomize.
+            name_pairs = [(preferred_name.lower(), names[0])]
+        else:
+            name_pairs = sample_name_pairs(curie, names)
+
+        for name_pair in name_pairs:
+            line = f"biolink:{biolink_type}||{curie}||{preferred_name}||{name_pair[0]}||{name_pair[1]}\n"
+            training_rows.append(line)
+
+            # As long as the preferred name is shorter than the right size, we should add this clique to the
+            # smaller file as well.
+            if generate_smaller and is_preferred_name_short:
+                smaller_rows.append(line)
+
+    return ''.join(training_rows), len(training_rows), ''.join(smaller_rows), len(smaller_rows), len(input_lines)
+
+
+def read_chunks(synonymf, chunk_lines):
+    """
+    Read a file in chunks of chunk_lines lines.
+    """
+    chunk = []
+    for line in synonymf:
+        chunk.append(line)
+        if len(chunk) >= chunk_lines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def convert_synonyms_to_sapbert(synonym_filename_gz, sapbert_filename_gzipped, workers=1):
     """
     Convert a synonyms file to the training format for SAPBERT (https://github.com/RENCI-NER/sapbert).
 
@@ -42,9 +173,12 @@ def convert_synonyms_to_sapbert(synonym_filename_gz, sapbert_filename_gzipped):
 
     :param synonym_filename_gz: The compendium file to convert.
     :param sapbert_filename_gzipped: The SAPBERT training file to generate.
+    :param workers: The number of worker processes to convert chunks of SAPBERT_CHUNK_LINES entries with. Chunks are
+        written out in the order they were read, and pairs are sampled per CURIE, so the output is the same however
+        many workers we use.
     """
 
-    logger.info(f"convert_synonyms_to_sapbert({synonym_filename_gz}, {sapbert_filename_gzipped})")
+    logger.info(f"convert_synonyms_to_sapbert({synonym_filename_gz}, {sapbert_filename_gzipped}, workers={workers})")
 
     # For now, the simplest way to identify the DrugChemicalConflated file is by name.
     # In this case we still generate DrugChemicalConflated.txt, but we also generate
@@ -60,80 +194,39 @@ def convert_synonyms_to_sapbert(synonym_filename_gz, sapbert_filename_gzipped):
     # Open SmallerFile for writing if needed.
     generate_smaller_file = None
     if generate_smaller_filename:
-        generate_smaller_file = gzip.open(generate_smaller_filename, 'wt', encoding='utf-8')
+        generate_smaller_file = open_compressed(generate_smaller_filename, 'wt', encoding='utf-8')
 
     # Go through all the synonyms in the input file.
     count_entry = 0
     count_training_rows = 0
     count_smaller_rows = 0
-    with gzip.open(synonym_filename_gz, "rt", encoding="utf-8") as synonymf, gzip.open(sapbert_filename_gzipped, "wt", encoding="utf-8") as sapbertf:
-        for input_line in synonymf:
-            count_entry += 1
-            entry = json.loads(input_line)
-
-            # Read fields from the synonym.
-            curie = entry['curie']
-            preferred_name = entry.get('preferred_name', '').strip()
-            if not preferred_name:
-                logging.warning(f"Unable to convert synonym entry for curie {curie}, skipping: {entry}")
-                continue
-
-            # Is the preferred name small enough that we should ignore it from generate_smaller_file?
-            is_preferred_name_short = (len(preferred_name) <= DRUG_CHEMICAL_SMALLER_MAX_LABEL_LENGTH)
-            #if not is_preferred_name_short:
-            #    logging.warning(f"CURIE {curie} (preferred name: {preferred_name}) will be excluded from the Smaller training file.")
-
-            # Collect and process the list of names.
-            names = entry['names']
-            if LOWERCASE_ALL_NAMES:
-                names = [name.lower() for name in names]
-
-            # We use '||' as a delimiter, so any occurrences of more than one pipe character
-            # should be changed to a single pipe character in the SAPBERT output, so we don't
-            # confuse it up with our delimiter.
-            names = [re.sub(r'\|\|+', '|', name) for name in names]
-
-            # Figure out the Biolink type to report.
-            types = entry['types']
-            if len(types) == 0:
-                biolink_type = 'NamedThing'
-            else:
-                biolink_type = types[0]
-
-            # How many names do we have?
-            if len(names) == 0:
-                # This shouldn't happen, but let's anticipate this anyway.
-                line = f"biolink:{biolink_type}||{curie}||{preferred_name}||{preferred_name.lower()}||{preferred_name.lower()}\n"
-                sapbertf.write(line)
-                count_training_rows += 1
-                if generate_smaller_file and is_preferred_name_short:
-                    generate_smaller_file.write(line)
-                    count_smaller_rows += 1
-            elif len(names) == 1:
-                # If we have less than two names, we don't have anything to randomize.
-                line = f"biolink:{biolink_type}||{curie}||{preferred_name}||{preferred_name.lower()}||{names[0]}\n"
-                sapbertf.write(line)
-                count_training_rows += 1
-                if generate_smaller_file and is_preferred_name_short:
-                    generate_smaller_file.write(line)
-                    count_smaller_rows += 1
-            else:
-                name_pairs = list(itertools.combinations(set(names), 2))
-
-                if len(name_pairs) > MAX_SYNONYM_PAIRS:
-                    # Randomly select 50 pairs.
-                    name_pairs = random.sample(name_pairs, MAX_SYNONYM_PAIRS)
-
-                for name_pair in name_pairs:
-                    line = f"biolink:{biolink_type}||{curie}||{preferred_name}||{name_pair[0]}||{name_pair[1]}\n"
-                    sapbertf.write(line)
-                    count_training_rows += 1
-
-                    # As long as the preferred name is shorter than the right size, we should add this clique to the
-                    # smaller file as well.
-                    if generate_smaller_file and is_preferred_name_short:
-                        generate_smaller_file.write(line)
-                        count_smaller_rows += 1
+
+    def write_result(result):
+        nonlocal count_entry, count_training_rows, count_smaller_rows
+        training_rows, count_chunk_training_rows, smaller_rows, count_chunk_smaller_rows, count_chunk_entries = result
+        sapbertf.write(training_rows)
+        count_training_rows += count_chunk_training_rows
+        count_entry += count_chunk_entries
+        if generate_smaller_file:
+            generate_smaller_file.write(smaller_rows)
+            count_smaller_rows += count_chunk_smaller_rows
+
+    with gzip.open(synonym_filename_gz, "rt", encoding="utf-8") as synonymf, open_compressed(sapbert_filename_gzipped, "wt", encoding="utf-8") as sapbertf:
+        chunks = read_chunks(synonymf, SAPBERT_CHUNK_LINES)
+        generate_smaller = generate_smaller_file is not None
+        if workers <= 1:
+            for chunk in chunks:
+                write_result(convert_synonym_lines(chunk, generate_smaller))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                # Write chunks out in order, without reading more than two chunks per worker ahead.
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(convert_synonym_lines, chunk, generate_smaller))
+                    while len(pending) > 2 * workers:
+                        write_result(pending.popleft().result())
+                while pending:
+                    write_result(pending.popleft().result())
 
     logger.info(f"Converted {synonym_filename_gz} to SAPBERT training file {synonym_filename_gz}: " +
                 f"read {count_entry} entries and wrote out {count_training_rows} training rows.")
@@ -144,5 +237,3 @@ def convert_synonyms_to_sapbert(synonym_filename_gz, sapbert_filename_gzipped):
         percentage = count_smaller_rows / float(count_training_rows) * 100
         logger.info(f"Converted {synonym_filename_gz} to smaller SAPBERT training file {generate_smaller_filename}: " +
                     f"read {count_entry} entries and wrote out {count_smaller_rows} training rows ({percentage:.2f}%).")
-
-
@@ -0,0 +1,343 @@
+"""
+incremental_glom.py - glom cliques incrementally, only recomputing the parts of the graph that have changed.
+
+Every build re-gloms every concord and identifier file from scratch, even when only one of them has changed since the
+last build (e.g. a new monthly RxNorm release). If `incremental_glom` is turned on in the config, builders can use an
+IncrementalGlom (see start_glom() and finish_glom()) instead of a UnionFind. It records every step of the glom (each
+call to glom() or add_cliques(), with its groups and its veto settings) in a state directory, together with the cliques
+it produced and the connected components of the "raw" graph of all groups (ignoring vetoes).
+
+On the next build, we compare the steps with the ones in the state directory:
+- If any step has been added, removed or reordered, or its veto settings have changed, we glom everything from scratch.
+- If no step has changed, we reuse the previous cliques as they are.
+- Otherwise, we diff the groups of every changed step against the previous ones. The identifiers in added or removed
+  groups, together with the previous raw components that contain them, are "affected". We keep the previous cliques
+  that don't contain any affected identifiers, and re-glom the groups that touch affected identifiers in their original
+  order.
+
+This gives exactly the same cliques as a full glom: the vetoes in UnionFind.glom() only look at the cliques that a group
+would merge, so groups in different raw components can never influence each other.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+from src import json_codec
+from src.unionfind import UnionFind
+from src.util import get_config, get_logger, get_memory_usage_summary
+
+logger = get_logger(__name__)
+
+# Change this if the layout of the state directory changes, so that old state is ignored.
+INCREMENTAL_GLOM_FORMAT_VERSION = 1
+
+# The kinds of step that we can record.
+STEP_ADD_CLIQUES = 'add_cliques'
+STEP_GLOM = 'glom'
+
+
+def start_glom(name):
+    """
+    Start a new glom for a builder. If `incremental_glom` is turned on in the config, this returns an IncrementalGlom
+    that keeps its state in `<incremental_glom_directory>/<name>`; otherwise it returns an empty UnionFind. Either way,
+    it can be passed to babel_utils.glom(), and should be passed to finish_glom() once all the groups have been added.
+
+    :param name: The name of this builder's state directory (e.g. 'chemicals').
+    """
+    config = get_config()
+    if config.get('incremental_glom', False):
+        return IncrementalGlom(os.path.join(config['incremental_glom_directory'], name))
+    return UnionFind()
+
+
+def finish_glom(dicts):
+    """
+    Finish a glom started with start_glom().
+
+    :return: A UnionFind containing the glommed cliques.
+    """
+    if isinstance(dicts, IncrementalGlom):
+        return dicts.run()
+    return dicts
+
+
+def read_groups(filename):
+    """
+    Read the groups recorded for a step, as lists of identifiers.
+    """
+    with open(filename, 'rb') as inf:
+        for line in inf:
+            yield json_codec.loads(line)
+
+
+def get_group_digests(filename):
+    """
+    Read the groups recorded for a step as an array of 128-bit digests, one per group. Groups are compared as sets, so
+    each digest is calculated from the sorted, unique identifiers in its group.
+    """
+    digests = bytearray()
+    for group in read_groups(filename):
+        digests += hashlib.blake2b('\t'.join(sorted(set(group))).encode('utf-8'), digest_size=16).digest()
+    return np.frombuffer(bytes(digests), dtype='S16')
+
+
+def get_options_digest(unique_prefixes, close):
+    """
+    Summarize the veto settings of a glom step, so that we can tell if they have changed.
+    """
+    options = {
+        'unique_prefixes': list(unique_prefixes),
+        'close': {prefix: sorted((curie, sorted(close_curies)) for curie, close_curies in closedict.items())
+                  for prefix, closedict in close.items()},
+    }
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class IncrementalGlom:
+    """
+    Record the steps of a glom, and glom them incrementally against the previous run when run() is called.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.previous_manifest = self.load_manifest()
+        # The directory we write this run's state into, which is created by the first step we record (see
+        # get_work_dir()) and becomes the state directory when run() finishes.
+        self.work_dir = None
+        self.work_dir_cleanup = None
+        self.steps = []
+        # How the last call to run() built the cliques ('full', 'unchanged' or 'incremental'), and how many groups it
+        # had to glom.
+        self.mode = None
+        self.glommed_group_count = 0
+
+    def __str__(self):
+        return f"IncrementalGlom({self.state_dir}) with {len(self.steps)} steps"
+
+    def load_manifest(self):
+        """
+        Load the manifest of the previous run, or return None if there isn't a usable one.
+        """
+        manifest_filename = os.path.join(self.state_dir, 'manifest.json')
+        if not os.path.exists(manifest_filename):
+            return None
+        with open(manifest_filename, 'r') as inf:
+            manifest = json.load(inf)
+        if manifest.get('version') != INCREMENTAL_GLOM_FORMAT_VERSION:
+            logger.info(f"Ignoring incremental glom state in {self.state_dir} with an old format version.")
+            return None
+        return manifest
+
+    def get_work_dir(self):
+        """
+        Return the work directory, creating it next to the state directory if it doesn't exist yet. If the glom is
+        abandoned (e.g. because the builder fails) before run() replaces the state directory with it, the work directory
+        is removed when this IncrementalGlom is garbage collected or when the process exits.
+        """
+        if self.work_dir is None:
+            parent_dir = os.path.dirname(os.path.abspath(self.state_dir))
+            os.makedirs(parent_dir, exist_ok=True)
+            self.work_dir = tempfile.mkdtemp(prefix='incremental-glom-', dir=parent_dir)
+            self.work_dir_cleanup = weakref.finalize(self, shutil.rmtree, self.work_dir, ignore_errors=True)
+        return self.work_dir
+
+    def discard_work_dir(self):
+        """
+        Remove the work directory, if we have created one.
+        """
+        if self.work_dir_cleanup is not None:
+            self.work_dir_cleanup()
+        self.work_dir = None
+        self.work_dir_cleanup = None
+
+    def record_step(self, kind, groups, options_digest=''):
+        """
+        Write the groups for a step into the work directory, computing their digest as we go.
+        """
+        filename = f"step-{len(self.steps):04d}.jsonl"
+        digest = hashlib.sha256()
+        count = 0
+        with open(os.path.join(self.get_work_dir(), filename), 'w', encoding='utf-8') as outf:
+            for group in groups:
+                # Sets don't have a stable order, so we sort them to make sure the same groups give the same digest.
+                if isinstance(group, (set, frozenset)):
+                    group = sorted(group)
+                line = json_codec.dumps_line(list(group))
+                outf.write(line)
+                digest.update(line.encode('utf-8'))
+                count += 1
+        self.steps.append({
+            'kind': kind,
+            'options_digest': options_digest,
+            'filename': filename,
+            'digest': digest.hexdigest(),
+            'count': count,
+        })
+
+    def add_cliques(self, cliques):
+        """
+        Record cliques that are already known to be equivalent (see UnionFind.add_clique()).
+        """
+        self.record_step(STEP_ADD_CLIQUES, cliques)
+
+    def glom(self, newgroups, unique_prefixes=['INCHIKEY'], pref='HP', close={}):
+        """
+        Record groups to be glommed (see UnionFind.glom()).
+        """
+        self.record_step(STEP_GLOM, newgroups, options_digest=get_options_digest(unique_prefixes, close))
+        self.steps[-1]['unique_prefixes'] = list(unique_prefixes)
+        self.steps[-1]['close'] = close
+
+    def apply_step(self, forest, raw, step, groups):
+        """
+        Apply the groups of a step to the glommed forest, and add them all to the raw forest.
+        """
+        def groups_with_raw(groups):
+            for group in groups:
+                raw.add_clique(group)
+                self.glommed_group_count += 1
+                yield group
+
+        if step['kind'] == STEP_ADD_CLIQUES:
+            for group in groups_with_raw(groups):
+                forest.add_clique(group)
+        else:
+            forest.glom(groups_with_raw(groups), unique_prefixes=step['unique_prefixes'], close=step['close'])
+
+    def is_same_structure(self):
+        """
+        Check whether the previous run had the same steps (in the same order, with the same veto settings) as this one.
+        """
+        if self.previous_manifest is None:
+            return False
+        previous_steps = self.previous_manifest['steps']
+        return len(previous_steps) == len(self.steps) and all(
+            (previous['kind'], previous['options_digest']) == (step['kind'], step['options_digest'])
+            for previous, step in zip(previous_steps, self.steps)
+        )
+
+    def run(self):
+        """
+        Glom all the recorded steps, reusing as much of the previous run as we can, and save the state for the next run.
+
+        :return: A UnionFind containing the glommed cliques.
+        """
+        try:
+            forest, raw = self.glom_steps()
+            self.save_state(forest, raw)
+        except BaseException:
+            # Don't leave a half-written work directory behind.
+            self.discard_work_dir()
+            raise
+        logger.info(f"Glommed {self.glommed_group_count:,} groups from {self} ({self.mode}) into {forest}: "
+                    f"{get_memory_usage_summary()}")
+        return forest
+
+    def glom_steps(self):
+        """
+        Glom all the recorded steps, reusing as much of the previous run as we can.
+
+        :return: A tuple of UnionFinds: the glommed cliques, and the raw components of all the groups.
+        """
+        forest = UnionFind()
+        raw = UnionFind(forest.interner)
+        cliques_filename = os.path.join(self.state_dir, 'cliques.jsonl')
+        components_filename = os.path.join(self.state_dir, 'components.jsonl')
+
+        if not self.is_same_structure():
+            logger.info(f"Glomming {self} from scratch: {get_memory_usage_summary()}")
+            self.mode = 'full'
+            for step in self.steps:
+                self.apply_step(forest, raw, step, read_groups(os.path.join(self.work_dir, step['filename'])))
+        else:
+            changed_steps = [
+                (previous, step) for previous, step in zip(self.previous_manifest['steps'], self.steps)
+                if previous['digest'] != step['digest']
+            ]
+            if not changed_steps:
+                logger.info(f"No steps have changed in {self}, reusing the previous cliques: {get_memory_usage_summary()}")
+                self.mode = 'unchanged'
+                forest.add_cliques(read_groups(cliques_filename))
+                raw.add_cliques(read_groups(components_filename))
+            else:
+                self.mode = 'incremental'
+                affected = self.get_affected_identifiers(changed_steps, components_filename)
+
+                # Keep every previous clique and raw component that doesn't contain any affected identifiers. Cliques are
+                # subsets of raw components, and affected identifiers include entire raw components, so a clique either
+                # consists entirely of affected identifiers or contains none of them.
+                forest.add_cliques(clique for clique in read_groups(cliques_filename) if clique[0] not in affected)
+                raw.add_cliques(component for component in read_groups(components_filename) if component[0] not in affected)
+
+                # Re-glom the groups that touch affected identifiers, in their original order.
+                for step in self.steps:
+                    groups = read_groups(os.path.join(self.work_dir, step['filename']))
+                    self.apply_step(forest, raw, step, (group for group in groups if any(curie in affected for curie in group)))
+
+        return forest, raw
+
+    def get_affected_identifiers(self, changed_steps, components_filename):
+        """
+        Find the identifiers whose cliques might have changed: every identifier in a group that has been added to or
+        removed from a changed step, together with every identifier in the same previous raw component.
+        """
+        touched = set()
+        for previous, step in changed_steps:
+            # Steps can have hundreds of millions of groups, so rather than loading both versions of a step into sets, we
+            # diff their group digests, and then reread each file to collect the groups that are only in one of them.
+            previous_filename = os.path.join(self.state_dir, previous['filename'])
+            filename = os.path.join(self.work_dir, step['filename'])
+            previous_digests = get_group_digests(previous_filename)
+            digests = get_group_digests(filename)
+            removed = ~np.isin(previous_digests, digests)
+            added = ~np.isin(digests, previous_digests)
+            del previous_digests, digests
+            for changed_filename, changed in [(previous_filename, removed), (filename, added)]:
+                if not changed.any():
+                    continue
+                for group, is_changed in zip(read_groups(changed_filename), changed):
+                    if is_changed:
+                        touched.update(group)
+        logger.info(f"{len(changed_steps)} steps of {self} have changed, touching {len(touched):,} identifiers: "
+                    f"{get_memory_usage_summary()}")
+
+        affected = set(touched)
+        for component in read_groups(components_filename):
+            if any(curie in touched for curie in component):
+                affected.update(component)
+        logger.info(f"{len(affected):,} identifiers in {self} are affected by these changes: {get_memory_usage_summary()}")
+        return affected
+
+    def save_state(self, forest, raw):
+        """
+        Write the cliques, raw components and manifest into the work directory, and then replace the state directory
+        with it.
+        """
+        work_dir = self.get_work_dir()
+        for filename, unionfind in [('cliques.jsonl', forest), ('components.jsonl', raw)]:
+            with open(os.path.join(work_dir, filename), 'w', encoding='utf-8') as outf:
+                for clique in unionfind.cliques():
+                    outf.write(json_codec.dumps_line(sorted(clique)))
+
+        manifest = {
+            'version': INCREMENTAL_GLOM_FORMAT_VERSION,
+            'steps': [
+                {key: value for key, value in step.items() if key not in {'unique_prefixes', 'close'}}
+                for step in self.steps
+            ],
+        }
+        with open(os.path.join(work_dir, 'manifest.json'), 'w') as outf:
+            json.dump(manifest, outf, indent=2)
+
+        if os.path.exists(self.state_dir):
+            shutil.rmtree(self.state_dir)
+        os.replace(work_dir, self.state_dir)
+        # The work directory is now the state directory, so it mustn't be cleaned up.
+        self.work_dir_cleanup.detach()
+        self.work_dir = None
+        self.work_dir_cleanup = None
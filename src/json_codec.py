@@ -0,0 +1,169 @@
+"""
+json_codec.py - encode and decode the JSON Lines files that Babel reads and writes.
+
+Babel's compendium, synonym and conflation files are JSON Lines files (see docs/DataFormats.md), and reading and writing
+hundreds of millions of JSON documents with the standard library's json module is a significant part of the runtime of
+the compendium, export and report stages. All of this I/O goes through this module instead, which uses orjson if it is
+installed and falls back to the standard library otherwise.
+
+orjson is listed in requirements.txt, so it is what the pipeline (and the Docker image) normally uses; the fallback
+only keeps Babel working in environments where it isn't installed.
+
+Both encoders write compact JSON (no whitespace between items, non-ASCII characters written as UTF-8), and for
+strings, integers, lists and dictionaries their output is identical. Floats are not always written in the same way:
+- Floats with an exponent are written differently (orjson writes `1e16` and `1e-7`, the standard library writes
+  `1e+16` and `1e-07`). Both decode to the same value.
+- NaN and infinite floats (which aren't valid JSON) are written as `null` by orjson, but as `NaN` or `Infinity` by the
+  standard library. We don't expect to write these values (e.g. information content values are always finite).
+So files containing floats (such as the `ic` values in compendia) may differ byte-for-byte, but not in value, depending
+on which encoder is installed. orjson doesn't support integers larger than 64 bits, so we hand documents containing
+those to the standard library instead.
+"""
+import gzip
+import json
+from typing import Iterator, List, Optional, TypedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The name of the JSON library that we're using, for logging.
+JSON_CODEC = 'orjson' if orjson is not None else 'json'
+
+
+class CompendiumIdentifier(TypedDict, total=False):
+    """One identifier in a compendium record (see docs/DataFormats.md)."""
+    i: str  # The CURIE of this identifier.
+    l: str  # The label of this identifier.
+    d: List[str]  # Descriptions of this identifier.
+    t: List[str]  # The taxa of this identifier, as NCBITaxon CURIEs.
+
+
+class CompendiumRecord(TypedDict, total=False):
+    """A single line of a compendium file: one clique (see docs/DataFormats.md)."""
+    type: str
+    ic: Optional[float]
+    identifiers: List[CompendiumIdentifier]
+    preferred_name: str
+    taxa: List[str]
+
+
+class SynonymRecord(TypedDict, total=False):
+    """A single line of a synonym file (see docs/DataFormats.md)."""
+    curie: str
+    names: List[str]
+    types: List[str]
+    preferred_name: str
+    shortest_name_length: int
+    clique_identifier_count: int
+    curie_suffix: int
+    taxa: List[str]
+
+
+def loads(text):
+    """
+    Decode a JSON document.
+
+    :param text: The JSON document, as a str or as UTF-8 encoded bytes.
+    :return: The decoded object.
+    """
+    if orjson is not None:
+        obj = orjson.loads(text)
+        # orjson decodes integers that don't fit in 64 bits as floats. The only integers in our files that can be that
+        # large are the curie_suffix values in synonym files (see SynonymRecord), so if we see one of those that has
+        # been turned into a float, we decode the document again with the standard library.
+        if not (isinstance(obj, dict) and isinstance(obj.get('curie_suffix'), float)):
+            return obj
+    return json.loads(text)
+
+
+def dumps(obj):
+    """
+    Encode an object as a compact JSON document.
+
+    :param obj: The object to encode.
+    :return: The JSON document as a str (without a trailing newline).
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # orjson.JSONEncodeError is a TypeError: fall through to the standard library, which can handle some
+            # values that orjson can't (e.g. integers larger than 64 bits).
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def dumps_line(obj):
+    """
+    Encode an object as a single line of a JSON Lines file.
+
+    :return: The JSON document as a str, including the trailing newline.
+    """
+    return dumps(obj) + '\n'
+
+
+def iter_jsonl(lines) -> Iterator:
+    """
+    Decode every non-blank line of an open JSON Lines file.
+
+    :param lines: An iterable of lines, such as a file (or gzip file) opened in text or binary mode.
+    :return: An iterator of decoded objects.
+    """
+    for line in lines:
+        if line.strip():
+            yield loads(line)
+
+
+def read_jsonl(filename) -> Iterator:
+    """
+    Decode every line of a JSON Lines file.
+
+    :param filename: The JSON Lines file to read. Files whose names end with `.gz` are decompressed.
+    :return: An iterator of decoded objects.
+    """
+    # Both orjson and json can decode UTF-8 bytes directly, so we don't need to decode each line into a str first.
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as inf:
+        yield from iter_jsonl(inf)
+
+
+def read_compendium(filename) -> Iterator[CompendiumRecord]:
+    """
+    Read the cliques in a compendium file.
+    """
+    return read_jsonl(filename)
+
+
+def read_synonyms(filename) -> Iterator[SynonymRecord]:
+    """
+    Read the entries in a synonym file (which may be gzipped).
+    """
+    return read_jsonl(filename)
+
+
+class JSONLWriter:
+    """
+    Write objects to a JSON Lines file, one per line. This can be used as a context manager, like jsonlines.Writer.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'w', encoding='utf-8')
+
+    def write(self, obj):
+        self.file.write(dumps_line(obj))
+
+    def write_all(self, objs):
+        for obj in objs:
+            self.write(obj)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
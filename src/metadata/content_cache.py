@@ -0,0 +1,301 @@
+"""
+content_cache.py - a content-addressed cache for the files that datahandlers derive from their downloads.
+
+Many datahandlers turn a raw download into `labels`, `synonyms`, `taxa` or `descriptions` files (e.g.
+pubchem.make_labels_or_synonyms() or ncbigene.pull_ncbigene_labels_synonyms_and_taxa()). Snakemake reruns these
+whenever a download is newer than its derived files, even if the download is byte-for-byte identical to the last one
+(which is what usually happens when a download is repeated). Some of these transformations take hours.
+
+Wrapping a datahandler function with @content_cached() makes it content-addressed instead:
+- We hash every input file with SHA-256. Hashes are memoized in `<cache directory>/hashes`, keyed by the path, size and
+  modification time of each file, so every download is only hashed once. write_download_metadata() uses the same
+  memoized hashes to record the content of each download in its metadata file.
+- We combine the input hashes with the name of the function, its version and a hash of its source code into a cache key.
+  The source code we hash is the whole module that defines the function, as well as every `src.*` module that it
+  imports from directly (e.g. src.babel_utils), so that fixing a helper function invalidates the cache entries that
+  depend on it. Helpers that are only reached indirectly aren't covered: increment the `version` of the cached
+  function if one of those changes.
+- If `<cache directory>/outputs/<cache key>` exists, we restore the output files from it instead of calling the
+  function. Otherwise, we call the function and store its output files there.
+
+Output files are stored and restored as hard links where possible, so the cache doesn't take up any extra space as long
+as it is on the same filesystem as the download directory. To make sure that a transformation never overwrites a cached
+file in place, we remove any existing output files before calling the function.
+"""
+import ast
+import functools
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from src.util import get_config, get_logger, get_memory_usage_summary
+
+logger = get_logger(__name__)
+
+# Change this if the layout of the cache directory or the way we compute cache keys changes, so that old entries are
+# ignored.
+CONTENT_CACHE_FORMAT_VERSION = 2
+
+# How many bytes to read at a time while hashing a file.
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def get_cache_directory():
+    """
+    Return the directory of the content cache, or None if the content cache is turned off in the config.
+    """
+    config = get_config()
+    if not config.get('datahandler_cache', False):
+        return None
+    return config['datahandler_cache_directory']
+
+
+def write_atomically(filename, text):
+    """
+    Write a text file to a temporary filename and move it into place once it is complete.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = f"{filename}.tmp-{os.getpid()}"
+    with open(tmp_filename, 'w') as outf:
+        outf.write(text)
+    os.replace(tmp_filename, filename)
+
+
+def hash_file(filename):
+    """
+    Calculate the SHA-256 hash of a file. If the content cache is turned on, the hash is memoized, and only recalculated
+    if the size or modification time of the file changes.
+
+    :param filename: The file to hash.
+    :return: The hex digest of the file.
+    """
+    stat = os.stat(filename)
+    source = {
+        'path': os.path.abspath(filename),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+    cache_directory = get_cache_directory()
+    memo_filename = None
+    if cache_directory is not None:
+        path_digest = hashlib.sha256(source['path'].encode('utf-8')).hexdigest()
+        memo_filename = os.path.join(cache_directory, 'hashes', f"{path_digest}.json")
+        if os.path.exists(memo_filename):
+            with open(memo_filename, 'r') as inf:
+                memo = json.load(inf)
+            if all(memo.get(key) == value for key, value in source.items()):
+                return memo['sha256']
+
+    logger.info(f"Hashing {filename} ({stat.st_size:,} bytes): {get_memory_usage_summary()}")
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as inf:
+        while True:
+            block = inf.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    sha256 = digest.hexdigest()
+
+    if memo_filename is not None:
+        write_atomically(memo_filename, json.dumps({**source, 'sha256': sha256}))
+    return sha256
+
+
+def hash_files(filenames):
+    """
+    Hash several files.
+
+    :return: A dictionary of filename -> SHA-256 hex digest.
+    """
+    return {filename: hash_file(filename) for filename in filenames}
+
+
+def get_cache_key(function_name, version, source_hash, input_hashes):
+    """
+    Combine everything that determines the output of a transformation into a single cache key.
+
+    :param function_name: The qualified name of the function.
+    :param version: The version of the function given to @content_cached().
+    :param source_hash: A hash of the source code of the function.
+    :param input_hashes: The SHA-256 hashes of the input files, in the order of the function's arguments.
+    """
+    key = {
+        'format_version': CONTENT_CACHE_FORMAT_VERSION,
+        'function': function_name,
+        'version': version,
+        'source': source_hash,
+        'inputs': input_hashes,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def link_or_copy(source, destination):
+    """
+    Hard link a file to a new location, falling back to copying it (e.g. if they are on different filesystems).
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def remove_if_exists(filename):
+    if os.path.lexists(filename):
+        os.remove(filename)
+
+
+def restore_outputs(entry_directory, output_filenames):
+    """
+    Restore the output files of a cache entry.
+
+    :return: True if every output was restored, False if the cache entry is missing or incomplete.
+    """
+    if not os.path.exists(os.path.join(entry_directory, 'manifest.json')):
+        return False
+    cached_filenames = [os.path.join(entry_directory, f"output-{index}") for index in range(len(output_filenames))]
+    if not all(os.path.exists(cached_filename) for cached_filename in cached_filenames):
+        return False
+
+    for cached_filename, output_filename in zip(cached_filenames, output_filenames):
+        os.makedirs(os.path.dirname(os.path.abspath(output_filename)), exist_ok=True)
+        remove_if_exists(output_filename)
+        link_or_copy(cached_filename, output_filename)
+        # Make the restored file look freshly written, so that Snakemake doesn't think it is older than its inputs.
+        os.utime(output_filename)
+    return True
+
+
+def store_outputs(entry_directory, output_filenames, manifest):
+    """
+    Store the output files of a transformation as a new cache entry. The entry is built in a temporary directory and
+    moved into place once it is complete, so concurrent jobs never see a partial entry.
+    """
+    parent_directory = os.path.dirname(entry_directory)
+    os.makedirs(parent_directory, exist_ok=True)
+    tmp_directory = tempfile.mkdtemp(prefix='entry-', dir=parent_directory)
+    try:
+        for index, output_filename in enumerate(output_filenames):
+            link_or_copy(output_filename, os.path.join(tmp_directory, f"output-{index}"))
+        with open(os.path.join(tmp_directory, 'manifest.json'), 'w') as outf:
+            json.dump(manifest, outf, indent=2)
+        if os.path.exists(entry_directory):
+            shutil.rmtree(entry_directory)
+        os.replace(tmp_directory, entry_directory)
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+
+def get_source_modules(function):
+    """
+    Return the modules whose source code can change the behaviour of a function: the module that defines it, and every
+    `src.*` module that it imports (or imports functions, classes or constants from) directly.
+
+    :return: A list of modules, sorted by name.
+    """
+    defining_module = sys.modules[function.__module__]
+    module_names = {defining_module.__name__}
+    for node in ast.walk(ast.parse(inspect.getsource(defining_module))):
+        if isinstance(node, ast.Import):
+            module_names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            module_names.add(node.module)
+            # `from src import babel_utils` imports a module rather than a name from one.
+            module_names.update(f"{node.module}.{alias.name}" for alias in node.names)
+    return [importlib.import_module(module_name) for module_name in sorted(module_names) if is_src_module(module_name)]
+
+
+def is_src_module(module_name):
+    """
+    Check whether a dotted name is a module with source code in the `src` package (rather than, say, a function in one,
+    or a namespace package).
+    """
+    if not module_name.startswith('src.'):
+        return False
+    try:
+        spec = importlib.util.find_spec(module_name)
+    except ModuleNotFoundError:
+        # The parent of the name is a module rather than a package.
+        return False
+    return spec is not None and spec.has_location
+
+
+def get_source_hash(function):
+    """
+    Return the SHA-256 hash of the source code of the modules from get_source_modules().
+    """
+    hasher = hashlib.sha256()
+    for module in get_source_modules(function):
+        hasher.update(module.__name__.encode('utf-8') + b'\0')
+        hasher.update(inspect.getsource(module).encode('utf-8') + b'\0')
+    return hasher.hexdigest()
+
+
+def content_cached(inputs, outputs, version=1, extra_inputs=None):
+    """
+    Make a datahandler function content-addressed: if it has already been called with input files that have the same
+    content, restore its output files from the cache instead of calling it again. If the content cache is turned off in
+    the config, the function is always called.
+
+    :param inputs: The names of the arguments that are input filenames.
+    :param outputs: The names of the arguments that are output filenames.
+    :param version: The version of the function. Increment this when the function's output changes for reasons that
+        aren't visible in the source code we hash (see get_source_modules()), e.g. a change in a helper function that
+        is only called indirectly.
+    :param extra_inputs: Input files that the function reads without being given as arguments
+        (e.g. `input_data/umls_precedence.txt`).
+    """
+    if extra_inputs is None:
+        extra_inputs = []
+
+    def decorator(function):
+        function_name = f"{function.__module__}.{function.__qualname__}"
+        signature = inspect.signature(function)
+        # The modules that the function depends on may not have been imported yet when it is decorated, so we hash their
+        # source code the first time the function is called.
+        source_hash = None
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            nonlocal source_hash
+            cache_directory = get_cache_directory()
+            if cache_directory is None:
+                return function(*args, **kwargs)
+            if source_hash is None:
+                source_hash = get_source_hash(function)
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            input_filenames = [arguments.arguments[name] for name in inputs] + list(extra_inputs)
+            output_filenames = [arguments.arguments[name] for name in outputs]
+
+            input_hashes = [hash_file(filename) for filename in input_filenames]
+            cache_key = get_cache_key(function_name, version, source_hash, input_hashes)
+            entry_directory = os.path.join(cache_directory, 'outputs', cache_key)
+
+            if restore_outputs(entry_directory, output_filenames):
+                logger.info(f"Restored {output_filenames} from content cache entry {cache_key} for {function_name}.")
+                return None
+
+            logger.info(f"No content cache entry for {function_name} with inputs {input_filenames}, running it: "
+                        f"{get_memory_usage_summary()}")
+            for output_filename in output_filenames:
+                remove_if_exists(output_filename)
+            result = function(*args, **kwargs)
+            store_outputs(entry_directory, output_filenames, {
+                'function': function_name,
+                'version': version,
+                'inputs': dict(zip(input_filenames, input_hashes)),
+                'outputs': output_filenames,
+            })
+            return result
+
+        return wrapper
+
+    return decorator
@@ -6,8 +6,17 @@ from datetime import datetime
 
 import yaml
 
-def write_download_metadata(filename, *, name, url='', description='', sources=None, counts=None):
-    write_metadata(filename, 'download', name, url=url, description=description, sources=sources, counts=None)
+from src.metadata.content_cache import hash_files
+
+def write_download_metadata(filename, *, name, url='', description='', sources=None, counts=None, downloaded_files=None):
+    # If we're given the files that were downloaded, we record their SHA-256 hashes, so that we can tell whether a new
+    # download has actually changed. These hashes are memoized by the content cache (see src/metadata/content_cache.py),
+    # so datahandlers that derive files from these downloads don't need to hash them again.
+    content_hashes = None
+    if downloaded_files is not None:
+        content_hashes = {os.path.basename(downloaded_file): sha256 for downloaded_file, sha256 in hash_files(downloaded_files).items()}
+    write_metadata(filename, 'download', name, url=url, description=description, sources=sources, counts=None,
+                   content_hashes=content_hashes)
 
 def write_concord_metadata(filename, *, name, concord_filename, url='', description='', sources=None, counts=None):
     # Concord files should all be in the format:
@@ -98,7 +107,7 @@ def write_combined_metadata(filename, typ, name, *, sources=None, url='', descri
         combined_from=combined_from
     )
 
-def write_metadata(filename, typ, name, *, sources=None, url='', description='', counts=None, combined_from=None):
+def write_metadata(filename, typ, name, *, sources=None, url='', description='', counts=None, combined_from=None, content_hashes=None):
     if type(typ) is not str:
         raise ValueError(f"Metadata entry type must be a string, not {type(typ)}: '{typ}'")
     if type(name) is not str:
@@ -109,6 +118,8 @@ def write_metadata(filename, typ, name, *, sources=None, url='', description='',
         counts = []
     if combined_from is None:
         combined_from = []
+    if content_hashes is None:
+        content_hashes = {}
 
     metadata_dir = os.path.dirname(filename)
     os.makedirs(metadata_dir, exist_ok=True)
@@ -122,4 +133,5 @@ def write_metadata(filename, typ, name, *, sources=None, url='', description='',
             'sources': sources,
             'counts': counts,
             'combined_from': combined_from,
+            'content_hashes': content_hashes,
         }, fout)
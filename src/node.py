@@ -2,8 +2,10 @@ import itertools
 import json
 import os
 import sqlite3
+from array import array
 from collections import defaultdict
 from urllib.parse import urlparse
+from urllib.request import pathname2url
 
 import curies
 
@@ -16,17 +18,29 @@ from src.util import (
     get_memory_usage_summary,
 )
 from src.LabeledID import LabeledID
+from src.curie_interner import CurieInterner
 from src.prefixes import PUBCHEMCOMPOUND
+from src.sstable import open_tsv_table
 
 logger = get_logger(__name__)
 
+# How many CURIEs should TSVSQLiteLoader.get_curies() look up in a single query? This needs to be below SQLite's limit on
+# the number of variables in a query (32,766 in recent versions of SQLite, but only 999 before 3.32.0).
+TSVSQLITELOADER_QUERY_BATCH_SIZE = 900
+
+# Change this if the format of the SQLite databases built by TSVSQLiteLoader changes, so that old databases are rebuilt.
+TSVSQLITELOADER_FORMAT_VERSION = 1
+
+# How much of each SQLite database TSVSQLiteLoader should memory-map (SQLite will only map as much as the file size).
+TSVSQLITELOADER_MMAP_SIZE = 64 * 1024 * 1024 * 1024
+
 class SynonymFactory:
     """
     A class used to load and retrieve synonyms for given node identifiers
 
     Attributes:
         synonym_dir (str): The directory where the synonym files are located
-        synonyms (dict): A dictionary to store the loaded synonyms
+        synonyms (dict): A dictionary of prefix -> (labels table, synonyms table), as SortedStringTables
 
     Methods:
         __init__(syndir)
@@ -63,38 +77,39 @@ class SynonymFactory:
         logger.info(f"Created SynonymFactory for directory {syndir}")
 
     def load_synonyms(self,prefix):
-        lbs = defaultdict(set)
+        # We don't load the labels and synonyms into memory: instead, we open (and build, if needed) a sorted string
+        # table for each file, and look up the identifiers we need when we need them.
         labelfname = os.path.join(self.synonym_dir, prefix, 'labels')
-        logger.info(f'Loading synonyms for {prefix} from {labelfname}: {get_memory_usage_summary()}')
-        count_labels = 0
-        count_synonyms = 0
-        if os.path.exists(labelfname):
-            with open(labelfname, 'r') as inf:
-                for line in inf:
-                    x = line.strip().split('\t')
-                    lbs[x[0]].add( ('http://www.geneontology.org/formats/oboInOwl#hasExactSynonym',x[1]) )
-                    count_labels += 1
         synfname = os.path.join(self.synonym_dir, prefix, 'synonyms')
-        if os.path.exists(synfname):
-            with open(synfname, 'r') as inf:
-                for line in inf:
-                    x = line.strip().split('\t')
-                    if len(x) < 3:
-                        continue
-                    lbs[x[0]].add( (x[1], x[2]) )
-                    count_synonyms += 1
-        self.synonyms[prefix] = lbs
-        logger.info(f'Loaded {count_labels:,} labels and {count_synonyms:,} synonyms for {prefix} from {labelfname}: {get_memory_usage_summary()}')
+        logger.info(f'Loading synonyms for {prefix} from {labelfname}: {get_memory_usage_summary()}')
+        labels_table = open_tsv_table(labelfname)
+        synonyms_table = open_tsv_table(synfname)
+        self.synonyms[prefix] = (labels_table, synonyms_table)
+        logger.info(f'Loaded labels ({labels_table}) and synonyms ({synonyms_table}) for {prefix}: {get_memory_usage_summary()}')
 
     def get_synonyms(self,node):
         node_synonyms = set()
+        ids_by_prefix = defaultdict(list)
         for ident in node['identifiers']:
             thisid = ident['identifier']
-            pref = Text.get_prefix(thisid)
+            ids_by_prefix[Text.get_prefix(thisid)].append(thisid)
+            node_synonyms.update( self.common_synonyms.get(thisid, set()) )
+        for pref, ids in ids_by_prefix.items():
             if pref not in self.synonyms:
                 self.load_synonyms(pref)
-            node_synonyms.update( self.synonyms[pref][thisid] )
-            node_synonyms.update( self.common_synonyms.get(thisid, set()) )
+            labels_table, synonyms_table = self.synonyms[pref]
+            if labels_table is not None:
+                for lines in labels_table.get_many(ids).values():
+                    for line in lines:
+                        x = line.split('\t')
+                        node_synonyms.add( ('http://www.geneontology.org/formats/oboInOwl#hasExactSynonym',x[1]) )
+            if synonyms_table is not None:
+                for lines in synonyms_table.get_many(ids).values():
+                    for line in lines:
+                        x = line.split('\t')
+                        if len(x) < 3:
+                            continue
+                        node_synonyms.add( (x[1], x[2]) )
         return node_synonyms
 
 
@@ -126,26 +141,26 @@ class DescriptionFactory:
 
     def load_descriptions(self,prefix):
         logger.info(f'Loading descriptions for {prefix}')
-        descs = defaultdict(set)
         descfname = os.path.join(self.root_dir, prefix, 'descriptions')
-        desc_count = 0
-        if os.path.exists(descfname):
-            with open(descfname, 'r') as inf:
-                for line in inf:
-                    x = line.strip().split('\t')
-                    descs[x[0]].add("\t".join(x[1:]))
-                    desc_count += 1
-        self.descriptions[prefix] = descs
-        logger.info(f'Loaded {desc_count:,} descriptions for {prefix}')
+        self.descriptions[prefix] = open_tsv_table(descfname)
+        logger.info(f'Loaded descriptions for {prefix}: {self.descriptions[prefix]}')
 
     def get_descriptions(self, ids: list[str]):
         node_descriptions = defaultdict(set)
+        ids_by_prefix = defaultdict(list)
         for thisid in ids:
-            pref = Text.get_prefix(thisid)
+            ids_by_prefix[Text.get_prefix(thisid)].append(thisid)
+            node_descriptions[thisid].update( self.common_descriptions.get(thisid, {}) )
+        for pref, pref_ids in ids_by_prefix.items():
             if pref not in self.descriptions:
                 self.load_descriptions(pref)
-            node_descriptions[thisid].update( self.descriptions[pref][thisid] )
-            node_descriptions[thisid].update( self.common_descriptions.get(thisid, {}) )
+            descriptions_table = self.descriptions[pref]
+            if descriptions_table is None:
+                continue
+            for thisid, lines in descriptions_table.get_many(pref_ids).items():
+                for line in lines:
+                    x = line.split('\t')
+                    node_descriptions[thisid].add("\t".join(x[1:]))
         return node_descriptions
 
 
@@ -156,12 +171,27 @@ class TaxonFactory:
     def __init__(self, rootdir):
         self.root_dir = rootdir
         self.tsvloader = TSVSQLiteLoader(rootdir, 'taxa', 'curie-curie')
+        # Taxa looked up by prefetch_taxa(), keyed by the upper-cased CURIE (since lookups are case-insensitive).
+        self.prefetched = {}
 
     def load_taxa(self, prefix):
         return self.tsvloader.load_prefix(prefix)
 
+    def prefetch_taxa(self, curies):
+        """
+        Look up the taxa for a large number of CURIEs (e.g. every CURIE in the next few thousand cliques) in a few
+        batched queries, so that get_taxa() can answer from memory. This replaces any previously prefetched taxa.
+        """
+        results = self.tsvloader.get_curies(curies)
+        self.prefetched = {curie.upper(): taxa for curie, taxa in results.items()}
+
     def get_taxa(self, curies: list[str]):
-        return self.tsvloader.get_curies(curies)
+        missing = [curie for curie in curies if curie.upper() not in self.prefetched]
+        results = self.tsvloader.get_curies(missing) if missing else {}
+        for curie in curies:
+            if curie not in results:
+                results[curie] = set(self.prefetched[curie.upper()])
+        return results
 
     def close(self):
         self.tsvloader.close()
@@ -172,10 +202,12 @@ class TSVSQLiteLoader:
     All of the files we load here (SynonymFactory, DescriptionFactory, TaxonFactory and InformationContentFactory)
     are TSV files in very similar formats (either <curie>\t<value> or <curie>\t<predicate>\t<value>). Some of these
     TSV files are very large, so we don't want to load them all into memory at once. Instead, we use SQLite to:
-    1.  Load them into SQLite files. SQLite supports "temporary databases" (https://www.sqlite.org/inmemorydb.html) --
-        the database is kept in memory, but data can spill onto the disk if the database gets large.
+    1.  Load them into SQLite files. Each TSV file is loaded into a SQLite database next to it (`<filename>.sqlite`),
+        which records the size and modification time of the TSV file it was built from. Since write_compendium() is
+        called many times per build (once per Biolink type for chemicals), later TSVSQLiteLoaders -- in this process or
+        any other -- simply open the existing database read-only, and it is only rebuilt if the TSV file changes.
     2.  Query identifiers by identifier prefix.
-    3.  Close and delete the SQLite files when we're done.
+    3.  Close the SQLite files when we're done.
 
     TODO: note that on Sterling, SQLite might not be able to detect when it's running out of memory (we have a limit
     of around 500Gi, but the node will have 1.5Ti, so SQLite won't detect a low-mem situation correctly). We should
@@ -206,6 +238,8 @@ class TSVSQLiteLoader:
     def get_sqlite_counts(self):
         counts = dict()
         for prefix in self.sqlites:
+            if self.sqlites[prefix] is None:
+                continue
             counts[prefix] = self.sqlites[prefix].execute(f"SELECT COUNT(*) FROM {prefix}").fetchone()[0]
         return counts
 
@@ -222,16 +256,74 @@ class TSVSQLiteLoader:
             self.sqlites[prefix] = None
             return False
 
-        # Write to a SQLite in-memory database so we don't need to hold it in memory all at once.
-        logger.info(f"Loading {prefix} into SQLite: {get_memory_usage_summary()}")
+        # Open the SQLite database for this TSV file, building it if needed.
+        sqlite_filename = tsv_filename + '.sqlite'
+        conn = self.open_persistent_sqlite(tsv_filename, sqlite_filename)
+        if conn is None:
+            self.build_persistent_sqlite(prefix, tsv_filename, sqlite_filename)
+            conn = self.open_persistent_sqlite(tsv_filename, sqlite_filename)
+            if conn is None:
+                raise RuntimeError(f"Could not open SQLite database {sqlite_filename} after building it from {tsv_filename}.")
+        self.sqlites[prefix] = conn
+        return True
+
+    @staticmethod
+    def get_source_metadata(tsv_filename):
+        """
+        Describe the TSV file that a SQLite database should have been built from. If any of these values change, the
+        SQLite database will be rebuilt.
+        """
+        stat = os.stat(tsv_filename)
+        return {
+            'version': TSVSQLITELOADER_FORMAT_VERSION,
+            'source_filename': os.path.abspath(tsv_filename),
+            'source_size': stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns,
+        }
+
+    def open_persistent_sqlite(self, tsv_filename, sqlite_filename):
+        """
+        Open an existing SQLite database read-only, as long as it was built from the current version of the TSV file.
+
+        :return: A SQLite connection, or None if the database doesn't exist or is out of date.
+        """
+        if not os.path.exists(sqlite_filename):
+            return None
+
+        # Databases are never modified once they've been moved into place (we replace them instead), so we can open
+        # them as immutable, which allows SQLite to skip locking entirely.
+        conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(sqlite_filename))}?mode=ro&immutable=1", uri=True)
+        try:
+            metadata = json.loads(conn.execute("SELECT value FROM metadata WHERE key = 'source'").fetchone()[0])
+        except (sqlite3.Error, TypeError) as e:
+            logger.warning(f"Could not read metadata from SQLite database {sqlite_filename}, rebuilding: {e}")
+            conn.close()
+            return None
+        if metadata != self.get_source_metadata(tsv_filename):
+            logger.info(f"SQLite database {sqlite_filename} ({metadata}) is out of date, rebuilding.")
+            conn.close()
+            return None
 
-        # Setting a SQLite database as "" does exactly what we want: create an in-memory database that will spill onto
-        # a temporary file if needed.
-        conn = sqlite3.connect('')
+        conn.execute(f"PRAGMA mmap_size = {TSVSQLITELOADER_MMAP_SIZE}")
+        logger.info(f"Opened SQLite database {sqlite_filename} for {tsv_filename}: {get_memory_usage_summary()}")
+        return conn
+
+    def build_persistent_sqlite(self, prefix, tsv_filename, sqlite_filename):
+        """
+        Load a TSV file into a new SQLite database. We write it to a temporary file and then move it into place, so that
+        other processes never see a partially written database.
+        """
+        logger.info(f"Loading {prefix} into SQLite database {sqlite_filename}: {get_memory_usage_summary()}")
+        tmp_filename = f"{sqlite_filename}.tmp-{os.getpid()}"
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        conn = sqlite3.connect(tmp_filename)
+        # We're writing a new file that nobody else can see yet, so we don't need a journal or synchronous writes.
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
         conn.execute(f"CREATE TABLE {prefix} (curie1 TEXT, curie2 TEXT)")
 
-        # Load taxa into memory.
-        logger.info(f"Reading records from {tsv_filename} into memory to load into SQLite: {get_memory_usage_summary()}")
+        logger.info(f"Reading records from {tsv_filename} to load into SQLite: {get_memory_usage_summary()}")
         records = []
         record_count = 0
         with open(tsv_filename, 'r') as inf:
@@ -250,10 +342,14 @@ class TSVSQLiteLoader:
         conn.executemany(f"INSERT INTO {prefix} VALUES (?, ?)", records)
         logger.info(f"Creating a case-insensitive index for the {record_count:,} records loaded into SQLite: {get_memory_usage_summary()}")
         conn.execute(f"CREATE INDEX curie1_idx ON {prefix}(curie1)")
+
+        # Record where this database came from, so we can tell if it's out of date.
+        conn.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("INSERT INTO metadata VALUES ('source', ?)", [json.dumps(self.get_source_metadata(tsv_filename))])
         conn.commit()
-        logger.info(f"Loaded {record_count:,} records from {tsv_filename} into SQLite table {prefix}: {get_memory_usage_summary()}")
-        self.sqlites[prefix] = conn
-        return True
+        conn.close()
+        os.replace(tmp_filename, sqlite_filename)
+        logger.info(f"Loaded {record_count:,} records from {tsv_filename} into SQLite database {sqlite_filename}: {get_memory_usage_summary()}")
 
     def get_curies(self, curies_to_query: list) -> dict[str, set[str]]:
         results = defaultdict(set)
@@ -277,18 +373,18 @@ class TSVSQLiteLoader:
                     results[curie] = set()
                 continue
 
-            # Query the SQLite.
-            query = f"SELECT curie1, curie2 FROM {prefix} WHERE curie1 = ?"
-            for curie in curies:
-                query_result = self.sqlites[prefix].execute(query, [curie.upper()]).fetchall()
-                if not query_result:
-                    results[curie] = set()
-                    continue
+            # Query the SQLite in batches of CURIEs. The CURIEs are stored in upper case, which allows us to query
+            # them case-insensitively.
+            values_by_curie1 = defaultdict(set)
+            curies_upper = sorted(set(curie.upper() for curie in curies))
+            for start in range(0, len(curies_upper), TSVSQLITELOADER_QUERY_BATCH_SIZE):
+                batch = curies_upper[start:start + TSVSQLITELOADER_QUERY_BATCH_SIZE]
+                query = f"SELECT curie1, curie2 FROM {prefix} WHERE curie1 IN ({', '.join('?' * len(batch))})"
+                for curie1, curie2 in self.sqlites[prefix].execute(query, batch):
+                    values_by_curie1[curie1].add(curie2)
 
-                for row in query_result:
-                    curie1 = curie
-                    curie2 = row[1]
-                    results[curie1].add(curie2)
+            for curie in curies:
+                results[curie] = set(values_by_curie1.get(curie.upper(), set()))
 
         return dict(results)
 
@@ -315,12 +411,13 @@ class InformationContentFactory:
     A class for creating and using information content objects.
 
     Attributes:
-        ic (dict): A dictionary containing information content values for different nodes.
+        ic_curies (CurieInterner): The CURIEs that have information content values.
+        ic_values (array): The information content value for every CURIE, indexed by its handle in ic_curies.
 
     Methods:
         __init__(ic_file)
             Initializes an InformationContentFactory object by loading information content values from a file.
-            The information content values are stored in the 'ic' attribute of the object.
+            The information content values are stored in the 'ic_curies' and 'ic_values' attributes of the object.
 
             Parameters:
                 ic_file (str): The path to the file containing the information content values.
@@ -338,7 +435,10 @@ class InformationContentFactory:
 
     def __init__(self, ic_file):
         config = get_config()
-        self.ic = {}
+        # icRDF.tsv has millions of entries, so rather than a dictionary of CURIE strings to floats, we keep the CURIEs in
+        # a CurieInterner and the values in an array indexed by their handles.
+        self.ic_curies = CurieInterner()
+        self.ic_values = array('d')
 
         unmapped_urls = []
         biolink_prefix_map = get_biolink_prefix_map()
@@ -358,9 +458,13 @@ class InformationContentFactory:
                 # If None, log this URL as unmapped.
                 if node_id is None:
                     unmapped_urls.append(x[0])
-
-                ic = x[1]
-                self.ic[node_id] = float(ic)
+                else:
+                    # If a CURIE appears more than once, the last value wins.
+                    handle = self.ic_curies.intern(node_id)
+                    if handle == len(self.ic_values):
+                        self.ic_values.append(float(x[1]))
+                    else:
+                        self.ic_values[handle] = float(x[1])
 
                 # Track IC values by prefix.
                 if isinstance(node_id, str):
@@ -373,7 +477,7 @@ class InformationContentFactory:
         # Sort the dictionary items by value in descending order
         sorted_by_prefix = sorted(count_by_prefix.items(), key=lambda item: item[1], reverse=True)
 
-        logger.info(f"Loaded {len(self.ic)} InformationContent values from {len(count_by_prefix.keys())} prefixes:")
+        logger.info(f"Loaded {len(self.ic_values)} InformationContent values from {len(count_by_prefix.keys())} prefixes:")
         # Now you can print the sorted items
         for key, value in sorted_by_prefix:
             logger.info(f'- {key}: {value}')
@@ -403,10 +507,10 @@ class InformationContentFactory:
         ICs = []
         for ident in node['identifiers']:
             thisid = ident['identifier']
-            if thisid in self.ic:
+            handle = self.ic_curies.get(thisid)
+            if handle is not None:
                 # IC values are numeric values between 0 and 100.
-                # Make sure this is a float for min() purposes.
-                ICs.append(float(self.ic[thisid]))
+                ICs.append(self.ic_values[handle])
         if len(ICs) == 0:
             return None
         return min(ICs)
@@ -502,13 +606,24 @@ class NodeFactory:
             logger.warning(f"no prefix specified in load_extra_labels({self}, {prefix}), can't load extra labels. Skipping.")
             return
         labelfname = os.path.join(self.label_dir,prefix,'labels')
-        lbs = {}
-        if os.path.exists(labelfname):
-            with open(labelfname,'r') as inf:
-                for line in inf:
-                    x = line.strip().split('\t')
-                    lbs[x[0]] = x[1]
-        self.extra_labels[prefix] = lbs
+        self.extra_labels[prefix] = open_tsv_table(labelfname)
+
+    def get_extra_label(self, prefix, iid):
+        """
+        Look up the label for an identifier in the labels file for its prefix. If there is more than one label, the
+        last one in the file is used.
+
+        :return: The label, or None if there is no label for this identifier.
+        """
+        if prefix not in self.extra_labels:
+            self.load_extra_labels(prefix)
+        labels_table = self.extra_labels.get(prefix)
+        if labels_table is None:
+            return None
+        lines = labels_table.get(iid)
+        if not lines:
+            return None
+        return lines[-1].split('\t')[1]
 
     def apply_labels(self, input_identifiers, labels):
         # Before we work on the labels (or try to load any extra labels), let's load up the common labels.
@@ -550,10 +665,9 @@ class NodeFactory:
                 except ValueError as e:
                     logger.error(f"Unable to apply_labels({self}, {input_identifiers}, {labels}): could not obtain prefix for identifier {iid}")
                     raise e
-                if prefix not in self.extra_labels:
-                    self.load_extra_labels(prefix)
-                if iid in self.extra_labels[prefix]:
-                    labeled_list.append( LabeledID(identifier=iid, label = self.extra_labels[prefix][iid]))
+                extra_label = self.get_extra_label(prefix, iid)
+                if extra_label is not None:
+                    labeled_list.append( LabeledID(identifier=iid, label = extra_label))
                 elif iid in self.common_labels:
                     # We only fall back to common labels if the prefix label doesn't have anything.
                     labeled_list.append( LabeledID(identifier=iid, label = self.common_labels[iid]))
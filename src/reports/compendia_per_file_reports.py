@@ -1,13 +1,14 @@
 """
 compendia_per_file_reports.py - Generate reports for the individual files in the compendia directory.
 """
-import itertools
 import json
-import logging
 import os
 from collections import defaultdict
 from datetime import datetime
 
+from src.assess_compendia import write_cluster_report
+from src.reports.compendium_scanner import scan_compendium, ContentReportAccumulator, ClusterReportAccumulator
+
 
 def get_datetime_as_string():
     """
@@ -46,79 +47,59 @@ def assert_files_in_directory(dir, expected_files, report_file):
         f.write(f"Confirmed that {dir} contains only the files {expected_files} at {get_datetime_as_string()}\n")
 
 
-def generate_content_report_for_compendium(compendium_path, report_path):
+def generate_content_report_for_compendium(compendium_path, report_path, workers=1):
     """
     Generate a report of CURIE prefixes per file.
 
     :param compendium_path: The path of the compendium file to read.
     :param report_path: The path to write the CURIE prefixes per file report as a JSON file.
+    :param workers: The number of worker processes to use to read large compendium files.
     """
+    generate_reports_for_compendium(compendium_path, content_report_path=report_path, workers=workers)
 
-    with open(report_path, "w") as report_file:
-        with open(compendium_path, "r") as compendium_file:
-            # This is a JSONL file, so we need to read each line as a JSON object.
-
-            # Track CURIE breakdowns for this compendium.
-            count_by_prefix = defaultdict(int)
-            count_by_biolink_type = defaultdict(int)
-            counters = {
-                'clique_count': 0,
-                'cliques_by_id_count': defaultdict(int),
-                'cliques_by_label_count': defaultdict(int),
-                'cliques_by_unique_label_count': defaultdict(int),
-                'cliques_by_description_count': defaultdict(int),
-                'cliques_by_unique_description_count': defaultdict(int),
-            }
-
-            # Since this is time-consuming, let's log a count as we go.
-            count_lines = 0
-
-            # Iterate through the compendium file.
-            for line in compendium_file:
-                count_lines += 1
-
-                # Report updates every 10 million lines.
-                if count_lines % 10000000 == 0:
-                    logging.info(f"Processed {count_lines:,} lines in {compendium_path}")
-
-                # Parse each line as a JSON object.
-                clique = json.loads(line)
-
-                # Track the CURIEs we're looking for.
-                identifiers = clique.get('identifiers', [])
-                ids = list(map(lambda x: x['i'], identifiers))
-
-                # Update counts by Biolink type.
-                count_by_biolink_type[clique.get('type', '')] += 1
-
-                # Update counts by prefix.
-                for curie in ids:
-                    prefix = curie.split(':')[0]
-                    count_by_prefix[prefix] += 1
-
-                # Update counts by flags.
-                counters['clique_count'] += 1
-                counters['cliques_by_id_count'][len(ids)] += 1
-                labels = list(filter(lambda x: x.strip() != '', map(lambda x: x.get('l', ''), identifiers)))
-                counters['cliques_by_label_count'][len(labels)] += 1
-                unique_labels = set(labels)
-                counters['cliques_by_unique_label_count'][len(unique_labels)] += 1
-
-                # Since descriptions are currently lists, we have to first flatten the list with
-                # itertools.chain.from_iterable() before we can count them.
-                descriptions = list(filter(lambda x: x.strip() != '', itertools.chain.from_iterable(map(lambda x: x.get('d', ''), identifiers))))
-                counters['cliques_by_description_count'][len(descriptions)] += 1
-                unique_descriptions = set(descriptions)
-                counters['cliques_by_unique_description_count'][len(unique_descriptions)] += 1
 
+def generate_reports_for_compendium(compendium_path, content_report_path=None, cluster_report_path=None, workers=1):
+    """
+    Generate the content report (see generate_content_report_for_compendium()) and/or the cluster report (see
+    assess_compendia.assess()) for a compendium, reading the compendium file only once.
+
+    :param compendium_path: The path of the compendium file to read.
+    :param content_report_path: The path to write the content report to as a JSON file, or None to skip it.
+    :param cluster_report_path: The path to write the cluster report to, or None to skip it.
+    :param workers: The number of worker processes to use to read large compendium files.
+    """
+    accumulator_factories = []
+    if content_report_path is not None:
+        accumulator_factories.append(ContentReportAccumulator)
+    if cluster_report_path is not None:
+        accumulator_factories.append(ClusterReportAccumulator)
+
+    accumulators = scan_compendium(compendium_path, accumulator_factories, workers=workers)
+
+    for accumulator in accumulators:
+        if isinstance(accumulator, ContentReportAccumulator):
+            write_content_report(accumulator, compendium_path, content_report_path)
+        else:
+            write_cluster_report(accumulator, cluster_report_path)
+
+
+def write_content_report(accumulator, compendium_path, report_path):
+    """
+    Write out a content report.
+
+    :param accumulator: The ContentReportAccumulator for this compendium.
+    :param compendium_path: The path of the compendium file that was read.
+    :param report_path: The path to write the report to as a JSON file.
+    """
+    with open(report_path, "w") as report_file:
         json.dump({
             'name': os.path.splitext(os.path.basename(compendium_path))[0],
             'compendium_path': compendium_path,
             'report_path': report_path,
-            'count_lines': count_lines,
-            'count_by_biolink_type': count_by_biolink_type,
-            'count_by_prefix': count_by_prefix,
-            'counters': counters,
+            'count_lines': accumulator.count_lines,
+            'count_by_biolink_type': accumulator.count_by_biolink_type,
+            'count_by_prefix': accumulator.count_by_prefix,
+            'counters': accumulator.counters,
         }, report_file, sort_keys=True, indent=2)
 
 
@@ -0,0 +1,223 @@
+"""
+compendium_scanner.py - compute several reports on a compendium file in a single pass.
+
+Several of our reports (the content reports in compendia_per_file_reports.py and the cluster reports in
+assess_compendia.py) need to look at every clique in a compendium file. Rather than having each of them read and parse
+the whole file, scan_compendium() reads the file once and passes every clique to a list of report accumulators.
+
+Large compendium files can also be split into byte ranges (aligned to line boundaries) that are scanned in parallel by
+a pool of worker processes. Each worker fills in its own accumulators, which are then merged in file order, so the
+results are the same as scanning the file in a single process.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from src import json_codec
+from src.util import Text
+
+# Don't bother scanning in parallel unless every worker will have at least this many bytes to read.
+SCAN_MIN_BYTES_PER_RANGE = 64 * 1024 * 1024
+
+# Log our progress every this many lines.
+SCAN_LOG_EVERY_X_LINES = 10_000_000
+
+
+class ContentReportAccumulator:
+    """
+    Count cliques by Biolink type, identifiers by prefix, and cliques by number of identifiers, labels and descriptions.
+    This is the content report written by generate_content_report_for_compendium().
+    """
+
+    def __init__(self):
+        self.count_lines = 0
+        self.count_by_prefix = defaultdict(int)
+        self.count_by_biolink_type = defaultdict(int)
+        self.counters = {
+            'clique_count': 0,
+            'cliques_by_id_count': defaultdict(int),
+            'cliques_by_label_count': defaultdict(int),
+            'cliques_by_unique_label_count': defaultdict(int),
+            'cliques_by_description_count': defaultdict(int),
+            'cliques_by_unique_description_count': defaultdict(int),
+        }
+
+    def add(self, clique):
+        self.count_lines += 1
+
+        # Track the CURIEs we're looking for.
+        identifiers = clique.get('identifiers', [])
+        ids = list(map(lambda x: x['i'], identifiers))
+
+        # Update counts by Biolink type.
+        self.count_by_biolink_type[clique.get('type', '')] += 1
+
+        # Update counts by prefix.
+        for curie in ids:
+            prefix = curie.split(':')[0]
+            self.count_by_prefix[prefix] += 1
+
+        # Update counts by flags.
+        counters = self.counters
+        counters['clique_count'] += 1
+        counters['cliques_by_id_count'][len(ids)] += 1
+        labels = list(filter(lambda x: x.strip() != '', map(lambda x: x.get('l', ''), identifiers)))
+        counters['cliques_by_label_count'][len(labels)] += 1
+        unique_labels = set(labels)
+        counters['cliques_by_unique_label_count'][len(unique_labels)] += 1
+
+        # Since descriptions are currently lists, we have to first flatten the list with
+        # itertools.chain.from_iterable() before we can count them.
+        descriptions = list(filter(lambda x: x.strip() != '', itertools.chain.from_iterable(map(lambda x: x.get('d', ''), identifiers))))
+        counters['cliques_by_description_count'][len(descriptions)] += 1
+        unique_descriptions = set(descriptions)
+        counters['cliques_by_unique_description_count'][len(unique_descriptions)] += 1
+
+    def merge(self, other):
+        self.count_lines += other.count_lines
+        merge_counts(self.count_by_prefix, other.count_by_prefix)
+        merge_counts(self.count_by_biolink_type, other.count_by_biolink_type)
+        for counter, value in other.counters.items():
+            if isinstance(value, int):
+                self.counters[counter] += value
+            else:
+                merge_counts(self.counters[counter], value)
+
+
+class ClusterReportAccumulator:
+    """
+    Count cliques by size and by "cluster type" (the number of identifiers with each prefix). This is the report
+    written by assess_compendia.assess().
+    """
+
+    def __init__(self):
+        self.nclusters = 0
+        self.clustersizes = defaultdict(int)
+        self.clustertypes = defaultdict(int)
+
+    def add(self, clique):
+        self.nclusters += 1
+        self.clustersizes[len(clique['identifiers'])] += 1
+        self.clustertypes[get_cluster_type(clique)] += 1
+
+    def merge(self, other):
+        self.nclusters += other.nclusters
+        merge_counts(self.clustersizes, other.clustersizes)
+        merge_counts(self.clustertypes, other.clustertypes)
+
+
+def get_cluster_type(clique):
+    """
+    Describe a clique by the number of identifiers it has with each prefix.
+
+    :return: A frozenset of (prefix, count) tuples.
+    """
+    pcounts = defaultdict(int)
+    for identifier in clique['identifiers']:
+        pcounts[Text.get_curie(identifier['i'])] += 1
+    return frozenset(pcounts.items())
+
+
+def merge_counts(counts, other_counts):
+    """
+    Add the counts in one dictionary to another. New keys are added in the order they appear in other_counts, so
+    merging the counts from consecutive parts of a file in order gives the same key order as counting the whole file.
+    """
+    for key, count in other_counts.items():
+        counts[key] += count
+
+
+def get_byte_ranges(filename, range_count):
+    """
+    Split a file into up to range_count byte ranges of roughly equal size, each of which starts at the beginning of a
+    line and ends at the end of a line.
+
+    :return: A list of (start, end) byte offsets.
+    """
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, 'rb') as f:
+        for index in range(1, range_count):
+            offset = size * index // range_count
+            if offset <= boundaries[-1]:
+                continue
+            f.seek(offset - 1)
+            # Skip to the end of the line that contains the byte before this offset.
+            f.readline()
+            boundary = f.tell()
+            if boundary >= size:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def scan_byte_range(filename, start, end, accumulator_factories):
+    """
+    Scan the cliques in a byte range of a compendium file.
+
+    :param filename: The compendium file to scan.
+    :param start: The offset of the first byte to scan (which must be at the start of a line).
+    :param end: The offset after the last byte to scan (which must be at the end of a line).
+    :param accumulator_factories: A list of functions (or classes) that return new, empty accumulators.
+    :return: A list of accumulators, one from each factory.
+    """
+    accumulators = [factory() for factory in accumulator_factories]
+    count_lines = 0
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            if not line.strip():
+                continue
+            count_lines += 1
+            if count_lines % SCAN_LOG_EVERY_X_LINES == 0:
+                logging.info(f"Processed {count_lines:,} lines in {filename} (bytes {start:,} to {end:,})")
+
+            clique = json_codec.loads(line)
+            for accumulator in accumulators:
+                accumulator.add(clique)
+    return accumulators
+
+
+def scan_compendium(filename, accumulator_factories, workers=1):
+    """
+    Read a compendium file once, passing every clique to several accumulators.
+
+    :param filename: The compendium file to scan.
+    :param accumulator_factories: A list of functions (or classes) that return new, empty accumulators. Accumulators
+        need an add(clique) method, and a merge(other) method if the file is scanned in parallel.
+    :param workers: The number of worker processes to use. The file is only scanned in parallel if every worker would
+        have at least SCAN_MIN_BYTES_PER_RANGE bytes to read.
+    :return: A list of accumulators, one from each factory.
+    """
+    size = os.path.getsize(filename)
+    workers = max(1, min(workers, size // SCAN_MIN_BYTES_PER_RANGE))
+    if workers == 1:
+        return scan_byte_range(filename, 0, size, accumulator_factories)
+
+    byte_ranges = get_byte_ranges(filename, workers)
+    logging.info(f"Scanning {filename} in {len(byte_ranges)} byte ranges with {workers} workers.")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        results = list(executor.map(
+            scan_byte_range,
+            itertools.repeat(filename),
+            [start for start, _ in byte_ranges],
+            [end for _, end in byte_ranges],
+            itertools.repeat(accumulator_factories),
+        ))
+
+    # Merge the accumulators in file order.
+    accumulators = results[0]
+    for range_accumulators in results[1:]:
+        for accumulator, range_accumulator in zip(accumulators, range_accumulators):
+            accumulator.merge(range_accumulator)
+    return accumulators
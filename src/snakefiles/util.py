@@ -1,8 +1,6 @@
 # Shared code used by Snakemake files
-import shutil
-import gzip
-
 import src.util
+from src.compression import compress_file
 
 logger = src.util.LoggingUtil.init_logging(__name__, level="INFO")
 
@@ -12,18 +10,18 @@ def write_done(filename):
         print("done", f)
 
 
-def gzip_files(input_filenames):
+def gzip_files(input_filenames, workers=None):
     """ Compress files using Gzip. Like with `gzip`, we compress the file by adding `.gz` to the end of the filename, but
     we do NOT delete the original file -- we'll leave that to the user.
 
     :param input_filenames: A list of Gzip files to compress.
+    :param workers: The number of threads to compress each file with (defaults to `compression_workers` in the config).
     """
     logger.info(f"Compressing: {input_filenames}")
     for filename in input_filenames:
         output_filename = filename + '.gz'
-        with open(filename, 'rb') as f_in, gzip.open(output_filename, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        logger.info(f"Compressed {filename} to {output_filename} using the gzip module.")
+        compress_file(filename, output_filename, workers=workers)
+        logger.info(f"Compressed {filename} to {output_filename} using src.compression.")
     logger.info(f"Done compressing: {input_filenames}")
 
 
@@ -0,0 +1,201 @@
+"""
+sparql_fetcher.py - download very large SPARQL result sets concurrently, a page at a time, straight to disk.
+
+UberGraph's get_all_labels(), get_all_descriptions(), get_all_synonyms() and write_normalized_information_content()
+used to page through their results with `ORDER BY ... OFFSET n LIMIT 200000`, one request at a time, and accumulate
+every row in memory. Every OFFSET page is slower than the last, because the server has to sort and skip all the rows
+before it. A PagedSPARQLFetcher instead:
+- Splits the IRI space into partitions (e.g. one per ontology IRI prefix, from get_iri_partitions()), so that several
+  partitions can be downloaded at the same time on a pool of `ubergraph_workers` threads.
+- Pages through each partition with keyset pagination: each page asks for the next `page_size` subjects whose IRIs
+  sort after the last IRI on the previous page, which the server can answer without skipping anything.
+- Retries failed pages up to `ubergraph_retries` times.
+- Writes every page to a file for its partition as soon as it arrives; these are concatenated in partition order once
+  they are all complete, so the output file is sorted by IRI and is the same however many workers we use.
+"""
+import http.client
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
+
+from SPARQLWrapper.SPARQLExceptions import SPARQLWrapperException
+
+from src.triplestore import TripleStore
+from src.util import get_config, get_logger
+
+logger = get_logger(__name__)
+
+# How long to wait (in seconds) before retrying a failed page. This doubles after every failed attempt.
+SPARQL_RETRY_DELAY = 10
+
+
+class SPARQLFetchError(RuntimeError):
+    """A page of SPARQL results could not be downloaded."""
+
+
+def get_iri_partitions(boundaries):
+    """
+    Split the space of IRIs into partitions at a list of boundaries (usually IRI prefixes). The partitions cover every
+    possible IRI exactly once: the first one starts at the empty string, and the last one has no upper bound.
+
+    :param boundaries: The IRIs (or IRI prefixes) to split at, in any order.
+    :return: A sorted list of (lower, upper) tuples, which represent the IRIs where lower <= IRI < upper. The first
+        lower bound is '' and the last upper bound is None.
+    """
+    edges = [''] + sorted(set(boundaries) - {''}) + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def to_sparql_string(value):
+    """
+    Quote a Python string as a SPARQL string literal.
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r') + '"'
+
+
+def make_page_filter(key_variable, lower, upper, after):
+    """
+    Make the FILTER clause that restricts a query to a single page of a partition.
+
+    :param key_variable: The name of the SPARQL variable that we paginate over (without the '?').
+    :param lower: The (inclusive) lower bound of the partition.
+    :param upper: The (exclusive) upper bound of the partition, or None if it has no upper bound.
+    :param after: The last key on the previous page, or None if this is the first page.
+    :return: A SPARQL FILTER clause.
+    """
+    key = f"STR(?{key_variable})"
+    conditions = [f"isIRI(?{key_variable})"]
+    if after is not None:
+        conditions.append(f"{key} > {to_sparql_string(after)}")
+    if lower:
+        conditions.append(f"{key} >= {to_sparql_string(lower)}")
+    if upper is not None:
+        conditions.append(f"{key} < {to_sparql_string(upper)}")
+    return f"FILTER({' && '.join(conditions)})"
+
+
+class PagedSPARQLFetcher:
+    """
+    Download the results of a SPARQL query to a file, in concurrent partitions of keyset-paginated pages.
+    """
+
+    def __init__(self, endpoint, page_size, workers=None, retries=None):
+        """
+        :param endpoint: The URL of the SPARQL endpoint.
+        :param page_size: The number of keys (e.g. subjects) to ask for in each page.
+        :param workers: The number of pages to download at the same time (defaults to `ubergraph_workers` in the
+            config).
+        :param retries: The number of times to retry a failed page (defaults to `ubergraph_retries` in the config).
+        """
+        config = get_config()
+        self.endpoint = endpoint
+        self.page_size = page_size
+        self.workers = max(1, workers if workers is not None else config.get('ubergraph_workers', 1))
+        self.retries = retries if retries is not None else config.get('ubergraph_retries', 0)
+
+    def query_page(self, query, outputs):
+        """
+        Run a query, retrying it if it fails.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                # SPARQLWrapper objects aren't thread-safe, so every page gets its own TripleStore. The rows are
+                # streamed from the response, so we never hold the whole parsed response as well as the rows.
+                rows = TripleStore(self.endpoint).query_stream(query, outputs)
+                return [dict(zip(outputs, row)) for row in rows]
+            except (OSError, ValueError, http.client.HTTPException, SPARQLWrapperException) as err:
+                if attempt >= self.retries:
+                    raise SPARQLFetchError(f"Could not query {self.endpoint} after {attempt + 1} attempts: {err}") from err
+                delay = SPARQL_RETRY_DELAY * 2 ** attempt
+                logger.warning(f"Attempt {attempt + 1} to query {self.endpoint} failed, retrying in {delay} seconds: {err}")
+                time.sleep(delay)
+
+    def fetch_partition(self, query_template, key_variable, outputs, format_row, partition, filename):
+        """
+        Download every page in a partition, writing the formatted rows to a file.
+
+        :return: The number of rows written.
+        """
+        lower, upper = partition
+        after = None
+        count_rows = 0
+        count_pages = 0
+        with open(filename, 'w', encoding='utf-8') as outf:
+            while True:
+                query = Template(query_template).safe_substitute(
+                    page_filter=make_page_filter(key_variable, lower, upper, after),
+                    page_size=self.page_size,
+                )
+                rows = self.query_page(query, outputs)
+                count_pages += 1
+
+                # Servers may return the rows in any order, so sort them to make the output reproducible.
+                rows.sort(key=lambda row: tuple(row[output] or '' for output in outputs))
+                for row in rows:
+                    line = format_row(row)
+                    if line is not None:
+                        outf.write(line)
+                count_rows += len(rows)
+
+                # A page that has fewer keys than we asked for is the last page in its partition.
+                keys = {row[key_variable] for row in rows}
+                if len(keys) < self.page_size:
+                    break
+                after = max(keys)
+
+        logger.info(f"Downloaded {count_rows} rows in {count_pages} pages for IRIs from {lower!r} to {upper!r}.")
+        return count_rows
+
+    def fetch_to_file(self, query_template, key_variable, outputs, format_row, filename, partitions=None):
+        """
+        Download all the results of a query to a file.
+
+        The query template must contain `$page_filter` in a subquery that selects `LIMIT $page_size` distinct values of
+        the key variable, ordered by `STR(?key)`, and must return at least one row for every key that the subquery
+        selects. For example:
+
+            SELECT ?thing ?label WHERE {
+              { SELECT DISTINCT ?thing WHERE { ?thing rdfs:label ?label . $page_filter }
+                ORDER BY STR(?thing) LIMIT $page_size }
+              ?thing rdfs:label ?label .
+            }
+
+        Only rows whose key is an IRI are downloaded.
+
+        :param query_template: The query, as a string.Template.
+        :param key_variable: The name of the variable to paginate over (without the '?').
+        :param outputs: The variables to read from each row.
+        :param format_row: A function that turns a row (a dictionary of output to value) into a line to write, or None
+            to skip the row. It is called from the worker threads.
+        :param filename: The file to write. It is written atomically.
+        :param partitions: A list of (lower, upper) partitions from get_iri_partitions(); defaults to a single
+            partition that covers every IRI.
+        :return: The number of rows downloaded.
+        """
+        if partitions is None:
+            partitions = get_iri_partitions([])
+
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        tmp_directory = tempfile.mkdtemp(prefix=os.path.basename(filename) + '.', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            partition_filenames = [os.path.join(tmp_directory, f"partition-{index}") for index in range(len(partitions))]
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self.fetch_partition, query_template, key_variable, outputs, format_row,
+                                           partition, partition_filename)
+                           for partition, partition_filename in zip(partitions, partition_filenames)]
+                count_rows = sum(future.result() for future in futures)
+
+            tmp_filename = os.path.join(tmp_directory, 'output')
+            with open(tmp_filename, 'wb') as outf:
+                for partition_filename in partition_filenames:
+                    with open(partition_filename, 'rb') as inf:
+                        shutil.copyfileobj(inf, outf)
+            os.replace(tmp_filename, filename)
+        finally:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+        logger.info(f"Downloaded {count_rows} rows from {self.endpoint} in {len(partitions)} partitions to {filename}.")
+        return count_rows
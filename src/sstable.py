@@ -0,0 +1,274 @@
+"""
+sstable.py - a build-once, memory-mapped sorted string table for our per-prefix TSV files.
+
+The label, synonym and description files in the download directory (e.g. `UniProtKB/labels`) are TSV files in which the
+first column is a CURIE. Some of these are tens of gigabytes in size, so we don't want to load them into a dictionary in
+every process that needs them. Instead, the first time we need one of these files we build a sorted copy of it next to
+the original file:
+
+- `<filename>.sst` contains every (stripped, non-empty) line of the original file, sorted by its first column. Lines
+  with the same first column are kept in the order in which they appear in the original file.
+- `<filename>.sst.idx` is a sparse index: a JSON header describing the file the table was built from, followed by the
+  byte offset and key of every SPARSE_INDEX_EVERY'th line of the sorted file.
+
+Lookups bisect the sparse index and then scan a handful of lines from the memory-mapped table, so only the index needs to
+be held in memory, and the table itself is shared (via the page cache) between every process that opens it. The table
+is rebuilt automatically if the size or modification time of the original file changes.
+"""
+import heapq
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from array import array
+from bisect import bisect_left
+
+from src.util import get_logger, get_memory_usage_summary
+
+logger = get_logger(__name__)
+
+# Change this if the format of the table files changes, so that old tables are rebuilt.
+SSTABLE_FORMAT_VERSION = 1
+
+# How many lines between entries in the sparse index.
+SPARSE_INDEX_EVERY = 64
+
+# How many lines to sort in memory at a time while building a table.
+SORT_CHUNK_LINES = 5_000_000
+
+# Tables that have already been opened in this process, keyed by the TSV filename.
+_open_tables = {}
+
+
+def get_key(line):
+    """
+    Return the key (the first column) of a TSV line.
+    """
+    tab = line.find('\t')
+    if tab < 0:
+        return line
+    return line[:tab]
+
+
+def open_tsv_table(tsv_filename):
+    """
+    Open the sorted string table for a TSV file, building it if necessary. Tables are cached, so every factory in a
+    process that asks for the same file will share the same table.
+
+    :param tsv_filename: The TSV file to look up.
+    :return: A SortedStringTable, or None if the TSV file doesn't exist.
+    """
+    if tsv_filename in _open_tables:
+        return _open_tables[tsv_filename]
+    if not os.path.exists(tsv_filename):
+        return None
+    table = SortedStringTable(tsv_filename)
+    _open_tables[tsv_filename] = table
+    return table
+
+
+class SortedStringTable:
+    """
+    A read-only, memory-mapped table of TSV lines, sorted by their first column.
+    """
+
+    def __init__(self, tsv_filename):
+        self.tsv_filename = tsv_filename
+        self.table_filename = tsv_filename + '.sst'
+        self.index_filename = tsv_filename + '.sst.idx'
+
+        if not self.load_index():
+            self.build()
+            if not self.load_index():
+                raise RuntimeError(f"Could not load sorted string table {self.table_filename} after building it.")
+
+        self.file = open(self.table_filename, 'rb')
+        self.size = os.path.getsize(self.table_filename)
+        if self.size == 0:
+            # mmap() can't map an empty file.
+            self.mmap = None
+        else:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __str__(self):
+        return f"SortedStringTable({self.tsv_filename}) containing {self.record_count:,} lines"
+
+    def get_source_header(self):
+        """
+        Describe the TSV file that this table should be built from.
+        """
+        stat = os.stat(self.tsv_filename)
+        return {
+            'version': SSTABLE_FORMAT_VERSION,
+            'source_size': stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns,
+        }
+
+    def load_index(self):
+        """
+        Load the sparse index, if it exists and was built from the current version of the TSV file.
+
+        :return: True if the index was loaded, False if the table needs to be (re)built.
+        """
+        if not os.path.exists(self.index_filename) or not os.path.exists(self.table_filename):
+            return False
+
+        expected_header = self.get_source_header()
+        index_keys = []
+        index_offsets = array('q')
+        with open(self.index_filename, 'rb') as indexf:
+            header = json.loads(indexf.readline())
+            if any(header.get(key) != value for key, value in expected_header.items()):
+                logger.info(f"Sorted string table {self.table_filename} is out of date, rebuilding.")
+                return False
+            for line in indexf:
+                offset, key = line.rstrip(b'\n').split(b'\t', 1)
+                index_offsets.append(int(offset))
+                index_keys.append(key)
+
+        self.record_count = header['records']
+        self.index_keys = index_keys
+        self.index_offsets = index_offsets
+        return True
+
+    def build(self):
+        """
+        Build the sorted table and its sparse index from the TSV file. We sort chunks of the file in memory, write them
+        to temporary files and then merge them. Both files are written to temporary filenames and moved into place
+        once they are complete, so other processes will never see a partially written table.
+        """
+        logger.info(f"Building sorted string table {self.table_filename} from {self.tsv_filename}: {get_memory_usage_summary()}")
+        header = self.get_source_header()
+        output_dir = os.path.dirname(os.path.abspath(self.table_filename))
+        tmpdir = tempfile.mkdtemp(prefix='sstable-', dir=output_dir)
+        try:
+            # Step 1. Sort the file in chunks. Python's sort is stable, so lines with the same key stay in file order.
+            chunk_filenames = []
+            with open(self.tsv_filename, 'r') as inf:
+                while True:
+                    chunk = []
+                    for line in inf:
+                        line = line.strip()
+                        if line:
+                            chunk.append(line)
+                            if len(chunk) >= SORT_CHUNK_LINES:
+                                break
+                    if not chunk:
+                        break
+                    chunk.sort(key=get_key)
+                    chunk_filename = os.path.join(tmpdir, f"chunk-{len(chunk_filenames):05d}")
+                    with open(chunk_filename, 'w', encoding='utf-8') as chunkf:
+                        for line in chunk:
+                            chunkf.write(line + '\n')
+                    chunk_filenames.append(chunk_filename)
+                    logger.info(f"Sorted chunk {len(chunk_filenames):,} of {self.tsv_filename}: {get_memory_usage_summary()}")
+
+            # Step 2. Merge the chunks, writing out the sparse index as we go. heapq.merge() breaks ties in the order
+            # of its inputs, so the merge is stable as well.
+            table_tmp = os.path.join(tmpdir, 'table')
+            index_tmp = os.path.join(tmpdir, 'index')
+            chunk_files = [open(chunk_filename, 'r', encoding='utf-8') for chunk_filename in chunk_filenames]
+            try:
+                record_count = 0
+                offset = 0
+                index_lines = []
+                with open(table_tmp, 'wb') as tablef:
+                    for line in heapq.merge(*chunk_files, key=lambda line: get_key(line.rstrip('\n'))):
+                        encoded = line.encode('utf-8')
+                        if record_count % SPARSE_INDEX_EVERY == 0:
+                            key = get_key(line.rstrip('\n'))
+                            index_lines.append(f"{offset}\t{key}\n".encode('utf-8'))
+                        tablef.write(encoded)
+                        offset += len(encoded)
+                        record_count += 1
+            finally:
+                for chunk_file in chunk_files:
+                    chunk_file.close()
+
+            header['records'] = record_count
+            with open(index_tmp, 'wb') as indexf:
+                indexf.write((json.dumps(header) + '\n').encode('utf-8'))
+                indexf.writelines(index_lines)
+
+            os.replace(table_tmp, self.table_filename)
+            os.replace(index_tmp, self.index_filename)
+            logger.info(f"Built sorted string table {self.table_filename} with {record_count:,} lines: {get_memory_usage_summary()}")
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def get(self, key):
+        """
+        Look up all the lines whose first column is key.
+
+        :param key: The key to look up.
+        :return: A list of matching lines (without their trailing newlines), in the order they appear in the TSV file.
+        """
+        if self.mmap is None:
+            return []
+        key = key.encode('utf-8')
+
+        # Start scanning from the last indexed line whose key is smaller than the one we're looking for, so that we
+        # don't miss any matching lines that started before the first indexed line with this key.
+        position = bisect_left(self.index_keys, key)
+        offset = self.index_offsets[position - 1] if position > 0 else 0
+
+        results = []
+        mm = self.mmap
+        while offset < self.size:
+            end = mm.find(b'\n', offset)
+            if end < 0:
+                end = self.size
+            line = mm[offset:end]
+            tab = line.find(b'\t')
+            line_key = line if tab < 0 else line[:tab]
+            if line_key == key:
+                results.append(line.decode('utf-8'))
+            elif line_key > key:
+                break
+            offset = end + 1
+        return results
+
+    def iter_prefix(self, prefix):
+        """
+        Iterate over all the lines whose first column starts with prefix, in sorted order.
+
+        :param prefix: The prefix to look for (e.g. 'UMLS:').
+        :return: An iterator of matching lines (without their trailing newlines).
+        """
+        if self.mmap is None:
+            return
+        prefix = prefix.encode('utf-8')
+
+        position = bisect_left(self.index_keys, prefix)
+        offset = self.index_offsets[position - 1] if position > 0 else 0
+
+        mm = self.mmap
+        while offset < self.size:
+            end = mm.find(b'\n', offset)
+            if end < 0:
+                end = self.size
+            line = mm[offset:end]
+            tab = line.find(b'\t')
+            line_key = line if tab < 0 else line[:tab]
+            if line_key.startswith(prefix):
+                yield line.decode('utf-8')
+            elif line_key > prefix:
+                break
+            offset = end + 1
+
+    def get_many(self, keys):
+        """
+        Look up all the lines for several keys at once. Looking them up in sorted order means that we read the table
+        sequentially.
+
+        :param keys: An iterable of keys to look up.
+        :return: A dictionary of key -> list of matching lines, for every key (even if it has no matching lines).
+        """
+        return {key: self.get(key) for key in sorted(set(keys))}
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
@@ -1,11 +1,43 @@
+import io
+import json
 import os
+import re
 from src.util import LoggingUtil
-from SPARQLWrapper import SPARQLWrapper2, JSON, POSTDIRECTLY, POST
+from SPARQLWrapper import SPARQLWrapper, SPARQLWrapper2, JSON, TSV, POSTDIRECTLY, POST
 from string import Template
 
 import logging
 logger = LoggingUtil.init_logging(__name__, logging.ERROR)
 
+# Escape sequences that can appear in literals in SPARQL TSV results (the same as in Turtle).
+TSV_ESCAPE_SEQUENCE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+TSV_ESCAPED_CHARACTERS = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+
+def unescape_tsv_literal(text):
+    """ Replace the escape sequences in the lexical form of a literal from SPARQL TSV results. """
+    def replace(match):
+        if match.group(3) is not None:
+            return TSV_ESCAPED_CHARACTERS.get(match.group(3), match.group(0))
+        return chr(int(match.group(1) or match.group(2), 16))
+    return TSV_ESCAPE_SEQUENCE.sub(replace, text) if '\\' in text else text
+
+
+def parse_tsv_term(term):
+    """ Convert an RDF term from SPARQL TSV results into its value, as SPARQLWrapper would return it from JSON
+    results: IRIs without their angle brackets, literals without their quotes, language tags or datatypes, and blank
+    nodes without their `_:` prefix. Unbound values are returned as None. """
+    if term == '':
+        return None
+    if term.startswith('<') and term.endswith('>'):
+        return term[1:-1]
+    if term.startswith('"'):
+        return unescape_tsv_literal(term[1:term.rindex('"')])
+    if term.startswith('_:'):
+        return term[2:]
+    # Numbers and booleans are written without quotes.
+    return term
+
 
 class TripleStore(object):
     """ Connect to a SPARQL endpoint and provide services for loading and executing queries."""
@@ -50,6 +82,40 @@ class TripleStore(object):
         logger.debug ("query result: %s", result)
         return result
 
+    def query_stream (self, query_text, outputs, post=False):
+        """ Execute a fully formed query and yield its results one row at a time, as tuples of the values of the
+        outputs (or None for unbound outputs), without loading the whole response into memory.
+
+        We ask for SPARQL TSV results, which we can parse a line at a time. If the endpoint sends JSON anyway, we fall
+        back to parsing the whole response. """
+        service = SPARQLWrapper (self.service.endpoint)
+        if post:
+            service.setRequestMethod(POSTDIRECTLY)
+            service.setMethod(POST)
+        service.setQuery (query_text)
+        service.setReturnFormat (TSV)
+        response = service.query().response
+        try:
+            if 'json' in response.headers.get('Content-Type', ''):
+                bindings = json.load(response)['results']['bindings']
+                for b in bindings:
+                    yield tuple(b[val]['value'] if val in b else None for val in outputs)
+                return
+
+            lines = io.TextIOWrapper(response, encoding='utf-8', newline='\n')
+            header = next(lines, '').rstrip('\r\n')
+            columns = [column.lstrip('?$') for column in header.split('\t')]
+            indexes = [columns.index(val) if val in columns else None for val in outputs]
+            for line in lines:
+                terms = line.rstrip('\r\n').split('\t')
+                yield tuple(None if index is None else parse_tsv_term(terms[index]) for index in indexes)
+        finally:
+            response.close()
+
+    def query_template_stream (self, template_text, outputs, inputs={}, post = False):
+        """ Given template text, inputs, and outputs, execute a query and yield its results as tuples. """
+        return self.query_stream (Template (template_text).safe_substitute (**inputs), outputs, post= post)
+
     def query_template (self, template_text, outputs, inputs=[], post = False):
         """ Given template text, inputs, and outputs, execute a query. """
         return self.query (Template (template_text).safe_substitute (**inputs), outputs, post= post)
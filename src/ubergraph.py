@@ -1,211 +1,197 @@
 import logging
+import os
+import tempfile
 
+from src import json_codec
+from src.sparql_fetcher import PagedSPARQLFetcher, get_iri_partitions
 from src.triplestore import TripleStore
-from src.util import Text
+from src.util import Text, get_config
 from collections import defaultdict
 from src.babel_utils import norm
 
+
+def iri_to_curie(iri):
+    """
+    Convert an IRI from UberGraph into a CURIE, or return it as-is if it can't be converted.
+    """
+    try:
+        return Text.opt_to_curie(iri)
+    except ValueError as verr:
+        logging.warning(f"WARNING: Unable to translate {iri} to a CURIE; it will be used as-is: {verr}")
+        return iri
+
+
 class UberGraph:
     #Some of these get_subclass_and_whatever things can/should be merged...
 
+    # The UberGraph SPARQL endpoint.
+    SPARQL_ENDPOINT = "https://ubergraph.apps.renci.org/sparql"
+
     # UberGraph stored descriptions with the RDF property IAO:0000115 ("definition")
     RDF_DESCRIPTION_PROPERTY = "http://purl.obolibrary.org/obo/IAO_0000115"
 
     # When the query needs to be queried in batches -- such as, for example, get_all_labels() -- this
-    # constant controls how large each batch should be.
+    # constant controls how many subjects each batch should include.
     QUERY_BATCH_SIZE = 200_000
 
+    # The IRI prefix of the OBO ontologies. Batched queries are partitioned at `{OBO_IRI_PREFIX}{ontology}_` for every
+    # ontology in `ubergraph_ontologies` in the config, so that they can be downloaded concurrently.
+    OBO_IRI_PREFIX = "http://purl.obolibrary.org/obo/"
+
     def __init__(self):
-        self.triplestore = TripleStore("https://ubergraph.apps.renci.org/sparql")
+        self.triplestore = TripleStore(UberGraph.SPARQL_ENDPOINT)
+        self.fetcher = PagedSPARQLFetcher(UberGraph.SPARQL_ENDPOINT, UberGraph.QUERY_BATCH_SIZE)
 
-    def get_all_labels(self):
-        # Since this is a very large query, we do this in chunks.
-        query_count = """
-                      prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-                      select (count (distinct *) as ?count)
-                      from <http://reasoner.renci.org/ontology>
-                      where {
-                        ?thing rdfs:label ?label .
-                      }
-                      """
-        rr = self.triplestore.query_template(
-            inputs={},
-            outputs=['count'],
-            template_text=query_count
-        )
-        if len(rr) == 0:
-            raise RuntimeError("get_all_labels() count failed: no counts returned")
-        if len(rr) > 1:
-            raise RuntimeError("get_all_labels() count failed: too many counts returned")
-
-        total_count = int(rr[0]['count'])
-
-        results = []
-        for start in range(0, total_count, UberGraph.QUERY_BATCH_SIZE):
-            # end = start + UberGraph.QUERY_BATCH_SIZE if UberGraph.QUERY_BATCH_SIZE < total_count else UberGraph.QUERY_BATCH_SIZE
-            print(f"Querying get_all_labels() offset {start} limit {UberGraph.QUERY_BATCH_SIZE} (total count: {total_count})")
-
-            text = """
-                   prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-                   select distinct ?thing ?label
-                   from <http://reasoner.renci.org/ontology>
+    def get_partitions(self):
+        """
+        Return the IRI partitions to download batched queries in.
+        """
+        ontologies = get_config().get('ubergraph_ontologies', [])
+        return get_iri_partitions([f"{UberGraph.OBO_IRI_PREFIX}{ontology}_" for ontology in ontologies])
+
+    def read_download(self, write_function):
+        """
+        Call a write_all_*() method to download into a temporary JSONL file, and yield the rows from that file.
+        """
+        tmp_directory = get_config()['tmp_directory']
+        os.makedirs(tmp_directory, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix='ubergraph-', dir=tmp_directory) as download_directory:
+            filename = os.path.join(download_directory, 'download.jsonl')
+            write_function(filename)
+            with open(filename, 'r', encoding='utf-8') as inf:
+                for line in inf:
+                    yield json_codec.loads(line)
+
+    def write_all_labels(self, filename):
+        """
+        Download every label in UberGraph into a JSONL file, sorted by IRI.
+
+        :param filename: The file to write, with one `{"iri": curie, "label": label}` object per line.
+        :return: The number of labels downloaded.
+        """
+        text = """
+               prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+               select distinct ?thing ?label
+               from <http://reasoner.renci.org/ontology>
+               where {
+                 {
+                   select distinct ?thing
                    where {
                      ?thing rdfs:label ?label .
+                     $page_filter
                    }
-                   order by ?thing ?label
-                   """ + f"offset {start} limit {UberGraph.QUERY_BATCH_SIZE}"
-
-            rr = self.triplestore.query_template(
-                inputs={}, \
-                outputs=['thing', 'label'], \
-                template_text=text \
-                )
-            for x in rr:
-                y = {}
-                try:
-                    y['iri'] = Text.opt_to_curie(x['thing'])
-                except ValueError as verr:
-                    logging.warning(f"WARNING: Unable to translate {x['thing']} to a CURIE; it will be used as-is: {verr}")
-                    y['iri'] = x['thing']
-                y['label'] = x['label']
-                results.append(y)
+                   order by str(?thing)
+                   limit $page_size
+                 }
+                 ?thing rdfs:label ?label .
+               }
+               """
+        return self.fetcher.fetch_to_file(
+            text, 'thing', ['thing', 'label'],
+            lambda x: json_codec.dumps_line({'iri': iri_to_curie(x['thing']), 'label': x['label']}),
+            filename,
+            partitions=self.get_partitions(),
+        )
 
-        return results
+    def get_all_labels(self):
+        """
+        Yield every label in UberGraph as a dictionary with the keys `iri` (a CURIE) and `label`.
+        """
+        yield from self.read_download(self.write_all_labels)
 
+    def write_all_descriptions(self, filename):
+        """
+        Download every description in UberGraph into a JSONL file, sorted by IRI.
 
-    def get_all_descriptions(self):
-        # Since this is a very large query, we do this in chunks.
-        query_count = """
-                      prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-                      select (count (distinct *) as ?count)
-                      from <http://reasoner.renci.org/ontology>
-                      where {
-                        ?thing rdfs:label ?label .
-                      }
-                      """
-        rr = self.triplestore.query_template(
-            inputs={},
-            outputs=['count'],
-            template_text=query_count
-        )
-        if len(rr) == 0:
-            raise RuntimeError("get_all_descriptions() count failed: no counts returned")
-        if len(rr) > 1:
-            raise RuntimeError("get_all_descriptions() count failed: too many counts returned")
-
-        total_count = int(rr[0]['count'])
-
-        results = []
-        for start in range(0, total_count, UberGraph.QUERY_BATCH_SIZE):
-            # end = start + UberGraph.QUERY_BATCH_SIZE if UberGraph.QUERY_BATCH_SIZE < total_count else UberGraph.QUERY_BATCH_SIZE
-            print(f"Querying get_all_descriptions() offset {start} limit {UberGraph.QUERY_BATCH_SIZE} (total count: {total_count})")
-
-            text = """
-                   prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-                   select distinct ?thing ?description
-                   from <http://reasoner.renci.org/ontology>
+        :param filename: The file to write, with one `{"iri": curie, "description": description}` object per line.
+        :return: The number of descriptions downloaded.
+        """
+        text = """
+               prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+               select distinct ?thing ?description
+               from <http://reasoner.renci.org/ontology>
+               where {
+                 {
+                   select distinct ?thing
                    where {
                      ?thing <""" + UberGraph.RDF_DESCRIPTION_PROPERTY + """> ?description .
+                     $page_filter
                    }
-                   order by ?thing ?description
-                   """ + f"offset {start} limit {UberGraph.QUERY_BATCH_SIZE}"
-
-            rr = self.triplestore.query_template(
-                inputs={}, \
-                outputs=['thing', 'description'], \
-                template_text=text \
-                )
-            for x in rr:
-                y = {}
-                try:
-                    y['iri'] = Text.opt_to_curie(x['thing'])
-                except ValueError as verr:
-                    print(f"WARNING: Unable to translate {x['thing']} to a CURIE; it will be used as-is: {verr}")
-                    y['iri'] = x['thing']
-                y['description'] = x['description']
-                results.append(y)
+                   order by str(?thing)
+                   limit $page_size
+                 }
+                 ?thing <""" + UberGraph.RDF_DESCRIPTION_PROPERTY + """> ?description .
+               }
+               """
+        return self.fetcher.fetch_to_file(
+            text, 'thing', ['thing', 'description'],
+            lambda x: json_codec.dumps_line({'iri': iri_to_curie(x['thing']), 'description': x['description']}),
+            filename,
+            partitions=self.get_partitions(),
+        )
 
-        return results
+    def get_all_descriptions(self):
+        """
+        Yield every description in UberGraph as a dictionary with the keys `iri` (a CURIE) and `description`.
+        """
+        yield from self.read_download(self.write_all_descriptions)
 
+    def write_all_synonyms(self, filename):
+        """
+        Download every synonym of every class in UberGraph into a JSONL file, sorted by IRI.
 
-    def get_all_synonyms(self):
-        # Since this is a very large query, we do this in chunks.
-        query_count = """
-                      prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-                      prefix owl: <http://www.w3.org/2002/07/owl#>
-                      prefix oboInOwl: <http://www.geneontology.org/formats/oboInOwl#>
-                      
-                      SELECT (COUNT(DISTINCT ?cls) AS ?count)
-                      from <http://reasoner.renci.org/ontology>
-                      WHERE
-                      {
-                        ?cls a owl:Class
-                        # FILTER (!isBlank(?cls))
-                      }
-                      """
-        rr = self.triplestore.query_template(
-            inputs={},
-            outputs=['count'],
-            template_text=query_count
-        )
-        if len(rr) == 0:
-            raise RuntimeError("get_all_synonyms() count failed: no counts returned")
-        if len(rr) > 1:
-            raise RuntimeError("get_all_synonyms() count failed: too many counts returned")
-
-        total_count = int(rr[0]['count'])
-
-        results = []
-        for start in range(0, total_count, UberGraph.QUERY_BATCH_SIZE):
-            print(f"Querying get_all_synonyms() offset {start} limit {UberGraph.QUERY_BATCH_SIZE} (total count: {total_count})")
-
-            text = """
-                    prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-                    prefix owl: <http://www.w3.org/2002/07/owl#>
-                    prefix oboInOwl: <http://www.geneontology.org/formats/oboInOwl#>
-                    SELECT ?cls ?pred ?val
-                    from <http://reasoner.renci.org/ontology>
-                    WHERE
-                    {
-                      {
-                        SELECT DISTINCT ?cls
-                        WHERE {
-                          ?cls a owl:Class .
-                          # FILTER (!isBlank(?cls))
-                        }
-                        ORDER BY ?cls
-                        """ \
-                        + f"OFFSET {start} LIMIT {UberGraph.QUERY_BATCH_SIZE}" \
-                        + """
-                      }
+        :param filename: The file to write, with one `[curie, predicate, synonym]` list per line.
+        :return: The number of synonyms downloaded.
+        """
+        text = """
+                prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+                prefix owl: <http://www.w3.org/2002/07/owl#>
+                prefix oboInOwl: <http://www.geneontology.org/formats/oboInOwl#>
+                SELECT DISTINCT ?cls ?pred ?val
+                from <http://reasoner.renci.org/ontology>
+                WHERE
+                {
+                  {
+                    SELECT DISTINCT ?cls
+                    WHERE {
+                      ?cls a owl:Class .
                       VALUES ?pred {
                         oboInOwl:hasRelatedSynonym
                         oboInOwl:hasNarrowSynonym
                         oboInOwl:hasBroadSynonym
                         oboInOwl:hasExactSynonym
                       }
-                      ?cls ?pred ?val
+                      ?cls ?pred ?val .
+                      $page_filter
                     }
-                    """
-            rr = self.triplestore.query_template(
-                inputs={}, \
-                outputs=['cls', 'pred', 'val'], \
-                template_text=text \
-                )
-            for x in rr:
-                try:
-                    cls_curie = Text.opt_to_curie(x['cls'])
-                except ValueError as verr:
-                    print(f"Unable to convert {x['cls']} to a CURIE; it will be used as-is: {verr}")
-                    cls_curie = x['cls']
-                y = ( cls_curie, x['pred'], x['val'])
-                results.append(y)
+                    ORDER BY STR(?cls)
+                    LIMIT $page_size
+                  }
+                  VALUES ?pred {
+                    oboInOwl:hasRelatedSynonym
+                    oboInOwl:hasNarrowSynonym
+                    oboInOwl:hasBroadSynonym
+                    oboInOwl:hasExactSynonym
+                  }
+                  ?cls ?pred ?val
+                }
+                """
+        return self.fetcher.fetch_to_file(
+            text, 'cls', ['cls', 'pred', 'val'],
+            lambda x: json_codec.dumps_line([iri_to_curie(x['cls']), x['pred'], x['val']]),
+            filename,
+            partitions=self.get_partitions(),
+        )
 
-        return results
+    def get_all_synonyms(self):
+        """
+        Yield every synonym of every class in UberGraph as a (curie, predicate, synonym) tuple.
+        """
+        for row in self.read_download(self.write_all_synonyms):
+            yield tuple(row)
 
-    def get_subclasses_of(self,iri):
+    def stream_subclasses_of(self,iri):
+        """Yield a dictionary with the descendent (as a CURIE) and its label for every subclass of iri."""
         text="""
         prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         prefix UBERON: <http://purl.obolibrary.org/obo/UBERON_>
@@ -228,24 +214,26 @@ class UberGraph:
             }
         }
         """
-        rr = self.triplestore.query_template(
+        rows = self.triplestore.query_template_stream(
             inputs  = { 'sourcedefclass': iri  }, \
             outputs = [ 'descendent', 'descendentLabel' ], \
             template_text = text \
         )
-        results = []
-        for x in rr:
+        for descendent, descendent_label in rows:
             y = {}
             try:
-                y['descendent'] = Text.opt_to_curie(x['descendent'])
+                y['descendent'] = Text.opt_to_curie(descendent)
             except ValueError as verr:
-                print(f"Descendent {x['descendent']} could not be converted to a CURIE, will be used as-is: {verr}")
-                y['descendent'] = x['descendent']
-            y['descendentLabel'] = x['descendentLabel']
-            results.append(y)
-        return results
+                print(f"Descendent {descendent} could not be converted to a CURIE, will be used as-is: {verr}")
+                y['descendent'] = descendent
+            y['descendentLabel'] = descendent_label
+            yield y
 
-    def get_subclasses_and_smiles(self,iri):
+    def get_subclasses_of(self,iri):
+        return list(self.stream_subclasses_of(iri))
+
+    def stream_subclasses_and_smiles(self,iri):
+        """Yield a dictionary with the descendent (as a CURIE) and its SMILES (if any) for every subclass of iri."""
         text="""
         prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         prefix UBERON: <http://purl.obolibrary.org/obo/UBERON_>
@@ -269,27 +257,27 @@ class UberGraph:
             }
         }
         """
-        rr = self.triplestore.query_template(
+        rows = self.triplestore.query_template_stream(
             inputs  = { 'sourcedefclass': iri  }, \
             outputs = [ 'descendent', 'descendentSmiles' ], \
             template_text = text \
         )
-        results = []
-        for x in rr:
+        for descendent, descendent_smiles in rows:
             y = {}
             try:
-                y['descendent'] = Text.opt_to_curie(x['descendent'])
+                y['descendent'] = Text.opt_to_curie(descendent)
             except ValueError as verr:
-                print(f"Descendent {x['descendent']} could not be converted to a CURIE, will be used as-is: {verr}")
-                y['descendent'] = x['descendent']
-            if x['descendentSmiles'] is not None:
-                y['SMILES'] = x['descendentSmiles']
-            results.append(y)
-        return results
+                print(f"Descendent {descendent} could not be converted to a CURIE, will be used as-is: {verr}")
+                y['descendent'] = descendent
+            if descendent_smiles is not None:
+                y['SMILES'] = descendent_smiles
+            yield y
 
+    def get_subclasses_and_smiles(self,iri):
+        return list(self.stream_subclasses_and_smiles(iri))
 
-    def get_subclasses_and_xrefs(self,iri):
-        """Return all subclasses of iri that have an xref as well as the xref.
+    def stream_subclasses_and_xrefs(self,iri):
+        """Yield a (subclass, xref) pair of CURIEs for every xref of every subclass of iri.
         Does not return subclasses that lack an xref."""
         text="""
         prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -311,24 +299,31 @@ class UberGraph:
           ?descendent <http://www.geneontology.org/formats/oboInOwl#hasDbXref> ?xref .
         }
         """
-        resultmap = self.triplestore.query_template(
+        rows = self.triplestore.query_template_stream(
             inputs  = { 'sourcedefclass': iri  }, \
             outputs = [ 'descendent', 'xref' ], \
             template_text = text \
         )
-        results = defaultdict(set)
-        for row in resultmap:
+        for descendent, xref in rows:
             # Sometimes we're getting back just strings that aren't curies, skip those (but complain)
             try:
-                dcurie = Text.opt_to_curie(row['descendent'])
-                results[ dcurie ].add( (Text.opt_to_curie(row['xref']) ))
+                yield Text.opt_to_curie(descendent), Text.opt_to_curie(xref)
             except ValueError as verr:
-                print(f'Bad XREF from {row["descendent"]} to {row["xref"]}: {verr}')
+                print(f'Bad XREF from {descendent} to {xref}: {verr}')
                 continue
 
+    def get_subclasses_and_xrefs(self,iri):
+        """Return all subclasses of iri that have an xref as well as the xref.
+        Does not return subclasses that lack an xref."""
+        results = defaultdict(set)
+        for dcurie, xref in self.stream_subclasses_and_xrefs(iri):
+            results[ dcurie ].add( xref )
+
         return results
 
-    def get_subclasses_and_exacts(self,iri):
+    def stream_subclasses_and_matches(self,iri,predicates):
+        """Yield a (subclass, match) pair for every match of every subclass of iri with any of the predicates (as
+        prefixed names from the query below). Subclasses without a match are yielded once with a match of None."""
         text=lambda predicate: f"""
         prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         prefix UBERON: <http://purl.obolibrary.org/obo/UBERON_>
@@ -341,6 +336,8 @@ class UberGraph:
         prefix NCIT: <http://purl.obolibrary.org/obo/NCIT_>
         PREFIX EXACT_MATCH: <http://www.w3.org/2004/02/skos/core#exactMatch>
         PREFIX M_EXACT_MATCH: <http://purl.obolibrary.org/obo/mondo#exactMatch>
+        PREFIX CLOSE_MATCH: <http://www.w3.org/2004/02/skos/core#closeMatch>
+        PREFIX M_CLOSE_MATCH: <http://purl.obolibrary.org/obo/mondo#closeMatch>
         PREFIX EQUIVALENT_CLASS: <http://www.w3.org/2002/07/owl#equivalentClass>
         PREFIX ID: <http://www.geneontology.org/formats/oboInOwl#id>
         SELECT DISTINCT ?descendent ?match
@@ -354,97 +351,52 @@ class UberGraph:
             }}
         }}
         """
-        resultmap = self.triplestore.query_template(
-               template_text=text('EXACT_MATCH:'),
-               inputs={
-                   'identifier': iri
-               }, outputs=[ 'descendent', 'match' ] )
-        resultmap += self.triplestore.query_template(
-               template_text=text('M_EXACT_MATCH:'),
-               inputs={
-                   'identifier': iri
-               }, outputs=[ 'descendent', 'match' ] )
-        resultmap += self.triplestore.query_template(
-                template_text=text('EQUIVALENT_CLASS:'),
-                inputs={
-                    'identifier': iri
-                }, outputs=[ 'descendent', 'match'] )
-        results = defaultdict(list)
-        for row in resultmap:
-            try:
-                desc = Text.opt_to_curie(row['descendent'])
-            except ValueError as verr:
-                print(f"Descendant {row['descendent']} could not be converted to a CURIE, will be used as-is: {verr}")
-                desc = row['descendent']
-
-            if row['match'] is None:
-                results[desc] += []
-            else:
-                # Sometimes, if there are no exact_matches, we'll get some kind of blank node id
-                # like 't19830198'. Want to filter those out.
+        for predicate in predicates:
+            rows = self.triplestore.query_template_stream(
+                   template_text=text(predicate),
+                   inputs={
+                       'identifier': iri
+                   }, outputs=[ 'descendent', 'match' ] )
+            for descendent, match in rows:
                 try:
-                    results[ desc ].append(Text.opt_to_curie(row['match']))
+                    desc = Text.opt_to_curie(descendent)
                 except ValueError as verr:
-                    print(f'Row {row} could not be converted to a CURIE: {verr}')
-                    continue
+                    print(f"Descendant {descendent} could not be converted to a CURIE, will be used as-is: {verr}")
+                    desc = descendent
+
+                if match is None:
+                    yield desc, None
+                else:
+                    # Sometimes, if there are no exact_matches, we'll get some kind of blank node id
+                    # like 't19830198'. Want to filter those out.
+                    try:
+                        yield desc, Text.opt_to_curie(match)
+                    except ValueError as verr:
+                        print(f"Value {match} for {descendent} could not be converted to a CURIE: {verr}")
+                        continue
 
+    def stream_subclasses_and_exacts(self,iri):
+        return self.stream_subclasses_and_matches(iri, ['EXACT_MATCH:', 'M_EXACT_MATCH:', 'EQUIVALENT_CLASS:'])
+
+    def stream_subclasses_and_close(self,iri):
+        return self.stream_subclasses_and_matches(iri, ['CLOSE_MATCH:', 'M_CLOSE_MATCH:'])
+
+    def get_subclasses_and_exacts(self,iri):
+        results = defaultdict(list)
+        for desc, match in self.stream_subclasses_and_exacts(iri):
+            if match is None:
+                results[desc] += []
+            else:
+                results[desc].append(match)
         return results
 
     def get_subclasses_and_close(self,iri):
-        text=lambda predicate: f"""
-        prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-        prefix UBERON: <http://purl.obolibrary.org/obo/UBERON_>
-        prefix CL: <http://purl.obolibrary.org/obo/CL_>
-        prefix GO: <http://purl.obolibrary.org/obo/GO_>
-        prefix CHEBI: <http://purl.obolibrary.org/obo/CHEBI_>
-        prefix MONDO: <http://purl.obolibrary.org/obo/MONDO_>
-        prefix HP: <http://purl.obolibrary.org/obo/HP_>
-        prefix EFO: <http://www.ebi.ac.uk/efo/EFO_>
-        prefix NCIT: <http://purl.obolibrary.org/obo/NCIT_>
-        PREFIX CLOSE_MATCH: <http://www.w3.org/2004/02/skos/core#closeMatch>
-        PREFIX M_CLOSE_MATCH: <http://purl.obolibrary.org/obo/mondo#closeMatch>
-        PREFIX EQUIVALENT_CLASS: <http://www.w3.org/2002/07/owl#equivalentClass>
-        PREFIX ID: <http://www.geneontology.org/formats/oboInOwl#id>
-        SELECT DISTINCT ?descendent ?match
-        FROM <http://reasoner.renci.org/ontology>
-        WHERE {{
-            graph <http://reasoner.renci.org/redundant> {{
-                ?descendent rdfs:subClassOf $identifier .
-            }}
-            OPTIONAL {{
-                ?descendent {predicate} ?match.
-            }}
-        }}
-        """
-        resultmap = self.triplestore.query_template(
-               template_text=text('CLOSE_MATCH:'),
-               inputs={
-                   'identifier': iri
-               }, outputs=[ 'descendent',  'match' ] )
-        resultmap += self.triplestore.query_template(
-               template_text=text('M_CLOSE_MATCH:'),
-               inputs={
-                   'identifier': iri
-               }, outputs=[ 'descendent', 'match' ] )
         results = defaultdict(list)
-        for row in resultmap:
-            try:
-                desc = Text.opt_to_curie(row['descendent'])
-            except ValueError as verr:
-                print(f"Descendant {row['descendent']} could not be converted to a CURIE, will be used as-is: {verr}")
-                desc = row['descendent']
-
-            if row['match'] is None:
+        for desc, match in self.stream_subclasses_and_close(iri):
+            if match is None:
                 results[desc] += []
             else:
-                try:
-                    results[ desc].append( (Text.opt_to_curie(row['match']) ))
-                except ValueError as verr:
-                    # Sometimes, if there are no exact_matches, we'll get some kind of blank node id
-                    # like 't19830198'. Want to filter those out.
-                    print(f"Value {row['match']} in row {row} could not be converted to a CURIE: {verr}")
-                    continue
-
+                results[desc].append(match)
         return results
 
     def write_normalized_information_content(self, filename):
@@ -454,25 +406,29 @@ class UberGraph:
         :param filename: The filename to write the normalized information content to -- we write them as `IRI\tNIC`.
         :return: The number of normalized information content entries downloaded.
         """
-        count_query = "SELECT (COUNT(*) AS ?count) WHERE { ?iri <http://reasoner.renci.org/vocab/normalizedInformationContent> ?nic }"
-        count_result = self.triplestore.query(count_query, ['count'])
-        total_count = int(count_result[0]['count'])
-
-        assert total_count > 0
-
-        write_count = 0
-        with open(filename, "w") as ftsv:
-            for start in range(0, total_count, UberGraph.QUERY_BATCH_SIZE):
-                print(f"Querying write_normalized_information_content() offset {start} limit {UberGraph.QUERY_BATCH_SIZE} (total count: {total_count})")
-
-                query = "SELECT ?iri ?nic WHERE " \
-                        "{ ?iri <http://reasoner.renci.org/vocab/normalizedInformationContent> ?nic }" \
-                        f"ORDER BY ASC(?iri) OFFSET {start} LIMIT {UberGraph.QUERY_BATCH_SIZE}"
-                results = self.triplestore.query(query, ['iri', 'nic'])
+        query = """
+                SELECT ?iri ?nic
+                WHERE {
+                  {
+                    SELECT DISTINCT ?iri
+                    WHERE {
+                      ?iri <http://reasoner.renci.org/vocab/normalizedInformationContent> ?nic .
+                      $page_filter
+                    }
+                    ORDER BY STR(?iri)
+                    LIMIT $page_size
+                  }
+                  ?iri <http://reasoner.renci.org/vocab/normalizedInformationContent> ?nic
+                }
+                """
+        write_count = self.fetcher.fetch_to_file(
+            query, 'iri', ['iri', 'nic'],
+            lambda row: f"{row['iri']}\t{row['nic']}\n",
+            filename,
+            partitions=self.get_partitions(),
+        )
 
-                for row in results:
-                    ftsv.write(f"{row['iri']}\t{row['nic']}\n")
-                    write_count += 1
+        assert write_count > 0
 
         print(f"Wrote {write_count} information content values into {filename}.")
         return write_count
@@ -486,23 +442,26 @@ def build_sets(iri, concordfiles, set_type, ignore_list = [], other_prefixes={},
         return
     uber = UberGraph()
     if set_type == 'xref':
-        uberres = uber.get_subclasses_and_xrefs(iri)
+        uberres = uber.stream_subclasses_and_xrefs(iri)
     elif set_type == 'exact':
-        uberres = uber.get_subclasses_and_exacts(iri)
+        uberres = uber.stream_subclasses_and_exacts(iri)
     elif set_type == 'close':
-        uberres = uber.get_subclasses_and_close(iri)
-    for k,v in uberres.items():
+        uberres = uber.stream_subclasses_and_close(iri)
+    # Write each concord as its row streams in, only remembering the ones we've already written.
+    written = set()
+    for k,x in uberres:
+        if x is None:
+            continue
         if not hop_ontologies:
             subclass_prefix = Text.get_curie(k)
             if subclass_prefix != prefix:
                 continue
-        v = set([ norm(x,other_prefixes) for x in v ])
-        for x in v:
-            if Text.get_curie(x) not in ignore_list:
-                p = Text.get_curie(k)
-                if p in concordfiles:
-                    concordfiles[p].write(f'{k}\t{types2relations[set_type]}\t{x}\n')
-
+        x = norm(x,other_prefixes)
+        if Text.get_curie(x) not in ignore_list:
+            p = Text.get_curie(k)
+            if p in concordfiles and (k, x) not in written:
+                written.add((k, x))
+                concordfiles[p].write(f'{k}\t{types2relations[set_type]}\t{x}\n')
 
 if __name__ == '__main__':
     ug = UberGraph()
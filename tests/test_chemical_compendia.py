@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from src.babel_utils import write_clique_list
+from src.createcompendia import chemicals
+
+
+def write_inputs(tmp_path):
+    type_file = tmp_path / 'types'
+    type_file.write_text("PUBCHEM.COMPOUND:1\tbiolink:SmallMolecule\nPUBCHEM.COMPOUND:2\tbiolink:MolecularMixture\n")
+    untyped_compendia = str(tmp_path / 'untyped_compendia')
+    write_clique_list(untyped_compendia, [['PUBCHEM.COMPOUND:1', 'CHEBI:1'], ['PUBCHEM.COMPOUND:2', 'CHEBI:2']])
+    return str(type_file), untyped_compendia
+
+
+def test_build_compendia_removes_spill_files(tmp_path, monkeypatch):
+    """The typed spill files are written into a temporary directory, which is removed whether or not we succeed."""
+    type_file, untyped_compendia = write_inputs(tmp_path)
+    written = {}
+
+    def write_compendium(metadata_yamls, sets, ofname, biotype, labels, **kwargs):
+        written[biotype] = sorted(map(sorted, sets))
+
+    monkeypatch.setattr(chemicals, 'write_compendium', write_compendium)
+    chemicals.build_compendia(type_file, untyped_compendia, [], [], 'icRDF.tsv')
+    assert written == {
+        'biolink:SmallMolecule': [['CHEBI:1', 'PUBCHEM.COMPOUND:1']],
+        'biolink:MolecularMixture': [['CHEBI:2', 'PUBCHEM.COMPOUND:2']],
+    }
+    assert sorted(os.listdir(tmp_path)) == ['types', 'untyped_compendia']
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('write_compendium failed')
+
+    monkeypatch.setattr(chemicals, 'write_compendium', fail)
+    with pytest.raises(RuntimeError):
+        chemicals.build_compendia(type_file, untyped_compendia, [], [], 'icRDF.tsv')
+    assert sorted(os.listdir(tmp_path)) == ['types', 'untyped_compendia']
@@ -0,0 +1,16 @@
+from src.babel_utils import format_clique, parse_clique, read_clique_list, write_clique_list
+
+
+def test_clique_list_round_trip(tmp_path):
+    cliques = [
+        ['RXCUI:1092396', 'PUBCHEM.COMPOUND:446284', 'UMLS:C1370123'],
+        ['CHEBI:15377'],
+        ['NCIT:C1234', 'MESH:D000001 "quoted" \\ label', 'UNII:ÅBC'],
+    ]
+    filename = str(tmp_path / 'untyped_compendium')
+    assert write_clique_list(filename, cliques) == 3
+    with open(filename, 'a') as outf:
+        outf.write('\n')
+    assert list(read_clique_list(filename)) == cliques
+    assert parse_clique(format_clique(iter(cliques[0]))) == cliques[0]
+    assert format_clique(cliques[1]) == '["CHEBI:15377"]\n'
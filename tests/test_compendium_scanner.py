@@ -0,0 +1,58 @@
+import json
+import random
+
+from src.assess_compendia import assess
+from src.reports import compendium_scanner
+from src.reports.compendia_per_file_reports import generate_content_report_for_compendium, generate_reports_for_compendium
+
+
+def write_compendium(filename, count, seed=0):
+    rng = random.Random(seed)
+    with open(filename, 'w') as f:
+        for i in range(count):
+            identifiers = []
+            for j in range(rng.randint(1, 5)):
+                identifier = {'i': f"{rng.choice(['CHEBI', 'MESH', 'UNII', 'ncbigene'])}:{i}_{j}", 'd': []}
+                if rng.random() < 0.7:
+                    identifier['l'] = rng.choice(['water', 'salt', ' ', f'label {i}'])
+                if rng.random() < 0.3:
+                    identifier['d'] = [rng.choice(['a description', 'another description', ''])]
+                identifiers.append(identifier)
+            f.write(json.dumps({'type': rng.choice(['biolink:SmallMolecule', 'biolink:Drug']), 'identifiers': identifiers}) + '\n')
+
+
+def test_byte_ranges(tmp_path):
+    compendium = str(tmp_path / 'SmallMolecule.txt')
+    write_compendium(compendium, 500)
+    with open(compendium, 'rb') as f:
+        contents = f.read()
+    for range_count in [1, 2, 7, 5000]:
+        byte_ranges = compendium_scanner.get_byte_ranges(compendium, range_count)
+        assert byte_ranges[0][0] == 0 and byte_ranges[-1][1] == len(contents)
+        assert all(end == next_start for (_, end), (next_start, _) in zip(byte_ranges, byte_ranges[1:]))
+        assert all(contents[end - 1:end] == b'\n' for _, end in byte_ranges)
+
+
+def test_parallel_reports(tmp_path, monkeypatch):
+    """Scanning a compendium in parallel should produce exactly the same reports as scanning it in one process."""
+    compendium = str(tmp_path / 'SmallMolecule.txt')
+    write_compendium(compendium, 2000)
+
+    generate_content_report_for_compendium(compendium, str(tmp_path / 'content.json'))
+    assess(compendium, str(tmp_path / 'clusters.txt'))
+
+    monkeypatch.setattr(compendium_scanner, 'SCAN_MIN_BYTES_PER_RANGE', 1)
+    generate_reports_for_compendium(compendium, str(tmp_path / 'content-parallel.json'),
+                                    str(tmp_path / 'clusters-parallel.txt'), workers=4)
+
+    with open(tmp_path / 'content.json') as f1, open(tmp_path / 'content-parallel.json') as f2:
+        assert f1.read().replace('content.json', '') == f2.read().replace('content-parallel.json', '')
+
+    # The cluster type distribution is written out as frozensets, whose order can change when they are sent between
+    # processes, so we only compare the cluster size distribution here.
+    with open(tmp_path / 'clusters.txt') as f1, open(tmp_path / 'clusters-parallel.txt') as f2:
+        assert f1.read().split('\nCluster Type Distribution\n')[0] == f2.read().split('\nCluster Type Distribution\n')[0]
+
+    single, = compendium_scanner.scan_compendium(compendium, [compendium_scanner.ClusterReportAccumulator])
+    parallel, = compendium_scanner.scan_compendium(compendium, [compendium_scanner.ClusterReportAccumulator], workers=3)
+    assert single.clustertypes == parallel.clustertypes
@@ -0,0 +1,80 @@
+import gzip
+import random
+import zlib
+
+import pytest
+
+from src.compression import ParallelGzipWriter, compress_file, open_compressed
+from src.snakefiles.util import gzip_files
+
+
+def make_text(lines=20_000):
+    rng = random.Random(0)
+    words = [f"word{index}" for index in range(500)]
+    return ''.join(' '.join(rng.choice(words) for _ in range(8)) + '\n' for _ in range(lines))
+
+
+def read_single_gzip_member(filename):
+    """
+    Decompress a gzip file, checking that it consists of exactly one gzip member.
+    """
+    with open(filename, 'rb') as inf:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = decompressor.decompress(inf.read())
+    assert decompressor.eof
+    assert decompressor.unused_data == b''
+    return data
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_parallel_gzip_writer(tmp_path, workers):
+    text = make_text()
+    filename = str(tmp_path / 'output.txt.gz')
+    with ParallelGzipWriter(open(filename, 'wb'), workers=workers, level=6, block_size=10_000) as outf:
+        # Write in pieces that don't line up with the blocks.
+        encoded = text.encode('utf-8')
+        for start in range(0, len(encoded), 7_777):
+            outf.write(encoded[start:start + 7_777])
+
+    assert read_single_gzip_member(filename) == text.encode('utf-8')
+    with gzip.open(filename, 'rt', encoding='utf-8') as inf:
+        assert inf.read() == text
+
+
+def test_open_compressed_text(tmp_path):
+    filename = str(tmp_path / 'synonyms.txt.gz')
+    with open_compressed(filename, 'wt', workers=2) as outf:
+        outf.write('{"curie":"CHEBI:15377","names":["water","H₂O"]}\n')
+    with gzip.open(filename, 'rt', encoding='utf-8') as inf:
+        assert inf.read() == '{"curie":"CHEBI:15377","names":["water","H₂O"]}\n'
+
+    # An empty file should still be a valid gzip file.
+    empty_filename = str(tmp_path / 'empty.txt.gz')
+    with open_compressed(empty_filename, 'wt'):
+        pass
+    assert read_single_gzip_member(empty_filename) == b''
+
+    with pytest.raises(ValueError):
+        open_compressed(filename, 'rt')
+
+
+def test_open_compressed_zstd(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    filename = str(tmp_path / 'synonyms.txt.zst')
+    text = make_text(1000)
+    with open_compressed(filename, 'wt', workers=2) as outf:
+        outf.write(text)
+    with open(filename, 'rb') as inf:
+        assert zstandard.ZstdDecompressor().stream_reader(inf).read().decode('utf-8') == text
+
+
+def test_gzip_files(tmp_path):
+    text = make_text(5000)
+    filename = tmp_path / 'Disease.txt'
+    filename.write_text(text)
+    gzip_files([str(filename)], workers=2)
+    assert read_single_gzip_member(str(filename) + '.gz') == text.encode('utf-8')
+    assert filename.exists()
+
+    compress_file(str(filename), str(tmp_path / 'copy.gz'), workers=1, level=1)
+    assert read_single_gzip_member(str(tmp_path / 'copy.gz')) == text.encode('utf-8')
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+import duckdb
+
+from src.concords import (read_concord_arrow_batches, read_concord_batches, read_concord_numpy_batches,
+                          read_concord_pairs, read_concord_pair_table, get_concord_table_pairs,
+                          get_columnar_concord_filename)
+
+
+def read_as_text(filename):
+    with open(filename, 'r') as inf:
+        return [tuple(line.strip().split('\t')) for line in inf]
+
+
+def test_columnar_concord(tmp_path):
+    """Reading a concord through its Parquet copy should give the same triples as reading it as text."""
+    concord = str(tmp_path / 'UMLS')
+    with open(concord, 'w') as outf:
+        for i in range(2500):
+            outf.write(f"UMLS:C{i:07d}\toio:equivalent\tMESH:D{i:06d}\n")
+        outf.write("UMLS:C9999999\t\tNOT_A_CURIE\n")
+        outf.write("  HP:0000001\tskos:exactMatch\tMONDO:odd:local:id  \n")
+
+    batches = list(read_concord_batches(concord, batch_size=1000))
+    assert os.path.exists(get_columnar_concord_filename(concord))
+    assert [len(batch) for batch in batches] == [1000, 1000, 502]
+    assert [triple for batch in batches for triple in batch] == read_as_text(concord)
+
+    # Every row records the line it came from.
+    with duckdb.connect() as db:
+        line_numbers = db.execute("SELECT line_number FROM read_parquet(?)",
+                                  [get_columnar_concord_filename(concord)]).fetchall()
+    assert sorted(line_number for (line_number,) in line_numbers) == list(range(1, 2503))
+
+    # The Arrow and NumPy batches have the prefixes and local IDs in separate columns.
+    arrow_batches = list(read_concord_arrow_batches(concord, batch_size=1000))
+    assert [batch.num_rows for batch in arrow_batches] == [1000, 1000, 502]
+    assert arrow_batches[0].slice(0, 1).to_pylist() == [{
+        'subject_prefix': 'UMLS', 'subject_local_id': 'C0000000', 'predicate': 'oio:equivalent',
+        'object_prefix': 'MESH', 'object_local_id': 'D000000'}]
+    assert arrow_batches[-1].slice(500).to_pylist() == [
+        {'subject_prefix': 'UMLS', 'subject_local_id': 'C9999999', 'predicate': '', 'object_prefix': 'NOT_A_CURIE',
+         'object_local_id': None},
+        {'subject_prefix': 'HP', 'subject_local_id': '0000001', 'predicate': 'skos:exactMatch',
+         'object_prefix': 'MONDO', 'object_local_id': 'odd:local:id'}]
+    numpy_batches = list(read_concord_numpy_batches(concord, batch_size=1000))
+    assert list(numpy_batches[1]['subject_local_id'][:2]) == ['C0001000', 'C0001001']
+
+    # Changing the concord file should rebuild the Parquet copy.
+    with open(concord, 'a') as outf:
+        outf.write("UMLS:C0000001\toio:equivalent\tNCIT:C1\n")
+    pairs = list(read_concord_pairs(concord))
+    assert len(pairs) == 2503
+    assert pairs[-1] == ('UMLS:C0000001', 'NCIT:C1')
+
+    # A pair table has the same pairs, together with their prefixes.
+    table = read_concord_pair_table(concord)
+    assert get_concord_table_pairs(table) == pairs
+    assert table.slice(2500, 2).to_pylist() == [
+        {'subject_prefix': 'UMLS', 'subject': 'UMLS:C9999999', 'object_prefix': 'NOT_A_CURIE', 'object': 'NOT_A_CURIE'},
+        {'subject_prefix': 'HP', 'subject': 'HP:0000001', 'object_prefix': 'MONDO', 'object': 'MONDO:odd:local:id'}]
+
+
+def test_invalid_concord(tmp_path):
+    """Concords with the wrong number of columns are read as text, and rejected in strict mode."""
+    concord = str(tmp_path / 'HP')
+    with open(concord, 'w') as outf:
+        outf.write("HP:0000001\tskos:exactMatch\tMONDO:0000001\n")
+        outf.write("HP:0000002\tskos:exactMatch\tMONDO:0000002\textra\n")
+
+    assert list(read_concord_pairs(concord)) == [('HP:0000001', 'MONDO:0000001'), ('HP:0000002', 'MONDO:0000002')]
+    assert [batch.to_pylist() for batch in read_concord_arrow_batches(concord)][0][1] == {
+        'subject_prefix': 'HP', 'subject_local_id': '0000002', 'predicate': 'skos:exactMatch',
+        'object_prefix': 'MONDO', 'object_local_id': '0000002'}
+    with pytest.raises(RuntimeError):
+        list(read_concord_pairs(concord, strict=True))
+
+    table = read_concord_pair_table(concord)
+    assert get_concord_table_pairs(table) == list(read_concord_pairs(concord))
+    assert table.column('object_prefix').to_pylist() == ['MONDO', 'MONDO']
+    with pytest.raises(RuntimeError):
+        read_concord_pair_table(concord, strict=True)
@@ -0,0 +1,116 @@
+import gzip
+import hashlib
+import os
+
+import yaml
+
+from src.metadata import content_cache
+from src.metadata.content_cache import content_cached, get_source_hash, get_source_modules, hash_file
+from src.metadata.provenance import write_download_metadata
+from src.util import get_config
+
+
+calls = []
+
+
+@content_cached(inputs=['infile'], outputs=['labelfile', 'synfile'])
+def make_test_labels_and_synonyms(infile, labelfile, synfile):
+    calls.append(infile)
+    with gzip.open(infile, 'rt') as inf, open(labelfile, 'w') as labelf, open(synfile, 'w') as synf:
+        for line in inf:
+            curie, label = line.rstrip('\n').split('\t')
+            labelf.write(f"{curie}\t{label}\n")
+            synf.write(f"{curie}\toboInOwl:hasExactSynonym\t{label.lower()}\n")
+
+
+def use_cache_directory(monkeypatch, tmp_path):
+    monkeypatch.setitem(get_config(), 'datahandler_cache', True)
+    monkeypatch.setitem(get_config(), 'datahandler_cache_directory', str(tmp_path / 'cache'))
+
+
+def write_download(filename, labels):
+    # Gzip headers include a timestamp, so fix it to make identical downloads byte-for-byte identical.
+    with gzip.GzipFile(filename, 'wb', mtime=0) as outf:
+        for index, label in enumerate(labels):
+            outf.write(f"TEST:{index}\t{label}\n".encode('utf-8'))
+
+
+def test_content_cached(monkeypatch, tmp_path):
+    use_cache_directory(monkeypatch, tmp_path)
+    calls.clear()
+    download = str(tmp_path / 'download.tsv.gz')
+    labels = str(tmp_path / 'labels')
+    synonyms = str(tmp_path / 'synonyms')
+
+    write_download(download, ['Alpha', 'Beta'])
+    make_test_labels_and_synonyms(download, labels, synonyms)
+    assert len(calls) == 1
+
+    # Deleting the outputs (as Snakemake does before rerunning a job) and redownloading identical content should
+    # restore the outputs from the cache.
+    os.remove(labels)
+    os.remove(synonyms)
+    write_download(download, ['Alpha', 'Beta'])
+    make_test_labels_and_synonyms(download, labels, synonyms)
+    assert len(calls) == 1
+    with open(labels) as inf:
+        assert inf.read() == "TEST:0\tAlpha\nTEST:1\tBeta\n"
+    with open(synonyms) as inf:
+        assert inf.read() == "TEST:0\toboInOwl:hasExactSynonym\talpha\nTEST:1\toboInOwl:hasExactSynonym\tbeta\n"
+
+    # A download with different content should be transformed again, without touching the previous cache entry.
+    write_download(download, ['Gamma'])
+    make_test_labels_and_synonyms(download, labels, synonyms)
+    assert len(calls) == 2
+    with open(labels) as inf:
+        assert inf.read() == "TEST:0\tGamma\n"
+
+    write_download(download, ['Alpha', 'Beta'])
+    make_test_labels_and_synonyms(download, labels, synonyms)
+    assert len(calls) == 2
+    with open(labels) as inf:
+        assert inf.read() == "TEST:0\tAlpha\nTEST:1\tBeta\n"
+
+
+def test_content_cache_turned_off(monkeypatch, tmp_path):
+    monkeypatch.setitem(get_config(), 'datahandler_cache', False)
+    calls.clear()
+    download = str(tmp_path / 'download.tsv.gz')
+    write_download(download, ['Alpha'])
+    for _ in range(2):
+        make_test_labels_and_synonyms(download, str(tmp_path / 'labels'), str(tmp_path / 'synonyms'))
+    assert len(calls) == 2
+    assert not os.path.exists(tmp_path / 'cache')
+
+
+def test_source_hash_covers_helper_modules(monkeypatch):
+    from src.datahandlers import ncbitaxon
+    module_names = [module.__name__ for module in get_source_modules(ncbitaxon.make_labels_and_synonyms)]
+    assert 'src.datahandlers.ncbitaxon' in module_names
+    assert 'src.babel_utils' in module_names
+    assert 'src.prefixes' in module_names
+
+    # Changing the source code of a helper module should change the cache key.
+    import src.babel_utils
+    source_hash = get_source_hash(ncbitaxon.make_labels_and_synonyms)
+    real_getsource = content_cache.inspect.getsource
+    monkeypatch.setattr(content_cache.inspect, 'getsource', lambda obj: real_getsource(obj) + (
+        '# changed\n' if obj is src.babel_utils else ''))
+    assert get_source_hash(ncbitaxon.make_labels_and_synonyms) != source_hash
+
+
+def test_download_metadata_hashes(monkeypatch, tmp_path):
+    use_cache_directory(monkeypatch, tmp_path)
+    download = tmp_path / 'test.owl'
+    download.write_text('<rdf:RDF/>\n')
+    metadata_yaml = str(tmp_path / 'metadata.yaml')
+    write_download_metadata(metadata_yaml, name='Test', url='http://example.org/test.owl', downloaded_files=[str(download)])
+
+    with open(metadata_yaml) as inf:
+        metadata = yaml.safe_load(inf)
+    sha256 = metadata['content_hashes']['test.owl']
+    assert sha256 == hashlib.sha256(b'<rdf:RDF/>\n').hexdigest()
+
+    # The hash should be memoized, so it isn't recalculated unless the file changes.
+    monkeypatch.setattr(content_cache, 'HASH_BLOCK_SIZE', None)
+    assert hash_file(str(download)) == sha256
@@ -0,0 +1,67 @@
+import os
+
+from src import json_codec
+from src.createcompendia.geneprotein import build_conflation
+from src.curie_index import CurieIndex, CurieIndexEntry, write_curie_index_shard
+
+
+def write_compendium(filename, cliques):
+    with json_codec.JSONLWriter(filename) as writer:
+        for biolink_type, curies in cliques:
+            writer.write({'type': biolink_type, 'identifiers': [{'i': curie} for curie in curies]})
+
+
+def write_shard(tmp_path, name, cliques):
+    compendium = str(tmp_path / 'compendia' / f'{name}.txt')
+    os.makedirs(os.path.dirname(compendium), exist_ok=True)
+    write_compendium(compendium, cliques)
+    index_filename = str(tmp_path / 'indexes' / 'curies' / f'{name}.tsv')
+    write_curie_index_shard(compendium, index_filename)
+    return index_filename
+
+
+def test_curie_index(tmp_path):
+    disease = write_shard(tmp_path, 'Disease', [
+        ('biolink:Disease', ['MONDO:0000001', 'UMLS:C0000001', 'MESH:D000001']),
+        ('biolink:Disease', ['MONDO:0000002', 'UMLS:C0000002']),
+    ])
+    phenotype = write_shard(tmp_path, 'PhenotypicFeature', [
+        ('biolink:PhenotypicFeature', ['HP:0000001', 'UMLS:C0000001']),
+    ])
+    assert os.path.exists(disease + '.sst')
+
+    index = CurieIndex([disease, phenotype])
+    assert 'MESH:D000001' in index
+    assert 'MESH:D999999' not in index
+    assert index.get('MESH:D000001') == CurieIndexEntry('MESH:D000001', 'Disease', 'MONDO:0000001', 'biolink:Disease')
+    assert index.get_clique_leader('HP:0000001') == 'HP:0000001'
+    assert index.get_clique_leader('HP:9999999') is None
+    assert index.lookup('UMLS:C0000001') == [
+        CurieIndexEntry('UMLS:C0000001', 'Disease', 'MONDO:0000001', 'biolink:Disease'),
+        CurieIndexEntry('UMLS:C0000001', 'PhenotypicFeature', 'HP:0000001', 'biolink:PhenotypicFeature'),
+    ]
+    assert [entry.curie for entry in index.iter_prefix('UMLS:')] == ['UMLS:C0000001', 'UMLS:C0000002', 'UMLS:C0000001']
+
+
+def test_geneprotein_conflation_with_curie_index(tmp_path):
+    gene = write_shard(tmp_path, 'Gene', [
+        ('biolink:Gene', ['NCBIGene:1', 'HGNC:1']),
+        ('biolink:Gene', ['NCBIGene:2']),
+    ])
+    protein = write_shard(tmp_path, 'Protein', [
+        ('biolink:Protein', ['UniProtKB:P1']),
+        ('biolink:Protein', ['UniProtKB:P2']),
+        ('biolink:Protein', ['UniProtKB:P3']),
+    ])
+    concord = str(tmp_path / 'UniProtNCBI')
+    with open(concord, 'w') as outf:
+        outf.write("UniProtKB:P1\trelated_to\tNCBIGene:1\n")
+        outf.write("UniProtKB:P2\trelated_to\tNCBIGene:1\n")
+        # Neither of these pairs should be included, since one of their CURIEs isn't in the compendia.
+        outf.write("UniProtKB:P3\trelated_to\tNCBIGene:3\n")
+        outf.write("UniProtKB:P4\trelated_to\tNCBIGene:2\n")
+
+    outfile = str(tmp_path / 'GeneProtein.txt')
+    build_conflation(concord, gene, protein, outfile)
+    with open(outfile) as inf:
+        assert inf.read() == '["NCBIGene:1","UniProtKB:P1","UniProtKB:P2"]\n'
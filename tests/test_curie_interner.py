@@ -0,0 +1,73 @@
+import curies
+
+import src.node
+from src.curie_interner import CurieInterner, CurieMap
+from src.node import InformationContentFactory
+from src.unionfind import UnionFind
+from src.babel_utils import glom
+
+
+def test_interner_round_trip():
+    """Every CURIE should come back out exactly as it went in, including suffixes that look numerical but aren't."""
+    curies = ['PUBCHEM.COMPOUND:962', 'CHEBI:15377', 'MONDO:0005148', 'UniProtKB:P12345', 'NCBIGene:0',
+              'INCHIKEY:XLYOFNOQVPJJNP-UHFFFAOYSA-N', 'HP:0000001', 'nocolon', 'UMLS:', 'CHEBI:15377']
+    interner = CurieInterner()
+    handles = [interner.intern(curie) for curie in curies]
+    assert len(interner) == len(curies) - 1
+    assert handles[1] == handles[-1]
+    assert interner.curies(handles) == curies
+    assert list(interner) == curies[:-1]
+    assert interner.prefix(handles[0]) == 'PUBCHEM.COMPOUND'
+    assert interner.get('CHEBI:15378') is None
+    assert 'MONDO:5148' not in interner
+    assert 'MONDO:0005148' in interner
+
+
+def test_curie_map():
+    interner = CurieInterner()
+    cm = CurieMap(interner)
+    cm['CHEBI:1'] = 'CHEBI:1'
+    cm['PUBCHEM.COMPOUND:2'] = 'CHEBI:1'
+    interner.intern('MESH:D000001')
+    cm['MESH:D000001'] = 'CHEBI:1'
+    cm['PUBCHEM.COMPOUND:2'] = 'CHEBI:3'
+    assert len(cm) == 3
+    assert cm['PUBCHEM.COMPOUND:2'] == 'CHEBI:3'
+    assert cm.get('CHEBI:3') is None
+    assert 'CHEBI:3' not in cm
+    assert dict(cm.items()) == {'CHEBI:1': 'CHEBI:1', 'PUBCHEM.COMPOUND:2': 'CHEBI:3', 'MESH:D000001': 'CHEBI:1'}
+
+
+def test_shared_interner_unionfind():
+    """A UnionFind sharing an interner should only contain the CURIEs that were glommed into it."""
+    interner = CurieInterner(['A:1', 'A:2', 'B:1', 'B:2'])
+    uf = UnionFind(interner)
+    glom(uf, [('A:1', 'B:1'), ('A:2', 'C:3')], unique_prefixes=['A'])
+    assert len(uf) == 4
+    assert 'B:2' not in uf
+    assert uf['C:3'] == {'A:2', 'C:3'}
+    assert sorted(map(sorted, uf.values())) == [['A:1', 'B:1'], ['A:2', 'C:3']]
+
+
+def test_information_content_factory(tmp_path, monkeypatch):
+    """InformationContentFactory stores its values by interned CURIE, and looks them up by exact CURIE."""
+    monkeypatch.setattr(src.node, 'get_biolink_prefix_map', lambda: curies.Converter.from_prefix_map({
+        'CHEBI': 'http://purl.obolibrary.org/obo/CHEBI_',
+        'MONDO': 'http://purl.obolibrary.org/obo/MONDO_',
+    }))
+    icrdf = tmp_path / 'icRDF.tsv'
+    icrdf.write_text(
+        "http://purl.obolibrary.org/obo/CHEBI_15377\t55.5\n"
+        "http://purl.obolibrary.org/obo/MONDO_0005148\t80\n"
+        "http://purl.obolibrary.org/obo/MONDO_0005148\t70.25\n"
+    )
+    ic_factory = InformationContentFactory(str(icrdf))
+    assert len(ic_factory.ic_values) == 2
+
+    def node(*identifiers):
+        return {'identifiers': [{'identifier': identifier} for identifier in identifiers]}
+
+    assert ic_factory.get_ic(node('CHEBI:15377')) == 55.5
+    assert ic_factory.get_ic(node('CHEBI:15377', 'MONDO:0005148')) == 55.5
+    assert ic_factory.get_ic(node('MONDO:0005148')) == 70.25
+    assert ic_factory.get_ic(node('MONDO:5148', 'CHEBI:1')) is None
@@ -0,0 +1,291 @@
+import gzip
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src import downloads
+from src.downloads import DownloadError, DownloadManager, list_ftp_directory
+from src.util import get_config
+
+
+# A local stand-in for an HTTP server that supports byte ranges, serving files from a dictionary of path -> bytes.
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    files = {}
+    requests = []
+    fail_after = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        content = self.files.get(self.path)
+        range_header = self.headers.get('Range')
+        self.requests.append((self.path, range_header))
+        if content is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(content) - 1
+        if range_header:
+            start_text, end_text = range_header.removeprefix('bytes=').split('-')
+            start = int(start_text)
+            end = min(int(end_text) if end_text else len(content) - 1, len(content) - 1)
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(content)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+        else:
+            self.send_response(200)
+        body = content[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Last-Modified', 'Wed, 01 Jan 2025 00:00:00 GMT')
+        self.end_headers()
+        if self.fail_after is not None and len(body) > self.fail_after:
+            # Simulate a dropped connection partway through the transfer.
+            self.wfile.write(body[:self.fail_after])
+            self.close_connection = True
+            type(self).fail_after = None
+            return
+        self.wfile.write(body)
+
+
+@contextmanager
+def http_server(files):
+    handler = type('TestRangeRequestHandler', (RangeRequestHandler,), {'files': files, 'requests': []})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}", handler
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# A local stand-in for an anonymous FTP server, just big enough for ftplib: it serves files from a dictionary of
+# path -> bytes, and supports SIZE, MDTM, MLSD, PASV, REST and RETR.
+class FTPRequestHandler(socketserver.StreamRequestHandler):
+    files = {}
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        self.reply('220 Test FTP server')
+        rest = 0
+        passive = None
+        while True:
+            line = self.rfile.readline().decode('utf-8').strip()
+            if not line:
+                return
+            command, _, argument = line.partition(' ')
+            command = command.upper()
+            if command == 'USER':
+                self.reply('331 Send password')
+            elif command in {'PASS', 'TYPE', 'OPTS'}:
+                self.reply('230 OK' if command == 'PASS' else '200 OK')
+            elif command == 'SIZE':
+                if argument in self.files:
+                    self.reply(f'213 {len(self.files[argument])}')
+                else:
+                    self.reply('550 No such file')
+            elif command == 'MDTM':
+                self.reply('213 20250101000000')
+            elif command == 'PASV':
+                passive = socket.socket()
+                passive.bind(('127.0.0.1', 0))
+                passive.listen(1)
+                port = passive.getsockname()[1]
+                self.reply(f'227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 255})')
+            elif command == 'REST':
+                rest = int(argument)
+                self.reply('350 Restarting')
+            elif command in {'RETR', 'MLSD'}:
+                if command == 'RETR':
+                    data = self.files[argument][rest:]
+                else:
+                    directory = argument.rstrip('/') + '/'
+                    entries = set()
+                    for path in self.files:
+                        if path.startswith(directory):
+                            name, _, subpath = path[len(directory):].partition('/')
+                            entries.add(f"type={'dir' if subpath else 'file'}; {name}")
+                    data = ''.join(f'{entry}\r\n' for entry in sorted(entries)).encode('utf-8')
+                self.reply('150 Opening data connection')
+                conn, _ = passive.accept()
+                conn.sendall(data)
+                conn.close()
+                passive.close()
+                rest = 0
+                self.reply('226 Transfer complete')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+@contextmanager
+def ftp_server(files):
+    handler = type('TestFTPRequestHandler', (FTPRequestHandler,), {'files': files})
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"ftp://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_content(size, seed=0):
+    return bytes((index * 7 + seed) % 251 for index in range(size))
+
+
+@pytest.fixture(autouse=True)
+def content_cache_directory(monkeypatch, tmp_path):
+    # Completed downloads are hashed by the content cache, so keep its memoized hashes out of the download directory.
+    monkeypatch.setitem(get_config(), 'datahandler_cache_directory', str(tmp_path / 'content_cache'))
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(downloads, 'DOWNLOAD_BLOCK_SIZE', 1000)
+    monkeypatch.setattr(downloads, 'DOWNLOAD_SEGMENT_SIZE', 10_000)
+    monkeypatch.setattr(downloads, 'DOWNLOAD_MANIFEST_EVERY', 2000)
+    monkeypatch.setattr(downloads, 'DOWNLOAD_RETRY_DELAY', 0)
+
+
+def test_parallel_http_downloads(tmp_path, small_segments):
+    files = {f'/data/file{index}.bin': make_content(25_000 + index, seed=index) for index in range(4)}
+    with http_server(files) as (base_url, handler):
+        manager = DownloadManager(max_workers=4, max_workers_per_host=2, retries=0)
+        filenames = manager.download_all([(base_url + path, str(tmp_path / os.path.basename(path))) for path in files])
+
+        for path, filename in zip(files, filenames):
+            with open(filename, 'rb') as inf:
+                assert inf.read() == files[path]
+            with open(filename + '.download.json') as inf:
+                manifest = json.load(inf)
+            assert manifest['sha256'] == hashlib.sha256(files[path]).hexdigest()
+            assert manifest['completed'] == [[0, len(files[path])]]
+            assert not os.path.exists(filename + '.part')
+
+        # Every file should have been split into three ranged segments (as well as the request to find its size).
+        assert sorted(range_header for path, range_header in handler.requests if path == '/data/file0.bin') == [
+            'bytes=0-0', 'bytes=0-9999', 'bytes=10000-19999', 'bytes=20000-24999']
+
+        # Downloading them again should only check the remote files.
+        handler.requests.clear()
+        manager.download_all([(base_url + path, str(tmp_path / os.path.basename(path))) for path in files])
+        assert sorted(handler.requests) == sorted((path, 'bytes=0-0') for path in files)
+
+
+def test_resume_interrupted_http_download(tmp_path, small_segments):
+    content = make_content(25_000)
+    files = {'/big.bin': content}
+    with http_server(files) as (base_url, handler):
+        handler.fail_after = 5000
+        manager = DownloadManager(max_workers=1, retries=0)
+        filename = str(tmp_path / 'big.bin')
+        with pytest.raises(DownloadError):
+            manager.download(base_url + '/big.bin', filename)
+
+        # The manifest should record the other segments, and the part of the first segment that was written before the
+        # connection dropped.
+        with open(filename + '.download.json') as inf:
+            assert json.load(inf)['completed'] == [[0, 5000], [10000, 25000]]
+
+        handler.requests.clear()
+        manager.download(base_url + '/big.bin', filename)
+        with open(filename, 'rb') as inf:
+            assert inf.read() == content
+        assert sorted(range_header for _, range_header in handler.requests) == ['bytes=0-0', 'bytes=5000-9999']
+
+
+def test_checksum_mismatch(tmp_path, small_segments):
+    with http_server({'/file.txt': b'hello\n'}) as (base_url, handler):
+        manager = DownloadManager(max_workers=1, retries=0)
+        with pytest.raises(DownloadError):
+            manager.download(base_url + '/file.txt', str(tmp_path / 'file.txt'), sha256='0' * 64)
+        assert not os.path.exists(tmp_path / 'file.txt')
+
+        sha256 = hashlib.sha256(b'hello\n').hexdigest()
+        assert manager.download(base_url + '/file.txt', str(tmp_path / 'file.txt'), sha256=sha256) == str(tmp_path / 'file.txt')
+
+
+def test_ftp_downloads(tmp_path, small_segments):
+    files = {
+        '/pubmed/baseline/pubmed25n0001.xml.gz': gzip.compress(b'<PubmedArticleSet/>\n'),
+        '/pubmed/baseline/pubmed25n0001.xml.gz.md5': b'MD5 checksum\n',
+        '/pubmed/baseline/old/pubmed24n0001.xml.gz': gzip.compress(b'<PubmedArticleSet/>\n'),
+        '/gene/DATA/big.bin': make_content(25_000),
+    }
+    with ftp_server(files) as base_url:
+        assert list_ftp_directory(base_url + '/pubmed/baseline/') == [
+            base_url + '/pubmed/baseline/pubmed25n0001.xml.gz',
+            base_url + '/pubmed/baseline/pubmed25n0001.xml.gz.md5',
+        ]
+        assert len(list_ftp_directory(base_url + '/pubmed/', recursive=True)) == 3
+
+        manager = DownloadManager(max_workers=2, retries=0)
+        filename = str(tmp_path / 'big.bin')
+        # Pretend that an earlier download got 12,000 bytes in, so that the download restarts from there.
+        with open(filename + '.part', 'wb') as outf:
+            outf.write(files['/gene/DATA/big.bin'][:12_000])
+        with open(filename + '.download.json', 'w') as outf:
+            json.dump({
+                'version': downloads.DOWNLOAD_MANIFEST_FORMAT_VERSION,
+                'url': base_url + '/gene/DATA/big.bin',
+                'remote': downloads.get_remote_file_info(base_url + '/gene/DATA/big.bin')._asdict(),
+                'completed': [[0, 12_000]],
+            }, outf)
+        manager.download(base_url + '/gene/DATA/big.bin', filename)
+        with open(filename, 'rb') as inf:
+            assert inf.read() == files['/gene/DATA/big.bin']
+
+
+def test_empty_and_fully_resumed_downloads(tmp_path, small_segments):
+    content = make_content(25_000)
+    with http_server({'/empty.txt': b'', '/big.bin': content}) as (base_url, handler):
+        manager = DownloadManager(max_workers=2, retries=0)
+        filename = manager.download(base_url + '/empty.txt', str(tmp_path / 'empty.txt'))
+        with open(filename, 'rb') as inf:
+            assert inf.read() == b''
+        assert not os.path.exists(filename + '.part')
+
+        # Pretend that an earlier download wrote every byte, but was interrupted before the file was moved into place.
+        filename = str(tmp_path / 'big.bin')
+        with open(filename + '.part', 'wb') as outf:
+            outf.write(content)
+        with open(filename + '.download.json', 'w') as outf:
+            json.dump({
+                'version': downloads.DOWNLOAD_MANIFEST_FORMAT_VERSION,
+                'url': base_url + '/big.bin',
+                'remote': downloads.get_remote_file_info(base_url + '/big.bin')._asdict(),
+                'completed': [[0, len(content)]],
+            }, outf)
+        handler.requests.clear()
+        manager.download(base_url + '/big.bin', filename)
+        with open(filename, 'rb') as inf:
+            assert inf.read() == content
+        assert handler.requests == [('/big.bin', 'bytes=0-0')]
+
+
+def test_permanent_errors_are_not_retried(tmp_path, small_segments):
+    with http_server({}) as (base_url, handler):
+        manager = DownloadManager(max_workers=1, retries=3)
+        with pytest.raises(DownloadError):
+            manager.download(base_url + '/missing.txt', str(tmp_path / 'missing.txt'))
+        assert handler.requests == [('/missing.txt', 'bytes=0-0')]
@@ -1,5 +1,8 @@
+import random
+
 import pytest
 from src.babel_utils import glom
+from src.unionfind import UnionFind
 
 """glom is a tool that looks at list of sets of values and combines them together if they share members"""
 
@@ -54,3 +57,58 @@ def test_bigger_sets():
         assert True
 
 
+
+def test_unionfind_simple():
+    """The UnionFind backend should produce the same cliques as the dictionary backend."""
+    d = UnionFind()
+    eqs = [('1','2'), ('2','3'), ('4','5')]
+    glom(d,eqs)
+    assert len(d) == 5
+    assert d['1'] == d['2'] == d['3'] == {'1','2','3'}
+    assert d['4'] == d['5'] == {'4','5'}
+    assert set([frozenset(x) for x in d.values()]) == {frozenset({'1','2','3'}), frozenset({'4','5'})}
+
+def test_unionfind_two_calls():
+    d = UnionFind()
+    eqs = [('1','2'), ('2','3'), ('4','5'), ('6','7')]
+    oeqs = [('5','7')]
+    glom(d,eqs)
+    glom(d,oeqs)
+    assert d['1']==d['2']==d['3']=={'1','2','3'}
+    assert d['4']==d['5']==d['6']==d['7']=={'4','5','6','7'}
+
+def test_unionfind_bigger_sets():
+    d = UnionFind()
+    with pytest.raises(ValueError):
+        glom(d, [{'1','2','3'}])
+
+def test_unionfind_unique_prefixes():
+    """A pair that would put two identifiers with a unique prefix into one clique is ignored, and its new
+    identifiers are not added."""
+    for d in [{}, UnionFind()]:
+        glom(d, [('MONDO:1','UMLS:1'), ('MONDO:2','UMLS:2')], unique_prefixes=['MONDO'])
+        glom(d, [('UMLS:1','UMLS:2'), ('MONDO:1', 'MONDO:3'), ('UMLS:2', 'MESH:1')], unique_prefixes=['MONDO'])
+        assert d['MONDO:1'] == {'MONDO:1','UMLS:1'}
+        assert d['MONDO:2'] == {'MONDO:2','UMLS:2','MESH:1'}
+        assert 'MONDO:3' not in d
+
+def test_unionfind_close():
+    """A pair that would turn a close match into an exact match is ignored."""
+    close = {'MONDO': {'MONDO:1': {'HP:1'}}}
+    for d in [{}, UnionFind()]:
+        glom(d, [('MONDO:1','UMLS:1'), ('HP:1','UMLS:2')], unique_prefixes=['MONDO','HP'])
+        glom(d, [('UMLS:1','UMLS:2'), ('UMLS:1','MESH:1')], unique_prefixes=['MONDO','HP'], close=close)
+        assert d['MONDO:1'] == {'MONDO:1','UMLS:1','MESH:1'}
+        assert d['HP:1'] == {'HP:1','UMLS:2'}
+
+def test_unionfind_matches_dict():
+    """Random pairs should give identical cliques with both backends."""
+    rng = random.Random(42)
+    prefixes = ['MONDO', 'HP', 'UMLS', 'MESH']
+    pairs = [(f'{rng.choice(prefixes)}:{rng.randint(0, 200)}', f'{rng.choice(prefixes)}:{rng.randint(0, 200)}') for _ in range(1000)]
+    d = {}
+    uf = UnionFind()
+    glom(d, pairs, unique_prefixes=['MONDO', 'HP'])
+    glom(uf, pairs, unique_prefixes=['MONDO', 'HP'])
+    assert set(d.keys()) == set(uf.keys())
+    assert set([frozenset(x) for x in d.values()]) == set([frozenset(x) for x in uf.values()])
@@ -0,0 +1,135 @@
+import random
+
+import pytest
+
+from src.babel_utils import glom
+from src.incremental_glom import IncrementalGlom
+from src.unionfind import UnionFind
+
+
+def get_steps(rng, pair_count):
+    """Generate a list of glom steps: an identifier file, followed by two concords with lots of vetoed pairs."""
+    identifiers = [(f"MONDO:{i}",) for i in range(100)]
+    concords = []
+    for _ in range(2):
+        pairs = []
+        for _ in range(pair_count):
+            prefixes = rng.sample(['MONDO', 'HP', 'UMLS', 'MESH'], 2)
+            pairs.append({f"{prefix}:{rng.randint(0, 150)}" for prefix in prefixes})
+        concords.append(pairs)
+    close = {'MONDO': {'MONDO:1': {'MONDO:2'}, 'MONDO:2': {'MONDO:1'}}}
+    return identifiers, concords, close
+
+
+def glom_steps(dicts, identifiers, concords, close):
+    glom(dicts, identifiers, unique_prefixes=['MONDO', 'HP'])
+    for pairs in concords:
+        glom(dicts, pairs, unique_prefixes=['MONDO', 'HP'], close=close)
+
+
+def get_cliques(unionfind):
+    return sorted(sorted(clique) for clique in unionfind.cliques())
+
+
+def run_incremental(state_dir, identifiers, concords, close):
+    glommer = IncrementalGlom(state_dir)
+    glom_steps(glommer, identifiers, concords, close)
+    return glommer.run(), glommer.mode
+
+
+def run_full(identifiers, concords, close):
+    unionfind = UnionFind()
+    glom_steps(unionfind, identifiers, concords, close)
+    return unionfind
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_incremental_glom(tmp_path, seed):
+    rng = random.Random(seed)
+    state_dir = str(tmp_path / 'state' / 'diseasephenotype')
+    identifiers, concords, close = get_steps(rng, 150)
+
+    result, mode = run_incremental(state_dir, identifiers, concords, close)
+    assert mode == 'full'
+    assert get_cliques(result) == get_cliques(run_full(identifiers, concords, close))
+
+    result, mode = run_incremental(state_dir, identifiers, concords, close)
+    assert mode == 'unchanged'
+    assert get_cliques(result) == get_cliques(run_full(identifiers, concords, close))
+
+    # Change the second concord: remove some pairs and add some new ones.
+    changed_pairs = concords[1][10:] + [{f"UMLS:{rng.randint(0, 150)}", f"MESH:{rng.randint(0, 150)}"} for _ in range(10)]
+    concords = [concords[0], changed_pairs]
+    result, mode = run_incremental(state_dir, identifiers, concords, close)
+    assert mode == 'incremental'
+    assert get_cliques(result) == get_cliques(run_full(identifiers, concords, close))
+
+    # Changing the veto settings means we have to start again.
+    close = {}
+    result, mode = run_incremental(state_dir, identifiers, concords, close)
+    assert mode == 'full'
+    assert get_cliques(result) == get_cliques(run_full(identifiers, concords, close))
+
+
+def test_incremental_glom_only_reglom_affected_components(tmp_path):
+    state_dir = str(tmp_path / 'state' / 'chemicals')
+    identifiers = []
+    concords = [[(f"CHEBI:{i}", f"MESH:{i}") for i in range(1000)], [(f"MESH:{i}", f"UMLS:{i}") for i in range(1000)]]
+    run_incremental(state_dir, identifiers, concords, {})
+
+    # Replacing a single pair should only re-glom the groups in the two cliques that it touches.
+    concords[1][5] = ("MESH:5", "UMLS:6")
+    glommer = IncrementalGlom(state_dir)
+    glom_steps(glommer, identifiers, concords, {})
+    result = glommer.run()
+    assert glommer.mode == 'incremental'
+    assert glommer.glommed_group_count == 4
+    assert result['MESH:5'] == {'CHEBI:5', 'MESH:5', 'UMLS:6', 'MESH:6', 'CHEBI:6'}
+    assert 'UMLS:5' not in result
+    assert get_cliques(result) == get_cliques(run_full(identifiers, concords, {}))
+
+    # Groups are compared as sets, so reordering the groups in a step (or the identifiers in a group) doesn't affect
+    # anything else.
+    concords[0] = [(mesh, chebi) for chebi, mesh in reversed(concords[0])]
+    concords[1][7] = ("MESH:7", "UMLS:8")
+    glommer = IncrementalGlom(state_dir)
+    glom_steps(glommer, identifiers, concords, {})
+    result = glommer.run()
+    assert glommer.mode == 'incremental'
+    assert glommer.glommed_group_count == 4
+    assert get_cliques(result) == get_cliques(run_full(identifiers, concords, {}))
+
+
+def test_incremental_glom_work_directory(tmp_path, monkeypatch):
+    """The work directory is only created once a step is recorded, and is removed if the glom fails or is abandoned."""
+    state_dir = str(tmp_path / 'state' / 'test')
+    identifiers, concords, close = get_steps(random.Random(1), 50)
+
+    def work_dirs():
+        return sorted(path.name for path in (tmp_path / 'state').iterdir() if path.name.startswith('incremental-glom-'))
+
+    glommer = IncrementalGlom(state_dir)
+    assert not (tmp_path / 'state').exists()
+    glom_steps(glommer, identifiers, concords, close)
+    assert len(work_dirs()) == 1
+
+    # A failure while glomming should remove the work directory and leave the previous state alone.
+    def fail(*args, **kwargs):
+        raise RuntimeError('glom failed')
+    monkeypatch.setattr(IncrementalGlom, 'save_state', fail)
+    with pytest.raises(RuntimeError):
+        glommer.run()
+    assert work_dirs() == []
+    monkeypatch.undo()
+
+    # An abandoned glom should remove its work directory once it is garbage collected.
+    glommer = IncrementalGlom(state_dir)
+    glom_steps(glommer, identifiers, concords, close)
+    assert len(work_dirs()) == 1
+    del glommer
+    assert work_dirs() == []
+
+    # A successful glom turns the work directory into the state directory.
+    run_incremental(state_dir, identifiers, concords, close)
+    assert work_dirs() == []
+    assert (tmp_path / 'state' / 'test' / 'manifest.json').exists()
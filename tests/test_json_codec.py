@@ -0,0 +1,37 @@
+import gzip
+import json
+
+from src import json_codec
+
+
+def test_json_codec_round_trip(tmp_path):
+    records = [
+        {"type": "biolink:Gene", "ic": 100.0, "identifiers": [{"i": "NCBIGene:2538", "l": "G6PC1", "d": [], "t": ["NCBITaxon:9606"]}],
+         "preferred_name": "G6PC1", "taxa": ["NCBITaxon:9606"]},
+        {"curie": "CHEBI:15377", "names": ["water", "H₂O", 'say "hi"'], "curie_suffix": 15377},
+        # Too large for orjson, so this should be written by the standard library instead.
+        {"curie": "EXAMPLE:123456789012345678901234567890", "curie_suffix": 123456789012345678901234567890},
+    ]
+
+    filename = str(tmp_path / 'records.jsonl')
+    with json_codec.JSONLWriter(filename) as writer:
+        writer.write_all(records)
+    assert list(json_codec.read_jsonl(filename)) == records
+
+    # The output should be the same compact JSON that the standard library writes.
+    with open(filename, 'r', encoding='utf-8') as f:
+        assert f.read().splitlines() == [json.dumps(r, ensure_ascii=False, separators=(',', ':')) for r in records]
+
+    gz_filename = str(tmp_path / 'records.jsonl.gz')
+    with gzip.open(gz_filename, 'wt', encoding='utf-8') as f:
+        for record in records:
+            f.write(json_codec.dumps_line(record))
+        f.write('\n')
+    assert list(json_codec.read_synonyms(gz_filename)) == records
+
+
+def test_json_codec_floats():
+    # Floats with exponents may be written differently by orjson and the standard library, but decode to the same value.
+    for value in [1e16, 1e-7, 0.1, 100.0]:
+        assert json_codec.loads(json_codec.dumps({'ic': value})) == {'ic': value}
+        assert json.loads(json_codec.dumps({'ic': value})) == {'ic': value}
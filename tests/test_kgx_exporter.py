@@ -0,0 +1,86 @@
+import gzip
+from itertools import combinations
+
+import pytest
+
+from src import json_codec
+from src.exporters import kgx
+from src.exporters.kgx import EDGE_TOPOLOGY_STAR, convert_compendium_to_kgx
+
+
+def write_test_compendium(compendium, count_cliques=40):
+    with json_codec.JSONLWriter(compendium) as writer:
+        for i in range(count_cliques):
+            identifiers = [{'i': f'MONDO:{i:07d}', 'l': f'Disease {i}'}]
+            identifiers.extend({'i': f'UMLS:C{i:05d}{j:02d}'} for j in range(i % 5))
+            writer.write({'type': 'biolink:Disease', 'ic': None, 'identifiers': identifiers, 'preferred_name': f'Disease {i}'})
+
+
+def read_jsonl_gz(filename):
+    with gzip.open(filename, 'rt', encoding='utf-8') as inf:
+        return [json_codec.loads(line) for line in inf]
+
+
+def test_convert_compendium_to_kgx(tmp_path):
+    compendium = str(tmp_path / 'Disease.txt')
+    write_test_compendium(compendium)
+    nodes_file = str(tmp_path / 'kgx' / 'Disease_nodes.jsonl.gz')
+    edges_file = str(tmp_path / 'kgx' / 'Disease_edges.jsonl.gz')
+    convert_compendium_to_kgx(compendium, nodes_file, edges_file)
+
+    nodes = read_jsonl_gz(nodes_file)
+    assert len(nodes) == sum(1 + i % 5 for i in range(40))
+    assert nodes[1:3] == [
+        {'id': 'MONDO:0000001', 'name': 'Disease 1', 'category': 'biolink:Disease',
+         'equivalent_identifiers': ['MONDO:0000001', 'UMLS:C0000100']},
+        {'id': 'UMLS:C0000100', 'name': '', 'category': 'biolink:Disease',
+         'equivalent_identifiers': ['MONDO:0000001', 'UMLS:C0000100']},
+    ]
+
+    # Every pair of identifiers in a clique should be connected, with a unique ID.
+    edges = read_jsonl_gz(edges_file)
+    expected_pairs = []
+    for i in range(40):
+        curies = [f'MONDO:{i:07d}'] + [f'UMLS:C{i:05d}{j:02d}' for j in range(i % 5)]
+        expected_pairs.extend(combinations(curies, 2))
+    assert [(edge['subject'], edge['object']) for edge in edges] == expected_pairs
+    assert all(edge['predicate'] == 'biolink:same_as' for edge in edges)
+    assert len(set(edge['id'] for edge in edges)) == len(edges)
+
+
+def test_convert_compendium_to_kgx_star(tmp_path):
+    compendium = str(tmp_path / 'Disease.txt')
+    write_test_compendium(compendium)
+    edges_file = str(tmp_path / 'kgx' / 'Disease_edges.jsonl.gz')
+    convert_compendium_to_kgx(compendium, str(tmp_path / 'kgx' / 'Disease_nodes.jsonl.gz'), edges_file,
+                              edge_topology=EDGE_TOPOLOGY_STAR)
+
+    edges = read_jsonl_gz(edges_file)
+    assert len(edges) == sum(i % 5 for i in range(40))
+    assert [(edge['subject'], edge['object']) for edge in edges[:3]] == [
+        ('MONDO:0000001', 'UMLS:C0000100'),
+        ('MONDO:0000002', 'UMLS:C0000200'),
+        ('MONDO:0000002', 'UMLS:C0000201'),
+    ]
+
+    with pytest.raises(ValueError):
+        convert_compendium_to_kgx(compendium, str(tmp_path / 'nodes.jsonl.gz'), str(tmp_path / 'edges.jsonl.gz'),
+                                  edge_topology='mesh')
+
+
+def test_convert_compendium_to_kgx_in_parallel(tmp_path, monkeypatch):
+    compendium = str(tmp_path / 'Disease.txt')
+    write_test_compendium(compendium, count_cliques=200)
+
+    single = (str(tmp_path / 'single' / 'nodes.jsonl.gz'), str(tmp_path / 'single' / 'edges.jsonl.gz'))
+    convert_compendium_to_kgx(compendium, *single)
+
+    monkeypatch.setattr(kgx, 'KGX_MIN_BYTES_PER_SHARD', 1000)
+    parallel = (str(tmp_path / 'parallel' / 'nodes.jsonl.gz'), str(tmp_path / 'parallel' / 'edges.jsonl.gz'))
+    convert_compendium_to_kgx(compendium, *parallel, workers=4)
+
+    # The parallel output is made of several gzip members, but should decompress to exactly the same content.
+    for single_filename, parallel_filename in zip(single, parallel):
+        with gzip.open(single_filename, 'rb') as single_file, gzip.open(parallel_filename, 'rb') as parallel_file:
+            assert single_file.read() == parallel_file.read()
+    assert sorted(p.name for p in (tmp_path / 'parallel').iterdir()) == ['edges.jsonl.gz', 'nodes.jsonl.gz']
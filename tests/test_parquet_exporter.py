@@ -0,0 +1,118 @@
+import gzip
+import os
+
+import duckdb
+import pyarrow.parquet as pq
+
+from src import json_codec
+from src.exporters.duckdb_exporters import export_synonyms_to_parquet
+from src.exporters.parquet import export_compendium_to_parquet
+
+
+def write_test_compendium(compendium):
+    with json_codec.JSONLWriter(compendium) as writer:
+        for i in range(25):
+            writer.write({
+                'type': 'biolink:Disease',
+                'ic': 100.0 if i % 2 == 0 else None,
+                'identifiers': [
+                    {'i': f'MONDO:{i:07d}', 'l': f'Disease {i}', 'd': [f'The disease numbered {i}.']},
+                    {'i': f'UMLS:C{i:07d}'},
+                ],
+                'preferred_name': f'Disease {i}',
+            })
+
+
+def test_export_compendium_to_parquet(tmp_path):
+    compendium = str(tmp_path / 'Disease.txt')
+    write_test_compendium(compendium)
+
+    clique_parquet = str(tmp_path / 'parquet' / 'filename=Disease' / 'Clique.parquet')
+    export_compendium_to_parquet(compendium, clique_parquet, row_group_size=10, compression='snappy')
+
+    parquet_dir = os.path.dirname(clique_parquet)
+    assert sorted(os.listdir(parquet_dir)) == ['Clique.parquet', 'Edge.parquet', 'Node.parquet']
+
+    cliques = pq.read_table(clique_parquet).to_pylist()
+    assert len(cliques) == 25
+    assert cliques[3] == {
+        'clique_leader': 'MONDO:0000003',
+        'preferred_name': 'Disease 3',
+        'clique_identifier_count': 2,
+        'biolink_type': 'biolink:Disease',
+        'information_content': None,
+    }
+    assert cliques[4]['information_content'] == 100.0
+
+    edge_file = pq.ParquetFile(os.path.join(parquet_dir, 'Edge.parquet'))
+    assert edge_file.metadata.num_rows == 50
+    assert edge_file.metadata.num_row_groups == 5
+    assert edge_file.read().to_pylist()[:2] == [
+        {'clique_leader': 'MONDO:0000000', 'curie': 'MONDO:0000000', 'conflation': 'None'},
+        {'clique_leader': 'MONDO:0000000', 'curie': 'UMLS:C0000000', 'conflation': 'None'},
+    ]
+
+    nodes = pq.read_table(os.path.join(parquet_dir, 'Node.parquet')).to_pylist()
+    assert nodes[2:4] == [
+        {'curie': 'MONDO:0000001', 'label': 'Disease 1', 'label_lc': 'disease 1', 'description': ['The disease numbered 1.']},
+        {'curie': 'UMLS:C0000001', 'label': None, 'label_lc': None, 'description': None},
+    ]
+
+
+def test_export_empty_compendium_to_parquet(tmp_path):
+    compendium = tmp_path / 'Empty.txt'
+    compendium.write_text('')
+    clique_parquet = str(tmp_path / 'parquet' / 'Clique.parquet')
+    export_compendium_to_parquet(str(compendium), clique_parquet, row_group_size=10, compression='snappy')
+    assert pq.read_table(clique_parquet).num_rows == 0
+    assert pq.read_table(str(tmp_path / 'parquet' / 'Node.parquet')).num_rows == 0
+
+
+def get_bloom_filter_columns(parquet_filename):
+    return set(column for column, in duckdb.sql(
+        "SELECT DISTINCT path_in_schema FROM parquet_metadata(?) WHERE bloom_filter_offset IS NOT NULL",
+        params=[parquet_filename]).fetchall())
+
+
+def test_export_sorted_compendium_to_parquet(tmp_path):
+    compendium = str(tmp_path / 'Disease.txt')
+    write_test_compendium(compendium)
+    clique_parquet = str(tmp_path / 'parquet' / 'Clique.parquet')
+    export_compendium_to_parquet(compendium, clique_parquet, row_group_size=10, compression='snappy', sorted_layout=True)
+
+    edge_parquet = str(tmp_path / 'parquet' / 'Edge.parquet')
+    edge_file = pq.ParquetFile(edge_parquet)
+    assert edge_file.metadata.num_row_groups == 5
+    assert edge_file.metadata.row_group(0).sorting_columns[0].column_index == 1
+    curies = edge_file.read().column('curie').to_pylist()
+    assert curies == sorted(curies)
+    assert len(curies) == 50
+
+    # Every row group should have min/max statistics for the CURIEs, and Bloom filters for the lookup columns.
+    first_row_group = edge_file.metadata.row_group(0).column(1).statistics
+    assert (first_row_group.min, first_row_group.max) == ('MONDO:0000000', 'MONDO:0000009')
+    assert get_bloom_filter_columns(edge_parquet) == {'curie', 'clique_leader'}
+
+    node_parquet = str(tmp_path / 'parquet' / 'Node.parquet')
+    assert get_bloom_filter_columns(node_parquet) == {'curie'}
+    assert duckdb.sql("SELECT label FROM read_parquet(?) WHERE curie = 'MONDO:0000012'", params=[node_parquet]).fetchall() == [('Disease 12',)]
+
+
+def test_export_sorted_synonyms_to_parquet(tmp_path):
+    synonyms = str(tmp_path / 'Disease.txt.gz')
+    with gzip.open(synonyms, 'wt') as outf:
+        for i in range(25, 0, -1):
+            outf.write(json_codec.dumps_line({
+                'curie': f'MONDO:{i:07d}',
+                'preferred_name': f'Disease {i}',
+                'names': [f'Disease {i}', f'DIS{i}'],
+                'types': ['Disease'],
+            }))
+
+    synonyms_parquet = str(tmp_path / 'Synonyms.parquet')
+    export_synonyms_to_parquet(synonyms, str(tmp_path / 'duckdbs' / 'synonyms.duckdb'), synonyms_parquet, sorted_layout=True)
+
+    labels = pq.read_table(synonyms_parquet).column('label_lc').to_pylist()
+    assert len(labels) == 50
+    assert labels == sorted(labels)
+    assert get_bloom_filter_columns(synonyms_parquet) == {'label_lc', 'clique_leader'}
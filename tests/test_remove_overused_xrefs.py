@@ -0,0 +1,47 @@
+import random
+from collections import defaultdict
+
+import pyarrow as pa
+import pytest
+
+from src.babel_utils import remove_overused_xrefs, remove_overused_xrefs_from_table
+
+
+def remove_overused_xrefs_with_dicts(pairlist, bothways=False):
+    """The original dictionary-based implementation of remove_overused_xrefs(), to check the vectorized one against."""
+    xref_counts_v = defaultdict(int)
+    xref_counts_k = defaultdict(int)
+    for k, v in pairlist:
+        xref_counts_v[v] += 1
+        xref_counts_k[k] += 1
+    return [(k, v) for k, v in pairlist if xref_counts_v[v] < 2 and (not bothways or xref_counts_k[k] < 2)]
+
+
+def test_remove_overused_xrefs():
+    pairs = [('UBERON:1', 'UMLS:1'), ('UBERON:2', 'UMLS:1'), ('UBERON:3', 'UMLS:2'), ('UBERON:3', 'UMLS:3')]
+    assert remove_overused_xrefs(pairs) == [('UBERON:3', 'UMLS:2'), ('UBERON:3', 'UMLS:3')]
+    assert remove_overused_xrefs(pairs, bothways=True) == []
+    assert remove_overused_xrefs([]) == []
+
+
+@pytest.mark.parametrize("bothways", [False, True])
+def test_remove_overused_xrefs_parity(bothways):
+    rng = random.Random(1234)
+    pairs = [[f"A:{rng.randint(0, 3000)}", f"B:{rng.randint(0, 3000)}"] for _ in range(5000)]
+    assert remove_overused_xrefs(pairs, bothways=bothways) == remove_overused_xrefs_with_dicts(pairs, bothways=bothways)
+
+
+@pytest.mark.parametrize("bothways", [False, True])
+def test_remove_overused_xrefs_from_table(bothways):
+    rng = random.Random(1234)
+    pairs = [(f"A:{rng.randint(0, 3000)}", f"B:{rng.randint(0, 3000)}") for _ in range(5000)]
+    # Split the table into several chunks, as it would be if it was read in batches.
+    table = pa.Table.from_batches([
+        pa.record_batch([pa.array([subject for subject, _ in chunk]), pa.array([obj for _, obj in chunk])],
+                        names=['subject', 'object'])
+        for chunk in [pairs[:1000], pairs[1000:3500], pairs[3500:]]
+    ])
+    result = remove_overused_xrefs_from_table(table, bothways=bothways)
+    assert list(zip(result.column('subject').to_pylist(), result.column('object').to_pylist())) == \
+        remove_overused_xrefs_with_dicts(pairs, bothways=bothways)
+    assert remove_overused_xrefs_from_table(table.slice(0, 0)).num_rows == 0
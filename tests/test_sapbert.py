@@ -0,0 +1,62 @@
+import gzip
+from itertools import combinations
+
+from src import json_codec
+from src.exporters import sapbert
+from src.exporters.sapbert import MAX_SYNONYM_PAIRS, convert_synonyms_to_sapbert, sample_name_pairs, unrank_pair
+
+
+def write_test_synonyms(filename, count_entries=300):
+    with gzip.open(filename, 'wt', encoding='utf-8') as outf:
+        for i in range(count_entries):
+            names = [f'Name {i}-{j}' for j in range(i % 40)]
+            outf.write(json_codec.dumps_line({
+                'curie': f'MONDO:{i:07d}',
+                'preferred_name': f'Disease {i}',
+                'names': names,
+                'types': ['Disease'],
+            }))
+
+
+def read_lines_gz(filename):
+    with gzip.open(filename, 'rt', encoding='utf-8') as inf:
+        return inf.readlines()
+
+
+def test_unrank_pair():
+    for n in [2, 3, 10, 37]:
+        assert [unrank_pair(index, n) for index in range(n * (n - 1) // 2)] == list(combinations(range(n), 2))
+
+
+def test_sample_name_pairs():
+    # With few enough names, we should get every pair, ignoring duplicates.
+    assert sample_name_pairs('MONDO:1', ['a', 'b', 'a', 'c']) == [('a', 'b'), ('a', 'c'), ('b', 'c')]
+
+    names = [f'name {index}' for index in range(5000)]
+    pairs = sample_name_pairs('MONDO:2', names)
+    assert len(pairs) == MAX_SYNONYM_PAIRS
+    assert len(set(pairs)) == MAX_SYNONYM_PAIRS
+    assert all(name1 != name2 for name1, name2 in pairs)
+
+    # The sample only depends on the CURIE and the names.
+    assert sample_name_pairs('MONDO:2', names) == pairs
+    assert sample_name_pairs('MONDO:3', names) != pairs
+
+
+def test_convert_synonyms_to_sapbert_in_parallel(tmp_path, monkeypatch):
+    synonyms = str(tmp_path / 'Disease.txt.gz')
+    write_test_synonyms(synonyms)
+
+    single = str(tmp_path / 'single' / 'Disease.txt.gz')
+    convert_synonyms_to_sapbert(synonyms, single)
+    lines = read_lines_gz(single)
+    assert lines[0] == 'biolink:Disease||MONDO:0000000||Disease 0||disease 0||disease 0\n'
+    assert lines[1] == 'biolink:Disease||MONDO:0000001||Disease 1||disease 1||name 1-0\n'
+    assert len(lines) == sum(1 if i % 40 < 2 else min(MAX_SYNONYM_PAIRS, (i % 40) * (i % 40 - 1) // 2)
+                             for i in range(300))
+
+    # Converting in chunks on several workers should give exactly the same output.
+    monkeypatch.setattr(sapbert, 'SAPBERT_CHUNK_LINES', 7)
+    parallel = str(tmp_path / 'parallel' / 'Disease.txt.gz')
+    convert_synonyms_to_sapbert(synonyms, parallel, workers=3)
+    assert read_lines_gz(parallel) == lines
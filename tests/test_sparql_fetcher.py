@@ -0,0 +1,231 @@
+import json
+import re
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src import sparql_fetcher
+from src.datahandlers import obo
+from src.sparql_fetcher import PagedSPARQLFetcher, SPARQLFetchError, get_iri_partitions
+from src.triplestore import parse_tsv_term
+from src.ubergraph import UberGraph, build_sets
+from src.util import get_config
+
+pyoxigraph = pytest.importorskip('pyoxigraph')
+
+ONTOLOGY_GRAPH = 'http://reasoner.renci.org/ontology'
+LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+EXACT_SYNONYM = 'http://www.geneontology.org/formats/oboInOwl#hasExactSynonym'
+OWL_CLASS = 'http://www.w3.org/2002/07/owl#Class'
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+NIC = 'http://reasoner.renci.org/vocab/normalizedInformationContent'
+REDUNDANT_GRAPH = 'http://reasoner.renci.org/redundant'
+SUBCLASS_OF = 'http://www.w3.org/2000/01/rdf-schema#subClassOf'
+DBXREF = 'http://www.geneontology.org/formats/oboInOwl#hasDbXref'
+
+
+def make_store():
+    store = pyoxigraph.Store()
+    graph = pyoxigraph.NamedNode(ONTOLOGY_GRAPH)
+
+    def add(subject, predicate, obj):
+        store.add(pyoxigraph.Quad(pyoxigraph.NamedNode(subject), pyoxigraph.NamedNode(predicate), obj, graph))
+
+    for ontology in ['GO', 'HP', 'MONDO']:
+        for index in range(25):
+            iri = f'http://purl.obolibrary.org/obo/{ontology}_{index:07d}'
+            add(iri, RDF_TYPE, pyoxigraph.NamedNode(OWL_CLASS))
+            add(iri, LABEL, pyoxigraph.Literal(f'{ontology} term {index}'))
+            if index % 3 == 0:
+                add(iri, LABEL, pyoxigraph.Literal(f'{ontology} "alternative" term {index}'))
+                add(iri, EXACT_SYNONYM, pyoxigraph.Literal(f'{ontology} synonym {index}'))
+            add(iri, NIC, pyoxigraph.Literal(str(50 + index)))
+            # Every GO term is a subclass of GO:0000000, and has an xref to a (made-up) UBERON term.
+            if ontology == 'GO':
+                store.add(pyoxigraph.Quad(pyoxigraph.NamedNode(iri), pyoxigraph.NamedNode(SUBCLASS_OF),
+                                          pyoxigraph.NamedNode('http://purl.obolibrary.org/obo/GO_0000000'),
+                                          pyoxigraph.NamedNode(REDUNDANT_GRAPH)))
+                add(iri, DBXREF, pyoxigraph.Literal(f'UBERON:{index:07d}'))
+    # A label with characters that need to be escaped in TSV results.
+    add('http://purl.obolibrary.org/obo/GO_0000001', LABEL, pyoxigraph.Literal('tab\there, "quotes",\nand ü', language='en'))
+    # A label outside the OBO ontologies, and one on a blank node, which should be ignored.
+    add('http://example.org/thing', LABEL, pyoxigraph.Literal('An example thing'))
+    store.add(pyoxigraph.Quad(pyoxigraph.BlankNode(), pyoxigraph.NamedNode(LABEL), pyoxigraph.Literal('blank'), graph))
+    return store
+
+
+# A local stand-in for a SPARQL endpoint, backed by an in-memory pyoxigraph store. It can be told to fail the next few
+# requests. Like UberGraph, it lets queries use GRAPH clauses alongside FROM, so it ignores FROM and queries the union of
+# all the graphs. It returns TSV results if they are asked for, and JSON otherwise.
+class SPARQLRequestHandler(BaseHTTPRequestHandler):
+    store = None
+    queries = []
+    fail_next = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.answer(urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)['query'][0])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        if self.headers.get('Content-Type', '').startswith('application/sparql-query'):
+            self.answer(body)
+        else:
+            self.answer(urllib.parse.parse_qs(body)['query'][0])
+
+    def answer(self, query):
+        with self.lock:
+            self.queries.append(query)
+            fail = type(self).fail_next > 0
+            if fail:
+                type(self).fail_next -= 1
+        if fail:
+            self.send_error(503)
+            return
+        query = re.sub(r'(?im)^\s*from\s+<[^>]*>\s*$', '', query)
+        results = self.store.query(query, use_default_graph_as_union=True)
+        if 'text/tab-separated-values' in self.headers.get('Accept', ''):
+            content_type, results_format = 'text/tab-separated-values', pyoxigraph.QueryResultsFormat.TSV
+        else:
+            content_type, results_format = 'application/sparql-results+json', pyoxigraph.QueryResultsFormat.JSON
+        body = results.serialize(format=results_format)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextmanager
+def sparql_server(store):
+    handler = type('TestSPARQLRequestHandler', (SPARQLRequestHandler,), {'store': store, 'queries': []})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/sparql", handler
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def ubergraph(monkeypatch, tmp_path):
+    monkeypatch.setattr(sparql_fetcher, 'SPARQL_RETRY_DELAY', 0)
+    monkeypatch.setattr(UberGraph, 'QUERY_BATCH_SIZE', 4)
+    monkeypatch.setitem(get_config(), 'ubergraph_ontologies', ['GO', 'HP', 'MONDO'])
+    monkeypatch.setitem(get_config(), 'ubergraph_workers', 3)
+    monkeypatch.setitem(get_config(), 'tmp_directory', str(tmp_path / 'tmp'))
+    with sparql_server(make_store()) as (endpoint, handler):
+        monkeypatch.setattr(UberGraph, 'SPARQL_ENDPOINT', endpoint)
+        yield handler
+
+
+def test_get_iri_partitions():
+    assert get_iri_partitions([]) == [('', None)]
+    assert get_iri_partitions(['http://b/', 'http://a/', 'http://b/']) == [
+        ('', 'http://a/'), ('http://a/', 'http://b/'), ('http://b/', None)]
+
+
+def test_paged_fetcher(ubergraph, tmp_path):
+    labels_file = str(tmp_path / 'labels.jsonl')
+    count = UberGraph().write_all_labels(labels_file)
+    with open(labels_file) as inf:
+        labels = [json.loads(line) for line in inf]
+
+    assert count == len(labels) == 3 * (25 + 9) + 2
+    # IRIs are sorted before they are converted into CURIEs.
+    assert labels[:5] == [
+        {'iri': 'http://example.org/thing', 'label': 'An example thing'},
+        {'iri': 'GO:0000000', 'label': 'GO "alternative" term 0'},
+        {'iri': 'GO:0000000', 'label': 'GO term 0'},
+        {'iri': 'GO:0000001', 'label': 'GO term 1'},
+        {'iri': 'GO:0000001', 'label': 'tab\there, "quotes",\nand ü'},
+    ]
+    assert labels[-1] == {'iri': 'MONDO:0000024', 'label': 'MONDO term 24'}
+    # The labels should be sorted by IRI, and only written once.
+    assert sorted(labels[1:], key=lambda unit: (unit['iri'], unit['label'])) == labels[1:]
+    assert len({(unit['iri'], unit['label']) for unit in labels}) == len(labels)
+
+    # Every partition is paged through with keyset pagination, not OFFSET.
+    assert not any('offset' in query.lower() for query in ubergraph.queries)
+    assert any('> "http://purl.obolibrary.org/obo/GO_0000003"' in query for query in ubergraph.queries)
+
+    # The result should be the same however many workers we use.
+    fetcher = PagedSPARQLFetcher(UberGraph.SPARQL_ENDPOINT, page_size=100, workers=1)
+    uber = UberGraph()
+    uber.fetcher = fetcher
+    uber.write_all_labels(str(tmp_path / 'labels-single.jsonl'))
+    with open(str(tmp_path / 'labels-single.jsonl')) as inf:
+        assert [json.loads(line) for line in inf] == labels
+
+
+def test_paged_fetcher_retries(ubergraph, tmp_path):
+    ubergraph.fail_next = 2
+    filename = str(tmp_path / 'icRDF.tsv')
+    assert UberGraph().write_normalized_information_content(filename) == 75
+    with open(filename) as inf:
+        assert inf.readline() == 'http://purl.obolibrary.org/obo/GO_0000000\t50\n'
+
+    ubergraph.fail_next = 100
+    fetcher = PagedSPARQLFetcher(UberGraph.SPARQL_ENDPOINT, page_size=10, workers=2, retries=1)
+    with pytest.raises(SPARQLFetchError):
+        fetcher.fetch_to_file('SELECT ?iri WHERE { ?iri ?p ?o . $page_filter } LIMIT $page_size', 'iri', ['iri'],
+                              lambda row: row['iri'] + '\n', str(tmp_path / 'failed.txt'))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['icRDF.tsv']
+
+
+def test_pull_uber_synonyms_and_labels(ubergraph, tmp_path):
+    synonyms_file = str(tmp_path / 'synonyms.jsonl')
+    obo.pull_uber_synonyms(synonyms_file, [])
+    with open(synonyms_file) as inf:
+        synonyms = [json.loads(line) for line in inf]
+    assert len(synonyms) == 3 * 9
+    assert synonyms[0] == {'curie': 'GO:0000000', 'predicate': EXACT_SYNONYM, 'synonym': 'GO synonym 0'}
+
+    labels_file = str(tmp_path / 'labels')
+    obo.pull_uber_labels(labels_file, [str(tmp_path / 'HP' / 'labels')])
+    with open(tmp_path / 'HP' / 'labels') as inf:
+        hp_labels = inf.readlines()
+    assert len(hp_labels) == 25 + 9
+    assert hp_labels[1] == 'HP:0000000\tHP term 0\n'
+
+
+def test_parse_tsv_term():
+    assert parse_tsv_term('<http://purl.obolibrary.org/obo/GO_0000001>') == 'http://purl.obolibrary.org/obo/GO_0000001'
+    assert parse_tsv_term('"tab\\there \\"quoted\\" \\u00FC"@en') == 'tab\there "quoted" ü'
+    assert parse_tsv_term('"5"^^<http://www.w3.org/2001/XMLSchema#string>') == '5'
+    assert parse_tsv_term('42') == '42'
+    assert parse_tsv_term('_:b0') == 'b0'
+    assert parse_tsv_term('') is None
+
+
+def test_stream_subclasses(ubergraph, tmp_path):
+    uber = UberGraph()
+    rows = uber.stream_subclasses_of('GO:0000000')
+    assert not isinstance(rows, list)
+    subclasses = list(rows)
+    assert uber.get_subclasses_of('GO:0000000') == subclasses
+    # One row for every label of every subclass, which come through the TSV results intact.
+    assert len(subclasses) == 25 + 9 + 1
+    assert len({row['descendent'] for row in subclasses}) == 25
+    assert {row['descendentLabel'] for row in subclasses if row['descendent'] == 'GO:0000001'} == {
+        'GO term 1', 'tab\there, "quotes",\nand ü'}
+
+    xrefs = uber.get_subclasses_and_xrefs('GO:0000000')
+    assert xrefs['GO:0000003'] == {'UBERON:0000003'}
+
+    concords = tmp_path / 'concords'
+    with open(concords, 'w') as outf:
+        build_sets('GO:0000000', {'GO': outf}, 'xref', ignore_list=['UBERON'])
+        build_sets('GO:0000000', {'GO': outf}, 'xref')
+    with open(concords) as inf:
+        lines = inf.readlines()
+    assert len(lines) == 25
+    assert 'GO:0000003\txref\tUBERON:0000003\n' in lines
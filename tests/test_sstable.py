@@ -0,0 +1,76 @@
+import os
+import random
+
+from src.sstable import SortedStringTable
+
+
+def write_tsv(filename, lines):
+    with open(filename, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def test_sstable_lookups(tmp_path):
+    """Lookups should return every line for a key in file order, including keys that span sparse index blocks."""
+    rng = random.Random(42)
+    lines = []
+    expected = {}
+    for i in range(5000):
+        key = f"UniProtKB:P{rng.randint(0, 999):05d}"
+        line = f"{key}\tlabel {i}\textra"
+        lines.append(line)
+        expected.setdefault(key, []).append(line)
+    # Many lines with the same key, so that they cover several blocks of the sparse index.
+    for i in range(300):
+        line = f"UniProtKB:P00500\tduplicate {i}"
+        lines.append(line)
+        expected.setdefault("UniProtKB:P00500", []).append(line)
+    lines.append("  ")
+    lines.append("NOTAB")
+    expected["NOTAB"] = ["NOTAB"]
+
+    tsv = str(tmp_path / 'labels')
+    write_tsv(tsv, lines)
+    table = SortedStringTable(tsv)
+    assert table.record_count == len(lines) - 1
+    for key, key_lines in expected.items():
+        assert table.get(key) == key_lines
+    assert table.get("UniProtKB:P99999") == []
+    assert table.get("AAA:1") == []
+    assert table.get("ZZZ:1") == []
+    assert table.get_many(["UniProtKB:P00500", "UniProtKB:Q1"]) == {
+        "UniProtKB:P00500": expected["UniProtKB:P00500"],
+        "UniProtKB:Q1": [],
+    }
+    table.close()
+
+    # Reopening the table shouldn't rebuild it, but changing the TSV file should.
+    mtime = os.path.getmtime(tsv + '.sst')
+    assert SortedStringTable(tsv).get("NOTAB") == ["NOTAB"]
+    assert os.path.getmtime(tsv + '.sst') == mtime
+    write_tsv(tsv, ["CHEBI:15377\twater", "CHEBI:15377\tdihydrogen oxide"])
+    table = SortedStringTable(tsv)
+    assert table.get("CHEBI:15377") == ["CHEBI:15377\twater", "CHEBI:15377\tdihydrogen oxide"]
+    assert table.get("NOTAB") == []
+
+
+def test_sstable_empty(tmp_path):
+    tsv = str(tmp_path / 'descriptions')
+    write_tsv(tsv, [])
+    table = SortedStringTable(tsv)
+    assert table.get("CHEBI:1") == []
+
+
+def test_sstable_iter_prefix(tmp_path):
+    """Prefix scans should return every line whose key starts with the prefix, in sorted order."""
+    lines = [f"UMLS:C{i:07d}\tlabel {i}" for i in range(500, 0, -1)]
+    lines += [f"MESH:D{i:06d}\tlabel {i}" for i in range(500)]
+    lines += ["UMLSX:1\tnot UMLS", "NCIT:C1\tlabel"]
+
+    tsv = str(tmp_path / 'labels')
+    write_tsv(tsv, lines)
+    table = SortedStringTable(tsv)
+    assert list(table.iter_prefix('UMLS:')) == sorted(line for line in lines if line.startswith('UMLS:'))
+    assert len(list(table.iter_prefix('MESH:D0001'))) == 100
+    assert list(table.iter_prefix('HP:')) == []
+    assert list(table.iter_prefix('ZZZ:')) == []
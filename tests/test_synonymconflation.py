@@ -0,0 +1,67 @@
+import gzip
+import json
+
+from src.synonyms import synonymconflation
+
+
+def write_jsonl(filename, records, opener=open):
+    with opener(filename, 'wt') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def test_conflate_synonyms(tmp_path, monkeypatch):
+    """Conflated synonyms should be merged in conflation order and written after the unconflated ones, in the order
+    in which each conflated clique was first seen, even when they are spread over several partitions."""
+    monkeypatch.setattr(synonymconflation, 'SYNONYM_CONFLATION_GROUPS_PER_PARTITION', 1)
+
+    compendium = str(tmp_path / 'compendium.txt')
+    write_jsonl(compendium, [
+        {'type': 'biolink:SmallMolecule', 'identifiers': [{'i': 'CHEBI:1'}, {'i': 'PUBCHEM.COMPOUND:1'}]},
+        {'type': 'biolink:SmallMolecule', 'identifiers': [{'i': 'CHEBI:2'}]},
+    ])
+    conflation = str(tmp_path / 'conflation.txt')
+    write_jsonl(conflation, [['RXCUI:10', 'CHEBI:2'], ['CHEBI:1', 'RXCUI:20']])
+
+    def synonym(curie, names, types, taxa=[]):
+        return {'curie': curie, 'names': names, 'types': types, 'preferred_name': names[0],
+                'shortest_name_length': min(map(len, names)), 'clique_identifier_count': 1, 'taxa': taxa}
+
+    synonyms_gz = str(tmp_path / 'synonyms.txt.gz')
+    write_jsonl(synonyms_gz, [
+        synonym('CHEBI:2', ['water', 'H2O'], ['SmallMolecule']),
+        synonym('CHEBI:3', ['salt'], ['SmallMolecule']),
+        synonym('CHEBI:1', ['aspirin'], ['SmallMolecule', 'OntologyClass'], ['NCBITaxon:9606']),
+        synonym('RXCUI:20', ['aspirin 81 mg', 'aspirin'], ['Drug']),
+        synonym('RXCUI:10', ['drinking water'], ['Drug']),
+    ], opener=gzip.open)
+
+    output_gz = str(tmp_path / 'output.txt.gz')
+    synonymconflation.conflate_synonyms([synonyms_gz], [compendium], [conflation], output_gz)
+    with gzip.open(output_gz, 'rt') as f:
+        output = [json.loads(line) for line in f]
+
+    assert output == [
+        synonym('CHEBI:3', ['salt'], ['SmallMolecule']),
+        {'curie': 'RXCUI:10', 'names': ['drinking water', 'water', 'H2O'], 'types': ['Drug', 'SmallMolecule'],
+         'preferred_name': 'drinking water', 'shortest_name_length': 3, 'clique_identifier_count': 2, 'taxa': [],
+         'curie_suffix': 10},
+        {'curie': 'CHEBI:1', 'names': ['aspirin', 'aspirin 81 mg'], 'types': ['SmallMolecule', 'Drug'],
+         'preferred_name': 'aspirin', 'shortest_name_length': 7, 'clique_identifier_count': 2,
+         'taxa': ['NCBITaxon:9606'], 'curie_suffix': 1},
+    ]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['compendium.txt', 'conflation.txt', 'output.txt.gz', 'synonyms.txt.gz']
+
+
+def test_large_conflation_group():
+    """A single large conflation group should be conflated in conflation order (not arrival order)."""
+    size = 10_000
+    group = synonymconflation.ConflatedSynonymGroup('RXCUI:0')
+    for i in reversed(range(size)):
+        group.add({'curie': f'RXCUI:{i}', 'names': [f'drug {i}', 'drug'], 'types': ['Drug'], 'shortest_name_length': 4,
+                   'clique_identifier_count': 2, 'taxa': []})
+    conflated = group.conflate([f'RXCUI:{i}' for i in range(size)], {})
+    assert conflated['curie'] == 'RXCUI:0'
+    assert conflated['names'] == ['drug 0', 'drug'] + [f'drug {i}' for i in range(1, size)]
+    assert conflated['types'] == ['Drug']
+    assert conflated['clique_identifier_count'] == 2 * size
@@ -0,0 +1,68 @@
+import os
+
+from src.node import TaxonFactory, TSVSQLiteLoader
+import src.node
+
+
+def write_taxa(rootdir, prefix, rows):
+    os.makedirs(os.path.join(rootdir, prefix), exist_ok=True)
+    with open(os.path.join(rootdir, prefix, 'taxa'), 'w') as f:
+        for curie, taxon in rows:
+            f.write(f"{curie}\t{taxon}\n")
+
+
+def test_get_curies_batched(tmp_path, monkeypatch):
+    """get_curies() should return the same results whether or not the CURIEs need several batches."""
+    rootdir = str(tmp_path)
+    rows = [(f"UniProtKB:P{i}", f"NCBITaxon:{i % 7}") for i in range(100)] + [("UniProtKB:P1", "NCBITaxon:9606")]
+    write_taxa(rootdir, 'UniProtKB', rows)
+    monkeypatch.setattr(src.node, 'TSVSQLITELOADER_QUERY_BATCH_SIZE', 8)
+
+    loader = TSVSQLiteLoader(rootdir, 'taxa', 'curie-curie')
+    query = [f"UniProtKB:P{i}" for i in range(0, 120, 3)] + ["UniProtKB:p1", "UniProtKB:P1", "MONDO:1"]
+    results = loader.get_curies(query)
+    assert set(results.keys()) == set(query)
+    assert results["UniProtKB:P1"] == {"NCBITaxon:1", "NCBITaxon:9606"}
+    assert results["UniProtKB:p1"] == {"NCBITaxon:1", "NCBITaxon:9606"}
+    assert results["UniProtKB:P9"] == {"NCBITaxon:2"}
+    assert results["UniProtKB:P111"] == set()
+    assert results["MONDO:1"] == set()
+    loader.close()
+
+
+def test_prefetch_taxa(tmp_path):
+    rootdir = str(tmp_path)
+    write_taxa(rootdir, 'NCBIGene', [("NCBIGene:1", "NCBITaxon:9606"), ("NCBIGene:2", "NCBITaxon:10090")])
+    taxon_factory = TaxonFactory(rootdir)
+    taxon_factory.prefetch_taxa(["NCBIGene:1", "NCBIGene:3"])
+    assert taxon_factory.get_taxa(["NCBIGene:1", "NCBIGene:2", "NCBIGene:3"]) == {
+        "NCBIGene:1": {"NCBITaxon:9606"},
+        "NCBIGene:2": {"NCBITaxon:10090"},
+        "NCBIGene:3": set(),
+    }
+    taxon_factory.close()
+
+
+def test_persistent_sqlite(tmp_path):
+    """The SQLite database should be reused by later loaders and rebuilt when the TSV file changes."""
+    rootdir = str(tmp_path)
+    write_taxa(rootdir, 'NCBIGene', [("NCBIGene:1", "NCBITaxon:9606")])
+    sqlite_filename = os.path.join(rootdir, 'NCBIGene', 'taxa.sqlite')
+
+    loader = TSVSQLiteLoader(rootdir, 'taxa', 'curie-curie')
+    assert loader.get_curies(["NCBIGene:1"]) == {"NCBIGene:1": {"NCBITaxon:9606"}}
+    loader.close()
+    mtime = os.path.getmtime(sqlite_filename)
+
+    loader = TSVSQLiteLoader(rootdir, 'taxa', 'curie-curie')
+    assert loader.get_curies(["NCBIGene:1"]) == {"NCBIGene:1": {"NCBITaxon:9606"}}
+    loader.close()
+    assert os.path.getmtime(sqlite_filename) == mtime
+
+    write_taxa(rootdir, 'NCBIGene', [("NCBIGene:1", "NCBITaxon:10090"), ("NCBIGene:2", "NCBITaxon:9606")])
+    loader = TSVSQLiteLoader(rootdir, 'taxa', 'curie-curie')
+    assert loader.get_curies(["NCBIGene:1", "NCBIGene:2"]) == {
+        "NCBIGene:1": {"NCBITaxon:10090"},
+        "NCBIGene:2": {"NCBITaxon:9606"},
+    }
+    loader.close()
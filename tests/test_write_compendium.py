@@ -0,0 +1,98 @@
+import os
+from collections import defaultdict
+
+import curies
+import pytest
+
+import src.node
+from src import babel_utils
+
+
+def test_factories_are_set_up_once_per_worker(tmp_path, monkeypatch):
+    """Every worker process should set up its factories once, and reuse them for every shard it writes."""
+    def make_compendium_factories(icrdf_filename):
+        return {'pid': os.getpid(), 'icrdf_filename': icrdf_filename}
+
+    def write_compendium_cliques(synonym_list, ofname, compendium_filename, synonyms_filename, node_type, labels,
+                                 extra_prefixes, icrdf_filename, property_list, shard_description='', factories=None):
+        for filename in [compendium_filename, synonyms_filename]:
+            with open(filename, 'w') as outf:
+                outf.writelines(f"{clique[0]}\n" for clique in synonym_list)
+        # Report the factories we were given through the property source counts.
+        return {'cliques': len(synonym_list), 'eq_ids': 0, 'synonyms': 0,
+                'property_sources': {(factories['pid'], id(factories), os.getpid()): 1}}
+
+    monkeypatch.setattr(babel_utils, 'make_compendium_factories', make_compendium_factories)
+    monkeypatch.setattr(babel_utils, 'write_compendium_cliques', write_compendium_cliques)
+    monkeypatch.setattr(babel_utils, 'WRITE_COMPENDIUM_SHARDS_PER_WORKER', 5)
+
+    cliques = [[f"TEST:{i}"] for i in range(100)]
+    compendium = str(tmp_path / 'Test.txt')
+    synonyms = str(tmp_path / 'Test.synonyms.txt')
+    counts = babel_utils.write_compendium_in_parallel(2, cliques, 'Test.txt', compendium, synonyms, 'biolink:Test',
+                                                      {}, [], 'icRDF.tsv', None)
+
+    assert counts['cliques'] == 100
+    with open(compendium) as inf:
+        assert inf.read().splitlines() == [clique[0] for clique in cliques]
+
+    # Every shard was written with factories that were set up in the worker process that wrote it, and each worker
+    # only set up one set of factories.
+    factories_by_worker = defaultdict(set)
+    for (factories_pid, factories_id, worker_pid), count in counts['property_sources'].items():
+        assert factories_pid == worker_pid != os.getpid()
+        factories_by_worker[worker_pid].add(factories_id)
+    assert sum(counts['property_sources'].values()) == 10
+    assert all(len(factories) == 1 for factories in factories_by_worker.values())
+
+
+def test_parallel_output_matches_serial_output(tmp_path, monkeypatch):
+    """Writing a compendium with several workers should produce exactly the same files as writing it with one."""
+    schema = None
+    try:
+        import biolink_model
+        schema = os.path.join(list(biolink_model.__path__)[0], 'schema', 'biolink_model.yaml')
+    except ImportError:
+        pass
+    if schema is None or not os.path.exists(schema):
+        pytest.skip("The biolink_model package (with its schema) is needed to set up a NodeFactory offline.")
+    from bmt import Toolkit
+    toolkit = Toolkit(schema, predicate_map={'predicate mappings': []})
+    monkeypatch.setattr(src.node, 'get_biolink_model_toolkit', lambda biolink_version: toolkit)
+    monkeypatch.setattr(src.node, 'get_biolink_prefix_map', lambda: curies.Converter.from_prefix_map({
+        'CHEBI': 'http://purl.obolibrary.org/obo/CHEBI_',
+    }))
+
+    download_dir = tmp_path / 'downloads'
+    (download_dir / 'CHEBI').mkdir(parents=True)
+    cliques = [[f"CHEBI:{i}", f"PUBCHEM.COMPOUND:{i}"] for i in range(1, 201)]
+    with open(download_dir / 'CHEBI' / 'labels', 'w') as outf:
+        outf.writelines(f"CHEBI:{i}\tchemical {i}\n" for i in range(1, 201))
+    with open(download_dir / 'CHEBI' / 'synonyms', 'w') as outf:
+        outf.writelines(f"CHEBI:{i}\toboInOwl:hasExactSynonym\tsynonym {i}\n" for i in range(1, 201, 3))
+    with open(download_dir / 'CHEBI' / 'descriptions', 'w') as outf:
+        outf.writelines(f"CHEBI:{i}\tThe description of chemical {i}.\n" for i in range(1, 201, 7))
+    with open(download_dir / 'CHEBI' / 'taxa', 'w') as outf:
+        outf.writelines(f"CHEBI:{i}\tNCBITaxon:9606\n" for i in range(1, 201, 11))
+    icrdf = tmp_path / 'icRDF.tsv'
+    icrdf.write_text("".join(f"http://purl.obolibrary.org/obo/CHEBI_{i}\t{i / 4}\n" for i in range(1, 201, 5)))
+
+    config = babel_utils.get_config()
+    monkeypatch.setitem(config, 'download_directory', str(download_dir))
+    monkeypatch.setitem(config, 'common', {'labels': [], 'synonyms': [], 'descriptions': []})
+    # Make sure that the parallel run is actually split into several shards.
+    monkeypatch.setattr(babel_utils, 'WRITE_COMPENDIUM_MIN_CLIQUES_PER_SHARD', 10)
+
+    outputs = {}
+    for workers in [1, 2]:
+        output_dir = tmp_path / f'output-{workers}'
+        monkeypatch.setitem(config, 'output_directory', str(output_dir))
+        babel_utils.write_compendium([], cliques, 'Test.txt', 'biolink:SmallMolecule', {},
+                                     icrdf_filename=str(icrdf), workers=workers)
+        outputs[workers] = {
+            name: (output_dir / name / 'Test.txt').read_bytes() for name in ['compendia', 'synonyms']
+        }
+
+    assert outputs[1]['compendia'].count(b'\n') == len(cliques)
+    assert b'synonym 1' in outputs[1]['synonyms']
+    assert outputs[2] == outputs[1]